@@ -22,19 +22,38 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
-from ctypes import cdll, c_int, c_char_p, c_ushort, c_void_p, CFUNCTYPE, \
-  POINTER, pointer, Structure, Union, byref, c_size_t
+from ctypes import CDLL, c_int, c_char_p, c_ushort, c_void_p, CFUNCTYPE, \
+  POINTER, pointer, Structure, Union, byref, c_size_t, c_uint, c_uint64, \
+  create_string_buffer, c_ssize_t, pythonapi, py_object, c_char, get_errno
 
+from asyncio import get_running_loop
+from importlib import import_module
+from itertools import count
+from os import environ, strerror
 from sysconfig import get_config_var
+from traceback import print_exc
 from site import getsitepackages
 from pathlib import Path
 from os.path import abspath, dirname, join as path_join
 
 from .env import LAP_MOD_NAME
+from .IOStats import IOStats, ProxyStats, LatencyHist, ProxyHists, \
+  ResolverStats, ConnectInfo, ShapingStats, MemStats, DgramStats, SockOpts, \
+  SOCKOPT_PROFILES, Timeouts, ExpiryStats, PoolStats
 
 AP_DEST_HOST = 0
 AP_DEST_FD = 1
 
+AP_DIR_I2O = 0
+AP_DIR_O2I = 1
+
+AP_FLAG_BUF_ADAPTIVE = 0x1
+AP_FLAG_RESOLVE_ASYNC = 0x2
+AP_FLAG_DGRAM = 0x4
+
+# Default ids for the tapped proxies
+_tap_ids = count(1)
+
 class _DestStruct(Structure):
     _fields_ = [
         ("dest", c_char_p),
@@ -50,41 +69,232 @@ class _AnonUnion(Union):
         ("out_fd", c_int),
     ]
 
+class asp_sockopts(Structure):
+    # Bit n of the mask is set for the n-th field of SockOpts
+    _fields_ = [
+        ("mask", c_uint),
+        ("nodelay", c_int),
+        ("sndbuf", c_int),
+        ("rcvbuf", c_int),
+        ("notsent_lowat", c_int),
+        ("quickack", c_int),
+        ("keepalive", c_int),
+        ("tos", c_int),
+    ]
+
+    @staticmethod
+    def frompy(opts):
+        # SockOpts (or anything SockOpts.get() takes) as a (mask, *values)
+        # tuple, the way _libasyncproxy.Proxy takes it
+        so = SockOpts.get(opts)
+        mask = sum(1 << i for i, v in enumerate(so) if v is not None)
+        return (mask, *(int(v) if v is not None else 0 for v in so))
+
+    def topy(self):
+        return SockOpts(*(getattr(self, f) if self.mask & (1 << i) else None
+                          for i, f in enumerate(SockOpts._fields)))
+
 class asyncproxy_ctor_args(Structure):
     _anonymous_ = ("_anon_union",)
     _fields_ = [
         ("fd", c_int),
         ("dest_type", c_int),
         ("_anon_union", _AnonUnion),
+        ("bufsize", c_size_t),
+        ("flags", c_uint),
+        ("connect_timeout", c_uint),
+        ("dgram_idle", c_uint),
+        ("sockopts", asp_sockopts),
     ]
 
+class asyncproxy_conninfo(Structure):
+    _fields_ = [
+        ("addr", c_char * 46),
+        ("port", c_ushort),
+        ("af", c_int),
+        ("nattempts", c_int),
+        ("connect_ns", c_uint64),
+    ]
+
+    def topy(self):
+        return ConnectInfo(self.addr.decode(), self.port, self.af,
+                           self.nattempts, self.connect_ns / 1e9)
+
 class transform_res(Structure):
     _fields_ = [
         ("buf", c_void_p),
         ("len", c_size_t),
     ]
 
+class asp_iostats_uni(Structure):
+    _fields_ = [
+        ("nops", c_uint64),
+        ("btotal", c_uint64),
+    ]
+
+    def topy(self):
+        return IOStats(self.nops, self.btotal)
+
+class asp_iostats_bi(Structure):
+    _fields_ = [
+        ("in_", asp_iostats_uni),
+        ("out", asp_iostats_uni),
+    ]
+
+class asyncproxy_stats(Structure):
+    _fields_ = [
+        ("source", asp_iostats_bi),
+        ("sink", asp_iostats_bi),
+    ]
+
+    def topy(self):
+        return ProxyStats(self.source.in_.topy(), self.source.out.topy(),
+                          self.sink.in_.topy(), self.sink.out.topy())
+
+class asp_resolve_stats(Structure):
+    _fields_ = [
+        ("hits", c_uint64),
+        ("misses", c_uint64),
+        ("failures", c_uint64),
+    ]
+
+    def topy(self):
+        return ResolverStats(self.hits, self.misses, self.failures)
+
+class asp_shaper_stats(Structure):
+    _fields_ = [
+        ("nthrottled", c_uint64),
+        ("throttled_ns", c_uint64),
+        ("deferred", c_uint64),
+    ]
+
+    def topy(self):
+        return ShapingStats(self.nthrottled, self.throttled_ns / 1e9, self.deferred)
+
+class asp_mem_stats(Structure):
+    _fields_ = [
+        ("buffered", c_uint64),
+        ("allocated", c_uint64),
+        ("wm_pauses", c_uint64),
+        ("budget_pauses", c_uint64),
+    ]
+
+    def topy(self):
+        return MemStats(self.buffered, self.allocated, self.wm_pauses, self.budget_pauses)
+
+class asp_slab_stats(Structure):
+    _fields_ = [
+        ("inuse", c_uint64),
+        ("cached", c_uint64),
+        ("hits", c_uint64),
+        ("misses", c_uint64),
+    ]
+
+    def topy(self):
+        return PoolStats(self.inuse, self.cached, self.hits, self.misses)
+
+class asp_dgram_stats(Structure):
+    _fields_ = [
+        ("nsessions", c_uint64),
+        ("sessions_total", c_uint64),
+        ("expired", c_uint64),
+        ("dropped", c_uint64),
+    ]
+
+    def topy(self):
+        return DgramStats(self.nsessions, self.sessions_total, self.expired, self.dropped)
+
+class asyncproxy_expiry_stats(Structure):
+    _fields_ = [
+        ("idle", c_uint64),
+        ("idle_i2o", c_uint64),
+        ("idle_o2i", c_uint64),
+        ("lifetime", c_uint64),
+    ]
+
+    def topy(self):
+        return ExpiryStats(self.idle, self.idle_i2o, self.idle_o2i, self.lifetime)
+
+ASP_HIST_NBUCKETS = 48
+
+class asp_hist(Structure):
+    _fields_ = [
+        ("count", c_uint64),
+        ("sum", c_uint64),
+        ("max", c_uint64),
+        ("buckets", c_uint64 * ASP_HIST_NBUCKETS),
+    ]
+
+    def topy(self):
+        return LatencyHist(self.count, self.sum, self.max, tuple(self.buckets))
+
+class asyncproxy_hists(Structure):
+    _fields_ = [
+        ("flush", asp_hist * 2),
+        ("transform", asp_hist * 2),
+    ]
+
+    def topy(self):
+        return ProxyHists(*(h.topy() for h in (*self.flush, *self.transform)))
+
 _asp_data_cb = CFUNCTYPE(None, POINTER(transform_res))
+_asp_stats_cb = CFUNCTYPE(None, POINTER(asyncproxy_stats))
+_asp_view_cb = CFUNCTYPE(c_ssize_t, c_void_p, c_size_t, c_size_t)
 
-_esuf = get_config_var('EXT_SUFFIX')
-if not _esuf:
-    _esuf = '.so'
-try:
-    _ROOT = str(Path(__file__).parent.absolute())
-except ImportError:
-    _ROOT = abspath(dirname(__file__))
-#print('ROOT: ' + str(_ROOT))
-modloc = getsitepackages()
-modloc.insert(0, path_join(_ROOT, ".."))
-for p in modloc:
+PyBUF_WRITE = 0x200
+_mv_from_memory = pythonapi.PyMemoryView_FromMemory
+_mv_from_memory.argtypes = [c_void_p, c_ssize_t, c_int]
+_mv_from_memory.restype = py_object
+
+def _load_ext():
+    # The native binding built into the module, unless LAP_NO_EXT is set
+    # to stick to ctypes for everything. It only provides the Proxy type
+    # (ctor, start/isalive/join/getdonefd/describe/getsockname/getstats and
+    # the view hooks), everything else goes through ctypes either way, see
+    # src/asp_pymod.c.
+    if environ.get('LAP_NO_EXT'):
+        return None
+    try:
+        return import_module(LAP_MOD_NAME)
+    except ImportError:
+        return None
+
+def _load_lib():
+    esuf = get_config_var('EXT_SUFFIX')
+    if not esuf:
+        esuf = '.so'
     try:
-        #print("Trying %s" % path_join(p, LAP_MOD_NAME + _esuf))
-        _asp = cdll.LoadLibrary(path_join(p, LAP_MOD_NAME + _esuf))
-    except:
-        continue
-    break
+        root = str(Path(__file__).parent.absolute())
+    except ImportError:
+        root = abspath(dirname(__file__))
+    modloc = getsitepackages()
+    modloc.insert(0, path_join(root, ".."))
+    for p in modloc:
+        try:
+            return CDLL(path_join(p, LAP_MOD_NAME + esuf), use_errno = True)
+        except OSError:
+            continue
+    return CDLL('libasyncproxy.so', use_errno = True)
+
+_ext = _load_ext()
+if _ext is not None:
+    # Same object, no need to look for it
+    _asp = CDLL(_ext.__file__, use_errno = True)
+    AsyncProxyError = _ext.Error
 else:
-    _asp = cdll.LoadLibrary('libasyncproxy.so')
+    _asp = _load_lib()
+
+    class AsyncProxyError(OSError):
+        pass
+
+def _aperror(fname:str, err:int = None):
+    # AsyncProxyError for a failed library call, with the errno it has left
+    # unless given
+    if err is None:
+        err = get_errno()
+    if err == 0:
+        return AsyncProxyError(f'{fname}() failed')
+    return AsyncProxyError(err, f'{fname}() failed: {strerror(err)}')
 
 _asp.asyncproxy_ctor.argtypes = [POINTER(asyncproxy_ctor_args)]
 _asp.asyncproxy_ctor.restype = c_void_p
@@ -92,50 +302,385 @@ _asp.asyncproxy_start.argtypes = [c_void_p,]
 _asp.asyncproxy_start.restype = c_int
 _asp.asyncproxy_isalive.argtypes = [c_void_p,]
 _asp.asyncproxy_isalive.restype = c_int
+_asp.asyncproxy_ctor_batch.argtypes = [POINTER(asyncproxy_ctor_args), c_int,
+                                       POINTER(_asp_data_cb), c_int, POINTER(c_void_p),
+                                       POINTER(c_int)]
+_asp.asyncproxy_ctor_batch.restype = c_int
+_asp.asyncproxy_start_batch.argtypes = [POINTER(c_void_p), c_int, POINTER(c_int)]
+_asp.asyncproxy_start_batch.restype = c_int
+_asp.asyncproxy_isalive_batch.argtypes = [POINTER(c_void_p), c_int, POINTER(c_int)]
+_asp.asyncproxy_isalive_batch.restype = c_int
+_asp.asyncproxy_getstats_batch.argtypes = [POINTER(c_void_p), c_int, POINTER(asyncproxy_stats)]
 _asp.asyncproxy_dtor.argtypes = [c_void_p,]
 _asp.asyncproxy_set_i2o.argtypes = [c_void_p, _asp_data_cb]
 _asp.asyncproxy_set_o2i.argtypes = [c_void_p, _asp_data_cb]
+_asp.asyncproxy_set_view_cb.argtypes = [c_void_p, c_int, _asp_view_cb]
+_asp.asyncproxy_set_transform.argtypes = [c_void_p, c_int, c_char_p, c_char_p]
+_asp.asyncproxy_set_transform.restype = c_int
+_asp.asyncproxy_describe_transform.argtypes = [c_void_p, c_int, c_char_p, c_size_t]
+_asp.asyncproxy_describe_transform.restype = c_int
+_asp.asyncproxy_transform_load.argtypes = [c_char_p,]
+_asp.asyncproxy_transform_load.restype = c_int
+_asp.asyncproxy_set_ratelimit.argtypes = [c_void_p, c_int, c_uint64, c_uint64]
+_asp.asyncproxy_set_ratelimit.restype = c_int
+_asp.asyncproxy_set_shaper.argtypes = [c_void_p, c_int, c_void_p]
+_asp.asyncproxy_set_shaper.restype = c_int
+_asp.asyncproxy_getshapestats.argtypes = [c_void_p, POINTER(asp_shaper_stats)]
+_asp.asyncproxy_shaper_ctor.argtypes = [c_uint64, c_uint64]
+_asp.asyncproxy_shaper_ctor.restype = c_void_p
+_asp.asyncproxy_shaper_set.argtypes = [c_void_p, c_uint64, c_uint64]
+_asp.asyncproxy_shaper_dtor.argtypes = [c_void_p,]
+_asp.asyncproxy_set_watermarks.argtypes = [c_void_p, c_uint64, c_uint64]
+_asp.asyncproxy_set_watermarks.restype = c_int
+_asp.asyncproxy_getmemstats.argtypes = [c_void_p, POINTER(asp_mem_stats)]
+_asp.asyncproxy_getdgramstats.argtypes = [c_void_p, POINTER(asp_dgram_stats)]
+_asp.asyncproxy_setmembudget.argtypes = [c_uint64, c_uint64]
+_asp.asyncproxy_getmemstats_global.argtypes = [POINTER(asp_mem_stats),]
+_asp.asyncproxy_set_tap.argtypes = [c_void_p, c_void_p, c_uint64, c_uint, c_uint64]
+_asp.asyncproxy_set_tap.restype = c_int
+_asp.asyncproxy_tap_ctor.argtypes = [c_char_p, c_uint, c_uint]
+_asp.asyncproxy_tap_ctor.restype = c_void_p
+_asp.asyncproxy_tap_count.argtypes = [c_void_p,]
+_asp.asyncproxy_tap_count.restype = c_uint64
+_asp.asyncproxy_tap_dtor.argtypes = [c_void_p,]
+_asp.asyncproxy_set_stats_cb.argtypes = [c_void_p, _asp_stats_cb, c_uint]
+_asp.asyncproxy_getstats.argtypes = [c_void_p, POINTER(asyncproxy_stats)]
+_asp.asyncproxy_gethists.argtypes = [c_void_p, POINTER(asyncproxy_hists)]
+_asp.asyncproxy_gethists.restype = c_int
+_asp.asyncproxy_gethists_global.argtypes = [POINTER(asyncproxy_hists),]
+_asp.asyncproxy_setinstrument.argtypes = [c_int,]
 _asp.asyncproxy_join.argtypes = [c_void_p, c_int]
+_asp.asyncproxy_getdonefd.argtypes = [c_void_p,]
+_asp.asyncproxy_getdonefd.restype = c_int
 _asp.asyncproxy_describe.argtypes = [c_void_p,]
 _asp.asyncproxy_describe.restype = c_char_p
 _asp.asyncproxy_getsockname.argtypes = [c_void_p, POINTER(c_ushort)]
 _asp.asyncproxy_getsockname.restype = c_char_p
+_asp.asyncproxy_getconninfo.argtypes = [c_void_p, POINTER(asyncproxy_conninfo)]
+_asp.asyncproxy_getconninfo.restype = c_int
+_asp.asyncproxy_getsockopts.argtypes = [c_void_p, c_int, POINTER(asp_sockopts)]
+_asp.asyncproxy_getsockopts.restype = c_int
+_asp.asyncproxy_set_timeouts.argtypes = [c_void_p, c_uint, c_uint, c_uint, c_uint]
+_asp.asyncproxy_set_timeouts.restype = c_int
+_asp.asyncproxy_getexpiry.argtypes = [c_void_p,]
+_asp.asyncproxy_getexpiry.restype = c_int
+_asp.asyncproxy_getexpirystats_global.argtypes = [POINTER(asyncproxy_expiry_stats),]
 _asp.asyncproxy_setdebug.argtypes = [c_int,]
+_asp.asyncproxy_setsplice.argtypes = [c_int,]
+_asp.asyncproxy_setcompact.argtypes = [c_int, c_size_t, c_uint64]
+_asp.asyncproxy_getpoolstats.argtypes = [POINTER(asp_slab_stats),]
+_asp.asyncproxy_setdnscache.argtypes = [c_uint, c_uint]
+_asp.asyncproxy_getdnsstats.argtypes = [POINTER(asp_resolve_stats),]
+_asp.asyncproxy_engine_start.argtypes = [c_int,]
+_asp.asyncproxy_engine_start.restype = c_int
+_asp.asyncproxy_engine_stop.restype = c_int
 
 def setdebug(level):
     _asp.asyncproxy_setdebug(level)
 
+def setsplice(enable:bool):
+    # Controls whether proxies created from now on relay data between
+    # sockets/pipes using splice(2) when no transform is installed.
+    _asp.asyncproxy_setsplice(int(enable))
+
+def setcompact(enable:bool, stacksize:int = 0, poolcache:int = 0):
+    # Proxies created from now on take their relay buffers from the shared
+    # pool only while there is data in them and run on threads with a
+    # stacksize bytes stack (256 KB if 0). Up to poolcache bytes (4 MB if 0)
+    # of the buffers given back are kept in the pool for reuse.
+    _asp.asyncproxy_setcompact(int(enable), stacksize, poolcache)
+
+def getpoolstats():
+    st = asp_slab_stats()
+    _asp.asyncproxy_getpoolstats(byref(st))
+    return st.topy()
+
+def setinstrument(enable:bool):
+    # Proxies created from now on record flush and transform latency
+    # histograms, see AsyncProxyBase.gethists() and gethists_global().
+    _asp.asyncproxy_setinstrument(int(enable))
+
+def gethists_global():
+    h = asyncproxy_hists()
+    _asp.asyncproxy_gethists_global(byref(h))
+    return h.topy()
+
+def transform_load(path:str):
+    # Registers native transforms exported by the shared object, so that
+    # they can be attached by name, returns how many were loaded.
+    n = int(_asp.asyncproxy_transform_load(path.encode()))
+    if n < 0:
+        raise _aperror('asyncproxy_transform_load')
+    return n
+
+def setdnscache(ttl:float, size:int):
+    # Resolved destinations are cached for ttl seconds, size is the maximum
+    # number of entries (0 disables the cache).
+    _asp.asyncproxy_setdnscache(int(ttl * 1000), size)
+
+def getdnsstats():
+    st = asp_resolve_stats()
+    _asp.asyncproxy_getdnsstats(byref(st))
+    return st.topy()
+
+def setmembudget(budget:int, low:int = 0):
+    # Cap on the data held by all relays in the process, in bytes (0 - no
+    # cap). Readers are paused once it's exceeded and resumed when the total
+    # is down to low (3/4 of the budget by default).
+    _asp.asyncproxy_setmembudget(budget, low)
+
+def getmemstats_global():
+    st = asp_mem_stats()
+    _asp.asyncproxy_getmemstats_global(byref(st))
+    return st.topy()
+
+def getexpirystats_global():
+    # ExpiryStats for all the proxies in the process
+    st = asyncproxy_expiry_stats()
+    _asp.asyncproxy_getexpirystats_global(byref(st))
+    return st.topy()
+
+def engine_start(nthreads:int = 0):
+    # Attach all proxies started from now on to a pool of nthreads shared
+    # event loops (one per CPU core if 0) instead of a thread per proxy.
+    if int(_asp.asyncproxy_engine_start(nthreads)) != 0:
+        raise _aperror('asyncproxy_engine_start')
+
+def engine_stop():
+    if int(_asp.asyncproxy_engine_stop()) != 0:
+        raise _aperror('asyncproxy_engine_stop')
+
+class _CtypesProxy(object):
+    # Fallback for _libasyncproxy.Proxy, the same interface on top of
+    # ctypes.
+    handle = None
+    __asp = None
+
+    def __init__(self, fd:int, out_fd:int = -1, dest:str = None, port:int = 0,
+                 af:int = 0, bindto:str = None, bufsize:int = 0, flags:int = 0,
+                 connect_timeout:int = 0, dgram_idle:int = 0, sockopts:tuple = None):
+        args = asyncproxy_ctor_args()
+        args.fd = fd
+        if dest is not None:
+            args.dest_type = AP_DEST_HOST
+            args.dest = c_char_p(bytes(dest.encode()))
+            args.portn = port
+            args.af = af
+            if bindto is not None:
+                args.bindto = c_char_p(bytes(bindto.encode()))
+        else:
+            args.dest_type = AP_DEST_FD
+            args.out_fd = out_fd
+        args.bufsize = bufsize
+        args.flags = flags
+        args.connect_timeout = connect_timeout
+        args.dgram_idle = dgram_idle
+        if sockopts is not None:
+            args.sockopts = asp_sockopts(*sockopts)
+        self.handle = _asp.asyncproxy_ctor(byref(args))
+        if not bool(self.handle):
+            raise _aperror('asyncproxy_ctor')
+        self.__asp = _asp
+        self._vcbs = [None, None]
+
+    def start(self):
+        if int(self.__asp.asyncproxy_start(self.handle)) != 0:
+            raise _aperror('asyncproxy_start')
+
+    def isalive(self):
+        return bool(self.__asp.asyncproxy_isalive(self.handle))
+
+    def join(self, shutdown=True):
+        self.__asp.asyncproxy_join(self.handle, shutdown)
+
+    def getdonefd(self):
+        fd = int(self.__asp.asyncproxy_getdonefd(self.handle))
+        if fd < 0:
+            raise _aperror('asyncproxy_getdonefd')
+        return fd
+
+    def describe(self):
+        return self.__asp.asyncproxy_describe(self.handle)
+
+    def getsockname(self):
+        portnum = c_ushort()
+        a = self.__asp.asyncproxy_getsockname(self.handle, pointer(portnum))
+        if not bool(a):
+            raise _aperror('asyncproxy_getsockname')
+        return (a.decode(), portnum.value)
+
+    def getstats(self):
+        st = asyncproxy_stats()
+        self.__asp.asyncproxy_getstats(self.handle, byref(st))
+        return tuple((x.nops, x.btotal) for x in (st.source.in_, st.source.out,
+                                                  st.sink.in_, st.sink.out))
+
+    def set_view_hook(self, direction:int, hook):
+        cb = _asp_view_cb(self._view_hook(hook)) if hook is not None else None
+        self.__asp.asyncproxy_set_view_cb(self.handle, direction, cb)
+        self._vcbs[direction] = cb
+
+    @staticmethod
+    def _view_hook(hook):
+        # The in2out_view/out2in_view hooks are called as hook(view, length)
+        # with a writable memoryview over the relay buffer: view[:length] is
+        # the data received, the rest of it is free room the data can grow
+        # into. The hook modifies the data in place and returns its new
+        # length, or returns a bytes-like object to replace it with (copied
+        # into the buffer), or None to leave it as is. The view is only valid
+        # during the call.
+        def cb(buf, length, size):
+            view = _mv_from_memory(buf, size, PyBUF_WRITE)
+            try:
+                rval = hook(view, length)
+                if rval is None:
+                    return -1
+                if isinstance(rval, int):
+                    if rval < 0 or rval > size:
+                        raise ValueError(f'invalid length {rval} returned by {hook}')
+                    return rval
+                rlen = len(rval)
+                if rlen > size:
+                    raise ValueError(f'{rlen} bytes returned by {hook} do not fit into {size}')
+                view[:rlen] = rval
+                return rlen
+            except Exception:
+                # Pass the data through unchanged rather than drop it
+                print_exc()
+                return -1
+            finally:
+                view.release()
+        return cb
+
+    def __del__(self):
+        if bool(self.handle):
+            self.__asp.asyncproxy_dtor(self.handle)
+
+_Proxy = _ext.Proxy if _ext is not None else _CtypesProxy
+
 class AsyncProxyBase(object):
     _hndl = None
+    _core = None
     __asp = None
     in2out = None
     out2in = None
+    in2out_view = None
+    out2in_view = None
+    in2out_native = None
+    out2in_native = None
+    on_stats = None
+    stats_interval:float = 1.0
+    # Rate limits in bytes per second, either a rate or a (rate, burst)
+    # tuple, and Shaper instances to draw from in addition
+    in2out_rate = None
+    out2in_rate = None
+    in2out_shaper = None
+    out2in_shaper = None
+    # Per-direction high watermark, or a (high, low) tuple
+    watermarks = None
+    bufsize:int = 0
+    buf_adaptive:bool = False
+    # Tap instance to copy the relayed data to, every tap_sample-th chunk
+    # and up to tap_maxbytes in total (0 - no cap)
+    tap = None
+    tap_sample:int = 1
+    tap_maxbytes:int = 0
+    tap_id:int = None
+    # Relay datagrams rather than a byte stream, see AsyncDgramProxy
+    dgram:bool = False
+    session_idle:float = None
+    # Socket options for both legs, a SOCKOPT_PROFILES name, a SockOpts or
+    # a dict of them
+    sockopts = None
+    # Timeouts, a dict of them or the idle one in seconds
+    timeouts = None
 
-    def __init__(self, args:asyncproxy_ctor_args):
-        self._hndl = _asp.asyncproxy_ctor(byref(args))
-        if not bool(self._hndl):
-            raise Exception('asyncproxy_ctor() failed')
+    def __init__(self, args:dict, bufsize:int = None, buf_adaptive:bool = None,
+                 sockopts = None, timeouts = None):
+        # Relay buffer size per direction (0 - library default) and whether
+        # it should grow for bulk transfers, class attributes are used unless
+        # overridden. The args are the ones of _libasyncproxy.Proxy.
+        args['bufsize'] = self.bufsize if bufsize is None else bufsize
+        if sockopts is None:
+            sockopts = self.sockopts
+        if sockopts is not None:
+            args['sockopts'] = asp_sockopts.frompy(sockopts)
+        flags = args.get('flags', 0)
+        if (self.buf_adaptive if buf_adaptive is None else buf_adaptive):
+            flags |= AP_FLAG_BUF_ADAPTIVE
+        if self.dgram:
+            flags |= AP_FLAG_DGRAM
+            if self.session_idle:
+                args['dgram_idle'] = max(1, int(self.session_idle * 1000))
+        args['flags'] = flags
+        self._core = _Proxy(**args)
+        self._hndl = self._core.handle
         self.__asp = _asp
+        # Native transforms, either a name or a (name, args) tuple
+        for d, tf in ((AP_DIR_I2O, self.in2out_native), (AP_DIR_O2I, self.out2in_native)):
+            if tf is not None:
+                self.set_transform(d, *((tf,) if isinstance(tf, str) else tf))
         if self.in2out is not None:
             self._in2out_cb = _asp_data_cb(self.in2out)
             self.__asp.asyncproxy_set_i2o(self._hndl, self._in2out_cb)
         if self.out2in is not None:
             self._out2in_cb = _asp_data_cb(self.out2in)
             self.__asp.asyncproxy_set_o2i(self._hndl, self._out2in_cb)
+        # See _CtypesProxy._view_hook() for how the view hooks are called
+        if self.in2out_view is not None:
+            self._core.set_view_hook(AP_DIR_I2O, self.in2out_view)
+        if self.out2in_view is not None:
+            self._core.set_view_hook(AP_DIR_O2I, self.out2in_view)
+        for d, rate, shaper in ((AP_DIR_I2O, self.in2out_rate, self.in2out_shaper),
+                                (AP_DIR_O2I, self.out2in_rate, self.out2in_shaper)):
+            if rate is not None:
+                self.set_ratelimit(d, *((rate,) if isinstance(rate, int) else rate))
+            if shaper is not None:
+                self.set_shaper(d, shaper)
+        if self.watermarks is not None:
+            self.set_watermarks(*((self.watermarks,) if isinstance(self.watermarks, int)
+                                  else self.watermarks))
+        if self.tap is not None:
+            self.set_tap(self.tap)
+        if timeouts is None:
+            timeouts = self.timeouts
+        if timeouts is not None:
+            self.set_timeouts(*Timeouts.get(timeouts))
+        if self.on_stats is not None:
+            self._stats_cb = _asp_stats_cb(self._on_stats)
+            self.__asp.asyncproxy_set_stats_cb(self._hndl, self._stats_cb,
+                                               int(self.stats_interval * 1000))
 
     def start(self):
-        if int(self.__asp.asyncproxy_start(self._hndl)) != 0:
-            raise Exception('asyncproxy_start() failed')
+        self._core.start()
 
     def isAlive(self):
-        return bool(self.__asp.asyncproxy_isalive(self._hndl))
+        return self._core.isalive()
 
     def join(self, shutdown=True):
-        self.__asp.asyncproxy_join(self._hndl, shutdown)
+        self._core.join(shutdown)
+
+    def getdonefd(self):
+        # File descriptor that becomes readable once the relay is over, owned
+        # by the proxy and valid for as long as it exists.
+        return self._core.getdonefd()
+
+    async def wait_closed(self):
+        # Waits for a started proxy to finish without blocking the event
+        # loop, joins it afterwards.
+        loop = get_running_loop()
+        fd = self.getdonefd()
+        done = loop.create_future()
+        loop.add_reader(fd, lambda: done.done() or done.set_result(None))
+        try:
+            await done
+        finally:
+            loop.remove_reader(fd)
+        AsyncProxyBase.join(self, shutdown=False)
 
     def __del__(self):
-        if bool(self._hndl):
-            self.__asp.asyncproxy_dtor(self._hndl)
+        # Before the hooks the relay could still be calling are gone
+        self._core = None
 
     def _in2out(self, ptr, len):
         pass
@@ -146,32 +691,282 @@ class AsyncProxyBase(object):
         #print('out2in', ptr, len)
 
     def describe(self):
-        d = self.__asp.asyncproxy_describe(self._hndl)
-        return d
+        return self._core.describe()
+
+    def set_transform(self, direction:int, name:str, args:str = None):
+        # Attaches a native transform (built-in "xor" and "count", or loaded
+        # with transform_load()) to the given direction, before the start.
+        # The transform runs in the relay without taking the GIL.
+        name = name.encode() if name is not None else None
+        args = args.encode() if args is not None else None
+        if int(self.__asp.asyncproxy_set_transform(self._hndl, direction, name, args)) != 0:
+            raise _aperror('asyncproxy_set_transform')
+
+    def describe_transform(self, direction:int):
+        buf = create_string_buffer(256)
+        if int(self.__asp.asyncproxy_describe_transform(self._hndl, direction, buf, len(buf))) < 0:
+            return None
+        return buf.value.decode()
+
+    def set_ratelimit(self, direction:int, rate:int, burst:int = 0):
+        # Token bucket limit for the given direction, can be changed at any
+        # time (rate 0 lifts it). Once out of tokens the relay stops reading
+        # rather than drops anything. Burst defaults to 100 ms worth of rate.
+        if int(self.__asp.asyncproxy_set_ratelimit(self._hndl, direction, rate, burst)) != 0:
+            raise _aperror('asyncproxy_set_ratelimit')
+
+    def set_shaper(self, direction:int, shaper):
+        # Draw from a Shaper shared with other proxies (None to detach)
+        hndl = shaper._hndl if shaper is not None else None
+        if int(self.__asp.asyncproxy_set_shaper(self._hndl, direction, hndl)) != 0:
+            raise _aperror('asyncproxy_set_shaper')
+
+    def getshapestats(self):
+        # ShapingStats per direction, in2out first
+        st = (asp_shaper_stats * 2)()
+        self.__asp.asyncproxy_getshapestats(self._hndl, st)
+        return tuple(x.topy() for x in st)
+
+    def set_tap(self, tap, tap_id:int = None, sample:int = None, maxbytes:int = None):
+        # Copy relayed chunks (the way they are sent out, after transforms)
+        # to the Tap, before the start. Records are tagged with tap_id, a
+        # process-wide unique one unless given. Data that goes through
+        # splice(2) never reaches the userland, so it's off for tapped
+        # proxies.
+        if tap_id is None:
+            tap_id = next(_tap_ids) if self.tap_id is None else self.tap_id
+        sample = self.tap_sample if sample is None else sample
+        maxbytes = self.tap_maxbytes if maxbytes is None else maxbytes
+        hndl = tap._hndl if tap is not None else None
+        if int(self.__asp.asyncproxy_set_tap(self._hndl, hndl, tap_id, sample, maxbytes)) != 0:
+            raise _aperror('asyncproxy_set_tap')
+        self.tap_id = tap_id
+
+    def set_watermarks(self, high:int, low:int = 0):
+        # Stop reading in a direction once it holds high bytes not yet
+        # written out, resume once it's down to low (high / 2 by default).
+        if int(self.__asp.asyncproxy_set_watermarks(self._hndl, high, low)) != 0:
+            raise _aperror('asyncproxy_set_watermarks')
+
+    def set_timeouts(self, idle:float = None, in2out_idle:float = None,
+                     out2in_idle:float = None, lifetime:float = None):
+        # See Timeouts, before the start. The relays on the shared event
+        # loops are timed by a timer wheel of the loop, the rest by their
+        # own threads.
+        ms = [max(1, int(t * 1000)) if t else 0 for t in (idle, in2out_idle,
+                                                           out2in_idle, lifetime)]
+        if int(self.__asp.asyncproxy_set_timeouts(self._hndl, *ms)) != 0:
+            raise _aperror('asyncproxy_set_timeouts')
+
+    def getexpiry(self):
+        # Timeout the relay has been ended by, one of the ExpiryStats
+        # fields, or None
+        r = int(self.__asp.asyncproxy_getexpiry(self._hndl))
+        return ExpiryStats._fields[r - 1] if r > 0 else None
+
+    def getmemstats(self):
+        st = asp_mem_stats()
+        self.__asp.asyncproxy_getmemstats(self._hndl, byref(st))
+        return st.topy()
+
+    def getdgramstats(self):
+        st = asp_dgram_stats()
+        self.__asp.asyncproxy_getdgramstats(self._hndl, byref(st))
+        return st.topy()
+
+    def getstats(self):
+        return ProxyStats(*map(IOStats._make, self._core.getstats()))
+
+    def gethists(self):
+        h = asyncproxy_hists()
+        if int(self.__asp.asyncproxy_gethists(self._hndl, byref(h))) != 0:
+            return None
+        return h.topy()
+
+    def _on_stats(self, st_p):
+        # pylint: disable-next=not-callable
+        self.on_stats(st_p.contents.topy())
 
     def getsockname(self):
-        portnum = c_ushort()
-        a = self.__asp.asyncproxy_getsockname(self._hndl, pointer(portnum))
-        if not bool(a):
-            raise Exception('asyncproxy_getsockname() failed')
-        return (a.decode(), portnum.value)
+        return self._core.getsockname()
+
+    def getconninfo(self):
+        # ConnectInfo for the destination connected to, or None if not
+        # connected (yet)
+        ci = asyncproxy_conninfo()
+        if int(self.__asp.asyncproxy_getconninfo(self._hndl, byref(ci))) != 0:
+            return None
+        return ci.topy()
+
+    def getsockopts(self):
+        # SockOpts in effect for the (source, sink) sockets, the sink ones
+        # are all None until connected
+        res = []
+        for leg in (0, 1):
+            so = asp_sockopts()
+            if int(self.__asp.asyncproxy_getsockopts(self._hndl, leg, byref(so))) != 0:
+                raise _aperror('asyncproxy_getsockopts')
+            res.append(so.topy())
+        return tuple(res)
+
+class Shaper(object):
+    # Token bucket that any number of proxies can draw from, i.e. to cap
+    # the total bandwidth of a group of connections.
+    _hndl = None
+
+    def __init__(self, rate:int, burst:int = 0):
+        self._hndl = _asp.asyncproxy_shaper_ctor(rate, burst)
+        if not bool(self._hndl):
+            raise _aperror('asyncproxy_shaper_ctor')
+        self.__asp = _asp
+
+    def set(self, rate:int, burst:int = 0):
+        self.__asp.asyncproxy_shaper_set(self._hndl, rate, burst)
+
+    def __del__(self):
+        # Proxies using it hold their own references
+        if bool(self._hndl):
+            self.__asp.asyncproxy_shaper_dtor(self._hndl)
+
+class Tap(object):
+    # Capture ring in a memory-mapped file, nslots records of up to snaplen
+    # bytes of data each, that any number of proxies can be tapped into.
+    # Relays write to it without locking, overwriting the oldest records
+    # once it's full. See TapReader for decoding it.
+    _hndl = None
+
+    def __init__(self, path:str, nslots:int = 4096, snaplen:int = 256):
+        self._hndl = _asp.asyncproxy_tap_ctor(path.encode(), nslots, snaplen)
+        if not bool(self._hndl):
+            raise _aperror('asyncproxy_tap_ctor')
+        self.__asp = _asp
+        self.path = path
+
+    def count(self):
+        # Records written so far, including the overwritten ones
+        return int(self.__asp.asyncproxy_tap_count(self._hndl))
+
+    def __del__(self):
+        # Proxies using it hold their own references, the file stays
+        if bool(self._hndl):
+            self.__asp.asyncproxy_tap_dtor(self._hndl)
 
 class AsyncProxy(AsyncProxyBase):
-    def __init__(self, fd, dest, portn, af, bindto):
-        args = asyncproxy_ctor_args()
-        args.fd = fd
-        args.dest = c_char_p(bytes(dest.encode()))
-        args.portn = portn
-        args.af = af
-        args.dest_type = AP_DEST_HOST
-        if bindto is not None:
-            args.bindto = c_char_p(bytes(bindto.encode()))
-        super().__init__(args)
+    resolve_async:bool = False
+    connect_timeout:float = None
+
+    def __init__(self, fd, dest, portn, af, bindto, resolve_async:bool = None,
+                 connect_timeout:float = None, **kwa):
+        # With resolve_async the ctor does not block on the name resolution
+        # (unless it's cached), it's done by the relay once started and a
+        # failure there terminates the relay. All the addresses dest resolves
+        # into are tried (both IPv4 and IPv6 ones with af=AF_UNSPEC) until
+        # connected or connect_timeout seconds have passed.
+        args = dict(fd = fd, dest = dest, port = portn, af = af, bindto = bindto)
+        if (self.resolve_async if resolve_async is None else resolve_async):
+            args['flags'] = AP_FLAG_RESOLVE_ASYNC
+        if connect_timeout is None:
+            connect_timeout = self.connect_timeout
+        if connect_timeout:
+            args['connect_timeout'] = max(1, int(connect_timeout * 1000))
+        super().__init__(args, **kwa)
 
 class AsyncProxy2FD(AsyncProxyBase):
-    def __init__(self, fd1:int, fd2:int):
-        args = asyncproxy_ctor_args()
-        args.fd = fd1
-        args.out_fd = fd2
-        args.dest_type = AP_DEST_FD
-        super().__init__(args)
+    def __init__(self, fd1:int, fd2:int, **kwa):
+        super().__init__(dict(fd = fd1, out_fd = fd2), **kwa)
+
+class AsyncDgramProxy(AsyncProxy):
+    # Datagram flavour of AsyncProxy, fd is a SOCK_DGRAM socket. Message
+    # boundaries are kept: the transform hooks see one datagram at a time
+    # and a hook that cuts one down to nothing drops it, bufsize is the
+    # largest datagram relayed. With session_idle (seconds) each client
+    # address fd receives from gets a socket of its own to the destination,
+    # closed after that long without traffic either way.
+    dgram = True
+
+    def __init__(self, fd, dest, portn, af, bindto, session_idle:float = None, **kwa):
+        if session_idle is not None:
+            self.session_idle = session_idle
+        super().__init__(fd, dest, portn, af, bindto, **kwa)
+
+class AsyncDgramProxy2FD(AsyncProxy2FD):
+    # Datagram flavour of AsyncProxy2FD, e.g. over SOCK_DGRAM socketpairs
+    dgram = True
+
+class ProxyGroup(object):
+    # Any number of AsyncProxy2FD relays, one per (fd1, fd2) pair, created
+    # and started with a single call into the library, e.g. to set up a
+    # burst of them at once. The in2out/out2in hooks, the buffer settings
+    # and the socket options are shared by all of them. Relays that have
+    # failed are skipped, with the AsyncProxyError in errors (None for the
+    # rest).
+    in2out = None
+    out2in = None
+    bufsize:int = 0
+    buf_adaptive:bool = False
+    sockopts = None
+    _hndls = None
+
+    def __init__(self, pairs, start:bool = True, bufsize:int = None,
+                 buf_adaptive:bool = None, sockopts = None):
+        n = len(pairs)
+        args = (asyncproxy_ctor_args * n)()
+        bufsize = self.bufsize if bufsize is None else bufsize
+        flags = AP_FLAG_BUF_ADAPTIVE if (self.buf_adaptive if buf_adaptive is None
+                                         else buf_adaptive) else 0
+        sockopts = self.sockopts if sockopts is None else sockopts
+        sop = asp_sockopts(*asp_sockopts.frompy(sockopts)) if sockopts is not None \
+          else asp_sockopts()
+        for a, (fd1, fd2) in zip(args, pairs):
+            a.fd = fd1
+            a.out_fd = fd2
+            a.dest_type = AP_DEST_FD
+            a.bufsize = bufsize
+            a.flags = flags
+            a.sockopts = sop
+        self._hndls = (c_void_p * n)()
+        self.__asp = _asp
+        # Installed by the library along with the creation, before the start
+        hooks = None
+        if self.in2out is not None or self.out2in is not None:
+            hooks = (_asp_data_cb * 2)(*(_asp_data_cb(h) if h is not None else _asp_data_cb()
+                                         for h in (self.in2out, self.out2in)))
+        self._cbs = hooks
+        errs = (c_int * n)()
+        _asp.asyncproxy_ctor_batch(args, n, hooks, int(start), self._hndls, errs)
+        self.errors = [_aperror('asyncproxy_ctor_batch', e) if e != 0 else None for e in errs]
+
+    def __len__(self):
+        return len(self._hndls)
+
+    def start(self):
+        # Start the relays not started yet, errors are updated
+        errs = (c_int * len(self))()
+        self.__asp.asyncproxy_start_batch(self._hndls, len(self), errs)
+        fails = [_aperror('asyncproxy_start_batch', e) if e != 0 else None for e in errs]
+        self.errors = [e or f for e, f in zip(self.errors, fails)]
+
+    def isalive(self):
+        # Whether each of the relays is running, as a list
+        res = (c_int * len(self))()
+        self.__asp.asyncproxy_isalive_batch(self._hndls, len(self), res)
+        return [bool(x) for x in res]
+
+    def getstats(self):
+        # ProxyStats for each of the relays, None for the failed ones
+        res = (asyncproxy_stats * len(self))()
+        self.__asp.asyncproxy_getstats_batch(self._hndls, len(self), res)
+        return [st.topy() if hndl is not None else None
+                for st, hndl in zip(res, self._hndls)]
+
+    def join(self, shutdown=True):
+        for hndl in self._hndls:
+            if hndl is not None:
+                self.__asp.asyncproxy_join(hndl, shutdown)
+
+    def __del__(self):
+        if self._hndls is None:
+            return
+        for hndl in self._hndls:
+            if hndl is not None:
+                self.__asp.asyncproxy_dtor(hndl)
@@ -0,0 +1,171 @@
+# Copyright (c) 2026 Sippy Software, Inc. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# TCPProxy flavour for the asyncio applications: the listening socket and the
+# forwarders' completion fds are all watched by the running event loop, so no
+# extra threads are needed besides the ones doing the actual relaying. Only
+# the native (AsyncProxy-based) forwarders are supported.
+
+import sys
+import socket
+from asyncio import get_running_loop, gather
+from errno import ECONNABORTED, EINTR
+from time import strftime
+
+from .ForwarderFast import ForwarderFast
+from .IOStats import ProxyStats, ExpiryStats
+
+class AsyncTCPProxy(object):
+    debug = False
+    dead = False
+    loop = None
+    sock = None
+    forwarders: dict = None
+    reaped_stats: ProxyStats = None
+    allowed_ips: tuple = None
+    bindhost_out = None
+    forwarder_class:callable = ForwarderFast
+    bufsize:int = None
+    buf_adaptive:bool = None
+    resolve_async:bool = None
+    connect_timeout:float = None
+    # Socket options for both legs of the forwarders, a SOCKOPT_PROFILES
+    # name, a SockOpts or a dict of them
+    sockopts = None
+    # Timeouts of the forwarders, see AsyncProxyBase.timeouts
+    timeouts = None
+    reaped_expiry: ExpiryStats = None
+    backlog:int = 500
+
+    def __init__(self, port, newhost, newport = None, bindhost = '127.0.0.1', logger = None, newaf = None):
+        if newaf is None:
+            newaf = socket.AF_INET if (newport is not None) else socket.AF_UNIX
+        self.newhost = newhost
+        self.newport = newport
+        self.newaf = newaf
+        self.logger = logger
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind((bindhost, port))
+        self.port = port if (port != 0) else self.sock.getsockname()[1]
+        self.forwarders = {}
+        self.reaped_stats = ProxyStats()
+        self.reaped_expiry = ExpiryStats()
+
+    async def start(self):
+        self.loop = get_running_loop()
+        self.sock.setblocking(False)
+        self.sock.listen(self.backlog)
+        self.loop.add_reader(self.sock.fileno(), self._accept)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.shutdown()
+
+    def access_check(self, address):
+        if self.allowed_ips is None or address[0] in self.allowed_ips:  # pylint: disable=unsupported-membership-test
+            return True
+        return False
+
+    def _accept(self):
+        while not self.dead:
+            try:
+                newsock, address = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                if e.errno in (ECONNABORTED, EINTR):
+                    continue
+                self.log(f'got socket.error exception: {e}')
+                return
+            if not self.access_check(address):
+                newsock.close()
+                self.log('connection attempt from the unknown IP %s has been rejected' % address[0])
+                continue
+            self.spawn_forwarder(newsock)
+
+    def spawn_forwarder(self, newsock):
+        daddr = (self.newhost, self.newport) if (self.newaf != socket.AF_UNIX) else self.newhost
+        try:
+            fwd = self.forwarder_class(newsock, (daddr, self.newaf), self.bindhost_out,
+                                       logger = self.logger, bufsize = self.bufsize,
+                                       buf_adaptive = self.buf_adaptive,
+                                       resolve_async = self.resolve_async,
+                                       connect_timeout = self.connect_timeout,
+                                       sockopts = self.sockopts, timeouts = self.timeouts)
+            fwd.start()
+        except Exception as ex:
+            newsock.close()
+            self.log(f'setting up redirection to {daddr} failed: {ex}')
+            return
+        self.forwarders[fwd] = newsock
+        self.loop.add_reader(fwd.getdonefd(), self._on_done, fwd)
+
+    def _on_done(self, fwd):
+        self.loop.remove_reader(fwd.getdonefd())
+        fwd.join()
+        self.dprint(lambda: f'forwarder done: {fwd.describe()}')
+        self.forwarders.pop(fwd).close()
+        self.reaped_stats += fwd.getstats()
+        self.reaped_expiry = self.reaped_expiry.add(fwd.getexpiry())
+
+    def stats(self):
+        # Totals across all the forwarders, both active and already gone
+        res = self.reaped_stats
+        for fwd in self.forwarders:
+            res += fwd.getstats()
+        return res
+
+    def expiry_stats(self):
+        # ExpiryStats of the forwarders that have been ended by the timeouts
+        return self.reaped_expiry
+
+    async def shutdown(self):
+        if self.dead:
+            return
+        self.dead = True
+        if self.loop is not None:
+            self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+        forwarders = tuple(self.forwarders)
+        for fwd in forwarders:
+            self.loop.remove_reader(fwd.getdonefd())
+            fwd.shutdown()
+        await gather(*(fwd.wait_closed() for fwd in forwarders))
+        for fwd in forwarders:
+            self.forwarders.pop(fwd).close()
+            self.reaped_stats += fwd.getstats()
+
+    def dprint(self, get_msg):
+        if not self.debug: return
+        sys.stderr.write(f'{get_msg()}\n')
+        sys.stderr.flush()
+
+    def log(self, msg, flush = False):
+        msg = 'AsyncTCPProxy[%d]: %s' % (hash(self), msg)
+        if self.logger != None:
+            self.logger.log(msg, flush)
+        else:
+            self.dprint(lambda: f'{strftime("%Y-%m-%d %H:%M:%S")}: {msg}')
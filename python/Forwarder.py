@@ -21,26 +21,177 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+# Pure-Python relay, used whenever the ForwarderFast can't be. Each direction
+# has a preallocated buffer that is read into with recv_into() and written
+# out of through a memoryview, the poll interest is only updated when it
+# changes. By default every forwarder is served by its own thread, pass a
+# ForwarderLoop (or set it as the class attribute) to have one thread serve
+# many forwarders instead.
+
 import sys
-from threading import Thread, Lock
-import socket, select, fcntl, os
+from threading import Thread, Lock, Event
+from queue import SimpleQueue
+import socket, selectors, os
 import traceback
-from time import strftime
-from errno import EINTR
+from time import strftime, monotonic
+from errno import EINPROGRESS
+
+from .IOStats import IOStats, ProxyStats, ConnectInfo, SockOpts, Timeouts, \
+  ExpiryStats
+
+# Indices into Forwarder.nops/btotal, same order as ProxyStats
+_SOURCE_IN, _SOURCE_OUT, _SINK_IN, _SINK_OUT = range(4)
+
+_R, _W = selectors.EVENT_READ, selectors.EVENT_WRITE
+
+class _RelayBuf(object):
+    # Data pending in one direction, buf[head:tail]
+    __slots__ = ('buf', 'view', 'head', 'tail', 'eof')
+
+    def __init__(self, size):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.head = self.tail = 0
+        self.eof = False
+
+    def pending(self):
+        return self.tail - self.head
+
+    def space(self):
+        return len(self.buf) - self.tail + self.head
+
+    def recv(self, sock):
+        if self.tail == len(self.buf):
+            # Move the leftover to the front
+            n = self.tail - self.head
+            self.view[:n] = self.view[self.head:self.tail]
+            self.head, self.tail = 0, n
+        n = sock.recv_into(self.view[self.tail:])
+        self.tail += n
+        return n
+
+    def send(self, sock):
+        n = sock.send(self.view[self.head:self.tail])
+        self.head += n
+        if self.head == self.tail:
+            self.head = self.tail = 0
+        return n
+
+class _Poller(object):
+    # Selector plus the connect deadlines and the timeouts of the forwarders
+    # using it
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.connecting = set()
+        self.timed = set()
+
+    def poll(self, timeout = None):
+        if len(self.connecting) > 0 or len(self.timed) > 0:
+            tleft = min([fwd.deadline for fwd in self.connecting] +
+                        [fwd.tdeadline for fwd in self.timed]) - monotonic()
+            timeout = max(0, tleft) if timeout is None else max(0, min(timeout, tleft))
+        for key, mask in self.selector.select(timeout):
+            key.data(mask)
+        if len(self.connecting) > 0 or len(self.timed) > 0:
+            now = monotonic()
+            for fwd in tuple(self.connecting):
+                if now >= fwd.deadline:
+                    fwd.connect_timedout()
+            for fwd in tuple(self.timed):
+                if now >= fwd.tdeadline:
+                    fwd.check_timeouts(now)
+
+class ForwarderLoop(Thread):
+    # Shared event loop, serves any number of forwarders from one thread
+    daemon = True
+    dead = False
+
+    def __init__(self):
+        super().__init__()
+        self.poller = _Poller()
+        self.pending = SimpleQueue()
+        self.nforwarders = 0
+        self.wakeup = os.pipe()
+        os.set_blocking(self.wakeup[0], False)
+        self.poller.selector.register(self.wakeup[0], _R, self.on_wakeup)
+        self.start()
+
+    def add(self, fwd):
+        self.pending.put(fwd)
+        os.write(self.wakeup[1], b'\0')
+
+    def on_wakeup(self, mask):
+        try:
+            os.read(self.wakeup[0], 4096)
+        except BlockingIOError:
+            pass
+        while not self.pending.empty():
+            fwd = self.pending.get()
+            self.nforwarders += 1
+            fwd.attach(self.poller)
+
+    def detach(self, fwd):
+        self.nforwarders -= 1
+
+    def run(self):
+        while not self.dead or self.nforwarders > 0:
+            self.poller.poll()
+        self.poller.selector.close()
+        for fd in self.wakeup: os.close(fd)
+
+    def stop(self):
+        # Waits for the forwarders that are still running to finish
+        self.dead = True
+        os.write(self.wakeup[1], b'\0')
+        self.join()
 
 class Forwarder(Thread):
     daemon = True
     port1 = None
     port2 = None
     dead = False
+    finished = False
     bindhost_out = None
     sink = None
     source = None
     state = '__init__'
     state_lock = None
+    # Update the state on every I/O operation, for debugging
+    track_state:bool = False
+    nops = None
+    btotal = None
+    bufsize = 64 * 1024
+    connect_timeout = 10
+    donefds = None
+    loop: ForwarderLoop = None
+    poller: _Poller = None
+    deadline = None
+    daddr = None
+    conn_stime = None
+    conninfo: ConnectInfo = None
+    sockopts: SockOpts = None
+    quickack = (False, False)
+    timeouts: Timeouts = None
+    # Same as for the timeouts of AsyncProxy: start, last data received per
+    # direction, when to check them next and the one the relay was ended by
+    tstart = None
+    lastact = None
+    tdeadline = None
+    expiry = None
 
-    def __init__(self, source, sink_addr, bindhost_out = None, logger = None):
+    def __init__(self, source, sink_addr, bindhost_out = None, logger = None,
+                 bufsize = None, buf_adaptive = None, resolve_async = None,
+                 connect_timeout = None, loop = None, sockopts = None,
+                 timeouts = None):
+        # The sink is always resolved and connected asynchronously, so the
+        # resolve_async is implied, the buffers are fixed-size
         self.state_lock = Lock()
+        # Same semantics as the AsyncProxy.getdonefd(): becomes readable
+        # once the relay is over and stays so
+        self.donefds = os.pipe()
+        self.done = Event()
+        self.nops = [0] * 4
+        self.btotal = [0] * 4
         self.port1 = source.getpeername()[1]
         self.port2 = None
         Thread.__init__(self)
@@ -48,8 +199,19 @@ class Forwarder(Thread):
         self.sink_addr = sink_addr
         self.bindhost_out = bindhost_out
         self.logger = logger
-        #print('Creating new pipe thread  %s ( %s -> %s )' % \
-        #    ( self, source.getpeername(), sink_addr[0] ))
+        if bufsize:
+            self.bufsize = bufsize
+        if connect_timeout:
+            self.connect_timeout = connect_timeout
+        if loop is not None:
+            self.loop = loop
+        if sockopts is not None:
+            self.sockopts = SockOpts.get(sockopts)
+        if timeouts is not None:
+            self.timeouts = Timeouts.get(timeouts)
+        self.up = _RelayBuf(self.bufsize)
+        self.down = _RelayBuf(self.bufsize)
+        self.masks = {}
 
     def setstate(self, s):
         self.state_lock.acquire()
@@ -68,130 +230,250 @@ class Forwarder(Thread):
         self.state_lock.release()
         return s
 
+    def start(self):
+        if self.loop is None:
+            Thread.start(self)
+        else:
+            # Not to block the shared loop on the name lookup
+            self.daddr = self.resolve()
+            self.loop.add(self)
+
+    def resolve(self):
+        addr, af = self.sink_addr
+        if af == socket.AF_UNIX:
+            return addr
+        return socket.getaddrinfo(addr[0], addr[1], af, socket.SOCK_STREAM)[0][4]
+
     def run(self):
+        poller = _Poller()
         try:
-            self.setstate('self.sink = socket.socket()')
+            self.attach(poller)
+            while not self.finished:
+                poller.poll()
+        finally:
+            poller.selector.close()
+
+    def attach(self, poller):
+        # Called from the thread serving the relay
+        self.poller = poller
+        try:
+            self.source.setblocking(False)
+            if self.sockopts is not None:
+                self.sockopts.apply(self.source)
+                # Per leg, see SockOpts.rearm()
+                self.quickack = [bool(self.sockopts.quickack)] * 2
+            if self.timeouts is not None and any(t for t in self.timeouts):
+                self.tstart = monotonic()
+                self.lastact = [self.tstart, self.tstart]
+                self.tdeadline = self.tstart
+                poller.timed.add(self)
+            self.setmask(self.source, _R)
+            self.setstate('self.sink.connect(%s)' % str(self.sink_addr))
+            addr = self.daddr if self.daddr is not None else self.resolve()
             self.sink = socket.socket(self.sink_addr[1], socket.SOCK_STREAM)
+            self.sink.setblocking(False)
+            if self.sockopts is not None:
+                self.sockopts.apply(self.sink)
             if self.bindhost_out != None and self.bindhost_out != '127.0.0.1':
-                self.setstate('self.sink.bind(%s)' % str(self.bindhost_out))
                 self.sink.bind((self.bindhost_out, 0))
-            self.sink.settimeout(10)
-            self.setstate('%s -> self.sink.connect(%s)' % (self.getstate(), str(self.sink_addr)))
-            self.sink.connect(self.sink_addr[0])
-            self.setstate('self.sink.getsockname()')
-            sn = self.sink.getsockname()
-            self.port2 = sn[1] if (self.sink_addr[1] != socket.AF_UNIX) else 'AF_UNIX'
-            self.setstate('flags = fcntl.fcntl(self.sink)')
-            flags = fcntl.fcntl(self.sink, fcntl.F_GETFL, 0)
-            flags = flags | os.O_NONBLOCK
-            self.setstate('fcntl.fcntl(self.sink, fcntl.F_SETFL, flags)')
-            fcntl.fcntl(self.sink, fcntl.F_SETFL, flags)
-            flags = fcntl.fcntl(self.source, fcntl.F_GETFL, 0)
-            flags = flags | os.O_NONBLOCK
-            self.setstate('fcntl.fcntl(self.source, fcntl.F_SETFL, flags)')
-            fcntl.fcntl(self.source, fcntl.F_SETFL, flags)
-            buf_up = b''
-            buf_down = b''
-            pollobj = select.poll()
-            pollobj.register(self.sink.fileno(), select.POLLIN)
-            pollobj.register(self.source.fileno(), select.POLLIN)
-            while True:
-                self.setstate('select.poll()')
-                if len(buf_up) > 0:
-                    pollobj.modify(self.sink.fileno(), select.POLLIN | select.POLLOUT)
-                else:
-                    pollobj.modify(self.sink.fileno(), select.POLLIN)
-                if len(buf_down) > 0:
-                    pollobj.modify(self.source.fileno(), select.POLLIN | select.POLLOUT)
-                else:
-                    pollobj.modify(self.source.fileno(), select.POLLIN)
-
-                for fd, event in pollobj.poll():
-                    if event & select.POLLIN != 0:
-                        if fd == self.sink.fileno():
-                            self.setstate('self.sink.recv()')
-                            try:
-                                data = self.sink.recv(1024 * 8)
-                            except:
-                                data = b''
-                        else:
-                            self.setstate('self.source.recv()')
-                            try:
-                                data = self.source.recv(1024 * 8)
-                            except:
-                                data = b''
-                        #print(self, 'received %d bytes' % len(data))
-                        if not data:
-                            if fd == self.source.fileno():
-                                buf_down = b''
-                            else:
-                                buf_up = b''
-                            if len(buf_up) == 0 and len(buf_down) == 0:
-                                self.setstate('self.shutdown(autoshutdown = True) line 80')
-                                self.shutdown()
-                                return
-                            else:
-                                continue
-                        if fd == self.source.fileno():
-                            buf_up += data
-                        else:
-                            buf_down += data
-                    if event & select.POLLOUT != 0:
-                        if fd == self.sink.fileno():
-                            self.setstate('self.sink.send(buf_up)')
-                            try:
-                                size = self.sink.send(buf_up)
-                                buf_up = buf_up[size:]
-                            except:
-                                buf_up = b''
-                        else:
-                            self.setstate('size = self.source.send(buf_down)')
-                            try:
-                                size = self.source.send(buf_down)
-                                buf_down = buf_down[size:]
-                            except:
-                                buf_down = b''
-                        #print(self, 'sent %d bytes' % size)
-        except socket.timeout as e:
-            if self.dead:
-                return
-            self.log('timed out when processing data in state %s: %s' % (self.getstate(), str(e)))
-        except select.error as e:
-            if self.dead:
-                return
-            if e.errno == EINTR:
-                # Ignoring 'Interrupted system call'
-                pass
+            self.daddr = addr
+            self.conn_stime = monotonic()
+            err = self.sink.connect_ex(addr)
+            if err == 0:
+                self.connected()
+            elif err == EINPROGRESS:
+                self.deadline = monotonic() + self.connect_timeout
+                poller.connecting.add(self)
+                self.setmask(self.sink, _W)
             else:
-                self.log("got select.error exception: %s" % str(e))
+                raise OSError(err, os.strerror(err))
         except Exception as e:
-            if self.dead:
+            self.failed(e)
+
+    def connected(self):
+        addr, af = self.daddr, self.sink_addr[1]
+        self.conninfo = ConnectInfo(addr[0] if af != socket.AF_UNIX else addr,
+                                    addr[1] if af != socket.AF_UNIX else 0, af, 1,
+                                    monotonic() - self.conn_stime)
+        sn = self.sink.getsockname()
+        self.port2 = sn[1] if (self.sink_addr[1] != socket.AF_UNIX) else 'AF_UNIX'
+        self.setstate('relaying')
+        self.update()
+
+    def check_timeouts(self, now):
+        # Ends the relay once any of the timeouts has run out, otherwise
+        # moves the deadline to when the first one would
+        to, la = self.timeouts, self.lastact
+        dues = ((to.idle, max(la)), (to.in2out_idle, la[0]), (to.out2in_idle, la[1]),
+                (to.lifetime, self.tstart))
+        reason, due = min(((r, since + t) for r, (t, since) in zip(ExpiryStats._fields, dues)
+                           if t), key = lambda x: x[1])
+        if now < due:
+            self.tdeadline = due
+            return
+        self.expiry = reason
+        self.finish()
+
+    def connect_timedout(self):
+        self.poller.connecting.discard(self)
+        self.log('timed out when connecting to %s' % str(self.sink_addr))
+        self.finish()
+
+    def failed(self, e):
+        if not self.dead:
+            self.log('exception when processing data in state %s: %s' % (self.getstate(), str(e)))
+            if not isinstance(e, OSError):
+                self.log('-' * 70)
+                self.log(traceback.format_exc())
+                self.log('-' * 70, True)
+        self.finish()
+
+    def setmask(self, sock, mask):
+        omask = self.masks.get(sock, 0)
+        if mask == omask:
+            return
+        sel = self.poller.selector
+        if omask == 0:
+            sel.register(sock, mask, self.on_source if sock is self.source else self.on_sink)
+        elif mask == 0:
+            sel.unregister(sock)
+        else:
+            sel.modify(sock, mask, self.on_source if sock is self.source else self.on_sink)
+        self.masks[sock] = mask
+
+    def update(self):
+        # Recomputes poll interest after some I/O, finishes once either side
+        # is gone and the data it has sent is flushed out to the other one
+        up, down = self.up, self.down
+        if (up.eof and up.pending() == 0) or (down.eof and down.pending() == 0):
+            self.finish()
+            return
+        smask = (_R if not up.eof and up.space() > 0 else 0) | (_W if down.pending() > 0 else 0)
+        self.setmask(self.source, smask)
+        if self.deadline is None:
+            kmask = (_R if not down.eof and down.space() > 0 else 0) | (_W if up.pending() > 0 else 0)
+            self.setmask(self.sink, kmask)
+
+    def flush_up(self):
+        if self.track_state: self.state = 'self.sink.send()'
+        n = self.up.send(self.sink)
+        self.nops[_SINK_OUT] += 1
+        self.btotal[_SINK_OUT] += n
+
+    def flush_down(self):
+        if self.track_state: self.state = 'self.source.send()'
+        n = self.down.send(self.source)
+        self.nops[_SOURCE_OUT] += 1
+        self.btotal[_SOURCE_OUT] += n
+
+    def on_source(self, mask):
+        if self.finished:
+            return
+        try:
+            if mask & _W:
+                self.flush_down()
+            if mask & _R:
+                if self.track_state: self.state = 'self.source.recv_into()'
+                n = self.up.recv(self.source)
+                if n == 0:
+                    self.up.eof = True
+                else:
+                    self.nops[_SOURCE_IN] += 1
+                    self.btotal[_SOURCE_IN] += n
+                    if self.quickack[0]:
+                        self.quickack[0] = self.sockopts.rearm(self.source)
+                    if self.lastact is not None:
+                        self.lastact[0] = monotonic()
+                    # Try writing it out right away, saves a poll round
+                    if self.deadline is None and self.masks.get(self.sink, 0) & _W == 0:
+                        self.flush_up()
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:
+            self.failed(e)
+            return
+        self.update()
+
+    def on_sink(self, mask):
+        if self.finished:
+            return
+        try:
+            if self.deadline is not None:
+                self.poller.connecting.discard(self)
+                self.deadline = None
+                err = self.sink.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err != 0:
+                    raise OSError(err, os.strerror(err))
+                self.connected()
                 return
-            self.log('unhandled exception when processing data in state %s' % self.getstate())
-            self.log('-' * 70)
-            self.log(traceback.format_exc())
-            self.log('-' * 70, True)
-            self.setstate('self.shutdown(autoshutdown = True) #1')
-            self.shutdown()
-            self.log('shutting down channel')
-            raise e
-        self.setstate('self.shutdown(autoshutdown = True) #2')
-        self.shutdown()
+            if mask & _W:
+                self.flush_up()
+            if mask & _R:
+                if self.track_state: self.state = 'self.sink.recv_into()'
+                n = self.down.recv(self.sink)
+                if n == 0:
+                    self.down.eof = True
+                else:
+                    self.nops[_SINK_IN] += 1
+                    self.btotal[_SINK_IN] += n
+                    if self.quickack[1]:
+                        self.quickack[1] = self.sockopts.rearm(self.sink)
+                    if self.lastact is not None:
+                        self.lastact[1] = monotonic()
+                    if self.masks.get(self.source, 0) & _W == 0:
+                        self.flush_down()
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:
+            self.failed(e)
+            return
+        self.update()
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        self.poller.connecting.discard(self)
+        self.poller.timed.discard(self)
+        for s in (self.source, self.sink):
+            if s is not None and self.masks.get(s, 0) != 0:
+                self.poller.selector.unregister(s)
+        self.state_lock.acquire()
+        self.dead = True
+        self.state = 'finished' if self.expiry is None else f'finished ({self.expiry} timeout)'
+        for s in (self.sink, self.source):
+            if s is not None:
+                s.close()
+        self.sink = None
+        self.source = None
+        self.state_lock.release()
+        if self.loop is not None:
+            self.loop.detach(self)
+        os.write(self.donefds[1], b'\0')
+        self.done.set()
 
     def shutdown(self):
+        # Wakes up the thread serving the relay, which then finishes it
         self.state_lock.acquire()
         if self.dead:
             self.state_lock.release()
             return
         self.dead = True
-        if self.sink != None:
-            self.sink.close()
-            self.sink = None
-        if self.source != None:
-            self.source.close()
-            self.source = None
+        for s in (self.sink, self.source):
+            if s is None:
+                continue
+            try:
+                s.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
         self.state_lock.release()
 
+    def join(self, timeout = None):
+        if self.loop is None:
+            Thread.join(self, timeout)
+        else:
+            self.done.wait(timeout)
+
     def log(self, msg, flush = False):
         msg = 'Forwarder[%d]: %s' % (hash(self), msg)
         if self.logger != None:
@@ -202,4 +484,25 @@ class Forwarder(Thread):
                 sys.stdout.flush()
 
     def isAlive(self):
-        return self.is_alive()
+        if self.loop is None:
+            return self.is_alive()
+        return not self.done.is_set()
+
+    def getdonefd(self):
+        return self.donefds[0]
+
+    def getconninfo(self):
+        # Same as AsyncProxy.getconninfo(), None until connected
+        return self.conninfo
+
+    def getexpiry(self):
+        # Same as AsyncProxy.getexpiry()
+        return self.expiry
+
+    def getstats(self):
+        return ProxyStats(*(IOStats(n, b) for n, b in zip(self.nops, self.btotal)))
+
+    def __del__(self):
+        if self.donefds is not None:
+            for fd in self.donefds: os.close(fd)
+            self.donefds = None
@@ -34,9 +34,9 @@ class ForwarderFast(AsyncProxy):
     source = None
     state = '__init__'
 
-    def __init__(self, source, sink_addr, bindhost_out = None, logger = None):
+    def __init__(self, source, sink_addr, bindhost_out = None, logger = None, **kwa):
         addr, port = (sink_addr[0], 0) if (sink_addr[1] == socket.AF_UNIX) else sink_addr[0]
-        AsyncProxy.__init__(self, source.fileno(), addr, port, sink_addr[1], bindhost_out)
+        AsyncProxy.__init__(self, source.fileno(), addr, port, sink_addr[1], bindhost_out, **kwa)
         self.source = source
         self.port1 = source.getpeername()[1]
         if self.debug:
@@ -47,6 +47,10 @@ class ForwarderFast(AsyncProxy):
 
     def describe(self):
         s = 'Forwarder(%s) ( %s -> %s ), state = %s' % (self, self.port1, self.port2, AsyncProxy.describe(self))
+        ci = self.getconninfo()
+        if ci is not None:
+            s += ', connected to %s:%d in %.1f ms (%d attempt(s))' % \
+              (ci.addr, ci.port, ci.time * 1000, ci.attempts)
         return s
 
     def shutdown(self):
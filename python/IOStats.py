@@ -0,0 +1,210 @@
+# Copyright (c) 2026 Sippy Software, Inc. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import socket
+from collections import namedtuple
+
+class IOStats(namedtuple('IOStats', ('nops', 'btotal'), defaults = (0, 0))):
+    def __add__(self, other):
+        return IOStats(self.nops + other.nops, self.btotal + other.btotal)
+
+class ProxyStats(namedtuple('ProxyStats', ('source_in', 'source_out', 'sink_in', 'sink_out'),
+                            defaults = (IOStats(),) * 4)):
+    # Counters for both legs of a relay: source_in is what has been read from
+    # the client side, sink_out is what has been written to the destination
+    # and so on.
+    def __add__(self, other):
+        return ProxyStats(*(a + b for a, b in zip(self, other)))
+
+class ResolverStats(namedtuple('ResolverStats', ('hits', 'misses', 'failures'))):
+    # Name resolution cache counters, failures are misses that getaddrinfo()
+    # could not resolve either.
+    pass
+
+class ConnectInfo(namedtuple('ConnectInfo', ('addr', 'port', 'af', 'attempts', 'time'))):
+    # Destination address picked out of the resolved ones, number of
+    # connection attempts made and the time (in seconds) it took to connect.
+    pass
+
+class AcceptStats(namedtuple('AcceptStats', ('accepted', 'rejected', 'rate', 'queued',
+                                             'backlog', 'pending'))):
+    # Listener counters: connections accepted/rejected in total, accepts
+    # per second, connections waiting in the kernel accept queue (None when
+    # unknown) out of the backlog and the ones waiting for the forwarder to
+    # be set up.
+    pass
+
+class UpstreamStats(namedtuple('UpstreamStats', ('addr', 'active', 'conns', 'failures',
+                                                 'latency', 'ejected'))):
+    # Load balancer view of an upstream: active and total connections sent
+    # to it, failed connects, connect latency average (in seconds, None
+    # until known) and whether it is currently out of the rotation.
+    pass
+
+class ShapingStats(namedtuple('ShapingStats', ('nthrottled', 'throttled', 'deferred'))):
+    # Rate limiting counters for one direction: number of times the relay
+    # ran out of tokens, total time (in seconds) it spent waiting for them
+    # and bytes that were queued up in the socket at those points.
+    pass
+
+class MemStats(namedtuple('MemStats', ('buffered', 'allocated', 'wm_pauses',
+                                       'budget_pauses'))):
+    # Data held by the relay(s) not yet written out and the size of relay
+    # buffers, in bytes, and the number of times reading had to be paused
+    # over the high watermark or the process-wide budget.
+    pass
+
+class PoolStats(namedtuple('PoolStats', ('inuse', 'cached', 'hits', 'misses'))):
+    # Shared relay buffer pool: bytes handed out and kept for reuse, and the
+    # number of buffers taken from the pool and newly allocated.
+    pass
+
+class DgramStats(namedtuple('DgramStats', ('sessions', 'sessions_total', 'expired',
+                                           'dropped'))):
+    # Datagram relay counters: client sessions open and opened in total,
+    # sessions closed for being idle and datagrams that were not relayed
+    # (too big, dropped by a transform or refused on the way out).
+    pass
+
+class LatencyHist(namedtuple('LatencyHist', ('count', 'sum', 'max', 'buckets'))):
+    # Log2-scale histogram of durations, in nanoseconds: buckets[n] is the
+    # number of samples in the [2^n, 2^(n+1)) range.
+    def __add__(self, other):
+        return LatencyHist(self.count + other.count, self.sum + other.sum,
+                           max(self.max, other.max),
+                           tuple(a + b for a, b in zip(self.buckets, other.buckets)))
+
+    def mean(self):
+        return (self.sum / self.count / 1e9) if self.count > 0 else None
+
+    def percentile(self, q):
+        # Upper bound (in seconds) of the bucket holding the q-th percentile
+        if self.count == 0:
+            return None
+        limit = self.count * q / 100.0
+        total = 0
+        for n, b in enumerate(self.buckets):
+            total += b
+            if total >= limit:
+                return min(2 ** (n + 1), self.max) / 1e9
+        return self.max / 1e9
+
+class ProxyHists(namedtuple('ProxyHists', ('in2out_flush', 'out2in_flush',
+                                           'in2out_transform', 'out2in_transform'))):
+    # Time from data being received till it's all flushed out to the other
+    # side, and time spent in the transform hooks (including waiting for the
+    # GIL), per direction.
+    def __add__(self, other):
+        return ProxyHists(*(a + b for a, b in zip(self, other)))
+
+class Timeouts(namedtuple('Timeouts', ('idle', 'in2out_idle', 'out2in_idle', 'lifetime'),
+                          defaults = (None,) * 4)):
+    # Relay timeouts in seconds, None for none: idle is for no data received
+    # either way, in2out_idle/out2in_idle for none in that direction and the
+    # lifetime is counted from the start. The relay is ended once any of them
+    # runs out.
+    @classmethod
+    def get(cls, timeouts):
+        # Timeouts for a number (the idle one), a dict of them or Timeouts
+        # itself
+        if isinstance(timeouts, (int, float)):
+            return cls(idle = timeouts)
+        if isinstance(timeouts, dict):
+            return cls(**timeouts)
+        return timeouts
+
+class ExpiryStats(namedtuple('ExpiryStats', ('idle', 'in2out_idle', 'out2in_idle', 'lifetime'),
+                             defaults = (0,) * 4)):
+    # Number of relays ended by each of the Timeouts, the field names are
+    # the expiry reasons reported by getexpiry().
+    def __add__(self, other):
+        return ExpiryStats(*(a + b for a, b in zip(self, other)))
+
+    def add(self, reason):
+        # Adds one for the reason (None is for no expiry)
+        if reason is None:
+            return self
+        return self._replace(**{reason: getattr(self, reason) + 1})
+
+class SockOpts(namedtuple('SockOpts', ('nodelay', 'sndbuf', 'rcvbuf', 'notsent_lowat',
+                                       'quickack', 'keepalive', 'tos'),
+                          defaults = (None,) * 7)):
+    # Socket options applied to both legs of a relay, the ones that are None
+    # are left alone. As read back from a proxy, None stands for options that
+    # do not apply to the socket (i.e. TCP ones on a UNIX socket). Note that
+    # the kernel may adjust the values, e.g. Linux doubles the buffer sizes.
+    @classmethod
+    def get(cls, opts):
+        # SockOpts for a profile name (see SOCKOPT_PROFILES), a dict of the
+        # options or SockOpts itself
+        if isinstance(opts, str):
+            try:
+                return SOCKOPT_PROFILES[opts]
+            except KeyError:
+                raise ValueError(f'unknown socket option profile "{opts}"') from None
+        if isinstance(opts, dict):
+            return cls(**opts)
+        return opts
+
+    def apply(self, sock):
+        # Best effort, the way the library does it: options that do not
+        # apply to the socket are skipped, the rest are attempted even if
+        # some have failed.
+        if sock.family not in (socket.AF_INET, socket.AF_INET6):
+            return
+        istcp = sock.type == socket.SOCK_STREAM
+        tos = (socket.IPPROTO_IP, socket.IP_TOS) if sock.family == socket.AF_INET \
+          else (socket.IPPROTO_IPV6, getattr(socket, 'IPV6_TCLASS', None))
+        optdefs = ((socket.IPPROTO_TCP, socket.TCP_NODELAY),
+                   (socket.SOL_SOCKET, socket.SO_SNDBUF),
+                   (socket.SOL_SOCKET, socket.SO_RCVBUF),
+                   (socket.IPPROTO_TCP, getattr(socket, 'TCP_NOTSENT_LOWAT', None)),
+                   (socket.IPPROTO_TCP, getattr(socket, 'TCP_QUICKACK', None)),
+                   (socket.SOL_SOCKET, socket.SO_KEEPALIVE), tos)
+        for val, (level, name) in zip(self, optdefs):
+            if val is None or name is None or (level == socket.IPPROTO_TCP and not istcp):
+                continue
+            try:
+                sock.setsockopt(level, name, int(val))
+            except OSError:
+                pass
+
+    def rearm(self, sock):
+        # Linux drops back to the delayed ACKs on its own shortly after
+        # TCP_QUICKACK is set, so it only sticks if set again after each
+        # read. Returns False if it does not apply to the socket.
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+        except (OSError, AttributeError):
+            return False
+        return True
+
+# Named presets for the sockopts of the proxies: low-latency is for
+# interactive traffic (no Nagle, no delayed ACKs, little data queued up in
+# the kernel), bulk is for throughput. TCP_QUICKACK is one-shot on Linux, the
+# relays set it again after each read.
+SOCKOPT_PROFILES = {
+    'low-latency': SockOpts(nodelay = True, quickack = True, notsent_lowat = 16 * 1024,
+                            keepalive = True),
+    'bulk': SockOpts(nodelay = False, sndbuf = 4 * 1024 * 1024, rcvbuf = 4 * 1024 * 1024),
+}
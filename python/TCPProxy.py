@@ -22,11 +22,13 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import sys
-from threading import Thread
-import socket, os, select
+from threading import Thread, Lock, Condition
+from itertools import count
+from queue import SimpleQueue
+import socket, os, select, struct
 import traceback
-from time import sleep, strftime
-from errno import EADDRINUSE, ECONNRESET, EINTR
+from time import sleep, strftime, monotonic
+from errno import EADDRINUSE, ECONNRESET, ECONNABORTED
 
 try:
     from ctypes import ArgumentError
@@ -39,14 +41,75 @@ try:
 except:
     from .Forwarder import Forwarder
 
+from .IOStats import ProxyStats, AcceptStats, ExpiryStats
+
+class ForwarderReaper(Thread):
+    # Waits for the completion fds of the registered forwarders to become
+    # readable and passes their ids to the callback, so that finished ones
+    # are reaped as they go, without the accept loop ever scanning for them.
+    daemon = True
+    dead = False
+
+    def __init__(self, on_done):
+        super().__init__()
+        self.on_done = on_done
+        self.lock = Lock()
+        self.watched = {}
+        self.poller = select.poll()
+        self.wakeup = os.pipe()
+        os.set_blocking(self.wakeup[0], False)
+        self.poller.register(self.wakeup[0], select.POLLIN)
+
+    def watch(self, fd, fid):
+        with self.lock:
+            self.watched[fd] = fid
+            self.poller.register(fd, select.POLLIN)
+        os.write(self.wakeup[1], b'\0')
+
+    def stop(self):
+        self.dead = True
+        os.write(self.wakeup[1], b'\0')
+        self.join()
+        for fd in self.wakeup: os.close(fd)
+
+    def run(self):
+        while not self.dead:
+            for fd, flag in self.poller.poll():
+                if fd == self.wakeup[0]:
+                    try:
+                        os.read(fd, 4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                with self.lock:
+                    fid = self.watched.pop(fd, None)
+                    if fid is None:
+                        continue
+                    self.poller.unregister(fd)
+                self.on_done(fid)
+
 class TCPProxyBase(Thread):
     daemon = True
     dead = False
     debug = False
-    forwarders = None
+    forwarders: dict = None
+    reaped_stats: ProxyStats = None
+    stats_lock = None
+    reaper: ForwarderReaper = None
     allowed_ips: tuple = None
     bindhost_out = None
     disc_cb:callable = None
+    forwarder_class:callable = None
+    bufsize:int = None
+    buf_adaptive:bool = None
+    resolve_async:bool = None
+    connect_timeout:float = None
+    # Socket options for both legs of the forwarders, a SOCKOPT_PROFILES
+    # name, a SockOpts or a dict of them
+    sockopts = None
+    # Timeouts of the forwarders, see AsyncProxyBase.timeouts
+    timeouts = None
+    reaped_expiry: ExpiryStats = None
 
     def __init__(self, port, newhost, newport = None, bindhost = '127.0.0.1', logger = None, newaf = None):
         if newaf is None:
@@ -74,7 +137,13 @@ class TCPProxyBase(Thread):
                 sock.bind(bindaddr)
         self.port = port if (port != 0) else sock.getsockname()[1]
         self.sock = sock
-        self.forwarders = []
+        self.forwarders = {}
+        self.fids = count()
+        self.reaped_stats = ProxyStats()
+        self.reaped_expiry = ExpiryStats()
+        self.stats_lock = Condition()
+        self.reaper = ForwarderReaper(self.reap_forwarder)
+        self.reaper.start()
 
     def dprint(self, get_msg):
         if not self.debug: return
@@ -82,42 +151,98 @@ class TCPProxyBase(Thread):
         sys.stderr.flush()
 
     def spawn_forwarder(self, newsock):
-        daddr = (self.newhost, self.newport) if (self.newaf != socket.AF_UNIX) else self.newhost
+        fwd = self.make_forwarder(newsock)
+        if fwd is None:
+            return None
+        return self.register_forwarder(fwd)
+
+    def make_forwarder(self, newsock, sink_addr = None):
+        # Creates and starts a forwarder to the sink_addr, a (daddr, af)
+        # tuple (the proxy destination by default), None on failure
+        if sink_addr is None:
+            daddr = (self.newhost, self.newport) if (self.newaf != socket.AF_UNIX) else self.newhost
+            sink_addr = (daddr, self.newaf)
         try:
-            fwd = Forwarder(newsock, (daddr, self.newaf), self.bindhost_out, logger = self.logger)
-            self.forwarders.append(fwd)
+            fwd_class = Forwarder if self.forwarder_class is None else self.forwarder_class
+            fwd = fwd_class(newsock, sink_addr, self.bindhost_out, logger = self.logger,
+                            bufsize = self.bufsize, buf_adaptive = self.buf_adaptive,
+                            resolve_async = self.resolve_async,
+                            connect_timeout = self.connect_timeout,
+                            sockopts = self.sockopts, timeouts = self.timeouts)
             fwd.start()
         except Exception:
             if self.dead:
-                return
-            dst = f'{self.newhost}:{self.newport}' if (self.newaf != socket.AF_UNIX) else f'"{self.newhost}"'
+                return None
+            daddr, af = sink_addr
+            dst = f'{daddr[0]}:{daddr[1]}' if (af != socket.AF_UNIX) else f'"{daddr}"'
             self.log(f'setting up redirection to {dst} failed')
             self.log('-' * 70)
             self.log(traceback.format_exc())
             self.log('-' * 70, True)
             sleep(0.01)
-            return
-
-        forwarders = []
-        for fwd in self.forwarders:
-            if fwd.isAlive():
-                forwarders.append(fwd)
-            else:
-                self.dprint(lambda: f'joinning forwarder: {fwd.describe()}')
-                fwd.join()
-                self.dprint(lambda: f'joinning forwarder done: {fwd.describe()}')
-        self.forwarders = forwarders
+            return None
+        return fwd
+
+    def register_forwarder(self, fwd):
+        fid = next(self.fids)
+        with self.stats_lock:
+            self.forwarders[fid] = fwd
+        self.reaper.watch(fwd.getdonefd(), fid)
+        return fid
+
+    def reap_forwarder(self, fid):
+        # Called by the reaper once the forwarder is done, join() won't block
+        with self.stats_lock:
+            fwd = self.forwarders.pop(fid)
+            self.dprint(lambda: f'joinning forwarder: {fwd.describe()}')
+            fwd.join()
+            self.reaped_stats += fwd.getstats()
+            self.reaped_expiry = self.reaped_expiry.add(fwd.getexpiry())
+            self.forwarder_done(fwd)
+            self.stats_lock.notify_all()
+
+    def forwarder_done(self, fwd):
+        # Hook for the subclasses, called with the stats_lock held
+        pass
+
+    def wait_forwarders(self, fid = None):
+        # Blocks until the given (or all) forwarder(s) have been reaped
+        with self.stats_lock:
+            while (fid in self.forwarders) if fid is not None else len(self.forwarders) > 0:
+                self.stats_lock.wait()
+
+    def stats(self):
+        # Totals across all the forwarders, both active and already gone
+        with self.stats_lock:
+            res = self.reaped_stats
+            forwarders = tuple(self.forwarders.values())
+        for fwd in forwarders:
+            res += fwd.getstats()
+        return res
+
+    def expiry_stats(self):
+        # ExpiryStats of the forwarders that have been ended by the timeouts
+        with self.stats_lock:
+            return self.reaped_expiry
 
     def shutdown(self):
         self.dead = True
-        while len(self.forwarders) > 0:
-            forwarder = self.forwarders.pop()
+        with self.stats_lock:
+            forwarders = tuple(self.forwarders.values())
+        for forwarder in forwarders:
             self.dprint(lambda: f'shutting down forwarder: {forwarder.describe()}')
             if forwarder.isAlive():
                 forwarder.shutdown()
-            forwarder.join()
         self.sock.close()
         self.join()
+        # Catches the ones spawned while shutting down as well
+        with self.stats_lock:
+            forwarders = tuple(self.forwarders.values())
+        for forwarder in forwarders:
+            if forwarder.isAlive():
+                forwarder.shutdown()
+        self.wait_forwarders()
+        self.reaper.stop()
 
     def log(self, msg, flush = False):
         msg = 'TCPProxy[%d]: %s' % (hash(self), msg)
@@ -136,24 +261,103 @@ class TCPProxyActive(TCPProxyBase):
 
     def run(self):
         self.sock.connect(self.destaddr)
-        self.spawn_forwarder(self.sock)
-        self.forwarders[0].join()
+        fid = self.spawn_forwarder(self.sock)
+        if fid is not None:
+            self.wait_forwarders(fid)
         if self.disc_cb is not None:
             # pylint: disable-next=not-callable
             self.disc_cb()
             self.disc_cb = None
 
 class TCPProxy(TCPProxyBase):
-    def __init__(self, *a, **kwa):
+    backlog:int = 500
+    setup_threads:int = 1
+    handoff: SimpleQueue = None
+    naccepted:int = 0
+    nrejected:int = 0
+    acc_sec:int = 0
+    acc_cur:int = 0
+    acc_prev:int = 0
+
+    def __init__(self, *a, backlog = None, **kwa):
         super().__init__(*a, **kwa)
-        self.sock.listen(500)
+        if backlog is not None:
+            self.backlog = backlog
+        self.sock.setblocking(False)
+        self.sock.listen(self.backlog)
+        self.handoff = SimpleQueue()
 
     def access_check(self, address):
         if self.allowed_ips is None or address[0] in self.allowed_ips:  # pylint: disable=unsupported-membership-test
             return True
         return False
 
+    def accept_stats(self):
+        # Accept rate is the number of connections taken during the last
+        # full second, the queue depth (Linux only) is the number of the
+        # established connections waiting in the kernel to be accepted.
+        queued, backlog = None, self.backlog
+        if hasattr(socket, 'TCP_INFO'):
+            try:
+                ti = self.sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 32)
+                queued, backlog = struct.unpack_from('II', ti, 24)
+            except OSError:
+                pass
+        ago = int(monotonic()) - self.acc_sec
+        rate = (self.acc_prev, self.acc_cur, 0)[min(ago, 2)]
+        return AcceptStats(self.naccepted, self.nrejected, rate, queued, backlog,
+                           self.handoff.qsize())
+
+    def count_accepts(self, n):
+        now = int(monotonic())
+        if now != self.acc_sec:
+            self.acc_prev = self.acc_cur if (now == self.acc_sec + 1) else 0
+            self.acc_cur = 0
+            self.acc_sec = now
+        self.acc_cur += n
+        self.naccepted += n
+
+    def setup_loop(self):
+        # Forwarders are set up out of the accept loop, so that a slow
+        # constructor never holds up accepting
+        while (newsock := self.handoff.get()) is not None:
+            if self.dead:
+                newsock.close()
+                continue
+            self.spawn_forwarder(newsock)
+
+    def accept_all(self):
+        # Drains the accept queue, socket.accept() is accept4(SOCK_CLOEXEC)
+        # where available
+        naccepted = 0
+        while not self.dead:
+            try:
+                newsock, address = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            except socket.error as e:
+                if self.dead:
+                    break
+                if e.errno in (ECONNRESET, ECONNABORTED):
+                    # Ignore 'Connection reset by peer'
+                    self.log("Ignoring 'Connection reset by peer'")
+                    continue
+                self.log("got socket.error exception: %s" % str(e))
+                break
+            self.dprint(lambda: f'{newsock=}, {address=}')
+            naccepted += 1
+            if not self.access_check(address):
+                self.nrejected += 1
+                newsock.close()
+                self.log('connection attempt from the unknown IP %s has been rejected' % address[0])
+                continue
+            self.handoff.put(newsock)
+        if naccepted > 0:
+            self.count_accepts(naccepted)
+
     def run(self):
+        setup = [Thread(target = self.setup_loop, daemon = True) for i in range(self.setup_threads)]
+        for t in setup: t.start()
         poller = select.poll()
         READ_ONLY = select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR
         poller.register(self.sock.fileno(), READ_ONLY)
@@ -164,38 +368,12 @@ class TCPProxy(TCPProxyBase):
             if len(events) == 0:
                 continue
             fd, flag = events[0]
-            if flag & select.POLLHUP:
+            if flag & (select.POLLHUP | select.POLLNVAL):
                 break
-            if not flag & (select.POLLIN | select.POLLPRI):
-                continue
-            try:
-                self.dprint(lambda: 'self.sock.accept()')
-                newsock, address = self.sock.accept()
-                self.dprint(lambda: f'{newsock=}, {address=}')
-                if self.dead:
-                    self.log('ignore connection attempt from IP %s during shutdown' % address[0])
-                    newsock.shutdown(socket.SHUT_RDWR)
-                    newsock.close()
-                    continue
-                if not self.access_check(address):
-                    newsock.shutdown(socket.SHUT_RDWR)
-                    newsock.close()
-                    self.log('connection attempt from the unknown IP %s has been rejected' % address[0])
-                    continue
-            except socket.error as e:
-                if self.dead:
-                    return
-                if e.errno == ECONNRESET:
-                    # Ignore 'Connection reset by peer'
-                    self.log("Ignoring 'Connection reset by peer'")
-                    continue
-                elif e.errno == EINTR:
-                    # Ignore 'Interrupted system call'
-                    self.log("Ignoring 'Interrupted system call'")
-                    continue
-                self.log("got socket.error exception: %s" % str(e))
-                continue
-            self.spawn_forwarder(newsock)
+            if flag & (select.POLLIN | select.POLLPRI):
+                self.accept_all()
+        for t in setup: self.handoff.put(None)
+        for t in setup: t.join()
         if self.disc_cb is not None:
             # pylint: disable-next=not-callable
             self.disc_cb()
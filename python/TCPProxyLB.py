@@ -0,0 +1,149 @@
+# Copyright (c) 2026 Sippy Software, Inc. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# TCPProxy in front of a pool of upstreams: each connection goes to one of
+# them, picked by round-robin, least active connections or smooth weighted
+# round-robin. Upstreams are passively health checked: connect failures (and
+# connects slower than slow_connect, if set) are counted as they are reaped,
+# and the ones failing max_failures times in a row are ejected from the
+# rotation for eject_time seconds.
+
+import socket
+from time import monotonic
+
+from .TCPProxy import TCPProxy
+from .IOStats import UpstreamStats
+
+class Upstream(object):
+    # Either a (host, port) tuple or an AF_UNIX path
+    af:int = None
+    weight:int = 1
+    active:int = 0
+    nconns:int = 0
+    nfailures:int = 0
+    failures:int = 0
+    latency:float = None
+    ejected_until:float = 0.0
+    cweight:int = 0
+
+    def __init__(self, addr, weight:int = 1, af:int = None):
+        if af is None:
+            af = socket.AF_UNIX if isinstance(addr, str) else socket.AF_INET
+        self.addr = addr
+        self.af = af
+        self.weight = weight
+
+    def __str__(self):
+        return f'{self.addr[0]}:{self.addr[1]}' if (self.af != socket.AF_UNIX) else f'"{self.addr}"'
+
+    def stats(self, now):
+        return UpstreamStats(self.addr, self.active, self.nconns, self.nfailures,
+                             self.latency, self.ejected_until > now)
+
+class TCPProxyLB(TCPProxy):
+    policy:str = 'round_robin'
+    max_failures:int = 3
+    eject_time:float = 10.0
+    slow_connect:float = None
+    # Weight of the latest sample in the connect latency average
+    latency_alpha:float = 0.3
+    upstreams: list = None
+    assigned: dict = None
+    rrnext:int = 0
+
+    def __init__(self, port, upstreams, bindhost = '127.0.0.1', logger = None,
+                 policy = None, **kwa):
+        if policy is not None:
+            self.policy = policy
+        if self.policy not in ('round_robin', 'least_conn', 'weighted'):
+            raise ValueError(f'unknown balancing policy: {self.policy}')
+        super().__init__(port, None, bindhost = bindhost, logger = logger, **kwa)
+        self.upstreams = [u if isinstance(u, Upstream) else Upstream(u) for u in upstreams]
+        if len(self.upstreams) == 0:
+            raise ValueError('no upstreams given')
+        self.assigned = {}
+
+    def pick_upstream(self):
+        # Called with the stats_lock held. If all of them are ejected, it's
+        # better to try one anyway than to refuse the connection.
+        now = monotonic()
+        ups = [u for u in self.upstreams if u.ejected_until <= now] or self.upstreams
+        if self.policy == 'least_conn':
+            return min(ups, key = lambda u: u.active / u.weight)
+        if self.policy == 'weighted':
+            total = 0
+            for u in ups:
+                u.cweight += u.weight
+                total += u.weight
+            best = max(ups, key = lambda u: u.cweight)
+            best.cweight -= total
+            return best
+        self.rrnext += 1
+        return ups[self.rrnext % len(ups)]
+
+    def spawn_forwarder(self, newsock):
+        with self.stats_lock:
+            up = self.pick_upstream()
+            up.active += 1
+            up.nconns += 1
+        fwd = self.make_forwarder(newsock, (up.addr, up.af))
+        if fwd is None:
+            with self.stats_lock:
+                up.active -= 1
+                self.upstream_result(up, None)
+            newsock.close()
+            return None
+        # Before the forwarder is registered, so that it can't be reaped first
+        with self.stats_lock:
+            self.assigned[fwd] = up
+        return self.register_forwarder(fwd)
+
+    def forwarder_done(self, fwd):
+        up = self.assigned.pop(fwd)
+        up.active -= 1
+        # Not a failure of the upstream if we are the ones cutting it short
+        ci = fwd.getconninfo()
+        if ci is not None or not self.dead:
+            self.upstream_result(up, ci)
+
+    def upstream_result(self, up, ci):
+        # Passive health check, with the stats_lock held
+        if ci is not None:
+            a = self.latency_alpha
+            up.latency = ci.time if up.latency is None else (a * ci.time + (1 - a) * up.latency)
+            if self.slow_connect is None or ci.time <= self.slow_connect:
+                up.failures = 0
+                return
+        up.failures += 1
+        up.nfailures += 1
+        if up.failures < self.max_failures:
+            return
+        up.ejected_until = monotonic() + self.eject_time
+        # On probation once back: one more failure ejects it again
+        up.failures = self.max_failures - 1
+        self.log(f'upstream {up} ejected for {self.eject_time} seconds')
+
+    def upstream_stats(self):
+        now = monotonic()
+        with self.stats_lock:
+            return tuple(u.stats(now) for u in self.upstreams)
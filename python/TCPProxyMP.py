@@ -0,0 +1,301 @@
+# Copyright (c) 2026 Sippy Software, Inc. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Multi-process TCPProxy: the parent only accepts connections and passes
+# them over (SCM_RIGHTS) to a set of worker processes, each running its own
+# forwarders, so that the Python control path is not bound to a single core.
+# Workers report finished connections and their running stats totals back
+# to the parent over the same channel.
+
+import os, select, socket, struct
+from threading import Thread, Lock
+from multiprocessing import get_context
+
+from .TCPProxy import TCPProxy, ForwarderReaper
+from .ForwarderFast import ForwarderFast
+from .IOStats import IOStats, ProxyStats, ExpiryStats
+
+# Worker -> parent records: type followed by the ProxyStats counters, which
+# are the worker's totals so far (both active and finished connections). The
+# _REC_DONE ones have the expiry reason instead (1-based index into the
+# ExpiryStats fields, 0 - none) followed by zeros.
+_REC = struct.Struct('=B8Q')
+_REC_DONE, _REC_TOTALS = 1, 2
+
+def _pack_stats(rtype, st):
+    return _REC.pack(rtype, *(v for io in st for v in io))
+
+def _unpack_stats(vals):
+    return ProxyStats(*(IOStats(*vals[i:i + 2]) for i in range(0, 8, 2)))
+
+class TCPProxyWorker(object):
+    # Runs in the worker process: receives sockets and relays them
+    dirty = False
+
+    def __init__(self, chan, config):
+        self.chan = chan
+        self.config = config
+        self.forwarders = {}
+        self.reaped_stats = ProxyStats()
+        self.lock = Lock()
+        # Records come from both the reaper and the main thread
+        self.send_lock = Lock()
+        self.nextid = 0
+        self.reaper = ForwarderReaper(self.reap_forwarder)
+        self.reaper.start()
+
+    def reap_forwarder(self, fid):
+        with self.lock:
+            fwd, newsock = self.forwarders.pop(fid)
+        fwd.join()
+        newsock.close()
+        with self.lock:
+            self.reaped_stats += fwd.getstats()
+            self.dirty = True
+        reason = fwd.getexpiry()
+        code = ExpiryStats._fields.index(reason) + 1 if reason is not None else 0
+        self.send(_REC.pack(_REC_DONE, code, *((0,) * 7)))
+
+    def send(self, rec):
+        try:
+            with self.send_lock:
+                self.chan.sendall(rec)
+        except OSError:
+            pass
+
+    def spawn_forwarder(self, fd):
+        c = self.config
+        newsock = socket.socket(fileno = fd)
+        daddr = (c['newhost'], c['newport']) if (c['newaf'] != socket.AF_UNIX) else c['newhost']
+        try:
+            fwd = c['forwarder_class'](newsock, (daddr, c['newaf']), c['bindhost_out'],
+                                       bufsize = c['bufsize'], buf_adaptive = c['buf_adaptive'],
+                                       resolve_async = c['resolve_async'],
+                                       connect_timeout = c['connect_timeout'],
+                                       sockopts = c['sockopts'], timeouts = c['timeouts'])
+            fwd.start()
+        except Exception:
+            newsock.close()
+            self.send(_pack_stats(_REC_DONE, ProxyStats()))
+            return
+        with self.lock:
+            fid = self.nextid
+            self.nextid += 1
+            self.forwarders[fid] = (fwd, newsock)
+        self.reaper.watch(fwd.getdonefd(), fid)
+
+    def run(self):
+        poller = select.poll()
+        poller.register(self.chan.fileno(), select.POLLIN)
+        while True:
+            if len(poller.poll(self.config['stats_interval'] * 1000)) > 0:
+                try:
+                    msg, fds, _, _ = socket.recv_fds(self.chan, 1, 16)
+                except OSError:
+                    msg, fds = b'', []
+                for fd in fds:
+                    self.spawn_forwarder(fd)
+                if not msg:
+                    break
+            self.send_totals()
+        # Parent is gone or shutting down
+        with self.lock:
+            forwarders = tuple(self.forwarders.values())
+        for fwd, _ in forwarders:
+            if fwd.isAlive():
+                fwd.shutdown()
+        while True:
+            with self.lock:
+                if len(self.forwarders) == 0:
+                    break
+            select.select([], [], [], 0.01)
+        self.reaper.stop()
+        self.send_totals()
+        self.chan.close()
+
+    def send_totals(self):
+        with self.lock:
+            if len(self.forwarders) == 0 and not self.dirty:
+                return
+            st = self.reaped_stats
+            forwarders = tuple(self.forwarders.values())
+            self.dirty = False
+        for fwd, _ in forwarders:
+            st += fwd.getstats()
+        self.send(_pack_stats(_REC_TOTALS, st))
+
+def _worker_main(chan, config):
+    TCPProxyWorker(chan, config).run()
+
+class TCPProxyMP(TCPProxy):
+    nworkers:int = None
+    stats_interval:float = 1.0
+    workers: list = None
+    collector: Thread = None
+    # Last totals of the workers that have died and been replaced
+    retired_stats: ProxyStats = None
+
+    def __init__(self, *a, nworkers = None, **kwa):
+        super().__init__(*a, **kwa)
+        if nworkers is not None:
+            self.nworkers = nworkers
+        if not self.nworkers:
+            self.nworkers = os.cpu_count()
+        self.wlock = Lock()
+
+    def start(self):
+        # Spawned rather than forked, since the parent has threads running
+        # by now
+        self.ctx = get_context('spawn')
+        self.config = {'newhost': self.newhost, 'newport': self.newport, 'newaf': self.newaf,
+                  'bindhost_out': self.bindhost_out, 'bufsize': self.bufsize,
+                  'buf_adaptive': self.buf_adaptive, 'resolve_async': self.resolve_async,
+                  'connect_timeout': self.connect_timeout, 'sockopts': self.sockopts,
+                  'timeouts': self.timeouts,
+                  'forwarder_class': self.forwarder_class or ForwarderFast,
+                  'stats_interval': self.stats_interval}
+        self.retired_stats = ProxyStats()
+        self.workers = [self.spawn_worker() for i in range(self.nworkers)]
+        self.collector = Thread(target = self.collect, daemon = True)
+        self.collector.start()
+        super().start()
+
+    def spawn_worker(self):
+        chan, wchan = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        proc = self.ctx.Process(target = _worker_main, args = (wchan, self.config),
+                                daemon = True)
+        proc.start()
+        wchan.close()
+        # [channel, process, active connections, stats totals, alive]
+        return [chan, proc, 0, ProxyStats(), True]
+
+    def spawn_forwarder(self, newsock):
+        # Least-connections pick among the workers that are still there
+        with self.wlock:
+            alive = [w for w in self.workers if w[4]]
+            w = min(alive, key = lambda w: w[2]) if alive else None
+            if w is not None:
+                w[2] += 1
+        if w is None:
+            self.log('no worker processes to pass the connection to')
+            newsock.close()
+            return None
+        try:
+            socket.send_fds(w[0], [b'F'], [newsock.fileno()])
+        except OSError as e:
+            with self.wlock:
+                w[2] -= 1
+                w[4] = False
+            self.log(f'passing connection to the worker {w[1].pid} failed: {e}')
+            # The collector sees the EOF and replaces it
+            try:
+                w[0].shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        newsock.close()
+        return None
+
+    def replace_worker(self, w):
+        # Called by the collector once the worker's channel is gone, returns
+        # the new worker or None if shutting down
+        w[1].join(1.0)
+        if w[1].is_alive():
+            w[1].kill()
+            w[1].join()
+        with self.wlock:
+            w[4] = False
+            if self.dead:
+                return None
+            self.log(f'worker {w[1].pid} has exited ({w[1].exitcode}), respawning it')
+            nw = self.spawn_worker()
+            self.workers[self.workers.index(w)] = nw
+        with self.stats_lock:
+            self.retired_stats += w[3]
+        w[0].close()
+        return nw
+
+    def collect(self):
+        bufs = {w[0].fileno(): (w, bytearray()) for w in self.workers}
+        poller = select.poll()
+        for fd in bufs:
+            poller.register(fd, select.POLLIN)
+        while len(bufs) > 0:
+            for fd, flag in poller.poll():
+                w, buf = bufs[fd]
+                try:
+                    data = w[0].recv(_REC.size * 64)
+                except OSError:
+                    data = b''
+                if not data:
+                    poller.unregister(fd)
+                    del bufs[fd]
+                    nw = self.replace_worker(w)
+                    if nw is not None:
+                        bufs[nw[0].fileno()] = (nw, bytearray())
+                        poller.register(nw[0].fileno(), select.POLLIN)
+                    continue
+                buf += data
+                nrecs = len(buf) // _REC.size
+                for rtype, *vals in _REC.iter_unpack(bytes(buf[:nrecs * _REC.size])):
+                    if rtype == _REC_DONE:
+                        with self.wlock:
+                            w[2] -= 1
+                        if vals[0] > 0:
+                            with self.stats_lock:
+                                self.reaped_expiry = self.reaped_expiry.add(
+                                    ExpiryStats._fields[vals[0] - 1])
+                    else:
+                        with self.stats_lock:
+                            w[3] = _unpack_stats(vals)
+                del buf[:nrecs * _REC.size]
+
+    def worker_load(self):
+        # Active connections per worker process
+        with self.wlock:
+            return tuple(w[2] for w in self.workers)
+
+    def stats(self):
+        # Up to stats_interval behind for the connections that are active
+        with self.stats_lock:
+            res = self.retired_stats
+            for w in self.workers:
+                res += w[3]
+        return res
+
+    def shutdown(self):
+        self.dead = True
+        self.sock.close()
+        self.join()
+        # Closing our end of the channel makes the worker finish up
+        with self.wlock:
+            workers = tuple(self.workers)
+        for w in workers:
+            try:
+                w[0].shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+        self.collector.join()
+        for w in workers:
+            w[1].join()
+            w[0].close()
+        self.reaper.stop()
@@ -0,0 +1,108 @@
+# Copyright (c) 2026 Sippy Software, Inc. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+# Offline decoder for the capture rings the tapped proxies write to (see
+# AsyncProxy.Tap): returns the records still in the ring, oldest first, and
+# exports them as pcapng with an interface per proxy id, LINKTYPE_USER0
+# payloads and the direction in the epb_flags (in2out is inbound).
+
+import struct
+from collections import namedtuple
+
+from .AsyncProxy import AP_DIR_I2O
+
+TAP_MAGIC = b'ASPTAP\0\0'
+TAP_VERSION = 1
+# Native byte order, as written by the relays (see src/asp_tap.h)
+_HDR = struct.Struct('=8sIIIIIIQ')
+_REC = struct.Struct('=QQQIIII')
+_SEQ_BUSY = 2 ** 64 - 1
+
+LINKTYPE_USER0 = 147
+
+class TapRecord(namedtuple('TapRecord', ('seq', 'time', 'id', 'dir', 'origlen', 'data'))):
+    # Chunk relayed: its number in the ring, wall clock time (in seconds),
+    # id of the proxy, direction (AP_DIR_I2O/AP_DIR_O2I), full length and
+    # the part of it captured.
+    pass
+
+class TapReader(object):
+    def __init__(self, path:str):
+        with open(path, 'rb') as f:
+            self.buf = f.read()
+        if len(self.buf) < _HDR.size:
+            raise ValueError(f'{path}: too short for a tap ring')
+        magic, version, self.hdrsize, self.nslots, self.slotsize, self.snaplen, _, \
+          self.head = _HDR.unpack_from(self.buf)
+        if magic != TAP_MAGIC or version != TAP_VERSION:
+            raise ValueError(f'{path}: not a tap ring')
+
+    def lost(self):
+        # Records overwritten by the newer ones
+        return max(0, self.head - self.nslots)
+
+    def records(self):
+        res = []
+        for i in range(self.nslots):
+            off = self.hdrsize + i * self.slotsize
+            seq, ts, pid, origlen, caplen, d, _ = _REC.unpack_from(self.buf, off)
+            # Never written or caught in the middle of being written
+            if seq == 0 or seq == _SEQ_BUSY:
+                continue
+            off += _REC.size
+            res.append(TapRecord(seq - 1, ts / 1e9, pid, d, origlen,
+                                 self.buf[off:off + caplen]))
+        res.sort(key = lambda r: r.seq)
+        return res
+
+    def write_pcapng(self, f):
+        # Writes the records out into the binary file object
+        recs = self.records()
+        f.write(_block(0x0A0D0D0A, struct.pack('=IHHq', 0x1A2B3C4D, 1, 0, -1)))
+        ifaces = {}
+        for r in recs:
+            if r.id in ifaces:
+                continue
+            ifaces[r.id] = len(ifaces)
+            opts = _opt(2, f'asyncproxy {r.id}'.encode()) + _opt(0, b'')
+            f.write(_block(1, struct.pack('=HHI', LINKTYPE_USER0, 0, self.snaplen) + opts))
+        for r in recs:
+            # Default if_tsresol, microseconds
+            ts = round(r.time * 1e6)
+            flags = 1 if r.dir == AP_DIR_I2O else 2
+            body = struct.pack('=IIIII', ifaces[r.id], ts >> 32, ts & 0xffffffff,
+                               len(r.data), r.origlen) + _pad(r.data)
+            body += _opt(2, struct.pack('=I', flags)) + _opt(0, b'')
+            f.write(_block(6, body))
+        return len(recs)
+
+def _pad(data):
+    return data + b'\0' * (-len(data) % 4)
+
+def _opt(code, value):
+    return struct.pack('=HH', code, len(value)) + _pad(value)
+
+def _block(btype, body):
+    blen = len(body) + 12
+    return struct.pack('=II', btype, blen) + body + struct.pack('=I', blen)
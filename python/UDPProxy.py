@@ -0,0 +1,75 @@
+# Copyright (c) 2026 Sippy Software, Inc. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+# UDP counterpart of TCPProxy: datagrams coming to the port are relayed to
+# newhost:newport by an AsyncDgramProxy, each client address getting a
+# session (a socket connected to the destination) of its own, so that the
+# replies find their way back. Sessions are closed after session_idle
+# seconds without traffic. Transforms are set up by subclassing
+# AsyncDgramProxy and pointing proxy_class to it.
+
+import socket
+
+from .AsyncProxy import AsyncDgramProxy
+
+class UDPProxy(object):
+    proxy_class:callable = AsyncDgramProxy
+    session_idle:float = 30.0
+    bindhost_out = None
+    bufsize:int = None
+    proxy = None
+
+    def __init__(self, port, newhost, newport, bindhost = '127.0.0.1', logger = None,
+                 newaf = socket.AF_INET, session_idle = None):
+        if session_idle is not None:
+            self.session_idle = session_idle
+        self.newhost = newhost
+        self.newport = newport
+        self.logger = logger
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((bindhost, port))
+        self.port = port if (port != 0) else self.sock.getsockname()[1]
+        try:
+            self.proxy = self.proxy_class(self.sock.fileno(), newhost, newport, newaf,
+                                          self.bindhost_out, session_idle = self.session_idle,
+                                          bufsize = self.bufsize)
+        except Exception:
+            self.sock.close()
+            raise
+
+    def start(self):
+        self.proxy.start()
+
+    def isAlive(self):
+        return self.proxy.isAlive()
+
+    def shutdown(self):
+        self.proxy.join(shutdown = True)
+        self.sock.close()
+
+    def stats(self):
+        return self.proxy.getstats()
+
+    def dgram_stats(self):
+        return self.proxy.getdgramstats()
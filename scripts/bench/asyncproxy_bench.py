@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2026 Sippy Software, Inc. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Localhost benchmarks for the relay implementations: bulk throughput,
+# small message round-trip latency and connection churn, for the
+# AsyncProxy2FD (over socketpairs), TCPProxy+ForwarderFast and
+# TCPProxy+Forwarder paths. Results are written out as JSON, so that they
+# can be compared between releases.
+
+import sys, json, socket, platform
+from argparse import ArgumentParser
+from threading import Thread
+from time import monotonic, strftime
+from ctypes import string_at, memmove
+
+from asyncproxy.AsyncProxy import AsyncProxy2FD, engine_start, engine_stop, \
+  setsplice
+from asyncproxy.TCPProxy import TCPProxy
+from asyncproxy.ForwarderFast import ForwarderFast
+from asyncproxy.Forwarder import Forwarder
+
+CHUNK = 64 * 1024
+
+class XorProxy(AsyncProxy2FD):
+    # Representative cheap transform, applied in both directions
+    def in2out(self, res_p):
+        tr = res_p.contents
+        data = string_at(tr.buf, tr.len)
+        memmove(tr.buf, bytes(b ^ 0x5a for b in data), tr.len)
+
+    out2in = in2out
+
+class NativeXorProxy(AsyncProxy2FD):
+    # Same, done by the built-in native transform
+    in2out_native = ('xor', '5a')
+    out2in_native = ('xor', '5a')
+
+def recvall(sock, size):
+    got = 0
+    while got < size:
+        data = sock.recv(min(CHUNK, size - got))
+        if not data:
+            break
+        got += len(data)
+    return got
+
+def sendall(sock, size):
+    buf = b'\0' * CHUNK
+    left = size
+    while left > 0:
+        sock.sendall(buf[:min(CHUNK, left)])
+        left -= CHUNK
+
+class Server(Thread):
+    # Minimal thread-per-connection server: in the "sink" mode it reads a
+    # 8-byte length, swallows that many bytes and acks with a byte; in the
+    # "echo" mode it sends back whatever it gets.
+    daemon = True
+
+    def __init__(self, mode):
+        super().__init__()
+        self.mode = mode
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(1024)
+        self.port = self.sock.getsockname()[1]
+        self.start()
+
+    def run(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            Thread(target = self.serve, args = (conn,), daemon = True).start()
+
+    def serve(self, conn):
+        with conn:
+            try:
+                if self.mode == 'sink':
+                    while (hdr := conn.recv(8, socket.MSG_WAITALL)):
+                        recvall(conn, int.from_bytes(hdr, 'big'))
+                        conn.sendall(b'A')
+                else:
+                    while (data := conn.recv(CHUNK)):
+                        conn.sendall(data)
+            except OSError:
+                pass
+
+    def close(self):
+        self.sock.close()
+
+def percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(len(samples) * q / 100))]
+    return {'p50_us': pick(50) * 1e6, 'p99_us': pick(99) * 1e6,
+            'max_us': samples[-1] * 1e6}
+
+class Bench(object):
+    def __init__(self, args):
+        self.args = args
+
+    # AsyncProxy2FD over two socketpairs
+    def pair_setup(self, pclass):
+        client, proxy_in = socket.socketpair()
+        proxy_out, server = socket.socketpair()
+        proxy = pclass(proxy_in.fileno(), proxy_out.fileno())
+        proxy.start()
+        socks = (client, proxy_in, proxy_out, server)
+        def cleanup():
+            proxy.join(shutdown=True)
+            for s in socks: s.close()
+        return client, server, cleanup
+
+    # TCPProxy in front of the server, using the given forwarder class
+    def tcp_setup(self, fclass, srv):
+        proxy = TCPProxy(0, '127.0.0.1', srv.port)
+        proxy.forwarder_class = fclass
+        proxy.start()
+        return proxy
+
+    def bulk_pair(self, pclass):
+        client, server, cleanup = self.pair_setup(pclass)
+        size = self.args.bulk_size
+        t = Thread(target = sendall, args = (client, size))
+        stime = monotonic()
+        t.start()
+        got = recvall(server, size)
+        etime = monotonic()
+        t.join()
+        cleanup()
+        assert got == size
+        return {'MBps': size / (etime - stime) / 1e6}
+
+    def bulk_tcp(self, fclass):
+        srv = Server('sink')
+        proxy = self.tcp_setup(fclass, srv)
+        size = self.args.bulk_size
+        with socket.create_connection(('127.0.0.1', proxy.port)) as s:
+            stime = monotonic()
+            s.sendall(size.to_bytes(8, 'big'))
+            sendall(s, size)
+            assert s.recv(1) == b'A'
+            etime = monotonic()
+        proxy.shutdown()
+        srv.close()
+        return {'MBps': size / (etime - stime) / 1e6}
+
+    def rtt(self, a, b):
+        msg = b'x' * self.args.msg_size
+        samples = []
+        for i in range(self.args.rtt_rounds):
+            stime = monotonic()
+            a.sendall(msg)
+            recvall(b, len(msg))
+            b.sendall(msg)
+            recvall(a, len(msg))
+            samples.append(monotonic() - stime)
+        return percentiles(samples)
+
+    def rtt_pair(self, pclass):
+        client, server, cleanup = self.pair_setup(pclass)
+        res = self.rtt(client, server)
+        cleanup()
+        return res
+
+    def rtt_tcp(self, fclass):
+        srv = Server('echo')
+        proxy = self.tcp_setup(fclass, srv)
+        msg = b'x' * self.args.msg_size
+        samples = []
+        with socket.create_connection(('127.0.0.1', proxy.port)) as s:
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            for i in range(self.args.rtt_rounds):
+                stime = monotonic()
+                s.sendall(msg)
+                recvall(s, len(msg))
+                samples.append(monotonic() - stime)
+        proxy.shutdown()
+        srv.close()
+        return percentiles(samples)
+
+    def churn_pair(self, pclass):
+        nconns = self.args.churn_conns
+        stime = monotonic()
+        for i in range(nconns):
+            client, server, cleanup = self.pair_setup(pclass)
+            client.sendall(b'x')
+            recvall(server, 1)
+            cleanup()
+        return {'conns_per_sec': nconns / (monotonic() - stime)}
+
+    def churn_tcp(self, fclass):
+        srv = Server('echo')
+        proxy = self.tcp_setup(fclass, srv)
+        nconns = self.args.churn_conns
+        stime = monotonic()
+        for i in range(nconns):
+            with socket.create_connection(('127.0.0.1', proxy.port)) as s:
+                s.sendall(b'x')
+                recvall(s, 1)
+        res = {'conns_per_sec': nconns / (monotonic() - stime)}
+        proxy.shutdown()
+        srv.close()
+        return res
+
+    def run(self):
+        paths = {
+            'AsyncProxy2FD': (AsyncProxy2FD, 'pair'),
+            'AsyncProxy2FD+transform': (XorProxy, 'pair'),
+            'AsyncProxy2FD+native': (NativeXorProxy, 'pair'),
+            'TCPProxy+ForwarderFast': (ForwarderFast, 'tcp'),
+            'TCPProxy+Forwarder': (Forwarder, 'tcp'),
+        }
+        results = {}
+        for test in self.args.tests:
+            results[test] = {}
+            for name, (cls, kind) in paths.items():
+                if self.args.paths and name not in self.args.paths:
+                    continue
+                method = getattr(self, f'{test}_{kind}')
+                res = method(cls)
+                results[test][name] = res
+                sys.stderr.write(f'{test} {name}: {res}\n')
+        return results
+
+def main():
+    parser = ArgumentParser(description = 'asyncproxy localhost benchmarks')
+    parser.add_argument('-o', '--output', help = 'write JSON results to a file instead of stdout')
+    parser.add_argument('-t', '--tests', nargs = '+', default = ['bulk', 'rtt', 'churn'],
+                        choices = ['bulk', 'rtt', 'churn'])
+    parser.add_argument('-p', '--paths', nargs = '+', default = None,
+                        help = 'only run for given paths (i.e. AsyncProxy2FD)')
+    parser.add_argument('--bulk-size', type = int, default = 64 * 1024 * 1024,
+                        help = 'bytes to transfer in the bulk test')
+    parser.add_argument('--msg-size', type = int, default = 64,
+                        help = 'message size for the round-trip test')
+    parser.add_argument('--rtt-rounds', type = int, default = 2000)
+    parser.add_argument('--churn-conns', type = int, default = 1000)
+    parser.add_argument('--engine', type = int, default = None, metavar = 'NTHREADS',
+                        help = 'use shared event loops (0 - one per CPU)')
+    parser.add_argument('--no-splice', action = 'store_true')
+    args = parser.parse_args()
+
+    if args.engine is not None:
+        engine_start(args.engine)
+    if args.no_splice:
+        setsplice(False)
+    results = Bench(args).run()
+    if args.engine is not None:
+        engine_stop()
+    report = {
+        'meta': {
+            'time': strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'engine': args.engine,
+            'splice': not args.no_splice,
+            'bulk_size': args.bulk_size,
+            'msg_size': args.msg_size,
+        },
+        'results': results,
+    }
+    out = json.dumps(report, indent = 2)
+    if args.output is None:
+        print(out)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(out + '\n')
+
+if __name__ == '__main__':
+    main()
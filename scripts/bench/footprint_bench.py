@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2026 Sippy Software, Inc. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or
+# other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+# Memory footprint of idle relays: opens N AsyncProxy2FD relays over
+# socketpairs, optionally passes a message through each of them once, and
+# reports how much the resident (RSS) and virtual (VSZ) size of the process
+# grew per connection. Run it once per configuration (default, --compact,
+# --engine) and compare, the results are written out as JSON.
+
+import sys, json, socket, platform, resource, subprocess
+from argparse import ArgumentParser
+from os import getpid
+from time import sleep, strftime
+
+from asyncproxy.AsyncProxy import AsyncProxy2FD, engine_start, engine_stop, \
+  setsplice, setcompact, getmemstats_global, getpoolstats
+
+# Sockets per relay: the four ends plus the two proxy's own copies
+FDS_PER_RELAY = 6
+
+def footprint():
+    # RSS and VSZ of the process in bytes
+    try:
+        with open('/proc/self/status') as f:
+            vals = dict(l.split(':', 1) for l in f)
+        return (int(vals['VmRSS'].split()[0]) * 1024,
+                int(vals['VmSize'].split()[0]) * 1024)
+    except OSError:
+        out = subprocess.check_output(('ps', '-o', 'rss=,vsz=', '-p', str(getpid())))
+        rss, vsz = out.split()
+        return (int(rss) * 1024, int(vsz) * 1024)
+
+def raise_nofile(need):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < need and (hard == resource.RLIM_INFINITY or hard >= need):
+        resource.setrlimit(resource.RLIMIT_NOFILE, (need, hard))
+        soft = need
+    return soft
+
+class Relay(object):
+    def __init__(self, bufsize):
+        self.client, self.proxy_in = socket.socketpair()
+        self.proxy_out, self.server = socket.socketpair()
+        self.proxy = AsyncProxy2FD(self.proxy_in.fileno(), self.proxy_out.fileno(),
+                                   bufsize = bufsize)
+        self.proxy.start()
+
+    def ping(self):
+        self.client.sendall(b'ping')
+        self.server.recv(16)
+        self.server.sendall(b'pong')
+        self.client.recv(16)
+
+    def close(self):
+        self.proxy.join(shutdown=True)
+        for s in (self.client, self.proxy_in, self.proxy_out, self.server): s.close()
+
+def run(args):
+    before = footprint()
+    relays = []
+    for i in range(args.conns):
+        relays.append(Relay(args.bufsize))
+    if args.ping:
+        for r in relays: r.ping()
+    # Let the threads and the buffers settle
+    sleep(args.settle)
+    after = footprint()
+    alive = sum(1 for r in relays if r.proxy.isAlive())
+    mstats = getmemstats_global()
+    pstats = getpoolstats()
+    for r in relays: r.close()
+    n = args.conns
+    return {
+        'conns': n,
+        'alive': alive,
+        'rss_per_conn': (after[0] - before[0]) / n,
+        'vsz_per_conn': (after[1] - before[1]) / n,
+        'rss_total': after[0],
+        'vsz_total': after[1],
+        'buffers_allocated': mstats.allocated,
+        'pool': pstats._asdict(),
+    }
+
+def main():
+    parser = ArgumentParser(description = 'asyncproxy idle relay memory footprint')
+    parser.add_argument('-o', '--output', help = 'write JSON results to a file instead of stdout')
+    parser.add_argument('-n', '--conns', type = int, default = 10000,
+                        help = 'number of idle relays to open')
+    parser.add_argument('--bufsize', type = int, default = 16 * 1024)
+    parser.add_argument('--ping', action = 'store_true',
+                        help = 'pass a message each way through every relay first')
+    parser.add_argument('--compact', action = 'store_true',
+                        help = 'lazy pooled buffers and small thread stacks')
+    parser.add_argument('--stacksize', type = int, default = 0,
+                        help = 'relay thread stack size in the compact mode')
+    parser.add_argument('--engine', type = int, default = None, metavar = 'NTHREADS',
+                        help = 'use shared event loops (0 - one per CPU)')
+    parser.add_argument('--settle', type = float, default = 1.0,
+                        help = 'seconds to wait before measuring')
+    args = parser.parse_args()
+
+    need = args.conns * FDS_PER_RELAY + 64
+    if raise_nofile(need) < need:
+        parser.error(f'{need} file descriptors needed, raise the limit or lower --conns')
+    # Copying keeps the data in the buffers, that is what's being measured
+    setsplice(False)
+    if args.compact:
+        setcompact(True, args.stacksize)
+    if args.engine is not None:
+        engine_start(args.engine)
+    results = run(args)
+    if args.engine is not None:
+        engine_stop()
+    sys.stderr.write(f'rss/conn {results["rss_per_conn"] / 1024:.1f} KB, '
+                     f'vsz/conn {results["vsz_per_conn"] / 1024:.1f} KB\n')
+    report = {
+        'meta': {
+            'time': strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'engine': args.engine,
+            'compact': args.compact,
+            'stacksize': args.stacksize,
+            'bufsize': args.bufsize,
+            'ping': args.ping,
+        },
+        'results': results,
+    }
+    out = json.dumps(report, indent = 2)
+    if args.output is None:
+        print(out)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(out + '\n')
+
+if __name__ == '__main__':
+    main()
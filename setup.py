@@ -12,7 +12,12 @@ from python.env import LAP_MOD_NAME
 is_win = get_platform().startswith('win')
 is_mac = get_platform().startswith('macosx-')
 
-lap_srcs = ['src/asyncproxy.c', 'src/asp_sock.c']
+lap_srcs = ['src/asyncproxy.c', 'src/asp_sock.c', 'src/asp_engine.c',
+            'src/asp_hist.c', 'src/asp_buf.c', 'src/asp_transform.c',
+            'src/asp_resolve.c', 'src/asp_connect.c', 'src/asp_shaper.c',
+            'src/asp_mem.c', 'src/asp_dgram.c', 'src/asp_tap.c',
+            'src/asp_sockopt.c', 'src/asp_timer.c', 'src/asp_slab.c',
+            'src/asp_pymod.c']
 
 extra_compile_args = ['-Wall', '-DPYTHON_AWARE']
 if not is_win:
@@ -0,0 +1,129 @@
+#include <sys/types.h>
+#include <sys/uio.h>
+#include <string.h>
+
+#include "asp_buf.h"
+#include "asp_slab.h"
+
+int
+asp_buf_ctor(struct asp_buf *bp, size_t size)
+{
+
+    memset(bp, '\0', sizeof(struct asp_buf));
+    bp->data = asp_slab_get(size);
+    if (bp->data == NULL)
+        return (-1);
+    bp->size = size;
+    return (0);
+}
+
+void
+asp_buf_dtor(struct asp_buf *bp)
+{
+
+    asp_slab_put(bp->data, bp->size);
+    bp->data = NULL;
+    bp->size = bp->off = bp->len = 0;
+}
+
+/*
+ * Change buffer capacity, the pending data (if any) is moved to the beginning
+ * of the new buffer.
+ */
+int
+asp_buf_resize(struct asp_buf *bp, size_t size)
+{
+    unsigned char *ndata;
+    struct iovec iov[2];
+    int i, n;
+    size_t len;
+
+    if (size < bp->len)
+        return (-1);
+    ndata = asp_slab_get(size);
+    if (ndata == NULL)
+        return (-1);
+    n = asp_buf_iov_data(bp, iov);
+    for (len = 0, i = 0; i < n; i++) {
+        memcpy(ndata + len, iov[i].iov_base, iov[i].iov_len);
+        len += iov[i].iov_len;
+    }
+    asp_slab_put(bp->data, bp->size);
+    bp->data = ndata;
+    bp->size = size;
+    bp->off = 0;
+    return (0);
+}
+
+/* Contiguous free space following the data */
+void *
+asp_buf_tail(struct asp_buf *bp, size_t *cfree)
+{
+    size_t tpos;
+
+    tpos = bp->off + bp->len;
+    if (tpos >= bp->size) {
+        tpos -= bp->size;
+        *cfree = bp->off - tpos;
+    } else {
+        *cfree = bp->size - tpos;
+    }
+    return (bp->data + tpos);
+}
+
+int
+asp_buf_iov_free(struct asp_buf *bp, struct iovec *iov)
+{
+    size_t cfree;
+
+    if (bp->len == bp->size)
+        return (0);
+    iov[0].iov_base = asp_buf_tail(bp, &cfree);
+    iov[0].iov_len = cfree;
+    if (cfree == ASP_BUF_FREE(bp))
+        return (1);
+    iov[1].iov_base = bp->data;
+    iov[1].iov_len = ASP_BUF_FREE(bp) - cfree;
+    return (2);
+}
+
+int
+asp_buf_iov_data(struct asp_buf *bp, struct iovec *iov)
+{
+    size_t clen;
+
+    if (bp->len == 0)
+        return (0);
+    clen = bp->size - bp->off;
+    iov[0].iov_base = bp->data + bp->off;
+    if (clen >= bp->len) {
+        iov[0].iov_len = bp->len;
+        return (1);
+    }
+    iov[0].iov_len = clen;
+    iov[1].iov_base = bp->data;
+    iov[1].iov_len = bp->len - clen;
+    return (2);
+}
+
+void
+asp_buf_produce(struct asp_buf *bp, size_t len)
+{
+
+    bp->len += len;
+}
+
+void
+asp_buf_consume(struct asp_buf *bp, size_t len)
+{
+
+    bp->len -= len;
+    if (bp->len == 0) {
+        /* Maximize contiguous space available for the next read */
+        bp->off = 0;
+        return;
+    }
+    bp->off += len;
+    if (bp->off >= bp->size)
+        bp->off -= bp->size;
+}
@@ -0,0 +1,28 @@
+#pragma once
+
+#include <stddef.h>
+
+struct iovec;
+
+/*
+ * Ring buffer holding data on its way from one side of the relay to the
+ * other. The data is never moved around, except when the buffer is resized.
+ * The storage comes from the asp_slab pool, data is NULL until constructed.
+ */
+struct asp_buf {
+    unsigned char *data;
+    size_t size;
+    size_t off;
+    size_t len;
+};
+
+#define ASP_BUF_FREE(bp) ((bp)->size - (bp)->len)
+
+int asp_buf_ctor(struct asp_buf *, size_t);
+void asp_buf_dtor(struct asp_buf *);
+int asp_buf_resize(struct asp_buf *, size_t);
+void *asp_buf_tail(struct asp_buf *, size_t *);
+int asp_buf_iov_free(struct asp_buf *, struct iovec *);
+int asp_buf_iov_data(struct asp_buf *, struct iovec *);
+void asp_buf_produce(struct asp_buf *, size_t);
+void asp_buf_consume(struct asp_buf *, size_t);
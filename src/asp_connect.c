@@ -0,0 +1,201 @@
+#if !defined(_POSIX_C_SOURCE)
+#define _POSIX_C_SOURCE 200112L
+#endif
+
+#include <sys/types.h>
+#include <sys/socket.h>
+#include <netinet/in.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <poll.h>
+#include <stdint.h>
+#include <string.h>
+#include <time.h>
+#include <unistd.h>
+
+#include "asp_connect.h"
+#include "asp_resolve.h"
+#include "asp_sockopt.h"
+
+/* How often to check whether the relay has been told to go away */
+#define ASP_CONNECT_POLL_MAX 100
+
+static uint64_t
+getmonotime_ns(void)
+{
+    struct timespec ts;
+
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ((uint64_t)ts.tv_sec * 1000000000 + ts.tv_nsec);
+}
+
+/*
+ * Order the addresses so that the families alternate, starting with the
+ * one getaddrinfo(3) prefers (RFC 8305, section 4).
+ */
+static int
+asp_connect_order(const struct asp_resolve_res *rrp, int *order)
+{
+    int i, j, n, fam, taken[ASP_RESOLVE_MAXADDRS];
+
+    memset(taken, '\0', sizeof(taken));
+    fam = rrp->addrs[0].ss.ss_family;
+    for (n = 0; n < rrp->naddrs; n++) {
+        for (j = -1, i = 0; i < rrp->naddrs; i++) {
+            if (taken[i])
+                continue;
+            if (j == -1)
+                j = i;
+            if (rrp->addrs[i].ss.ss_family == fam) {
+                j = i;
+                break;
+            }
+        }
+        taken[j] = 1;
+        order[n] = j;
+        fam = (rrp->addrs[j].ss.ss_family == AF_INET) ? AF_INET6 : AF_INET;
+    }
+    return (n);
+}
+
+static int
+asp_connect_attempt(const struct asp_resolve_addr *ap,
+  const struct sockaddr_in *bindaddr, const struct asp_sockopts *sop,
+  int *errp)
+{
+    int fd, flags;
+
+    fd = socket(ap->ss.ss_family, SOCK_STREAM, 0);
+    if (fd < 0)
+        goto e0;
+    flags = fcntl(fd, F_GETFL);
+    if (flags < 0 || fcntl(fd, F_SETFL, flags | O_NONBLOCK) < 0)
+        goto e1;
+    /* Before connecting, for the buffer sizes to affect the window scale */
+    if (sop != NULL)
+        asp_sockopts_apply(fd, sop);
+    if (bindaddr != NULL && bind(fd, (const struct sockaddr *)bindaddr,
+      sizeof(struct sockaddr_in)) != 0)
+        goto e1;
+    if (connect(fd, (const struct sockaddr *)&ap->ss, ap->alen) != 0 &&
+      errno != EINPROGRESS)
+        goto e1;
+    return (fd);
+e1:
+    *errp = errno;
+    close(fd);
+    return (-1);
+e0:
+    *errp = errno;
+    return (-1);
+}
+
+/*
+ * Connect to any of the resolved addresses "happy eyeballs" style: start
+ * with the first one and if it hasn't succeeded within ASP_CONNECT_DELAY
+ * start another one, and so on, keeping the earlier attempts going. The
+ * first attempt to complete wins. When bound to an IPv4 address, only
+ * IPv4 destinations are tried. Socket options in sop, if any, are set on
+ * each socket before it's connected.
+ *
+ * Returns 0 with a non-blocking connected socket in res->fd, or -1 with
+ * res->error set if all the attempts failed, the timeout (in ms, 0 - none)
+ * expired or the isrunning() callback returned 0.
+ */
+int
+asp_connect(const struct asp_resolve_res *rrp, const struct sockaddr_in *bindaddr,
+  const struct asp_sockopts *sop, unsigned int timeout,
+  int (*isrunning)(void *), void *arg, struct asp_connect_res *res)
+{
+    struct pollfd pfds[ASP_RESOLVE_MAXADDRS];
+    int aidxs[ASP_RESOLVE_MAXADDRS], order[ASP_RESOLVE_MAXADDRS];
+    int i, n, naddrs, next, npending, fd, err, wait;
+    socklen_t elen;
+    uint64_t stime, now, lastatt, left;
+
+    memset(res, '\0', sizeof(struct asp_connect_res));
+    res->fd = -1;
+    res->error = ENOENT;
+    naddrs = asp_connect_order(rrp, order);
+    npending = next = 0;
+    stime = lastatt = getmonotime_ns();
+    for (;;) {
+        now = getmonotime_ns();
+        if (timeout > 0 && now - stime >= (uint64_t)timeout * 1000000) {
+            res->error = ETIMEDOUT;
+            break;
+        }
+        if (next < naddrs && (npending == 0 ||
+          now - lastatt >= (uint64_t)ASP_CONNECT_DELAY * 1000000)) {
+            i = order[next++];
+            if (bindaddr != NULL && rrp->addrs[i].ss.ss_family != AF_INET)
+                continue;
+            res->nattempts++;
+            fd = asp_connect_attempt(&rrp->addrs[i], bindaddr, sop,
+              &res->error);
+            if (fd < 0) {
+                lastatt = 0;
+                continue;
+            }
+            pfds[npending].fd = fd;
+            pfds[npending].events = POLLOUT;
+            pfds[npending].revents = 0;
+            aidxs[npending] = i;
+            npending++;
+            lastatt = now;
+        }
+        if (npending == 0) {
+            if (next < naddrs)
+                continue;
+            break;
+        }
+        wait = ASP_CONNECT_POLL_MAX;
+        if (next < naddrs) {
+            left = (lastatt + (uint64_t)ASP_CONNECT_DELAY * 1000000 - now) / 1000000;
+            if (left < (uint64_t)wait)
+                wait = left;
+        }
+        if (timeout > 0) {
+            left = (stime + (uint64_t)timeout * 1000000 - now) / 1000000;
+            if (left < (uint64_t)wait)
+                wait = left;
+        }
+        n = poll(pfds, npending, wait);
+        if (n < 0 && errno != EINTR) {
+            res->error = errno;
+            break;
+        }
+        for (i = 0; n > 0 && i < npending; i++) {
+            if (pfds[i].revents == 0)
+                continue;
+            err = 0;
+            elen = sizeof(err);
+            if (getsockopt(pfds[i].fd, SOL_SOCKET, SO_ERROR, &err, &elen) != 0)
+                err = errno;
+            if (err == 0) {
+                res->fd = pfds[i].fd;
+                res->aidx = aidxs[i];
+                res->error = 0;
+                pfds[i] = pfds[--npending];
+                goto done;
+            }
+            res->error = err;
+            close(pfds[i].fd);
+            pfds[i] = pfds[npending - 1];
+            aidxs[i] = aidxs[npending - 1];
+            npending--;
+            i--;
+            /* Don't wait for the delay to expire if an attempt has failed */
+            lastatt = 0;
+        }
+        if (isrunning != NULL && !isrunning(arg)) {
+            res->error = ECANCELED;
+            break;
+        }
+    }
+done:
+    for (i = 0; i < npending; i++)
+        close(pfds[i].fd);
+    res->elapsed_ns = getmonotime_ns() - stime;
+    return (res->fd >= 0 ? 0 : -1);
+}
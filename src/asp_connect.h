@@ -0,0 +1,22 @@
+#pragma once
+
+#include <stdint.h>
+
+struct asp_resolve_res;
+struct asp_sockopts;
+struct sockaddr_in;
+
+/* RFC 8305 "Connection Attempt Delay" */
+#define ASP_CONNECT_DELAY 250
+
+struct asp_connect_res {
+    int fd;
+    int aidx;
+    int nattempts;
+    uint64_t elapsed_ns;
+    int error;
+};
+
+int asp_connect(const struct asp_resolve_res *, const struct sockaddr_in *,
+  const struct asp_sockopts *, unsigned int, int (*)(void *), void *,
+  struct asp_connect_res *);
@@ -0,0 +1,571 @@
+#if defined(__linux__)
+#define _GNU_SOURCE
+#endif
+
+#include <sys/types.h>
+#include <sys/socket.h>
+#include <sys/uio.h>
+#include <netinet/in.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <poll.h>
+#include <pthread.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include <unistd.h>
+
+#include "asp_dgram.h"
+#include "asp_iostats.h"
+#include "asp_sock.h"
+
+#if defined(__linux__) || defined(__FreeBSD__)
+#define HAVE_MMSG 1
+#endif
+
+#if !defined(HAVE_MMSG)
+struct mmsghdr {
+    struct msghdr msg_hdr;
+    unsigned int msg_len;
+};
+#endif
+
+#define ASP_DGRAM_NBUCKETS 256
+/* Longest poll, also how often idle sessions are looked for at most */
+#define ASP_DGRAM_TICK 1000
+#define ASP_DGRAM_TICK_MIN 10
+
+struct asp_dgram_sess {
+    struct sockaddr_storage addr;
+    socklen_t alen;
+    int fd;
+    uint64_t last;
+    struct asp_dgram_sess *next;
+};
+
+struct asp_dgram_relay {
+    const struct asp_dgram_args *args;
+    unsigned char *data;
+    struct mmsghdr msgs[ASP_DGRAM_BATCH];
+    struct mmsghdr omsgs[ASP_DGRAM_BATCH];
+    struct iovec iovs[ASP_DGRAM_BATCH];
+    struct sockaddr_storage addrs[ASP_DGRAM_BATCH];
+    struct asp_dgram_sess *sess[ASP_DGRAM_BATCH];
+    int keep[ASP_DGRAM_BATCH];
+    /* Source, sink and then session sockets */
+    struct pollfd *pfds;
+    struct asp_dgram_sess **psess;
+    int npfds;
+    int pfdsize;
+    int rebuild;
+    /* Source is connected, replies need no address */
+    int connected;
+    struct sockaddr_storage peer;
+    socklen_t peerlen;
+    struct asp_dgram_sess *buckets[ASP_DGRAM_NBUCKETS];
+    uint64_t now;
+};
+
+static uint64_t
+getmonotime_ns(void)
+{
+    struct timespec ts;
+
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ((uint64_t)ts.tv_sec * 1000000000 + ts.tv_nsec);
+}
+
+static int
+asp_recvmmsg(int fd, struct mmsghdr *msgs, unsigned int n)
+{
+#if defined(HAVE_MMSG)
+    return (recvmmsg(fd, msgs, n, 0, NULL));
+#else
+    unsigned int i;
+    ssize_t len;
+
+    for (i = 0; i < n; i++) {
+        len = recvmsg(fd, &msgs[i].msg_hdr, 0);
+        if (len < 0)
+            break;
+        msgs[i].msg_len = len;
+    }
+    return ((i > 0) ? (int)i : -1);
+#endif
+}
+
+static int
+asp_sendmmsg(int fd, struct mmsghdr *msgs, unsigned int n)
+{
+#if defined(HAVE_MMSG)
+    return (sendmmsg(fd, msgs, n, 0));
+#else
+    unsigned int i;
+    ssize_t len;
+
+    for (i = 0; i < n; i++) {
+        len = sendmsg(fd, &msgs[i].msg_hdr, 0);
+        if (len < 0)
+            break;
+        msgs[i].msg_len = len;
+    }
+    return ((i > 0) ? (int)i : -1);
+#endif
+}
+
+static void
+asp_dgram_count(uint64_t *cp, int64_t n)
+{
+
+    __atomic_add_fetch(cp, n, __ATOMIC_RELAXED);
+}
+
+/* Address bytes and port sessions are told apart by */
+static const void *
+asp_dgram_addrkey(const struct sockaddr_storage *ssp, socklen_t alen,
+  size_t *lenp, unsigned short *portp)
+{
+
+    switch (ssp->ss_family) {
+    case AF_INET:
+        *lenp = sizeof(struct in_addr);
+        *portp = ((const struct sockaddr_in *)ssp)->sin_port;
+        return (&((const struct sockaddr_in *)ssp)->sin_addr);
+    case AF_INET6:
+        *lenp = sizeof(struct in6_addr);
+        *portp = ((const struct sockaddr_in6 *)ssp)->sin6_port;
+        return (&((const struct sockaddr_in6 *)ssp)->sin6_addr);
+    default:
+        *lenp = alen;
+        *portp = 0;
+        return (ssp);
+    }
+}
+
+static unsigned int
+asp_dgram_hash(const struct sockaddr_storage *ssp, socklen_t alen)
+{
+    const unsigned char *p;
+    unsigned short port;
+    uint32_t h;
+    size_t i, len;
+
+    p = asp_dgram_addrkey(ssp, alen, &len, &port);
+    /* FNV-1a */
+    h = 2166136261u;
+    for (i = 0; i < len; i++)
+        h = (h ^ p[i]) * 16777619u;
+    h = (h ^ (port & 0xff)) * 16777619u;
+    h = (h ^ (port >> 8)) * 16777619u;
+    return (h % ASP_DGRAM_NBUCKETS);
+}
+
+static int
+asp_dgram_addreq(const struct asp_dgram_sess *sp,
+  const struct sockaddr_storage *ssp, socklen_t alen)
+{
+    const void *k1, *k2;
+    unsigned short p1, p2;
+    size_t l1, l2;
+
+    if (sp->addr.ss_family != ssp->ss_family)
+        return (0);
+    k1 = asp_dgram_addrkey(&sp->addr, sp->alen, &l1, &p1);
+    k2 = asp_dgram_addrkey(ssp, alen, &l2, &p2);
+    return (p1 == p2 && l1 == l2 && memcmp(k1, k2, l1) == 0);
+}
+
+static struct asp_dgram_sess *
+asp_dgram_sess_ctor(struct asp_dgram_relay *rp, int k, unsigned int h)
+{
+    const struct asp_dgram_args *args;
+    struct asp_dgram_sess *sp;
+    int flags;
+
+    args = rp->args;
+    sp = malloc(sizeof(struct asp_dgram_sess));
+    if (sp == NULL)
+        return (NULL);
+    sp->fd = socket(args->dest->sa_family, SOCK_DGRAM, 0);
+    if (sp->fd < 0)
+        goto e0;
+    flags = fcntl(sp->fd, F_GETFL);
+    if (flags < 0 || fcntl(sp->fd, F_SETFL, flags | O_NONBLOCK) < 0)
+        goto e1;
+    if (args->bindaddr != NULL && bind(sp->fd, args->bindaddr,
+      args->bindlen) != 0)
+        goto e1;
+    if (connect(sp->fd, args->dest, args->destlen) != 0)
+        goto e1;
+    memcpy(&sp->addr, &rp->addrs[k], rp->msgs[k].msg_hdr.msg_namelen);
+    sp->alen = rp->msgs[k].msg_hdr.msg_namelen;
+    sp->last = rp->now;
+    sp->next = rp->buckets[h];
+    rp->buckets[h] = sp;
+    rp->rebuild = 1;
+    asp_dgram_count(&args->stats->nsessions, 1);
+    asp_dgram_count(&args->stats->sessions_total, 1);
+    return (sp);
+e1:
+    close(sp->fd);
+e0:
+    free(sp);
+    return (NULL);
+}
+
+static struct asp_dgram_sess *
+asp_dgram_sess_lookup(struct asp_dgram_relay *rp, int k)
+{
+    struct asp_dgram_sess *sp;
+    socklen_t alen;
+    unsigned int h;
+
+    alen = rp->msgs[k].msg_hdr.msg_namelen;
+    h = asp_dgram_hash(&rp->addrs[k], alen);
+    for (sp = rp->buckets[h]; sp != NULL; sp = sp->next) {
+        if (asp_dgram_addreq(sp, &rp->addrs[k], alen))
+            return (sp);
+    }
+    return (asp_dgram_sess_ctor(rp, k, h));
+}
+
+/* Close sessions idle for longer than the timeout, all of them if force */
+static void
+asp_dgram_expire(struct asp_dgram_relay *rp, int force)
+{
+    struct asp_dgram_sess *sp, **spp;
+    uint64_t idle_ns;
+    int i;
+
+    idle_ns = (uint64_t)rp->args->idle_ms * 1000000;
+    for (i = 0; i < ASP_DGRAM_NBUCKETS; i++) {
+        for (spp = &rp->buckets[i]; *spp != NULL;) {
+            sp = *spp;
+            if (!force && rp->now - sp->last < idle_ns) {
+                spp = &sp->next;
+                continue;
+            }
+            *spp = sp->next;
+            close(sp->fd);
+            free(sp);
+            asp_dgram_count(&rp->args->stats->nsessions, -1);
+            if (!force)
+                asp_dgram_count(&rp->args->stats->expired, 1);
+            rp->rebuild = 1;
+        }
+    }
+}
+
+/* Bring the poll set in line with the sessions */
+static int
+asp_dgram_pfds(struct asp_dgram_relay *rp)
+{
+    struct asp_dgram_sess *sp;
+    void *p;
+    int i, n;
+
+    n = 2;
+    for (i = 0; i < ASP_DGRAM_NBUCKETS; i++) {
+        for (sp = rp->buckets[i]; sp != NULL; sp = sp->next)
+            n++;
+    }
+    if (n > rp->pfdsize) {
+        p = realloc(rp->pfds, n * 2 * sizeof(struct pollfd));
+        if (p == NULL)
+            return (-1);
+        rp->pfds = p;
+        p = realloc(rp->psess, n * 2 * sizeof(struct asp_dgram_sess *));
+        if (p == NULL)
+            return (-1);
+        rp->psess = p;
+        rp->pfdsize = n * 2;
+    }
+    rp->pfds[0].fd = rp->args->source->fd;
+    rp->pfds[1].fd = rp->args->sink->fd;
+    rp->psess[0] = rp->psess[1] = NULL;
+    n = 2;
+    for (i = 0; i < ASP_DGRAM_NBUCKETS; i++) {
+        for (sp = rp->buckets[i]; sp != NULL; sp = sp->next) {
+            rp->pfds[n].fd = sp->fd;
+            rp->psess[n] = sp;
+            n++;
+        }
+    }
+    for (i = 0; i < n; i++) {
+        rp->pfds[i].events = POLLIN;
+        rp->pfds[i].revents = 0;
+    }
+    rp->npfds = n;
+    rp->rebuild = 0;
+    return (0);
+}
+
+/* Read a batch of datagrams off the fd, returns how many */
+static int
+asp_dgram_recv(struct asp_dgram_relay *rp, int fd, struct asp_sock *asp)
+{
+    struct msghdr *mhp;
+    uint64_t bytes;
+    int k, n;
+
+    for (k = 0; k < ASP_DGRAM_BATCH; k++) {
+        rp->iovs[k].iov_base = rp->data + k * rp->args->msgsize;
+        rp->iovs[k].iov_len = rp->args->msgsize;
+        mhp = &rp->msgs[k].msg_hdr;
+        memset(mhp, '\0', sizeof(struct msghdr));
+        mhp->msg_name = &rp->addrs[k];
+        mhp->msg_namelen = sizeof(struct sockaddr_storage);
+        mhp->msg_iov = &rp->iovs[k];
+        mhp->msg_iovlen = 1;
+    }
+    /* Errors are those of single datagrams (i.e. ICMP), not of the relay */
+    n = asp_recvmmsg(fd, rp->msgs, ASP_DGRAM_BATCH);
+    if (n <= 0)
+        return (0);
+    for (bytes = 0, k = 0; k < n; k++)
+        bytes += rp->msgs[k].msg_len;
+    asp_sock_account(asp, 0, n, bytes);
+    return (n);
+}
+
+/*
+ * Check and transform the k-th datagram received in the given direction,
+ * returns its length or -1 if it is to be dropped.
+ */
+static ssize_t
+asp_dgram_xform(struct asp_dgram_relay *rp, int dir, int k)
+{
+    const struct asp_dgram_args *args;
+    size_t len;
+
+    args = rp->args;
+    if (rp->msgs[k].msg_hdr.msg_flags & MSG_TRUNC)
+        goto drop;
+    len = rp->msgs[k].msg_len;
+    if (args->transform != NULL) {
+        len = args->transform(args->arg, dir, rp->iovs[k].iov_base, len,
+          args->msgsize);
+        if (len == 0)
+            goto drop;
+    }
+    rp->iovs[k].iov_len = len;
+    return (len);
+drop:
+    asp_dgram_count(&args->stats->dropped, 1);
+    return (-1);
+}
+
+static void
+asp_dgram_queue(struct asp_dgram_relay *rp, int nout, int k, void *name,
+  socklen_t namelen)
+{
+    struct msghdr *mhp;
+
+    mhp = &rp->omsgs[nout].msg_hdr;
+    memset(mhp, '\0', sizeof(struct msghdr));
+    mhp->msg_name = name;
+    mhp->msg_namelen = namelen;
+    mhp->msg_iov = &rp->iovs[k];
+    mhp->msg_iovlen = 1;
+}
+
+/*
+ * Send out the datagrams queued, the ones the socket has no room for or
+ * that fail are dropped, much like the network would.
+ */
+static void
+asp_dgram_send(struct asp_dgram_relay *rp, int fd, struct asp_sock *asp,
+  int nout)
+{
+    uint64_t bytes;
+    int i, k, n, nsent;
+
+    bytes = 0;
+    nsent = 0;
+    for (i = 0; i < nout;) {
+        n = asp_sendmmsg(fd, &rp->omsgs[i], nout - i);
+        if (n < 0) {
+            if (errno == EINTR)
+                continue;
+            if (errno == EAGAIN || errno == EWOULDBLOCK)
+                break;
+            i++;
+            continue;
+        }
+        for (k = i; k < i + n; k++)
+            bytes += rp->omsgs[k].msg_len;
+        nsent += n;
+        i += n;
+    }
+    if (nsent > 0)
+        asp_sock_account(asp, 1, nsent, bytes);
+    if (nsent < nout)
+        asp_dgram_count(&rp->args->stats->dropped, nout - nsent);
+}
+
+/* Source to the sink or the sessions */
+static void
+asp_dgram_in(struct asp_dgram_relay *rp)
+{
+    const struct asp_dgram_args *args;
+    struct asp_dgram_sess *sp;
+    int j, k, n, nout;
+
+    args = rp->args;
+    n = asp_dgram_recv(rp, args->source->fd, args->source);
+    for (k = 0; k < n; k++) {
+        rp->sess[k] = NULL;
+        rp->keep[k] = (asp_dgram_xform(rp, 0, k) >= 0);
+        if (!rp->keep[k])
+            continue;
+        if (args->idle_ms == 0) {
+            if (!rp->connected) {
+                memcpy(&rp->peer, &rp->addrs[k], rp->msgs[k].msg_hdr.msg_namelen);
+                rp->peerlen = rp->msgs[k].msg_hdr.msg_namelen;
+            }
+            continue;
+        }
+        rp->sess[k] = asp_dgram_sess_lookup(rp, k);
+        if (rp->sess[k] == NULL) {
+            asp_dgram_count(&args->stats->dropped, 1);
+            continue;
+        }
+        rp->sess[k]->last = rp->now;
+    }
+    if (args->idle_ms == 0) {
+        for (nout = 0, k = 0; k < n; k++) {
+            if (rp->keep[k])
+                asp_dgram_queue(rp, nout++, k, NULL, 0);
+        }
+        asp_dgram_send(rp, args->sink->fd, args->sink, nout);
+        return;
+    }
+    /* Batch up the datagrams going to the same session */
+    for (k = 0; k < n; k++) {
+        sp = rp->sess[k];
+        if (sp == NULL)
+            continue;
+        for (nout = 0, j = k; j < n; j++) {
+            if (rp->sess[j] != sp)
+                continue;
+            asp_dgram_queue(rp, nout++, j, NULL, 0);
+            rp->sess[j] = NULL;
+        }
+        asp_dgram_send(rp, sp->fd, args->sink, nout);
+    }
+}
+
+/* Sink or a session back to the source */
+static void
+asp_dgram_out(struct asp_dgram_relay *rp, int idx)
+{
+    const struct asp_dgram_args *args;
+    struct asp_dgram_sess *sp;
+    void *name;
+    socklen_t namelen;
+    int k, n, nout;
+
+    args = rp->args;
+    sp = rp->psess[idx];
+    n = asp_dgram_recv(rp, rp->pfds[idx].fd, args->sink);
+    if (n == 0)
+        return;
+    if (sp != NULL) {
+        sp->last = rp->now;
+        name = &sp->addr;
+        namelen = sp->alen;
+    } else if (rp->connected) {
+        name = NULL;
+        namelen = 0;
+    } else if (rp->peerlen > 0) {
+        name = &rp->peer;
+        namelen = rp->peerlen;
+    } else {
+        /* Nobody to send it to yet */
+        asp_dgram_count(&args->stats->dropped, n);
+        return;
+    }
+    for (nout = 0, k = 0; k < n; k++) {
+        if (asp_dgram_xform(rp, 1, k) >= 0)
+            asp_dgram_queue(rp, nout++, k, name, namelen);
+    }
+    asp_dgram_send(rp, args->source->fd, args->source, nout);
+}
+
+int
+asp_dgram_run(const struct asp_dgram_args *args)
+{
+    struct asp_dgram_relay *rp;
+    struct sockaddr_storage ss;
+    socklen_t sslen;
+    uint64_t lastscan;
+    int i, n, tick, rval;
+
+    rval = -1;
+    rp = malloc(sizeof(struct asp_dgram_relay));
+    if (rp == NULL)
+        return (-1);
+    memset(rp, '\0', sizeof(struct asp_dgram_relay));
+    rp->args = args;
+    rp->data = malloc(ASP_DGRAM_BATCH * args->msgsize);
+    if (rp->data == NULL)
+        goto out;
+    sslen = sizeof(ss);
+    rp->connected = (getpeername(args->source->fd, (struct sockaddr *)&ss,
+      &sslen) == 0);
+    tick = ASP_DGRAM_TICK;
+    if (args->idle_ms > 0 && args->idle_ms / 4 < ASP_DGRAM_TICK)
+        tick = (args->idle_ms / 4 > ASP_DGRAM_TICK_MIN) ?
+          args->idle_ms / 4 : ASP_DGRAM_TICK_MIN;
+    if (args->tick_ms > 0 && args->tick_ms < (unsigned int)tick)
+        tick = (args->tick_ms > ASP_DGRAM_TICK_MIN) ? (int)args->tick_ms :
+          ASP_DGRAM_TICK_MIN;
+    rp->rebuild = 1;
+    lastscan = getmonotime_ns();
+    while (args->isrunning(args->arg)) {
+        if (rp->rebuild && asp_dgram_pfds(rp) != 0)
+            goto out;
+        n = poll(rp->pfds, rp->npfds, tick);
+        if (n < 0 && errno != EINTR)
+            goto out;
+        rp->now = getmonotime_ns();
+        if (n > 0) {
+            /* Either side shut down, or the sink stirred in session mode */
+            if (((rp->pfds[0].revents | rp->pfds[1].revents) &
+              (POLLHUP | POLLNVAL)) ||
+              (args->idle_ms > 0 && rp->pfds[1].revents != 0))
+                break;
+            if (rp->pfds[0].revents & (POLLIN | POLLERR))
+                asp_dgram_in(rp);
+            for (i = 1; i < rp->npfds; i++) {
+                if (rp->pfds[i].revents & (POLLIN | POLLERR))
+                    asp_dgram_out(rp, i);
+            }
+        }
+        if (args->idle_ms > 0 && rp->now - lastscan >= (uint64_t)tick * 1000000) {
+            asp_dgram_expire(rp, 0);
+            lastscan = rp->now;
+        }
+        if (args->report != NULL)
+            args->report(args->arg);
+    }
+    rval = 0;
+out:
+    asp_dgram_expire(rp, 1);
+    free(rp->pfds);
+    free(rp->psess);
+    free(rp->data);
+    free(rp);
+    return (rval);
+}
+
+void
+asp_dgram_getstats(const struct asp_dgram_stats *dsp, struct asp_dgram_stats *res)
+{
+
+    res->nsessions = __atomic_load_n(&dsp->nsessions, __ATOMIC_RELAXED);
+    res->sessions_total = __atomic_load_n(&dsp->sessions_total, __ATOMIC_RELAXED);
+    res->expired = __atomic_load_n(&dsp->expired, __ATOMIC_RELAXED);
+    res->dropped = __atomic_load_n(&dsp->dropped, __ATOMIC_RELAXED);
+}
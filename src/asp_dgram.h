@@ -0,0 +1,55 @@
+#pragma once
+
+#include <stddef.h>
+#include <stdint.h>
+
+struct asp_sock;
+struct sockaddr;
+
+/* Datagrams moved per recvmmsg(2)/sendmmsg(2) call */
+#define ASP_DGRAM_BATCH 32
+
+/*
+ * Session counters and datagrams that could not be relayed: truncated,
+ * filtered out by a transform or refused by the kernel on the way out.
+ * Updated atomically, readable at any time from any thread.
+ */
+struct asp_dgram_stats {
+    uint64_t nsessions;
+    uint64_t sessions_total;
+    uint64_t expired;
+    uint64_t dropped;
+};
+
+/*
+ * Relay datagrams between the source and the sink. With idle_ms set, every
+ * client address seen on the source gets a session of its own: a socket
+ * connected to dest (bound to bindaddr if not NULL) that is closed after
+ * idle_ms of no traffic either way, the sink is only polled then so that
+ * shutting it down ends the relay. Otherwise the sink is expected to be
+ * connected and replies go to the source peer, or if the source is not
+ * connected to the client address heard from last.
+ */
+struct asp_dgram_args {
+    struct asp_sock *source;
+    struct asp_sock *sink;
+    const struct sockaddr *dest;
+    size_t destlen;
+    const struct sockaddr *bindaddr;
+    size_t bindlen;
+    /* Largest datagram relayed, bigger ones are dropped */
+    size_t msgsize;
+    unsigned int idle_ms;
+    /* Longest time between the isrunning() calls in ms, 0 - default */
+    unsigned int tick_ms;
+    struct asp_dgram_stats *stats;
+    /* Keep going while non-zero */
+    int (*isrunning)(void *);
+    /* Rewrite the datagram in place, returns its new length, 0 - drop it */
+    size_t (*transform)(void *, int, void *, size_t, size_t);
+    void (*report)(void *);
+    void *arg;
+};
+
+int asp_dgram_run(const struct asp_dgram_args *);
+void asp_dgram_getstats(const struct asp_dgram_stats *, struct asp_dgram_stats *);
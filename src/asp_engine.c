@@ -0,0 +1,529 @@
+#if defined(__linux__)
+#define _GNU_SOURCE
+#endif
+
+#include <sys/types.h>
+#include <errno.h>
+#include <poll.h>
+#include <pthread.h>
+#include <stddef.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include <unistd.h>
+
+#if defined(__linux__)
+#include <sys/epoll.h>
+#include <sys/eventfd.h>
+#define HAVE_EPOLL 1
+#endif
+
+#include "asp_engine.h"
+
+#define ASP_ELOOP_MAXEVENTS 64
+
+struct asp_eloop {
+    pthread_t thread;
+    int epfd;
+    int wakefd;
+    /* Entries attached, accessed atomically, it's read by other threads */
+    int nents;
+    int stop;
+    pthread_mutex_t mutex;
+    pthread_cond_t cond;
+    struct asp_engine_ent *pending;
+    struct asp_engine_ent *ticking;
+    uint64_t next_tick;
+    /* Deadlines of the entries */
+    struct asp_twheel wheel;
+};
+
+#define ASP_TIMER2ENT(tp) ((struct asp_engine_ent *)(void *)((char *)(tp) - \
+  offsetof(struct asp_engine_ent, timer)))
+
+static struct {
+    pthread_mutex_t mutex;
+    struct asp_eloop *loops;
+    int nloops;
+} engine = {.mutex = PTHREAD_MUTEX_INITIALIZER};
+
+#if defined(HAVE_EPOLL)
+static uint32_t
+poll2ep(short events)
+{
+    uint32_t r = 0;
+
+    if (events & POLLIN)
+        r |= EPOLLIN;
+    if (events & POLLOUT)
+        r |= EPOLLOUT;
+    return (r);
+}
+
+static short
+ep2poll(uint32_t events)
+{
+    short r = 0;
+
+    if (events & EPOLLIN)
+        r |= POLLIN;
+    if (events & EPOLLOUT)
+        r |= POLLOUT;
+    if (events & EPOLLHUP)
+        r |= POLLHUP;
+    if (events & EPOLLERR)
+        r |= POLLERR;
+    return (r);
+}
+
+static uint64_t
+getmonotime_ms(void)
+{
+    struct timespec ts;
+
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ((uint64_t)ts.tv_sec * 1000 + ts.tv_nsec / 1000000);
+}
+
+static void
+asp_eloop_wakeup(struct asp_eloop *lp)
+{
+    uint64_t v = 1;
+
+    while (write(lp->wakefd, &v, sizeof(v)) < 0 && errno == EINTR)
+        continue;
+}
+
+static int
+asp_eloop_register(struct asp_eloop *lp, struct asp_engine_ent *ent)
+{
+    struct epoll_event ev;
+    int i;
+
+    for (i = 0; i < 2; i++) {
+        ent->tags[i].ent = ent;
+        ent->tags[i].idx = i;
+        memset(&ev, '\0', sizeof(ev));
+        ev.events = poll2ep(ent->pfds[i].events);
+        ev.data.ptr = &ent->tags[i];
+        if (epoll_ctl(lp->epfd, EPOLL_CTL_ADD, ent->pfds[i].fd, &ev) != 0) {
+            if (i > 0)
+                epoll_ctl(lp->epfd, EPOLL_CTL_DEL, ent->pfds[0].fd, NULL);
+            return (-1);
+        }
+        ent->regd[i] = ent->pfds[i].events;
+    }
+    return (0);
+}
+
+static void
+asp_eloop_unregister(struct asp_eloop *lp, struct asp_engine_ent *ent)
+{
+    int i;
+
+    for (i = 0; i < 2; i++)
+        epoll_ctl(lp->epfd, EPOLL_CTL_DEL, ent->pfds[i].fd, NULL);
+}
+
+static int
+asp_eloop_sync(struct asp_eloop *lp, struct asp_engine_ent *ent)
+{
+    struct epoll_event ev;
+    int i;
+
+    for (i = 0; i < 2; i++) {
+        if (ent->regd[i] == ent->pfds[i].events)
+            continue;
+        memset(&ev, '\0', sizeof(ev));
+        ev.events = poll2ep(ent->pfds[i].events);
+        ev.data.ptr = &ent->tags[i];
+        if (epoll_ctl(lp->epfd, EPOLL_CTL_MOD, ent->pfds[i].fd, &ev) != 0)
+            return (-1);
+        ent->regd[i] = ent->pfds[i].events;
+    }
+    return (0);
+}
+
+/* Keep the entry on the ticking list as long as it asks for it */
+static void
+asp_eloop_tick_sync(struct asp_eloop *lp, struct asp_engine_ent *ent)
+{
+
+    if (ent->tick && ent->tprevp == NULL) {
+        if (lp->ticking == NULL)
+            lp->next_tick = getmonotime_ms() + ASP_ELOOP_TICK;
+        ent->tnext = lp->ticking;
+        if (ent->tnext != NULL)
+            ent->tnext->tprevp = &ent->tnext;
+        ent->tprevp = &lp->ticking;
+        lp->ticking = ent;
+    } else if ((!ent->tick || ent->finished) && ent->tprevp != NULL) {
+        *ent->tprevp = ent->tnext;
+        if (ent->tnext != NULL)
+            ent->tnext->tprevp = ent->tprevp;
+        ent->tnext = NULL;
+        ent->tprevp = NULL;
+    }
+}
+
+/* Keep the entry timer in line with the deadline it has asked for */
+static void
+asp_eloop_timer_sync(struct asp_eloop *lp, struct asp_engine_ent *ent)
+{
+
+    if (ent->deadline == 0 || ent->finished) {
+        asp_timer_disarm(&lp->wheel, &ent->timer);
+    } else if (!ASP_TIMER_ISARMED(&ent->timer) ||
+      ent->timer.expires != ent->deadline) {
+        asp_timer_arm(&lp->wheel, &ent->timer, ent->deadline);
+    }
+}
+
+/* Step an entry, putting it on the done list if it's to be detached */
+static void
+asp_eloop_step(struct asp_eloop *lp, struct asp_engine_ent *ent,
+  struct asp_engine_ent **done)
+{
+
+    if (ent->step(ent->arg) == 0 && asp_eloop_sync(lp, ent) == 0) {
+        asp_eloop_tick_sync(lp, ent);
+        asp_eloop_timer_sync(lp, ent);
+        return;
+    }
+    asp_eloop_unregister(lp, ent);
+    ent->finished = 1;
+    asp_eloop_tick_sync(lp, ent);
+    asp_eloop_timer_sync(lp, ent);
+    ent->next = *done;
+    *done = ent;
+}
+
+/* Step the entries whose deadlines have passed */
+static void
+asp_eloop_expire(struct asp_eloop *lp, struct asp_engine_ent **done)
+{
+    struct asp_timer *tp, *next;
+    struct asp_engine_ent *ent;
+    uint64_t now;
+
+    now = getmonotime_ms();
+    for (tp = asp_twheel_expire(&lp->wheel, now); tp != NULL; tp = next) {
+        /* Stepping can re-arm it */
+        next = tp->next;
+        ent = ASP_TIMER2ENT(tp);
+        if (ent->finished)
+            continue;
+        /* Not moved on, don't spin on it */
+        if (ent->deadline <= now)
+            ent->deadline = now + ASP_TWHEEL_RES;
+        ent->pfds[0].revents = ent->pfds[1].revents = 0;
+        asp_eloop_step(lp, ent, done);
+    }
+}
+
+/* How long epoll_wait() can block for */
+static int
+asp_eloop_timeout(struct asp_eloop *lp)
+{
+    int timeout, tnext;
+
+    timeout = (lp->ticking != NULL) ? ASP_ELOOP_TICK : -1;
+    tnext = asp_twheel_next(&lp->wheel, getmonotime_ms());
+    if (tnext >= 0 && (timeout < 0 || tnext < timeout))
+        timeout = tnext;
+    return (timeout);
+}
+
+static void
+asp_eloop_tick(struct asp_eloop *lp, struct asp_engine_ent **done)
+{
+    struct asp_engine_ent *ent, *next;
+    uint64_t now;
+
+    now = getmonotime_ms();
+    if (now < lp->next_tick)
+        return;
+    lp->next_tick = now + ASP_ELOOP_TICK;
+    for (ent = lp->ticking; ent != NULL; ent = next) {
+        next = ent->tnext;
+        ent->pfds[0].revents = ent->pfds[1].revents = 0;
+        asp_eloop_step(lp, ent, done);
+    }
+}
+
+static int
+asp_eloop_wakeup_handle(struct asp_eloop *lp)
+{
+    struct asp_engine_ent *pending, *ent;
+    uint64_t v;
+    int stop;
+
+    while (read(lp->wakefd, &v, sizeof(v)) < 0 && errno == EINTR)
+        continue;
+    pthread_mutex_lock(&lp->mutex);
+    pending = lp->pending;
+    lp->pending = NULL;
+    stop = lp->stop;
+    for (ent = pending; ent != NULL; ent = ent->next) {
+        ent->attach_status = (asp_eloop_register(lp, ent) == 0) ? 1 : -1;
+        if (ent->attach_status < 0)
+            __atomic_sub_fetch(&lp->nents, 1, __ATOMIC_RELAXED);
+        else
+            asp_eloop_timer_sync(lp, ent);
+    }
+    if (pending != NULL)
+        pthread_cond_broadcast(&lp->cond);
+    pthread_mutex_unlock(&lp->mutex);
+    return (stop);
+}
+
+static void *
+asp_eloop_run(void *arg)
+{
+    struct asp_eloop *lp;
+    struct epoll_event evs[ASP_ELOOP_MAXEVENTS];
+    struct asp_engine_tag *tag;
+    struct asp_engine_ent *ent, *done;
+    int i, n, stop, timeout;
+
+    lp = (struct asp_eloop *)arg;
+    for (stop = 0; stop == 0;) {
+        timeout = asp_eloop_timeout(lp);
+        n = epoll_wait(lp->epfd, evs, ASP_ELOOP_MAXEVENTS, timeout);
+        if (n < 0) {
+            if (errno == EINTR)
+                continue;
+            fprintf(stderr, "asp_eloop_run: epoll_wait() failed: %s\n", strerror(errno));
+            fflush(stderr);
+            break;
+        }
+        done = NULL;
+        for (i = 0; i < n; i++) {
+            if (evs[i].data.ptr == NULL) {
+                stop = asp_eloop_wakeup_handle(lp);
+                continue;
+            }
+            tag = (struct asp_engine_tag *)evs[i].data.ptr;
+            ent = tag->ent;
+            /*
+             * The other fd of the pair could have detached it earlier in
+             * this batch, fini() is not called until the batch is over so
+             * that the entry is still valid here.
+             */
+            if (ent->finished)
+                continue;
+            ent->pfds[0].revents = ent->pfds[1].revents = 0;
+            ent->pfds[tag->idx].revents = ep2poll(evs[i].events);
+            asp_eloop_step(lp, ent, &done);
+        }
+        if (lp->ticking != NULL)
+            asp_eloop_tick(lp, &done);
+        if (lp->wheel.ntimers > 0)
+            asp_eloop_expire(lp, &done);
+        while (done != NULL) {
+            ent = done;
+            done = ent->next;
+            __atomic_sub_fetch(&lp->nents, 1, __ATOMIC_RELAXED);
+            ent->fini(ent->arg);
+        }
+    }
+    return (NULL);
+}
+
+static void
+asp_eloop_dtor(struct asp_eloop *lp)
+{
+
+    close(lp->wakefd);
+    close(lp->epfd);
+    pthread_cond_destroy(&lp->cond);
+    pthread_mutex_destroy(&lp->mutex);
+}
+
+static int
+asp_eloop_ctor(struct asp_eloop *lp)
+{
+    struct epoll_event ev;
+
+    memset(lp, '\0', sizeof(struct asp_eloop));
+    asp_twheel_init(&lp->wheel, getmonotime_ms());
+    lp->epfd = epoll_create1(EPOLL_CLOEXEC);
+    if (lp->epfd < 0)
+        goto e0;
+    lp->wakefd = eventfd(0, EFD_NONBLOCK | EFD_CLOEXEC);
+    if (lp->wakefd < 0)
+        goto e1;
+    memset(&ev, '\0', sizeof(ev));
+    ev.events = EPOLLIN;
+    ev.data.ptr = NULL;
+    if (epoll_ctl(lp->epfd, EPOLL_CTL_ADD, lp->wakefd, &ev) != 0)
+        goto e2;
+    if (pthread_mutex_init(&lp->mutex, NULL) != 0)
+        goto e2;
+    if (pthread_cond_init(&lp->cond, NULL) != 0)
+        goto e3;
+    if (pthread_create(&lp->thread, NULL, asp_eloop_run, lp) != 0)
+        goto e4;
+    return (0);
+e4:
+    pthread_cond_destroy(&lp->cond);
+e3:
+    pthread_mutex_destroy(&lp->mutex);
+e2:
+    close(lp->wakefd);
+e1:
+    close(lp->epfd);
+e0:
+    return (-1);
+}
+
+static void
+asp_eloop_shutdown(struct asp_eloop *lp)
+{
+
+    pthread_mutex_lock(&lp->mutex);
+    lp->stop = 1;
+    pthread_mutex_unlock(&lp->mutex);
+    asp_eloop_wakeup(lp);
+    pthread_join(lp->thread, NULL);
+    asp_eloop_dtor(lp);
+}
+#endif /* HAVE_EPOLL */
+
+int
+asp_engine_start(int nloops)
+{
+#if defined(HAVE_EPOLL)
+    struct asp_eloop *loops;
+    int i;
+
+    if (nloops <= 0) {
+        nloops = (int)sysconf(_SC_NPROCESSORS_ONLN);
+        if (nloops <= 0)
+            nloops = 1;
+    }
+    pthread_mutex_lock(&engine.mutex);
+    if (engine.nloops > 0) {
+        pthread_mutex_unlock(&engine.mutex);
+        errno = EALREADY;
+        return (-1);
+    }
+    loops = malloc(sizeof(struct asp_eloop) * nloops);
+    if (loops == NULL) {
+        pthread_mutex_unlock(&engine.mutex);
+        return (-1);
+    }
+    for (i = 0; i < nloops; i++) {
+        if (asp_eloop_ctor(&loops[i]) != 0) {
+            while (i-- > 0)
+                asp_eloop_shutdown(&loops[i]);
+            free(loops);
+            pthread_mutex_unlock(&engine.mutex);
+            return (-1);
+        }
+    }
+    engine.loops = loops;
+    engine.nloops = nloops;
+    pthread_mutex_unlock(&engine.mutex);
+    return (0);
+#else
+    (void)nloops;
+    errno = ENOTSUP;
+    return (-1);
+#endif
+}
+
+int
+asp_engine_stop(void)
+{
+#if defined(HAVE_EPOLL)
+    int i, busy;
+
+    pthread_mutex_lock(&engine.mutex);
+    if (engine.nloops == 0) {
+        pthread_mutex_unlock(&engine.mutex);
+        return (0);
+    }
+    busy = 0;
+    for (i = 0; i < engine.nloops; i++)
+        busy += __atomic_load_n(&engine.loops[i].nents, __ATOMIC_RELAXED);
+    if (busy > 0) {
+        pthread_mutex_unlock(&engine.mutex);
+        errno = EBUSY;
+        return (-1);
+    }
+    for (i = 0; i < engine.nloops; i++)
+        asp_eloop_shutdown(&engine.loops[i]);
+    free(engine.loops);
+    engine.loops = NULL;
+    engine.nloops = 0;
+    pthread_mutex_unlock(&engine.mutex);
+    return (0);
+#else
+    return (0);
+#endif
+}
+
+int
+asp_engine_isrunning(void)
+{
+    int rval;
+
+    pthread_mutex_lock(&engine.mutex);
+    rval = (engine.nloops > 0);
+    pthread_mutex_unlock(&engine.mutex);
+    return (rval);
+}
+
+int
+asp_engine_attach(struct asp_engine_ent *ent)
+{
+#if defined(HAVE_EPOLL)
+    struct asp_eloop *lp;
+    int i, n, nmin, rval;
+
+    pthread_mutex_lock(&engine.mutex);
+    if (engine.nloops == 0) {
+        pthread_mutex_unlock(&engine.mutex);
+        errno = ENOTSUP;
+        return (-1);
+    }
+    /* Pick the least loaded loop */
+    lp = &engine.loops[0];
+    nmin = __atomic_load_n(&lp->nents, __ATOMIC_RELAXED);
+    for (i = 1; i < engine.nloops; i++) {
+        n = __atomic_load_n(&engine.loops[i].nents, __ATOMIC_RELAXED);
+        if (n < nmin) {
+            lp = &engine.loops[i];
+            nmin = n;
+        }
+    }
+    /*
+     * Registration is done by the loop thread itself, so that no event for
+     * a partially registered pair could ever be observed.
+     */
+    pthread_mutex_lock(&lp->mutex);
+    __atomic_add_fetch(&lp->nents, 1, __ATOMIC_RELAXED);
+    ent->loop = lp;
+    ent->finished = 0;
+    ent->attach_status = 0;
+    ent->tnext = NULL;
+    ent->tprevp = NULL;
+    memset(&ent->timer, '\0', sizeof(ent->timer));
+    ent->next = lp->pending;
+    lp->pending = ent;
+    pthread_mutex_unlock(&engine.mutex);
+    asp_eloop_wakeup(lp);
+    while (ent->attach_status == 0)
+        pthread_cond_wait(&lp->cond, &lp->mutex);
+    rval = (ent->attach_status > 0) ? 0 : -1;
+    pthread_mutex_unlock(&lp->mutex);
+    return (rval);
+#else
+    (void)ent;
+    errno = ENOTSUP;
+    return (-1);
+#endif
+}
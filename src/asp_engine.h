@@ -0,0 +1,52 @@
+#pragma once
+
+#include <stdint.h>
+
+#include "asp_timer.h"
+
+struct pollfd;
+struct asp_eloop;
+struct asp_engine_ent;
+
+struct asp_engine_tag {
+    struct asp_engine_ent *ent;
+    int idx;
+};
+
+/*
+ * A pair of file descriptors driven by one of the engine event loops. The
+ * owner provides the pollfd array (events set, revents filled by the loop
+ * before each call to step()) and the callbacks; the rest is private to the
+ * engine. step() returns non-zero when the pair should be detached, fini() is
+ * called exactly once after the detach and may release the entry. As long as
+ * tick is set after step(), the loop also calls it every ASP_ELOOP_TICK ms
+ * with no revents, for the owner to resume whatever it is waiting on. Same
+ * goes for the deadline (monotonic, in ms, 0 - none): once it's passed the
+ * loop calls step() with no revents, that should move it further or clear
+ * it, or else it's called again in ASP_TWHEEL_RES ms or so.
+ */
+struct asp_engine_ent {
+    struct pollfd *pfds;
+    int (*step)(void *);
+    void (*fini)(void *);
+    void *arg;
+    int tick;
+    uint64_t deadline;
+    /* Private */
+    struct asp_eloop *loop;
+    short regd[2];
+    struct asp_engine_tag tags[2];
+    int finished;
+    int attach_status;
+    struct asp_engine_ent *next;
+    struct asp_engine_ent *tnext;
+    struct asp_engine_ent **tprevp;
+    struct asp_timer timer;
+};
+
+#define ASP_ELOOP_TICK 10
+
+int asp_engine_start(int);
+int asp_engine_stop(void);
+int asp_engine_isrunning(void);
+int asp_engine_attach(struct asp_engine_ent *);
@@ -0,0 +1,80 @@
+#include <stddef.h>
+#include <stdint.h>
+
+#include "asp_hist.h"
+
+/*
+ * Histograms are updated by the relay and read by anyone at any time, all
+ * accesses are relaxed atomics so that no locking is needed and the same
+ * histogram can be shared by multiple relays.
+ */
+#define ATOMIC_ADD(p, v) __atomic_fetch_add((p), (v), __ATOMIC_RELAXED)
+#define ATOMIC_LOAD(p) __atomic_load_n((p), __ATOMIC_RELAXED)
+
+void
+asp_hist_record(struct asp_hist *hp, uint64_t val)
+{
+    uint64_t omax;
+    int bidx;
+
+    bidx = (val > 0) ? 63 - __builtin_clzll(val) : 0;
+    if (bidx >= ASP_HIST_NBUCKETS)
+        bidx = ASP_HIST_NBUCKETS - 1;
+    ATOMIC_ADD(&hp->buckets[bidx], 1);
+    ATOMIC_ADD(&hp->count, 1);
+    ATOMIC_ADD(&hp->sum, val);
+    omax = ATOMIC_LOAD(&hp->max);
+    while (val > omax && !__atomic_compare_exchange_n(&hp->max, &omax, val,
+      1, __ATOMIC_RELAXED, __ATOMIC_RELAXED))
+        continue;
+}
+
+void
+asp_hist_read(const struct asp_hist *hp, struct asp_hist *res)
+{
+    int i;
+
+    res->count = ATOMIC_LOAD(&hp->count);
+    res->sum = ATOMIC_LOAD(&hp->sum);
+    res->max = ATOMIC_LOAD(&hp->max);
+    for (i = 0; i < ASP_HIST_NBUCKETS; i++)
+        res->buckets[i] = ATOMIC_LOAD(&hp->buckets[i]);
+}
+
+void
+asp_lat_enq(struct asp_lat *lp, size_t len, uint64_t ts)
+{
+    struct asp_lat_mark *mp;
+
+    if (len == 0)
+        return;
+    lp->enq += len;
+    if (lp->n == ASP_LAT_NMARKS) {
+        /* Out of marks, merge into the last one (over-reporting a bit) */
+        mp = &lp->marks[(lp->head + lp->n - 1) % ASP_LAT_NMARKS];
+        mp->end = lp->enq;
+        return;
+    }
+    mp = &lp->marks[(lp->head + lp->n) % ASP_LAT_NMARKS];
+    mp->end = lp->enq;
+    mp->ts = ts;
+    lp->n++;
+}
+
+void
+asp_lat_deq(struct asp_lat *lp, size_t len, uint64_t now,
+  struct asp_hist *hp, struct asp_hist *ghp)
+{
+    struct asp_lat_mark *mp;
+
+    lp->deq += len;
+    while (lp->n > 0) {
+        mp = &lp->marks[lp->head];
+        if (mp->end > lp->deq)
+            break;
+        asp_hist_record(hp, now - mp->ts);
+        asp_hist_record(ghp, now - mp->ts);
+        lp->head = (lp->head + 1) % ASP_LAT_NMARKS;
+        lp->n--;
+    }
+}
@@ -0,0 +1,41 @@
+#pragma once
+
+#include <stddef.h>
+#include <stdint.h>
+
+/*
+ * Log2-scale histogram of durations in nanoseconds: bucket N counts samples
+ * in the [2^N, 2^(N+1)) range, the last one also takes everything above it.
+ */
+#define ASP_HIST_NBUCKETS 48
+
+struct asp_hist {
+    uint64_t count;
+    uint64_t sum;
+    uint64_t max;
+    uint64_t buckets[ASP_HIST_NBUCKETS];
+};
+
+/*
+ * Tracks when bytes entered the relay buffer, so that the time it took to
+ * flush them out can be recorded once they are all gone.
+ */
+#define ASP_LAT_NMARKS 32
+
+struct asp_lat_mark {
+    uint64_t end;
+    uint64_t ts;
+};
+
+struct asp_lat {
+    uint64_t enq;
+    uint64_t deq;
+    unsigned int head;
+    unsigned int n;
+    struct asp_lat_mark marks[ASP_LAT_NMARKS];
+};
+
+void asp_hist_record(struct asp_hist *, uint64_t);
+void asp_hist_read(const struct asp_hist *, struct asp_hist *);
+void asp_lat_enq(struct asp_lat *, size_t, uint64_t);
+void asp_lat_deq(struct asp_lat *, size_t, uint64_t, struct asp_hist *, struct asp_hist *);
@@ -1,3 +1,7 @@
+#pragma once
+
+#include <stdint.h>
+
 struct asp_iostats_uni {
     uint64_t nops;
     uint64_t btotal;
@@ -7,4 +11,3 @@ struct asp_iostats_bi {
     struct asp_iostats_uni in;
     struct asp_iostats_uni out;
 };
-
@@ -0,0 +1,88 @@
+#include <stdint.h>
+
+#include "asp_mem.h"
+
+/*
+ * Readers are paused once the total buffered goes over the budget (0 - no
+ * budget), and resumed once it gets back to the low watermark, which is 3/4
+ * of the budget unless set explicitly.
+ */
+static struct {
+    uint64_t budget;
+    uint64_t low;
+    struct asp_mem_stats stats;
+} mem;
+
+void
+asp_mem_setbudget(uint64_t budget, uint64_t low)
+{
+
+    if (low == 0 || low > budget)
+        low = budget / 4 * 3;
+    __atomic_store_n(&mem.low, low, __ATOMIC_RELAXED);
+    __atomic_store_n(&mem.budget, budget, __ATOMIC_RELAXED);
+}
+
+int
+asp_mem_overbudget(void)
+{
+    uint64_t budget;
+
+    budget = __atomic_load_n(&mem.budget, __ATOMIC_RELAXED);
+    return (budget != 0 &&
+      __atomic_load_n(&mem.stats.buffered, __ATOMIC_RELAXED) >= budget);
+}
+
+int
+asp_mem_belowlow(void)
+{
+
+    return (__atomic_load_n(&mem.budget, __ATOMIC_RELAXED) == 0 ||
+      __atomic_load_n(&mem.stats.buffered, __ATOMIC_RELAXED) <=
+      __atomic_load_n(&mem.low, __ATOMIC_RELAXED));
+}
+
+/* Adjust buffered and allocated by the given (signed) amounts */
+void
+asp_mem_account(struct asp_mem_stats *msp, int64_t buffered, int64_t allocated)
+{
+
+    if (buffered != 0) {
+        __atomic_add_fetch(&msp->buffered, buffered, __ATOMIC_RELAXED);
+        __atomic_add_fetch(&mem.stats.buffered, buffered, __ATOMIC_RELAXED);
+    }
+    if (allocated != 0) {
+        __atomic_add_fetch(&msp->allocated, allocated, __ATOMIC_RELAXED);
+        __atomic_add_fetch(&mem.stats.allocated, allocated, __ATOMIC_RELAXED);
+    }
+}
+
+void
+asp_mem_paused(struct asp_mem_stats *msp, int budget)
+{
+
+    if (budget) {
+        __atomic_add_fetch(&msp->budget_pauses, 1, __ATOMIC_RELAXED);
+        __atomic_add_fetch(&mem.stats.budget_pauses, 1, __ATOMIC_RELAXED);
+    } else {
+        __atomic_add_fetch(&msp->wm_pauses, 1, __ATOMIC_RELAXED);
+        __atomic_add_fetch(&mem.stats.wm_pauses, 1, __ATOMIC_RELAXED);
+    }
+}
+
+void
+asp_mem_getstats(const struct asp_mem_stats *msp, struct asp_mem_stats *res)
+{
+
+    res->buffered = __atomic_load_n(&msp->buffered, __ATOMIC_RELAXED);
+    res->allocated = __atomic_load_n(&msp->allocated, __ATOMIC_RELAXED);
+    res->wm_pauses = __atomic_load_n(&msp->wm_pauses, __ATOMIC_RELAXED);
+    res->budget_pauses = __atomic_load_n(&msp->budget_pauses, __ATOMIC_RELAXED);
+}
+
+void
+asp_mem_getstats_global(struct asp_mem_stats *res)
+{
+
+    asp_mem_getstats(&mem.stats, res);
+}
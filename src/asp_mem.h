@@ -0,0 +1,25 @@
+#pragma once
+
+#include <stdint.h>
+
+/*
+ * Accounting of the data held by the relays on its way from one side to the
+ * other (buffered) and of the relay buffers themselves (allocated), per
+ * proxy and for the whole process, plus the process-wide budget for the
+ * former. Counters are updated atomically, so that they can be read at any
+ * time from any thread.
+ */
+struct asp_mem_stats {
+    uint64_t buffered;
+    uint64_t allocated;
+    uint64_t wm_pauses;
+    uint64_t budget_pauses;
+};
+
+void asp_mem_setbudget(uint64_t, uint64_t);
+int asp_mem_overbudget(void);
+int asp_mem_belowlow(void);
+void asp_mem_account(struct asp_mem_stats *, int64_t, int64_t);
+void asp_mem_paused(struct asp_mem_stats *, int);
+void asp_mem_getstats(const struct asp_mem_stats *, struct asp_mem_stats *);
+void asp_mem_getstats_global(struct asp_mem_stats *);
@@ -0,0 +1,405 @@
+#undef _POSIX_C_SOURCE
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+#include <errno.h>
+#include <string.h>
+
+#include "asyncproxy.h"
+
+/*
+ * Native binding for the bits of the API used on every proxy: the ctor and
+ * the calls the Python side makes over and over (start/isalive/join/...),
+ * plus the view hooks, called with a memoryview over the relay buffer
+ * without going through ctypes.
+ *
+ * That is all it covers. The per-proxy setters (transforms, rate limits,
+ * shapers, taps, watermarks, timeouts, socket options), the in2out/out2in
+ * and stats hooks, the struct returning getters (memory, datagram,
+ * expiry, histograms, connection info), the batch calls and the global
+ * knobs are still done with ctypes on the same library, using the handle:
+ * their arguments and results are the ctypes structures the Python side
+ * hands out, and they are called once per proxy rather than per relay
+ * turn.
+ */
+struct asp_pyproxy {
+    PyObject_HEAD
+    void *ap;
+    /* View hooks per direction, looked up with the GIL held */
+    PyObject *hooks[2];
+};
+
+static PyObject *asp_pyerror;
+
+static PyObject *
+asp_pyraise(const char *fname, int err)
+{
+    PyObject *v;
+
+    if (err == 0) {
+        PyErr_Format(asp_pyerror, "%s() failed", fname);
+        return (NULL);
+    }
+    v = Py_BuildValue("(iN)", err, PyUnicode_FromFormat("%s() failed: %s",
+      fname, strerror(err)));
+    if (v != NULL) {
+        PyErr_SetObject(asp_pyerror, v);
+        Py_DECREF(v);
+    }
+    return (NULL);
+}
+
+static int
+asp_pydir(int dir)
+{
+
+    if (dir != AP_DIR_I2O && dir != AP_DIR_O2I) {
+        PyErr_Format(PyExc_ValueError, "invalid direction %d", dir);
+        return (-1);
+    }
+    return (0);
+}
+
+static PyObject *
+asp_pyproxy_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"fd", "out_fd", "dest", "port", "af", "bindto",
+      "bufsize", "flags", "connect_timeout", "dgram_idle", "sockopts",
+      NULL};
+    struct asyncproxy_ctor_args aca;
+    struct asp_pyproxy *self;
+    const char *dest, *bindto;
+    Py_ssize_t bufsize;
+    void *ap;
+    int out_fd, err;
+
+    memset(&aca, '\0', sizeof(aca));
+    out_fd = -1;
+    dest = bindto = NULL;
+    bufsize = 0;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "i|izHiznIII(Iiiiiiii)",
+      kwlist, &aca.fd, &out_fd, &dest, &aca.portn, &aca.af, &bindto, &bufsize,
+      &aca.flags, &aca.connect_timeout, &aca.dgram_idle, &aca.sockopts.mask,
+      &aca.sockopts.nodelay, &aca.sockopts.sndbuf, &aca.sockopts.rcvbuf,
+      &aca.sockopts.notsent_lowat, &aca.sockopts.quickack,
+      &aca.sockopts.keepalive, &aca.sockopts.tos))
+        return (NULL);
+    if (bufsize < 0) {
+        PyErr_SetString(PyExc_ValueError, "bufsize must not be negative");
+        return (NULL);
+    }
+    aca.bufsize = bufsize;
+    if (dest != NULL) {
+        aca.dest_type = AP_DEST_HOST;
+        aca.dest = dest;
+        aca.bindto = bindto;
+    } else {
+        aca.dest_type = AP_DEST_FD;
+        aca.out_fd = out_fd;
+    }
+    self = (struct asp_pyproxy *)type->tp_alloc(type, 0);
+    if (self == NULL)
+        return (NULL);
+    /* Could be resolving the destination */
+    Py_BEGIN_ALLOW_THREADS
+    errno = 0;
+    ap = asyncproxy_ctor(&aca);
+    err = errno;
+    Py_END_ALLOW_THREADS
+    if (ap == NULL) {
+        Py_DECREF(self);
+        return (asp_pyraise("asyncproxy_ctor", err));
+    }
+    self->ap = ap;
+    return ((PyObject *)self);
+}
+
+static int
+asp_pyproxy_traverse(struct asp_pyproxy *self, visitproc visit, void *arg)
+{
+
+    Py_VISIT(self->hooks[0]);
+    Py_VISIT(self->hooks[1]);
+    return (0);
+}
+
+static int
+asp_pyproxy_clear(struct asp_pyproxy *self)
+{
+
+    /* The relay skips the hooks that are gone */
+    Py_CLEAR(self->hooks[0]);
+    Py_CLEAR(self->hooks[1]);
+    return (0);
+}
+
+static void
+asp_pyproxy_dealloc(struct asp_pyproxy *self)
+{
+
+    PyObject_GC_UnTrack(self);
+    if (self->ap != NULL) {
+        /* Joins the relay, which could be waiting for the GIL */
+        Py_BEGIN_ALLOW_THREADS
+        asyncproxy_dtor(self->ap);
+        Py_END_ALLOW_THREADS
+    }
+    asp_pyproxy_clear(self);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+/*
+ * Attaching to a shared loop waits for the loop thread, which could itself
+ * be waiting for the GIL to run a hook of some other proxy.
+ */
+static PyObject *
+asp_pyproxy_start(struct asp_pyproxy *self, PyObject *Py_UNUSED(ignored))
+{
+    int rval;
+
+    errno = 0;
+    Py_BEGIN_ALLOW_THREADS
+    rval = asyncproxy_start(self->ap);
+    Py_END_ALLOW_THREADS
+    if (rval != 0)
+        return (asp_pyraise("asyncproxy_start", errno));
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+asp_pyproxy_isalive(struct asp_pyproxy *self, PyObject *Py_UNUSED(ignored))
+{
+
+    return (PyBool_FromLong(asyncproxy_isalive(self->ap)));
+}
+
+static PyObject *
+asp_pyproxy_join(struct asp_pyproxy *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"shutdown", NULL};
+    int shutdown;
+
+    shutdown = 1;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|p", kwlist, &shutdown))
+        return (NULL);
+    Py_BEGIN_ALLOW_THREADS
+    asyncproxy_join(self->ap, shutdown);
+    Py_END_ALLOW_THREADS
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+asp_pyproxy_getdonefd(struct asp_pyproxy *self, PyObject *Py_UNUSED(ignored))
+{
+    int fd;
+
+    errno = 0;
+    fd = asyncproxy_getdonefd(self->ap);
+    if (fd < 0)
+        return (asp_pyraise("asyncproxy_getdonefd", errno));
+    return (PyLong_FromLong(fd));
+}
+
+static PyObject *
+asp_pyproxy_describe(struct asp_pyproxy *self, PyObject *Py_UNUSED(ignored))
+{
+
+    return (PyBytes_FromString(asyncproxy_describe(self->ap)));
+}
+
+static PyObject *
+asp_pyproxy_getsockname(struct asp_pyproxy *self, PyObject *Py_UNUSED(ignored))
+{
+    const char *addr;
+    unsigned short portn;
+
+    portn = 0;
+    errno = 0;
+    addr = asyncproxy_getsockname(self->ap, &portn);
+    if (addr == NULL)
+        return (asp_pyraise("asyncproxy_getsockname", errno));
+    return (Py_BuildValue("(sH)", addr, portn));
+}
+
+static PyObject *
+asp_pyproxy_getstats(struct asp_pyproxy *self, PyObject *Py_UNUSED(ignored))
+{
+    struct asyncproxy_stats st;
+
+    asyncproxy_getstats(self->ap, &st);
+    return (Py_BuildValue("((KK)(KK)(KK)(KK))",
+      (unsigned long long)st.source.in.nops,
+      (unsigned long long)st.source.in.btotal,
+      (unsigned long long)st.source.out.nops,
+      (unsigned long long)st.source.out.btotal,
+      (unsigned long long)st.sink.in.nops,
+      (unsigned long long)st.sink.in.btotal,
+      (unsigned long long)st.sink.out.nops,
+      (unsigned long long)st.sink.out.btotal));
+}
+
+/*
+ * Called by the relay with the GIL held, see _CtypesProxy._view_hook()
+ * for the semantics. Errors are reported as unraisable and the data is
+ * passed through unchanged.
+ */
+static ssize_t
+asp_pyproxy_view(void *arg, void *buf, size_t len, size_t size)
+{
+    PyObject *hook, *view, *rval, *r;
+    Py_buffer rb;
+    Py_ssize_t n;
+    ssize_t rlen;
+
+    hook = *(PyObject **)arg;
+    if (hook == NULL)
+        return (-1);
+    Py_INCREF(hook);
+    rlen = -1;
+    view = PyMemoryView_FromMemory(buf, size, PyBUF_WRITE);
+    if (view == NULL)
+        goto out;
+    rval = PyObject_CallFunction(hook, "On", view, (Py_ssize_t)len);
+    if (rval == NULL || rval == Py_None) {
+        /* Failed or left as is */
+    } else if (PyLong_Check(rval)) {
+        n = PyLong_AsSsize_t(rval);
+        if (n < 0 || (size_t)n > size) {
+            if (!PyErr_Occurred())
+                PyErr_Format(PyExc_ValueError,
+                  "invalid length %zd returned by %S", n, hook);
+        } else {
+            rlen = n;
+        }
+    } else if (PyObject_GetBuffer(rval, &rb, PyBUF_SIMPLE) == 0) {
+        if ((size_t)rb.len > size) {
+            PyErr_Format(PyExc_ValueError,
+              "%zd bytes returned by %S do not fit into %zu", rb.len, hook,
+              size);
+        } else {
+            memmove(buf, rb.buf, rb.len);
+            rlen = rb.len;
+        }
+        PyBuffer_Release(&rb);
+    }
+    Py_XDECREF(rval);
+    if (PyErr_Occurred()) {
+        rlen = -1;
+        PyErr_WriteUnraisable(hook);
+    }
+    /* The buffer is only valid during the call */
+    r = PyObject_CallMethod(view, "release", NULL);
+    Py_XDECREF(r);
+    Py_DECREF(view);
+out:
+    if (PyErr_Occurred()) {
+        rlen = -1;
+        PyErr_WriteUnraisable(hook);
+    }
+    Py_DECREF(hook);
+    return (rlen);
+}
+
+static PyObject *
+asp_pyproxy_set_view_hook(struct asp_pyproxy *self, PyObject *args)
+{
+    PyObject *hook;
+    int dir;
+
+    if (!PyArg_ParseTuple(args, "iO", &dir, &hook))
+        return (NULL);
+    if (asp_pydir(dir) != 0)
+        return (NULL);
+    if (hook == Py_None) {
+        hook = NULL;
+    } else if (!PyCallable_Check(hook)) {
+        PyErr_SetString(PyExc_TypeError, "hook must be callable or None");
+        return (NULL);
+    }
+    Py_XINCREF(hook);
+    Py_XSETREF(self->hooks[dir], hook);
+    asyncproxy_set_view_hook(self->ap, dir,
+      (hook != NULL) ? asp_pyproxy_view : NULL, &self->hooks[dir]);
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+asp_pyproxy_gethandle(struct asp_pyproxy *self, void *Py_UNUSED(closure))
+{
+
+    return (PyLong_FromVoidPtr(self->ap));
+}
+
+static PyMethodDef asp_pyproxy_methods[] = {
+    {"start", (PyCFunction)asp_pyproxy_start, METH_NOARGS, NULL},
+    {"isalive", (PyCFunction)asp_pyproxy_isalive, METH_NOARGS, NULL},
+    {"join", (PyCFunction)(void (*)(void))asp_pyproxy_join,
+      METH_VARARGS | METH_KEYWORDS, NULL},
+    {"getdonefd", (PyCFunction)asp_pyproxy_getdonefd, METH_NOARGS, NULL},
+    {"describe", (PyCFunction)asp_pyproxy_describe, METH_NOARGS, NULL},
+    {"getsockname", (PyCFunction)asp_pyproxy_getsockname, METH_NOARGS, NULL},
+    {"getstats", (PyCFunction)asp_pyproxy_getstats, METH_NOARGS, NULL},
+    {"set_view_hook", (PyCFunction)asp_pyproxy_set_view_hook, METH_VARARGS,
+      NULL},
+    {NULL, NULL, 0, NULL}
+};
+
+static PyGetSetDef asp_pyproxy_getset[] = {
+    {"handle", (getter)asp_pyproxy_gethandle, NULL,
+      "Proxy pointer for the ctypes binding", NULL},
+    {NULL, NULL, NULL, NULL, NULL}
+};
+
+static PyTypeObject asp_pyproxy_type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "_libasyncproxy.Proxy",
+    .tp_basicsize = sizeof(struct asp_pyproxy),
+    .tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC,
+    .tp_doc = "Proxy(fd, out_fd=-1, dest=None, port=0, af=0, bindto=None, "
+      "bufsize=0, flags=0, connect_timeout=0, dgram_idle=0, "
+      "sockopts=(mask, nodelay, sndbuf, rcvbuf, notsent_lowat, quickack, "
+      "keepalive, tos))",
+    .tp_new = asp_pyproxy_new,
+    .tp_dealloc = (destructor)asp_pyproxy_dealloc,
+    .tp_traverse = (traverseproc)asp_pyproxy_traverse,
+    .tp_clear = (inquiry)asp_pyproxy_clear,
+    .tp_methods = asp_pyproxy_methods,
+    .tp_getset = asp_pyproxy_getset,
+};
+
+static struct PyModuleDef asp_pymod = {
+    PyModuleDef_HEAD_INIT,
+    .m_name = "_libasyncproxy",
+    .m_doc = "Native binding for libasyncproxy",
+    .m_size = -1,
+};
+
+PyMODINIT_FUNC
+PyInit__libasyncproxy(void)
+{
+    PyObject *m;
+
+    if (PyType_Ready(&asp_pyproxy_type) < 0)
+        return (NULL);
+    m = PyModule_Create(&asp_pymod);
+    if (m == NULL)
+        return (NULL);
+    asp_pyerror = PyErr_NewException("_libasyncproxy.Error", PyExc_OSError,
+      NULL);
+    if (asp_pyerror == NULL)
+        goto e0;
+    Py_INCREF(asp_pyerror);
+    if (PyModule_AddObject(m, "Error", asp_pyerror) != 0) {
+        Py_DECREF(asp_pyerror);
+        goto e0;
+    }
+    Py_INCREF(&asp_pyproxy_type);
+    if (PyModule_AddObject(m, "Proxy", (PyObject *)&asp_pyproxy_type) != 0) {
+        Py_DECREF(&asp_pyproxy_type);
+        goto e0;
+    }
+    return (m);
+e0:
+    Py_DECREF(m);
+    return (NULL);
+}
@@ -0,0 +1,276 @@
+#if !defined(_POSIX_C_SOURCE)
+#define _POSIX_C_SOURCE 200112L
+#endif
+
+#include <sys/types.h>
+#include <sys/socket.h>
+#include <netdb.h>
+#include <pthread.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+
+#include "asp_resolve.h"
+
+#define ASP_RESOLVE_NBUCKETS 256
+#define ASP_RESOLVE_TTL_DEFAULT 30000
+#define ASP_RESOLVE_SIZE_DEFAULT 128
+
+/*
+ * Each entry sits on a hash chain and on the LRU list, most recently used
+ * first. The host and port strings are stored right after the entry.
+ */
+struct asp_resolve_ent {
+    struct asp_resolve_ent *hnext;
+    struct asp_resolve_ent *prev;
+    struct asp_resolve_ent *next;
+    uint32_t hash;
+    int af;
+    uint64_t ctime;
+    struct asp_resolve_res res;
+    const char *port;
+    char host[];
+};
+
+static struct {
+    pthread_mutex_t mutex;
+    struct asp_resolve_ent *buckets[ASP_RESOLVE_NBUCKETS];
+    struct asp_resolve_ent *head;
+    struct asp_resolve_ent *tail;
+    unsigned int nents;
+    unsigned int size;
+    unsigned int ttl;
+    struct asp_resolve_stats stats;
+} cache = {
+    .mutex = PTHREAD_MUTEX_INITIALIZER,
+    .size = ASP_RESOLVE_SIZE_DEFAULT,
+    .ttl = ASP_RESOLVE_TTL_DEFAULT,
+};
+
+static uint64_t
+getmonotime_ms(void)
+{
+    struct timespec ts;
+
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ((uint64_t)ts.tv_sec * 1000 + ts.tv_nsec / 1000000);
+}
+
+/* FNV-1a */
+static uint32_t
+asp_resolve_hash(const char *host, const char *port, int af)
+{
+    uint32_t h;
+    const char *cp;
+
+    h = 2166136261u;
+    for (cp = host; *cp != '\0'; cp++)
+        h = (h ^ (unsigned char)*cp) * 16777619u;
+    for (cp = port; *cp != '\0'; cp++)
+        h = (h ^ (unsigned char)*cp) * 16777619u;
+    return ((h ^ (uint32_t)af) * 16777619u);
+}
+
+static void
+lru_unlink(struct asp_resolve_ent *ep)
+{
+
+    if (ep->prev != NULL)
+        ep->prev->next = ep->next;
+    else
+        cache.head = ep->next;
+    if (ep->next != NULL)
+        ep->next->prev = ep->prev;
+    else
+        cache.tail = ep->prev;
+    ep->prev = ep->next = NULL;
+}
+
+static void
+lru_push(struct asp_resolve_ent *ep)
+{
+
+    ep->prev = NULL;
+    ep->next = cache.head;
+    if (cache.head != NULL)
+        cache.head->prev = ep;
+    else
+        cache.tail = ep;
+    cache.head = ep;
+}
+
+static void
+cache_remove(struct asp_resolve_ent *ep)
+{
+    struct asp_resolve_ent **epp;
+
+    for (epp = &cache.buckets[ep->hash % ASP_RESOLVE_NBUCKETS]; *epp != ep;
+      epp = &(*epp)->hnext)
+        continue;
+    *epp = ep->hnext;
+    lru_unlink(ep);
+    cache.nents--;
+    free(ep);
+}
+
+static struct asp_resolve_ent *
+cache_find(uint32_t hash, const char *host, const char *port, int af)
+{
+    struct asp_resolve_ent *ep;
+
+    for (ep = cache.buckets[hash % ASP_RESOLVE_NBUCKETS]; ep != NULL;
+      ep = ep->hnext) {
+        if (ep->hash == hash && ep->af == af && strcmp(ep->host, host) == 0 &&
+          strcmp(ep->port, port) == 0)
+            return (ep);
+    }
+    return (NULL);
+}
+
+/* Has to be called with the cache locked */
+static int
+cache_get(uint32_t hash, const char *host, const char *port, int af,
+  struct asp_resolve_res *res)
+{
+    struct asp_resolve_ent *ep;
+
+    ep = cache_find(hash, host, port, af);
+    if (ep == NULL)
+        return (-1);
+    if (getmonotime_ms() - ep->ctime >= cache.ttl) {
+        cache_remove(ep);
+        return (-1);
+    }
+    lru_unlink(ep);
+    lru_push(ep);
+    *res = ep->res;
+    return (0);
+}
+
+static void
+cache_put(uint32_t hash, const char *host, const char *port, int af,
+  const struct asp_resolve_res *res)
+{
+    struct asp_resolve_ent *ep;
+    size_t hlen, plen;
+
+    ep = cache_find(hash, host, port, af);
+    if (ep != NULL)
+        cache_remove(ep);
+    if (cache.size == 0)
+        return;
+    while (cache.nents >= cache.size)
+        cache_remove(cache.tail);
+    hlen = strlen(host) + 1;
+    plen = strlen(port) + 1;
+    ep = malloc(sizeof(struct asp_resolve_ent) + hlen + plen);
+    if (ep == NULL)
+        return;
+    memset(ep, '\0', sizeof(struct asp_resolve_ent));
+    memcpy(ep->host, host, hlen);
+    memcpy(ep->host + hlen, port, plen);
+    ep->port = ep->host + hlen;
+    ep->hash = hash;
+    ep->af = af;
+    ep->ctime = getmonotime_ms();
+    ep->res = *res;
+    ep->hnext = cache.buckets[hash % ASP_RESOLVE_NBUCKETS];
+    cache.buckets[hash % ASP_RESOLVE_NBUCKETS] = ep;
+    lru_push(ep);
+    cache.nents++;
+}
+
+/*
+ * Cache-only lookup, returns 0 and fills the result in on a hit, -1 if the
+ * name has to be resolved with asp_resolve().
+ */
+int
+asp_resolve_lookup(const char *host, const char *port, int af,
+  struct asp_resolve_res *res)
+{
+    uint32_t hash;
+    int rval;
+
+    hash = asp_resolve_hash(host, port, af);
+    pthread_mutex_lock(&cache.mutex);
+    rval = cache_get(hash, host, port, af, res);
+    if (rval == 0)
+        cache.stats.hits++;
+    pthread_mutex_unlock(&cache.mutex);
+    return (rval);
+}
+
+/*
+ * Resolve host and port into up to ASP_RESOLVE_MAXADDRS stream socket
+ * addresses, returns 0 or getaddrinfo(3) error code. Might block, unless
+ * the result is cached.
+ */
+int
+asp_resolve(const char *host, const char *port, int af,
+  struct asp_resolve_res *res)
+{
+    struct addrinfo hints, *ai, *aip;
+    uint32_t hash;
+    int n;
+
+    hash = asp_resolve_hash(host, port, af);
+    pthread_mutex_lock(&cache.mutex);
+    if (cache_get(hash, host, port, af, res) == 0) {
+        cache.stats.hits++;
+        pthread_mutex_unlock(&cache.mutex);
+        return (0);
+    }
+    cache.stats.misses++;
+    pthread_mutex_unlock(&cache.mutex);
+
+    memset(&hints, 0, sizeof(hints));
+    hints.ai_family = af;
+    hints.ai_socktype = SOCK_STREAM;
+    n = getaddrinfo(host, port, &hints, &ai);
+    if (n != 0) {
+        pthread_mutex_lock(&cache.mutex);
+        cache.stats.failures++;
+        pthread_mutex_unlock(&cache.mutex);
+        return (n);
+    }
+    memset(res, '\0', sizeof(struct asp_resolve_res));
+    for (aip = ai; aip != NULL && res->naddrs < ASP_RESOLVE_MAXADDRS;
+      aip = aip->ai_next) {
+        if (aip->ai_addrlen > sizeof(struct sockaddr_storage))
+            continue;
+        memcpy(&res->addrs[res->naddrs].ss, aip->ai_addr, aip->ai_addrlen);
+        res->addrs[res->naddrs].alen = aip->ai_addrlen;
+        res->naddrs++;
+    }
+    freeaddrinfo(ai);
+    if (res->naddrs == 0)
+        return (EAI_NONAME);
+
+    pthread_mutex_lock(&cache.mutex);
+    cache_put(hash, host, port, af, res);
+    pthread_mutex_unlock(&cache.mutex);
+    return (0);
+}
+
+/* Size of 0 disables the cache and flushes whatever is in it */
+void
+asp_resolve_setcache(unsigned int ttl_ms, unsigned int size)
+{
+
+    pthread_mutex_lock(&cache.mutex);
+    cache.ttl = ttl_ms;
+    cache.size = size;
+    while (cache.nents > size)
+        cache_remove(cache.tail);
+    pthread_mutex_unlock(&cache.mutex);
+}
+
+void
+asp_resolve_getstats(struct asp_resolve_stats *res)
+{
+
+    pthread_mutex_lock(&cache.mutex);
+    *res = cache.stats;
+    pthread_mutex_unlock(&cache.mutex);
+}
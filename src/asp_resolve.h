@@ -0,0 +1,32 @@
+#pragma once
+
+#include <sys/types.h>
+#include <sys/socket.h>
+#include <stdint.h>
+
+/*
+ * Name resolution with a TTL-bound LRU cache in front of getaddrinfo(3),
+ * keyed by host, port and address family.
+ */
+#define ASP_RESOLVE_MAXADDRS 8
+
+struct asp_resolve_addr {
+    struct sockaddr_storage ss;
+    socklen_t alen;
+};
+
+struct asp_resolve_res {
+    int naddrs;
+    struct asp_resolve_addr addrs[ASP_RESOLVE_MAXADDRS];
+};
+
+struct asp_resolve_stats {
+    uint64_t hits;
+    uint64_t misses;
+    uint64_t failures;
+};
+
+int asp_resolve(const char *, const char *, int, struct asp_resolve_res *);
+int asp_resolve_lookup(const char *, const char *, int, struct asp_resolve_res *);
+void asp_resolve_setcache(unsigned int, unsigned int);
+void asp_resolve_getstats(struct asp_resolve_stats *);
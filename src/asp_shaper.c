@@ -0,0 +1,129 @@
+#include <pthread.h>
+#include <stdint.h>
+#include <stdlib.h>
+
+#include "asp_shaper.h"
+
+/*
+ * Default burst is 100ms worth of the rate, but no less than that, and a
+ * relay that has run out of tokens is not woken up until there are at least
+ * ASP_SHAPER_QUANTUM (or burst) of them, to avoid tiny reads.
+ */
+#define ASP_SHAPER_MINBURST (16 * 1024)
+#define ASP_SHAPER_QUANTUM 4096
+
+struct asp_shaper {
+    pthread_mutex_t mutex;
+    uint64_t rate;
+    uint64_t burst;
+    double tokens;
+    uint64_t last;
+    unsigned int refcnt;
+};
+
+static void
+asp_shaper_set_locked(struct asp_shaper *sp, uint64_t rate, uint64_t burst)
+{
+
+    if (burst == 0) {
+        burst = rate / 10;
+        if (burst < ASP_SHAPER_MINBURST)
+            burst = ASP_SHAPER_MINBURST;
+    }
+    sp->rate = rate;
+    sp->burst = burst;
+    if (sp->tokens > burst)
+        sp->tokens = burst;
+}
+
+struct asp_shaper *
+asp_shaper_ctor(uint64_t rate, uint64_t burst)
+{
+    struct asp_shaper *sp;
+
+    sp = malloc(sizeof(*sp));
+    if (sp == NULL)
+        return (NULL);
+    if (pthread_mutex_init(&sp->mutex, NULL) != 0) {
+        free(sp);
+        return (NULL);
+    }
+    sp->refcnt = 1;
+    sp->last = 0;
+    asp_shaper_set_locked(sp, rate, burst);
+    /* Starts off full */
+    sp->tokens = sp->burst;
+    return (sp);
+}
+
+void
+asp_shaper_set(struct asp_shaper *sp, uint64_t rate, uint64_t burst)
+{
+
+    pthread_mutex_lock(&sp->mutex);
+    asp_shaper_set_locked(sp, rate, burst);
+    pthread_mutex_unlock(&sp->mutex);
+}
+
+struct asp_shaper *
+asp_shaper_ref(struct asp_shaper *sp)
+{
+
+    __atomic_fetch_add(&sp->refcnt, 1, __ATOMIC_RELAXED);
+    return (sp);
+}
+
+void
+asp_shaper_unref(struct asp_shaper *sp)
+{
+
+    if (__atomic_sub_fetch(&sp->refcnt, 1, __ATOMIC_ACQ_REL) != 0)
+        return;
+    pthread_mutex_destroy(&sp->mutex);
+    free(sp);
+}
+
+/*
+ * Returns the number of bytes that can be taken out of the bucket right
+ * now, SIZE_MAX if it's not limited. When it's 0, *delay is set to the time
+ * (in ns) until it is worth checking again.
+ */
+size_t
+asp_shaper_avail(struct asp_shaper *sp, uint64_t now, uint64_t *delay)
+{
+    double need;
+    size_t rval;
+
+    pthread_mutex_lock(&sp->mutex);
+    if (sp->rate == 0) {
+        sp->last = 0;
+        pthread_mutex_unlock(&sp->mutex);
+        return (SIZE_MAX);
+    }
+    if (sp->last != 0 && now > sp->last) {
+        sp->tokens += (double)(now - sp->last) * sp->rate / 1e9;
+        if (sp->tokens > sp->burst)
+            sp->tokens = sp->burst;
+    }
+    sp->last = now;
+    need = (sp->burst < ASP_SHAPER_QUANTUM) ? sp->burst : ASP_SHAPER_QUANTUM;
+    if (sp->tokens >= need) {
+        rval = (size_t)sp->tokens;
+    } else {
+        rval = 0;
+        *delay = (uint64_t)((need - sp->tokens) * 1e9 / sp->rate) + 1;
+    }
+    pthread_mutex_unlock(&sp->mutex);
+    return (rval);
+}
+
+/* Can go negative when shared, the debt is then paid off before anything else */
+void
+asp_shaper_consume(struct asp_shaper *sp, size_t len)
+{
+
+    pthread_mutex_lock(&sp->mutex);
+    if (sp->rate != 0)
+        sp->tokens -= len;
+    pthread_mutex_unlock(&sp->mutex);
+}
@@ -0,0 +1,24 @@
+#pragma once
+
+#include <stddef.h>
+#include <stdint.h>
+
+/*
+ * Token bucket rate limiter, rate is in bytes per second (0 - unlimited)
+ * and burst is the bucket depth. Reference counted, so that one bucket can
+ * be shared by any number of relays.
+ */
+struct asp_shaper;
+
+struct asp_shaper_stats {
+    uint64_t nthrottled;
+    uint64_t throttled_ns;
+    uint64_t deferred;
+};
+
+struct asp_shaper *asp_shaper_ctor(uint64_t, uint64_t);
+void asp_shaper_set(struct asp_shaper *, uint64_t, uint64_t);
+struct asp_shaper *asp_shaper_ref(struct asp_shaper *);
+void asp_shaper_unref(struct asp_shaper *);
+size_t asp_shaper_avail(struct asp_shaper *, uint64_t, uint64_t *);
+void asp_shaper_consume(struct asp_shaper *, size_t);
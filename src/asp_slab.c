@@ -0,0 +1,123 @@
+#include <pthread.h>
+#include <stddef.h>
+#include <stdint.h>
+#include <stdlib.h>
+
+#include "asp_slab.h"
+
+#define ASP_SLAB_NCLASSES 11
+
+struct asp_slab_blk {
+    struct asp_slab_blk *next;
+};
+
+static struct {
+    pthread_mutex_t mutex;
+    uint64_t maxcached;
+    struct asp_slab_blk *free[ASP_SLAB_NCLASSES];
+    struct asp_slab_stats stats;
+} slab = {.mutex = PTHREAD_MUTEX_INITIALIZER};
+
+/* Free list for the size, -1 if it's not one of the pooled sizes */
+static int
+asp_slab_class(size_t size)
+{
+    size_t bsize;
+    int c;
+
+    if (size < ASP_SLAB_MIN || size > ASP_SLAB_MAX || (size & (size - 1)) != 0)
+        return (-1);
+    for (c = 0, bsize = ASP_SLAB_MIN; bsize < size; c++)
+        bsize <<= 1;
+    return (c);
+}
+
+void *
+asp_slab_get(size_t size)
+{
+    struct asp_slab_blk *bp;
+    int c;
+
+    bp = NULL;
+    c = asp_slab_class(size);
+    pthread_mutex_lock(&slab.mutex);
+    if (c >= 0 && slab.free[c] != NULL) {
+        bp = slab.free[c];
+        slab.free[c] = bp->next;
+        slab.stats.cached -= size;
+        slab.stats.hits++;
+    } else {
+        slab.stats.misses++;
+    }
+    slab.stats.inuse += size;
+    pthread_mutex_unlock(&slab.mutex);
+    if (bp != NULL)
+        return (bp);
+    bp = malloc(size);
+    if (bp == NULL) {
+        pthread_mutex_lock(&slab.mutex);
+        slab.stats.inuse -= size;
+        pthread_mutex_unlock(&slab.mutex);
+    }
+    return (bp);
+}
+
+void
+asp_slab_put(void *p, size_t size)
+{
+    struct asp_slab_blk *bp;
+    int c;
+
+    if (p == NULL)
+        return;
+    bp = p;
+    c = asp_slab_class(size);
+    pthread_mutex_lock(&slab.mutex);
+    slab.stats.inuse -= size;
+    if (c >= 0 && slab.stats.cached + size <= slab.maxcached) {
+        bp->next = slab.free[c];
+        slab.free[c] = bp;
+        slab.stats.cached += size;
+        bp = NULL;
+    }
+    pthread_mutex_unlock(&slab.mutex);
+    free(bp);
+}
+
+/* Limit on the bytes kept on the free lists, the excess is freed */
+void
+asp_slab_setcache(uint64_t maxcached)
+{
+    struct asp_slab_blk *bp, *flist;
+    size_t bsize;
+    int c;
+
+    flist = NULL;
+    pthread_mutex_lock(&slab.mutex);
+    slab.maxcached = maxcached;
+    /* The largest blocks go first */
+    for (c = ASP_SLAB_NCLASSES - 1; c >= 0 && slab.stats.cached > maxcached; c--) {
+        bsize = (size_t)ASP_SLAB_MIN << c;
+        while (slab.free[c] != NULL && slab.stats.cached > maxcached) {
+            bp = slab.free[c];
+            slab.free[c] = bp->next;
+            slab.stats.cached -= bsize;
+            bp->next = flist;
+            flist = bp;
+        }
+    }
+    pthread_mutex_unlock(&slab.mutex);
+    for (bp = flist; bp != NULL; bp = flist) {
+        flist = bp->next;
+        free(bp);
+    }
+}
+
+void
+asp_slab_getstats(struct asp_slab_stats *res)
+{
+
+    pthread_mutex_lock(&slab.mutex);
+    *res = slab.stats;
+    pthread_mutex_unlock(&slab.mutex);
+}
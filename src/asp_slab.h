@@ -0,0 +1,29 @@
+#pragma once
+
+#include <stddef.h>
+#include <stdint.h>
+
+/*
+ * Pool of the relay buffers shared by all the proxies in the process. The
+ * blocks of a power of two size between ASP_SLAB_MIN and ASP_SLAB_MAX that
+ * are given back are kept on a free list per size, up to the cache limit in
+ * total, and handed out again before anything is allocated. Other sizes, and
+ * everything once the cache is full, go straight to malloc(3)/free(3). The
+ * cache limit is 0, i.e. nothing is kept, unless set.
+ */
+#define ASP_SLAB_MIN (1024)
+#define ASP_SLAB_MAX (1024 * 1024)
+
+struct asp_slab_stats {
+    /* Bytes handed out and not given back yet, and kept on the free lists */
+    uint64_t inuse;
+    uint64_t cached;
+    /* Requests served from the free lists and by malloc(3) */
+    uint64_t hits;
+    uint64_t misses;
+};
+
+void *asp_slab_get(size_t);
+void asp_slab_put(void *, size_t);
+void asp_slab_setcache(uint64_t);
+void asp_slab_getstats(struct asp_slab_stats *);
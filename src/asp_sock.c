@@ -1,8 +1,26 @@
+#if defined(__linux__)
+#define _GNU_SOURCE
+#endif
+
 #include <sys/types.h>
 #include <sys/socket.h>
+#include <sys/stat.h>
+#include <sys/uio.h>
 #include <errno.h>
+#include <fcntl.h>
 #include <inttypes.h>
 #include <pthread.h>
+#include <string.h>
+#include <unistd.h>
+
+#if defined(__linux__) && defined(SPLICE_F_NONBLOCK)
+#define HAVE_SPLICE 1
+#endif
+
+#if defined(__linux__)
+#include <sys/eventfd.h>
+#define HAVE_EVENTFD 1
+#endif
 
 #include "asp_iostats.h"
 #include "asp_sock.h"
@@ -61,3 +79,232 @@ asp_sock_send(struct asp_sock *asp, const void *msg, size_t len)
      }
      return (rlen);
 }
+
+struct recv_res
+asp_sock_recvv(struct asp_sock *asp, struct iovec *iov, int iovcnt)
+{
+     struct recv_res r = {0};
+     struct asp_iostats_bi tstats;
+     struct msghdr msg;
+     int update_stats;
+
+     update_stats = 0;
+     memset(&msg, '\0', sizeof(msg));
+     msg.msg_iov = iov;
+     msg.msg_iovlen = iovcnt;
+     r.len = recvmsg(asp->fd, &msg, 0);
+     if (r.len > 0) {
+         pthread_mutex_lock(&asp->mutex);
+         asp->stats.in.nops++;
+         asp->stats.in.btotal += r.len;
+         if (asp->on_stats_update != NULL) {
+             tstats = asp->stats;
+             update_stats = 1;
+         } else {
+             pthread_mutex_unlock(&asp->mutex);
+         }
+     } else {
+         r.errnom = errno;
+     }
+     if (update_stats) {
+         asp->on_stats_update(&tstats);
+         pthread_mutex_unlock(&asp->mutex);
+     }
+     return (r);
+}
+
+ssize_t
+asp_sock_sendv(struct asp_sock *asp, struct iovec *iov, int iovcnt)
+{
+     struct msghdr msg;
+     ssize_t rlen;
+
+     memset(&msg, '\0', sizeof(msg));
+     msg.msg_iov = iov;
+     msg.msg_iovlen = iovcnt;
+     rlen = sendmsg(asp->fd, &msg, 0);
+     if (rlen > 0) {
+         pthread_mutex_lock(&asp->mutex);
+         asp->stats.out.nops++;
+         asp->stats.out.btotal += rlen;
+         pthread_mutex_unlock(&asp->mutex);
+     }
+     return (rlen);
+}
+
+/*
+ * Account for nops datagrams, len bytes in total, moved in or out by a
+ * batched call made on the fd directly.
+ */
+void
+asp_sock_account(struct asp_sock *asp, int out, uint64_t nops, uint64_t len)
+{
+     struct asp_iostats_bi tstats;
+     struct asp_iostats_uni *sp;
+
+     pthread_mutex_lock(&asp->mutex);
+     sp = out ? &asp->stats.out : &asp->stats.in;
+     sp->nops += nops;
+     sp->btotal += len;
+     if (out || asp->on_stats_update == NULL) {
+         pthread_mutex_unlock(&asp->mutex);
+         return;
+     }
+     tstats = asp->stats;
+     asp->on_stats_update(&tstats);
+     pthread_mutex_unlock(&asp->mutex);
+}
+
+int
+asp_sock_cansplice(struct asp_sock *asp)
+{
+#if defined(HAVE_SPLICE)
+     struct stat sb;
+
+     if (fstat(asp->fd, &sb) != 0)
+         return (0);
+     return (S_ISSOCK(sb.st_mode) || S_ISFIFO(sb.st_mode));
+#else
+     (void)asp;
+     return (0);
+#endif
+}
+
+struct recv_res
+asp_sock_splice_in(struct asp_sock *asp, struct asp_pipe *app)
+{
+     struct recv_res r = {0};
+#if defined(HAVE_SPLICE)
+     struct asp_iostats_bi tstats;
+     int update_stats;
+
+     update_stats = 0;
+     r.len = splice(asp->fd, NULL, app->fds[1], NULL, ASP_PIPE_FREE(app),
+       SPLICE_F_MOVE | SPLICE_F_NONBLOCK);
+     if (r.len > 0) {
+         app->len += r.len;
+         pthread_mutex_lock(&asp->mutex);
+         asp->stats.in.nops++;
+         asp->stats.in.btotal += r.len;
+         if (asp->on_stats_update != NULL) {
+             tstats = asp->stats;
+             update_stats = 1;
+         } else {
+             pthread_mutex_unlock(&asp->mutex);
+         }
+     } else {
+         r.errnom = errno;
+     }
+     if (update_stats) {
+         asp->on_stats_update(&tstats);
+         pthread_mutex_unlock(&asp->mutex);
+     }
+#else
+     (void)asp;
+     (void)app;
+     r.len = -1;
+     r.errnom = ENOTSUP;
+#endif
+     return (r);
+}
+
+ssize_t
+asp_sock_splice_out(struct asp_sock *asp, struct asp_pipe *app)
+{
+#if defined(HAVE_SPLICE)
+     ssize_t rlen;
+
+     rlen = splice(app->fds[0], NULL, asp->fd, NULL, app->len,
+       SPLICE_F_MOVE | SPLICE_F_NONBLOCK);
+     if (rlen > 0) {
+         app->len -= rlen;
+         pthread_mutex_lock(&asp->mutex);
+         asp->stats.out.nops++;
+         asp->stats.out.btotal += rlen;
+         pthread_mutex_unlock(&asp->mutex);
+     }
+     return (rlen);
+#else
+     (void)asp;
+     (void)app;
+     errno = ENOTSUP;
+     return (-1);
+#endif
+}
+
+int
+asp_pipe_ctor(struct asp_pipe *app)
+{
+
+     app->len = 0;
+#if defined(HAVE_SPLICE)
+     if (pipe2(app->fds, O_NONBLOCK | O_CLOEXEC) == 0)
+         return (0);
+#else
+     errno = ENOTSUP;
+#endif
+     app->fds[0] = app->fds[1] = -1;
+     return (-1);
+}
+
+void
+asp_pipe_dtor(struct asp_pipe *app)
+{
+
+     if (app->fds[0] == -1)
+         return;
+     close(app->fds[0]);
+     close(app->fds[1]);
+     app->fds[0] = app->fds[1] = -1;
+     app->len = 0;
+}
+
+int
+asp_event_ctor(struct asp_event *aep)
+{
+
+#if defined(HAVE_EVENTFD)
+     aep->fds[0] = aep->fds[1] = eventfd(0, EFD_NONBLOCK | EFD_CLOEXEC);
+     if (aep->fds[0] != -1)
+         return (0);
+#else
+     if (pipe(aep->fds) == 0) {
+         fcntl(aep->fds[0], F_SETFD, FD_CLOEXEC);
+         fcntl(aep->fds[1], F_SETFD, FD_CLOEXEC);
+         fcntl(aep->fds[0], F_SETFL, O_NONBLOCK);
+         fcntl(aep->fds[1], F_SETFL, O_NONBLOCK);
+         return (0);
+     }
+#endif
+     aep->fds[0] = aep->fds[1] = -1;
+     return (-1);
+}
+
+/*
+ * Make the read end readable, it's never drained so that it stays this way
+ * for as long as the event exists.
+ */
+void
+asp_event_post(struct asp_event *aep)
+{
+#if defined(HAVE_EVENTFD)
+     uint64_t v = 1;
+#else
+     char v = 1;
+#endif
+
+     while (write(aep->fds[1], &v, sizeof(v)) < 0 && errno == EINTR)
+         continue;
+}
+
+void
+asp_event_dtor(struct asp_event *aep)
+{
+
+     if (aep->fds[0] == -1)
+         return;
+     close(aep->fds[0]);
+     if (aep->fds[1] != aep->fds[0])
+         close(aep->fds[1]);
+     aep->fds[0] = aep->fds[1] = -1;
+}
@@ -6,6 +6,7 @@
 
 struct asp_iostats_uni;
 struct asp_iostats_bi;
+struct iovec;
 
 struct asp_sock {
     int fd;
@@ -19,6 +20,31 @@ struct recv_res {
     int errnom;
 };
 
+#define ASP_PIPE_SIZE (64 * 1024)
+
+struct asp_pipe {
+    int fds[2];
+    size_t len;
+};
+
+#define ASP_PIPE_FREE(app) (ASP_PIPE_SIZE - (app)->len)
+
+/* Pollable one-shot flag: fds[0] becomes readable once posted */
+struct asp_event {
+    int fds[2];
+};
+
 void asp_sock_getstats(struct asp_sock *, struct asp_iostats_bi *, int);
 struct recv_res asp_sock_recv(struct asp_sock *, void *buf, size_t len);
 ssize_t asp_sock_send(struct asp_sock *, const void *msg, size_t len);
+struct recv_res asp_sock_recvv(struct asp_sock *, struct iovec *, int);
+ssize_t asp_sock_sendv(struct asp_sock *, struct iovec *, int);
+void asp_sock_account(struct asp_sock *, int, uint64_t, uint64_t);
+int asp_sock_cansplice(struct asp_sock *);
+struct recv_res asp_sock_splice_in(struct asp_sock *, struct asp_pipe *);
+ssize_t asp_sock_splice_out(struct asp_sock *, struct asp_pipe *);
+int asp_pipe_ctor(struct asp_pipe *);
+void asp_pipe_dtor(struct asp_pipe *);
+int asp_event_ctor(struct asp_event *);
+void asp_event_post(struct asp_event *);
+void asp_event_dtor(struct asp_event *);
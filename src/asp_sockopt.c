@@ -0,0 +1,176 @@
+#if defined(__linux__)
+#define _GNU_SOURCE
+#endif
+
+#include <sys/types.h>
+#include <sys/socket.h>
+#include <netinet/in.h>
+#include <netinet/tcp.h>
+#include <errno.h>
+#include <stddef.h>
+#include <string.h>
+
+#include "asp_sockopt.h"
+
+struct asp_sockopt_def {
+    unsigned int flag;
+    /* -1 for IP_TOS/IPV6_TCLASS, depending on the family */
+    int level;
+    int name;
+    size_t off;
+};
+
+static const struct asp_sockopt_def asp_sockopt_defs[] = {
+    {ASP_SO_NODELAY, IPPROTO_TCP, TCP_NODELAY,
+      offsetof(struct asp_sockopts, nodelay)},
+    {ASP_SO_SNDBUF, SOL_SOCKET, SO_SNDBUF,
+      offsetof(struct asp_sockopts, sndbuf)},
+    {ASP_SO_RCVBUF, SOL_SOCKET, SO_RCVBUF,
+      offsetof(struct asp_sockopts, rcvbuf)},
+#if defined(TCP_NOTSENT_LOWAT)
+    {ASP_SO_NOTSENT_LOWAT, IPPROTO_TCP, TCP_NOTSENT_LOWAT,
+      offsetof(struct asp_sockopts, notsent_lowat)},
+#endif
+#if defined(TCP_QUICKACK)
+    {ASP_SO_QUICKACK, IPPROTO_TCP, TCP_QUICKACK,
+      offsetof(struct asp_sockopts, quickack)},
+#endif
+    {ASP_SO_KEEPALIVE, SOL_SOCKET, SO_KEEPALIVE,
+      offsetof(struct asp_sockopts, keepalive)},
+    {ASP_SO_TOS, -1, 0, offsetof(struct asp_sockopts, tos)},
+    {0, 0, 0, 0}
+};
+
+#define ASP_SO_OPTVAL(sop, dp) ((int *)(void *)((char *)(sop) + (dp)->off))
+
+/* Family of the socket if it's an IP one, 0 otherwise */
+static int
+asp_sockopt_ipfamily(int fd, int *istcp)
+{
+    struct sockaddr_storage ss;
+    socklen_t slen;
+    int type;
+
+    slen = sizeof(ss);
+    if (getsockname(fd, (struct sockaddr *)(void *)&ss, &slen) != 0)
+        return (0);
+    if (ss.ss_family != AF_INET && ss.ss_family != AF_INET6)
+        return (0);
+    slen = sizeof(type);
+    *istcp = (getsockopt(fd, SOL_SOCKET, SO_TYPE, &type, &slen) == 0 &&
+      type == SOCK_STREAM);
+    return (ss.ss_family);
+}
+
+/*
+ * Resolves the level and name of the option for the socket, returns -1 if
+ * it doesn't apply to it.
+ */
+static int
+asp_sockopt_lookup(const struct asp_sockopt_def *dp, int af, int istcp,
+  int *level, int *name)
+{
+
+    *level = dp->level;
+    *name = dp->name;
+    if (dp->level == -1) {
+        if (af == AF_INET) {
+            *level = IPPROTO_IP;
+            *name = IP_TOS;
+        } else if (af == AF_INET6) {
+            *level = IPPROTO_IPV6;
+            *name = IPV6_TCLASS;
+        } else {
+            return (-1);
+        }
+    } else if (dp->level == IPPROTO_TCP && !istcp) {
+        return (-1);
+    }
+    return (0);
+}
+
+/*
+ * Returns -1 with errno set if any of the options that apply to the socket
+ * could not be set, the rest are set anyway.
+ */
+int
+asp_sockopts_apply(int fd, const struct asp_sockopts *sop)
+{
+    const struct asp_sockopt_def *dp;
+    int af, istcp, level, name, err;
+
+    if (sop->mask == 0)
+        return (0);
+    istcp = 0;
+    af = asp_sockopt_ipfamily(fd, &istcp);
+    err = 0;
+    for (dp = asp_sockopt_defs; dp->flag != 0; dp++) {
+        if ((sop->mask & dp->flag) == 0)
+            continue;
+        if (asp_sockopt_lookup(dp, af, istcp, &level, &name) != 0)
+            continue;
+        if (setsockopt(fd, level, name, ASP_SO_OPTVAL(sop, dp),
+          sizeof(int)) != 0)
+            err = errno;
+    }
+    if (err != 0) {
+        errno = err;
+        return (-1);
+    }
+    return (0);
+}
+
+/*
+ * Linux drops back to the delayed ACKs on its own shortly after TCP_QUICKACK
+ * is set, so it only sticks if set again after each read. Returns non-zero
+ * if that has to be done for the socket, see asp_sockopts_rearm().
+ */
+int
+asp_sockopts_needrearm(int fd, const struct asp_sockopts *sop)
+{
+#if defined(TCP_QUICKACK)
+    int istcp;
+
+    if ((sop->mask & ASP_SO_QUICKACK) == 0 || sop->quickack == 0)
+        return (0);
+    istcp = 0;
+    return (asp_sockopt_ipfamily(fd, &istcp) != 0 && istcp);
+#else
+    return (0);
+#endif
+}
+
+void
+asp_sockopts_rearm(int fd)
+{
+#if defined(TCP_QUICKACK)
+    int one;
+
+    one = 1;
+    setsockopt(fd, IPPROTO_TCP, TCP_QUICKACK, &one, sizeof(one));
+#endif
+}
+
+/*
+ * Options in effect for the socket, mask has the ones that could be read.
+ * Note that the kernel may adjust the values set, e.g. Linux doubles the
+ * buffer sizes.
+ */
+void
+asp_sockopts_get(int fd, struct asp_sockopts *res)
+{
+    const struct asp_sockopt_def *dp;
+    int af, istcp, level, name;
+    socklen_t olen;
+
+    memset(res, '\0', sizeof(struct asp_sockopts));
+    istcp = 0;
+    af = asp_sockopt_ipfamily(fd, &istcp);
+    for (dp = asp_sockopt_defs; dp->flag != 0; dp++) {
+        if (asp_sockopt_lookup(dp, af, istcp, &level, &name) != 0)
+            continue;
+        olen = sizeof(int);
+        if (getsockopt(fd, level, name, ASP_SO_OPTVAL(res, dp), &olen) == 0)
+            res->mask |= dp->flag;
+    }
+}
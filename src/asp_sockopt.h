@@ -0,0 +1,31 @@
+#pragma once
+
+/* Which of the options in struct asp_sockopts are set */
+#define ASP_SO_NODELAY 0x01
+#define ASP_SO_SNDBUF 0x02
+#define ASP_SO_RCVBUF 0x04
+#define ASP_SO_NOTSENT_LOWAT 0x08
+#define ASP_SO_QUICKACK 0x10
+#define ASP_SO_KEEPALIVE 0x20
+#define ASP_SO_TOS 0x40
+
+/*
+ * Socket options to apply to a relay leg, only the ones in the mask. The
+ * TCP level ones (and tos) are skipped for sockets that are not TCP (IP)
+ * ones, so is any option not supported by the platform.
+ */
+struct asp_sockopts {
+    unsigned int mask;
+    int nodelay;
+    int sndbuf;
+    int rcvbuf;
+    int notsent_lowat;
+    int quickack;
+    int keepalive;
+    int tos;
+};
+
+int asp_sockopts_apply(int, const struct asp_sockopts *);
+void asp_sockopts_get(int, struct asp_sockopts *);
+int asp_sockopts_needrearm(int, const struct asp_sockopts *);
+void asp_sockopts_rearm(int);
@@ -0,0 +1,134 @@
+#if !defined(_POSIX_C_SOURCE)
+#define _POSIX_C_SOURCE 200112L
+#endif
+
+#include <sys/types.h>
+#include <sys/mman.h>
+#include <sys/uio.h>
+#include <fcntl.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include <unistd.h>
+
+#include "asp_tap.h"
+
+struct asp_tap {
+    struct asp_tap_hdr *hdr;
+    unsigned char *slots;
+    size_t mapsize;
+    uint32_t nslots;
+    uint32_t slotsize;
+    uint32_t snaplen;
+    unsigned int refcnt;
+};
+
+#define ASP_TAP_ALIGN(x) (((x) + 7) & ~(size_t)7)
+
+struct asp_tap *
+asp_tap_ctor(const char *path, uint32_t nslots, uint32_t snaplen)
+{
+    struct asp_tap *tp;
+    void *p;
+    int fd;
+
+    if (nslots == 0)
+        return (NULL);
+    tp = malloc(sizeof(*tp));
+    if (tp == NULL)
+        return (NULL);
+    tp->nslots = nslots;
+    tp->snaplen = snaplen;
+    tp->slotsize = ASP_TAP_ALIGN(sizeof(struct asp_tap_rec) + snaplen);
+    tp->mapsize = sizeof(struct asp_tap_hdr) + (size_t)nslots * tp->slotsize;
+    fd = open(path, O_RDWR | O_CREAT | O_TRUNC, 0644);
+    if (fd < 0)
+        goto e0;
+    if (ftruncate(fd, tp->mapsize) != 0)
+        goto e1;
+    p = mmap(NULL, tp->mapsize, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+    if (p == MAP_FAILED)
+        goto e1;
+    close(fd);
+    /* Fresh file, all zeroes: no slot has been written yet */
+    tp->hdr = p;
+    tp->slots = (unsigned char *)p + sizeof(struct asp_tap_hdr);
+    memcpy(tp->hdr->magic, ASP_TAP_MAGIC, sizeof(tp->hdr->magic));
+    tp->hdr->version = ASP_TAP_VERSION;
+    tp->hdr->hdrsize = sizeof(struct asp_tap_hdr);
+    tp->hdr->nslots = nslots;
+    tp->hdr->slotsize = tp->slotsize;
+    tp->hdr->snaplen = snaplen;
+    tp->refcnt = 1;
+    return (tp);
+e1:
+    close(fd);
+e0:
+    free(tp);
+    return (NULL);
+}
+
+struct asp_tap *
+asp_tap_ref(struct asp_tap *tp)
+{
+
+    __atomic_fetch_add(&tp->refcnt, 1, __ATOMIC_RELAXED);
+    return (tp);
+}
+
+void
+asp_tap_unref(struct asp_tap *tp)
+{
+
+    if (__atomic_sub_fetch(&tp->refcnt, 1, __ATOMIC_ACQ_REL) != 0)
+        return;
+    munmap(tp->hdr, tp->mapsize);
+    free(tp);
+}
+
+/*
+ * Record len bytes of data, held in the iovecs, relayed in the given
+ * direction by the relay with the given id. Only the first snaplen bytes
+ * are kept, returns how many.
+ */
+size_t
+asp_tap_write(struct asp_tap *tp, uint64_t id, int dir, const struct iovec *iov,
+  int niov, size_t len)
+{
+    struct asp_tap_rec *rp;
+    struct timespec ts;
+    unsigned char *dp;
+    uint64_t seq;
+    size_t caplen, left, n;
+    int i;
+
+    seq = __atomic_fetch_add(&tp->hdr->head, 1, __ATOMIC_RELAXED);
+    rp = (struct asp_tap_rec *)(tp->slots + (seq % tp->nslots) * tp->slotsize);
+    __atomic_store_n(&rp->seq, ASP_TAP_SEQ_BUSY, __ATOMIC_RELAXED);
+    __atomic_thread_fence(__ATOMIC_RELEASE);
+    clock_gettime(CLOCK_REALTIME, &ts);
+    rp->ts_ns = (uint64_t)ts.tv_sec * 1000000000 + ts.tv_nsec;
+    rp->id = id;
+    rp->dir = dir;
+    rp->origlen = len;
+    caplen = (len < tp->snaplen) ? len : tp->snaplen;
+    rp->caplen = caplen;
+    dp = (unsigned char *)(rp + 1);
+    for (left = caplen, i = 0; i < niov && left > 0; i++) {
+        n = (iov[i].iov_len < left) ? iov[i].iov_len : left;
+        memcpy(dp, iov[i].iov_base, n);
+        dp += n;
+        left -= n;
+    }
+    __atomic_store_n(&rp->seq, seq + 1, __ATOMIC_RELEASE);
+    return (caplen);
+}
+
+/* Records written so far, including the ones overwritten since */
+uint64_t
+asp_tap_count(struct asp_tap *tp)
+{
+
+    return (__atomic_load_n(&tp->hdr->head, __ATOMIC_RELAXED));
+}
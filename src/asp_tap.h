@@ -0,0 +1,50 @@
+#pragma once
+
+#include <stddef.h>
+#include <stdint.h>
+
+/*
+ * Capture ring backed by a memory-mapped file: the header followed by nslots
+ * fixed size slots, each holding a record header and up to snaplen bytes of
+ * the chunk relayed. Writers take slots in turn with an atomic increment of
+ * head, overwriting the oldest ones, so that any number of relays can write
+ * to the same ring without locking. A record's seq is 0 until the slot is
+ * first written, ~0 while it is being written and head + 1 at the time it
+ * was taken afterwards. Native byte order.
+ */
+#define ASP_TAP_MAGIC "ASPTAP\0\0"
+#define ASP_TAP_VERSION 1
+
+struct asp_tap_hdr {
+    char magic[8];
+    uint32_t version;
+    uint32_t hdrsize;
+    uint32_t nslots;
+    uint32_t slotsize;
+    uint32_t snaplen;
+    uint32_t pad;
+    uint64_t head;
+};
+
+struct asp_tap_rec {
+    uint64_t seq;
+    /* CLOCK_REALTIME */
+    uint64_t ts_ns;
+    uint64_t id;
+    uint32_t origlen;
+    uint32_t caplen;
+    uint32_t dir;
+    uint32_t pad;
+};
+
+#define ASP_TAP_SEQ_BUSY UINT64_MAX
+
+struct asp_tap;
+struct iovec;
+
+struct asp_tap *asp_tap_ctor(const char *, uint32_t, uint32_t);
+struct asp_tap *asp_tap_ref(struct asp_tap *);
+void asp_tap_unref(struct asp_tap *);
+size_t asp_tap_write(struct asp_tap *, uint64_t, int, const struct iovec *, int,
+  size_t);
+uint64_t asp_tap_count(struct asp_tap *);
@@ -0,0 +1,111 @@
+#include <stddef.h>
+#include <stdint.h>
+#include <string.h>
+
+#include "asp_timer.h"
+
+void
+asp_twheel_init(struct asp_twheel *wp, uint64_t now)
+{
+
+    memset(wp, '\0', sizeof(struct asp_twheel));
+    wp->tick = now / ASP_TWHEEL_RES;
+}
+
+void
+asp_timer_arm(struct asp_twheel *wp, struct asp_timer *tp, uint64_t expires)
+{
+    struct asp_timer **headp;
+    uint64_t tick;
+
+    asp_timer_disarm(wp, tp);
+    tp->expires = expires;
+    /* Overdue ones go into the slot looked at next */
+    tick = expires / ASP_TWHEEL_RES;
+    if (tick < wp->tick)
+        tick = wp->tick;
+    headp = &wp->slots[tick % ASP_TWHEEL_NSLOTS];
+    tp->next = *headp;
+    if (tp->next != NULL)
+        tp->next->prevp = &tp->next;
+    tp->prevp = headp;
+    *headp = tp;
+    wp->ntimers++;
+}
+
+void
+asp_timer_disarm(struct asp_twheel *wp, struct asp_timer *tp)
+{
+
+    if (!ASP_TIMER_ISARMED(tp))
+        return;
+    *tp->prevp = tp->next;
+    if (tp->next != NULL)
+        tp->next->prevp = tp->prevp;
+    tp->next = NULL;
+    tp->prevp = NULL;
+    wp->ntimers--;
+}
+
+/*
+ * Disarms the timers that are due by now and returns them as a list linked
+ * through next.
+ */
+struct asp_timer *
+asp_twheel_expire(struct asp_twheel *wp, uint64_t now)
+{
+    struct asp_timer *res, *tp, *next;
+    uint64_t tick, last, n;
+
+    res = NULL;
+    last = now / ASP_TWHEEL_RES;
+    if (last < wp->tick)
+        return (NULL);
+    /* Each slot once at most, however long it's been */
+    n = last - wp->tick + 1;
+    if (n > ASP_TWHEEL_NSLOTS)
+        n = ASP_TWHEEL_NSLOTS;
+    for (tick = last - n + 1; tick <= last && wp->ntimers > 0; tick++) {
+        for (tp = wp->slots[tick % ASP_TWHEEL_NSLOTS]; tp != NULL; tp = next) {
+            next = tp->next;
+            if (tp->expires > now)
+                continue;
+            asp_timer_disarm(wp, tp);
+            tp->next = res;
+            res = tp;
+        }
+    }
+    /*
+     * The current slot is looked at again the next time, it can still get
+     * timers due within this tick.
+     */
+    wp->tick = last;
+    return (res);
+}
+
+/*
+ * Time till the earliest timer is due in ms, 0 if overdue, -1 if there are
+ * none. Timers more than a turn away are not looked for, a full turn is
+ * returned for them instead.
+ */
+int
+asp_twheel_next(const struct asp_twheel *wp, uint64_t now)
+{
+    const struct asp_timer *tp;
+    uint64_t tick, turn_end, first;
+
+    if (wp->ntimers == 0)
+        return (-1);
+    turn_end = (wp->tick + ASP_TWHEEL_NSLOTS) * ASP_TWHEEL_RES;
+    for (tick = wp->tick; tick < wp->tick + ASP_TWHEEL_NSLOTS; tick++) {
+        first = turn_end;
+        for (tp = wp->slots[tick % ASP_TWHEEL_NSLOTS]; tp != NULL; tp = tp->next) {
+            if (tp->expires < first)
+                first = tp->expires;
+        }
+        /* Anything found in the slot for this turn is the earliest */
+        if (first < (tick + 1) * ASP_TWHEEL_RES)
+            return ((first > now) ? (int)(first - now) : 0);
+    }
+    return ((turn_end > now) ? (int)(turn_end - now) : 0);
+}
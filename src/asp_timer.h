@@ -0,0 +1,36 @@
+#pragma once
+
+#include <stdint.h>
+
+/*
+ * Hashed timer wheel: a timer goes into one of the ASP_TWHEEL_NSLOTS slots
+ * by its expiry time (monotonic, in ms) over ASP_TWHEEL_RES, the ones that
+ * are more than a full turn away stay in their slot until the turn they are
+ * due. Arming and disarming is O(1), expiring is proportional to the slots
+ * passed and the timers in them, regardless of the number of timers in the
+ * wheel. Not locked, meant to be driven by a single thread.
+ */
+#define ASP_TWHEEL_NSLOTS 256
+#define ASP_TWHEEL_RES 10
+
+struct asp_timer {
+    uint64_t expires;
+    struct asp_timer *next;
+    /* NULL when not armed */
+    struct asp_timer **prevp;
+};
+
+struct asp_twheel {
+    /* Slot to be looked at next, in ASP_TWHEEL_RES units */
+    uint64_t tick;
+    unsigned int ntimers;
+    struct asp_timer *slots[ASP_TWHEEL_NSLOTS];
+};
+
+#define ASP_TIMER_ISARMED(tp) ((tp)->prevp != NULL)
+
+void asp_twheel_init(struct asp_twheel *, uint64_t);
+void asp_timer_arm(struct asp_twheel *, struct asp_timer *, uint64_t);
+void asp_timer_disarm(struct asp_twheel *, struct asp_timer *);
+struct asp_timer *asp_twheel_expire(struct asp_twheel *, uint64_t);
+int asp_twheel_next(const struct asp_twheel *, uint64_t);
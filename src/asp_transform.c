@@ -0,0 +1,277 @@
+#if defined(__linux__)
+#define _GNU_SOURCE
+#endif
+
+#include <dlfcn.h>
+#include <errno.h>
+#include <pthread.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+#include "asyncproxy_transform.h"
+#include "asp_transform.h"
+
+#define ATOMIC_ADD(p, v) __atomic_fetch_add((p), (v), __ATOMIC_RELAXED)
+#define ATOMIC_LOAD(p) __atomic_load_n((p), __ATOMIC_RELAXED)
+
+static void
+builtin_free(void *state)
+{
+
+    free(state);
+}
+
+/*
+ * "xor": XORs the data with a repeating key given in hex as an argument,
+ * i.e. "5a" or "deadbeef". The position in the key is carried over between
+ * chunks, so that the same transform applied on the other end of the
+ * connection restores the original stream.
+ */
+#define XOR_KEY_MAX 64
+
+struct xor_state {
+    unsigned char key[XOR_KEY_MAX];
+    size_t klen;
+    size_t pos;
+};
+
+static int
+xor_init(void **statep, const char *args)
+{
+    struct xor_state *xsp;
+    size_t i, alen;
+    unsigned int b;
+
+    if (args == NULL)
+        return (-1);
+    alen = strlen(args);
+    if (alen == 0 || alen % 2 != 0 || alen / 2 > XOR_KEY_MAX)
+        return (-1);
+    xsp = malloc(sizeof(struct xor_state));
+    if (xsp == NULL)
+        return (-1);
+    memset(xsp, '\0', sizeof(struct xor_state));
+    for (i = 0; i < alen / 2; i++) {
+        if (sscanf(args + i * 2, "%2x", &b) != 1) {
+            free(xsp);
+            return (-1);
+        }
+        xsp->key[i] = b;
+    }
+    xsp->klen = alen / 2;
+    *statep = xsp;
+    return (0);
+}
+
+static void
+xor_apply(void *state, struct transform_res *trp)
+{
+    struct xor_state *xsp;
+    unsigned char *cp;
+    size_t i, pos;
+
+    xsp = (struct xor_state *)state;
+    cp = (unsigned char *)trp->buf;
+    pos = xsp->pos;
+    for (i = 0; i < trp->len; i++) {
+        cp[i] ^= xsp->key[pos];
+        if (++pos == xsp->klen)
+            pos = 0;
+    }
+    xsp->pos = pos;
+}
+
+static const struct asyncproxy_transform xor_transform = {
+    .abi = ASYNCPROXY_TRANSFORM_ABI,
+    .name = "xor",
+    .init = xor_init,
+    .apply = xor_apply,
+    .free = builtin_free,
+};
+
+/*
+ * "count": passes data through unchanged counting the chunks and bytes,
+ * reported by describe() as "<nchunks> <nbytes>".
+ */
+struct count_state {
+    uint64_t nops;
+    uint64_t btotal;
+};
+
+static int
+count_init(void **statep, const char *args)
+{
+    struct count_state *csp;
+
+    csp = malloc(sizeof(struct count_state));
+    if (csp == NULL)
+        return (-1);
+    memset(csp, '\0', sizeof(struct count_state));
+    *statep = csp;
+    return (0);
+}
+
+static void
+count_apply(void *state, struct transform_res *trp)
+{
+    struct count_state *csp;
+
+    csp = (struct count_state *)state;
+    ATOMIC_ADD(&csp->nops, 1);
+    ATOMIC_ADD(&csp->btotal, trp->len);
+}
+
+static int
+count_describe(void *state, char *buf, size_t len)
+{
+    struct count_state *csp;
+
+    csp = (struct count_state *)state;
+    return (snprintf(buf, len, "%llu %llu",
+      (unsigned long long)ATOMIC_LOAD(&csp->nops),
+      (unsigned long long)ATOMIC_LOAD(&csp->btotal)));
+}
+
+static const struct asyncproxy_transform count_transform = {
+    .abi = ASYNCPROXY_TRANSFORM_ABI,
+    .name = "count",
+    .init = count_init,
+    .apply = count_apply,
+    .free = builtin_free,
+    .describe = count_describe,
+};
+
+static const struct asyncproxy_transform *const builtins[] = {
+    &xor_transform,
+    &count_transform,
+    NULL
+};
+
+/*
+ * Transforms loaded from plugins, the shared objects are never unloaded
+ * since there is no telling whether any of the proxies is still using them.
+ */
+struct asp_transform_reg {
+    const struct asyncproxy_transform *ops;
+    struct asp_transform_reg *next;
+};
+
+static pthread_mutex_t reg_mutex = PTHREAD_MUTEX_INITIALIZER;
+static struct asp_transform_reg *reg_head;
+
+static const struct asyncproxy_transform *
+asp_transform_lookup(const char *name)
+{
+    const struct asyncproxy_transform *const *opp;
+    struct asp_transform_reg *rp;
+
+    for (opp = builtins; *opp != NULL; opp++) {
+        if (strcmp((*opp)->name, name) == 0)
+            return (*opp);
+    }
+    for (rp = reg_head; rp != NULL; rp = rp->next) {
+        if (strcmp(rp->ops->name, name) == 0)
+            return (rp->ops);
+    }
+    return (NULL);
+}
+
+int
+asp_transform_load(const char *path)
+{
+    const struct asyncproxy_transform *const *opp, *const *tops;
+    struct asp_transform_reg *rp;
+    void *dlh;
+    int n;
+
+    dlh = dlopen(path, RTLD_NOW | RTLD_LOCAL);
+    if (dlh == NULL) {
+        fprintf(stderr, "asp_transform_load: dlopen() failed: %s\n", dlerror());
+        fflush(stderr);
+        errno = ENOENT;
+        return (-1);
+    }
+    tops = dlsym(dlh, ASYNCPROXY_TRANSFORM_SYM);
+    if (tops == NULL) {
+        fprintf(stderr, "asp_transform_load: %s: no " ASYNCPROXY_TRANSFORM_SYM
+          " symbol\n", path);
+        fflush(stderr);
+        errno = EINVAL;
+        goto e0;
+    }
+    pthread_mutex_lock(&reg_mutex);
+    for (opp = tops; *opp != NULL; opp++) {
+        if ((*opp)->abi != ASYNCPROXY_TRANSFORM_ABI || (*opp)->name == NULL ||
+          (*opp)->apply == NULL) {
+            fprintf(stderr, "asp_transform_load: %s: invalid or incompatible "
+              "transform\n", path);
+            fflush(stderr);
+            errno = EINVAL;
+            goto e1;
+        }
+        if (asp_transform_lookup((*opp)->name) != NULL) {
+            fprintf(stderr, "asp_transform_load: %s: transform \"%s\" is "
+              "already registered\n", path, (*opp)->name);
+            fflush(stderr);
+            errno = EEXIST;
+            goto e1;
+        }
+    }
+    for (n = 0, opp = tops; *opp != NULL; opp++, n++) {
+        rp = malloc(sizeof(struct asp_transform_reg));
+        if (rp == NULL)
+            break;
+        rp->ops = *opp;
+        rp->next = reg_head;
+        reg_head = rp;
+    }
+    pthread_mutex_unlock(&reg_mutex);
+    return (n);
+e1:
+    pthread_mutex_unlock(&reg_mutex);
+e0:
+    dlclose(dlh);
+    return (-1);
+}
+
+int
+asp_transform_ctor(struct asp_transform_inst *tip, const char *name,
+  const char *args)
+{
+    const struct asyncproxy_transform *ops;
+    void *state;
+
+    pthread_mutex_lock(&reg_mutex);
+    ops = asp_transform_lookup(name);
+    pthread_mutex_unlock(&reg_mutex);
+    if (ops == NULL) {
+        fprintf(stderr, "asp_transform_ctor: unknown transform \"%s\"\n", name);
+        fflush(stderr);
+        errno = ENOENT;
+        return (-1);
+    }
+    state = NULL;
+    if (ops->init != NULL && ops->init(&state, args) != 0) {
+        fprintf(stderr, "asp_transform_ctor: %s: init failed\n", name);
+        fflush(stderr);
+        errno = EINVAL;
+        return (-1);
+    }
+    tip->ops = ops;
+    tip->state = state;
+    return (0);
+}
+
+void
+asp_transform_dtor(struct asp_transform_inst *tip)
+{
+
+    if (tip->ops == NULL)
+        return;
+    if (tip->ops->free != NULL)
+        tip->ops->free(tip->state);
+    tip->ops = NULL;
+    tip->state = NULL;
+}
@@ -0,0 +1,14 @@
+#pragma once
+
+struct asyncproxy_transform;
+struct transform_res;
+
+/* Transform attached to one direction of a relay */
+struct asp_transform_inst {
+    const struct asyncproxy_transform *ops;
+    void *state;
+};
+
+int asp_transform_load(const char *);
+int asp_transform_ctor(struct asp_transform_inst *, const char *, const char *);
+void asp_transform_dtor(struct asp_transform_inst *);
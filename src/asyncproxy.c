@@ -31,7 +31,9 @@
 #endif
 
 #include <sys/types.h>
+#include <sys/ioctl.h>
 #include <sys/socket.h>
+#include <sys/uio.h>
 #include <netinet/in.h>
 #include <sys/un.h>
 #include <arpa/inet.h>
@@ -39,17 +41,29 @@
 #include <assert.h>
 #include <errno.h>
 #include <fcntl.h>
+#include <limits.h>
 #include <netdb.h>
 #include <poll.h>
 #include <pthread.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <time.h>
 #include <unistd.h>
 
 #include "asyncproxy.h"
+#include "asp_buf.h"
+#include "asp_connect.h"
+#include "asp_dgram.h"
+#include "asp_engine.h"
 #include "asp_iostats.h"
+#include "asp_mem.h"
+#include "asp_resolve.h"
+#include "asp_shaper.h"
+#include "asp_slab.h"
 #include "asp_sock.h"
+#include "asp_tap.h"
+#include "asp_transform.h"
 
 #define AP_STATE_INIT  0
 #define AP_STATE_START 1
@@ -62,6 +76,12 @@
 #endif
 
 static int dbg_level = DBG_LEVEL;
+static int use_splice = 1;
+static int use_compact = 0;
+static size_t compact_stacksize;
+static int use_instrument = 0;
+static struct asyncproxy_hists hists_global;
+static uint64_t expiry_global[AP_EXPIRY_MAX];
 
 #if !defined(INFTIM)
 # define INFTIM (-1)
@@ -71,18 +91,47 @@ struct asyncproxy {
     struct asp_sock source;
     struct asp_sock sink;
     enum ap_dest dest_type;
-    const char *dest;
+    char *dest;
     unsigned short portn;
     int af;
-    const char *bindto;
+    int sinkaf;
+    struct sockaddr_in bindaddr;
+    int bound;
     pthread_t thread;
     pthread_mutex_t mutex;
+    pthread_cond_t cond;
     int state;
     int debug;
+    int splice;
+    /* Buffers held only while there is data in them, see asyncproxy_setcompact() */
+    int compact;
+    size_t bufsize;
+    int buf_adaptive;
+    int resolve_pending;
+    struct asp_resolve_res *dests;
+    unsigned int connect_timeout;
+    /* AP_FLAG_DGRAM and the session idle timeout (ms) */
+    int dgram;
+    unsigned int dgram_idle;
+    struct asp_dgram_stats dstats;
+    struct asp_sockopts sockopts;
+    /* Timeouts in ms (0 - none) and the one the relay was ended by */
+    unsigned int idle;
+    unsigned int dir_idle[2];
+    unsigned int lifetime;
+    enum ap_expiry expired;
+    struct {
+        int done;
+        int abort;
+        int aidx;
+        int nattempts;
+        uint64_t stime;
+        uint64_t elapsed;
+    } conn;
+    /* AF_UNIX one is built from dest when needed, see asyncproxy_destaddr() */
     struct {
         union {
             struct sockaddr_in ip;
-            struct sockaddr_un un;
             struct sockaddr_in6 ip6;
             struct sockaddr sa;
         };
@@ -90,8 +139,37 @@ struct asyncproxy {
     } destaddr;
     int last_seen_alive;
     void (*transform[2])(struct transform_res *);
+    /* View hooks get vtransform_arg, vcb are the ones without it */
+    ssize_t (*vtransform[2])(void *, void *, size_t, size_t);
+    void *vtransform_arg[2];
+    ssize_t (*vcb[2])(void *, size_t, size_t);
+    struct asp_transform_inst xform[2];
+    /* Own and group token buckets per direction, either could be NULL */
+    struct asp_shaper *shaper[2];
+    struct asp_shaper *group[2];
+    struct asp_shaper_stats shstats[2];
+    /* Per-direction watermarks for the data held by the relay, 0 - none */
+    uint64_t wm_high;
+    uint64_t wm_low;
+    struct asp_mem_stats mstats;
+    /* Capture ring, set before the start, every tap_sample-th chunk goes in */
+    struct asp_tap *tap;
+    uint64_t tap_id;
+    unsigned int tap_sample;
+    uint64_t tap_maxbytes;
+    uint64_t tap_nchunks;
+    uint64_t tap_bytes;
+    void (*stats_cb)(const struct asyncproxy_stats *);
+    uint64_t stats_ival;
+    struct asyncproxy_hists *hists;
     int needsjoin;
-    char addrbuf[FILENAME_MAX];
+    int engine;
+    int iodone;
+    struct asp_event done;
+    struct asyncproxy_io *io;
+    struct asp_engine_ent ent;
+    /* For asyncproxy_getsockname(), allocated on the first call */
+    char *addrbuf;
 };
 
 const struct {
@@ -106,6 +184,29 @@ const struct {
     {-1, NULL}
 };
 
+static const char *expiry_descs[AP_EXPIRY_MAX] = {
+    [AP_EXPIRY_IDLE] = "QUIT (idle timeout)",
+    [AP_EXPIRY_IDLE_I2O] = "QUIT (in2out idle timeout)",
+    [AP_EXPIRY_IDLE_O2I] = "QUIT (out2in idle timeout)",
+    [AP_EXPIRY_LIFETIME] = "QUIT (lifetime exceeded)",
+};
+
+static uint64_t
+getmonotime_ns(void)
+{
+    struct timespec ts;
+
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ((uint64_t)ts.tv_sec * 1000000000 + ts.tv_nsec);
+}
+
+static uint64_t
+getmonotime_ms(void)
+{
+
+    return (getmonotime_ns() / 1000000);
+}
+
 #define tov(p) (void *)(p)
 #define tosa(p) (struct sockaddr *)tov(p)
 #define tocsa(p) (const struct sockaddr *)tov(p)
@@ -125,26 +226,68 @@ asp_pton(const char *saddr, struct sockaddr_in *addr)
     return (1);
 }
 
-static int
-resolve(struct sockaddr *ia, int pf, const char *host,
-  const char *servname, int flags)
+static void
+asyncproxy_setdest(struct asyncproxy *ap, const struct asp_resolve_res *rrp)
 {
-    int n;
-    struct addrinfo hints, *res;
 
-    memset(&hints, 0, sizeof(hints));
-    hints.ai_flags = flags;            /* We create listening sockets */
-    hints.ai_family = pf;              /* Protocol family */
-    hints.ai_socktype = SOCK_STREAM;   /* TCP */
+    *ap->dests = *rrp;
+    /* Unless happy eyeballs are needed, use the first socket address */
+    memcpy(&ap->destaddr.sa, &rrp->addrs[0].ss, rrp->addrs[0].alen);
+    ap->destaddr.alen = rrp->addrs[0].alen;
+}
+
+/*
+ * Socket address of the destination, for AF_UNIX it's built in the un
+ * provided from the path.
+ */
+static const struct sockaddr *
+asyncproxy_destaddr(const struct asyncproxy *ap, struct sockaddr_un *un,
+  socklen_t *alen)
+{
+    size_t len;
 
-    n = getaddrinfo(host, servname, &hints, &res);
-    if (n == 0) {
-        /* Use the first socket address returned */
-        memcpy(ia, res->ai_addr, res->ai_addrlen);
-        freeaddrinfo(res);
+    if (ap->af != AF_UNIX) {
+        *alen = ap->destaddr.alen;
+        return (&ap->destaddr.sa);
     }
+    len = strlen(ap->dest);
+    memset(un, '\0', sizeof(struct sockaddr_un));
+    un->sun_family = AF_UNIX;
+    memcpy(un->sun_path, ap->dest, len + 1);
+#if defined(HAVE_SOCKADDR_SUN_LEN)
+    un->sun_len = len;
+#endif
+    *alen = sizeof(struct sockaddr_un);
+    return (tocsa(un));
+}
+
+static int
+asyncproxy_resolve(struct asyncproxy *ap, int nonblock)
+{
+    struct asp_resolve_res rres;
+    char pnum[6];
+    int n;
 
-    return n;
+    snprintf(pnum, sizeof(pnum), "%u", ap->portn);
+    if (nonblock) {
+        if (asp_resolve_lookup(ap->dest, pnum, ap->af, &rres) != 0) {
+            ap->resolve_pending = 1;
+            return (0);
+        }
+    } else {
+        n = asp_resolve(ap->dest, pnum, ap->af, &rres);
+        if (n != 0) {
+            fprintf(stderr, "asyncproxy_resolve: %s: resolve() failed: %s\n",
+              ap->dest, gai_strerror(n));
+            fflush(stderr);
+            if (n != EAI_SYSTEM)
+                errno = EHOSTUNREACH;
+            return (-1);
+        }
+    }
+    asyncproxy_setdest(ap, &rres);
+    ap->resolve_pending = 0;
+    return (0);
 }
 
 static int
@@ -176,50 +319,324 @@ asp_sock_setnonblock(int fd)
     return (fcntl(fd, F_SETFL, flags | O_NONBLOCK));
 }
 
-struct io_buf {
-    unsigned char data[16 * 1024];
-    size_t len;
+#define NEG(idx) ((idx) ^ 1)
+
+#define ASP_BUF_DEFAULT (16 * 1024)
+#define ASP_BUF_MAX (1024 * 1024)
+/* Relay thread stack and buffer pool cache in the compact mode by default */
+#define ASP_STACK_COMPACT (256 * 1024)
+#define ASP_SLAB_CACHE_DEFAULT (4 * 1024 * 1024)
+/* Longest poll while throttled, so that new limits are picked up quickly */
+#define ASP_SHAPE_MAXWAIT 100
+
+/* Why reading in a direction is paused: over its watermark or the budget */
+#define ASP_MPAUSE_WM     0x1
+#define ASP_MPAUSE_BUDGET 0x2
+
+/* Data held in the given direction, in the buffer or in the splice pipe */
+#define ASP_IO_BUFFERED(io, i) ((io)->bufs[i].len + (io)->pipes[i].len)
+
+struct asyncproxy_io {
+    struct pollfd pfds[2];
+    struct asp_sock *asps[2];
+    struct asp_buf bufs[2];
+    size_t lastrlen[2];
+    struct asp_pipe pipes[2];
+    int eidx;
+    int inited;
+    uint64_t stats_last;
+    struct asp_lat lat[2];
+    uint64_t thr_start[2];
+    uint64_t thr_wake[2];
+    int mpaused[2];
+    /* TCP_QUICKACK is to be set again after each read, per direction */
+    int quickack[2];
+    /*
+     * For the timeouts, in ms: start and last data received per direction,
+     * the time to check them next at (0 - none)
+     */
+    uint64_t tstart;
+    uint64_t lastact[2];
+    uint64_t deadline;
 };
 
-#define BUF_FREE(ibp) (sizeof((ibp)->data) - (ibp)->len)
-#define BUF_P(ibp) (&(ibp)->data[(ibp)->len])
+static void
+asyncproxy_io_report(struct asyncproxy *ap, struct asyncproxy_io *io, int force)
+{
+    void (*stats_cb)(const struct asyncproxy_stats *);
+    struct asyncproxy_stats st;
+    uint64_t now, ival;
 
-#define NEG(idx) ((idx) ^ 1)
+    pthread_mutex_lock(&ap->mutex);
+    stats_cb = ap->stats_cb;
+    ival = ap->stats_ival;
+    pthread_mutex_unlock(&ap->mutex);
+    if (stats_cb == NULL)
+        return;
+    now = getmonotime_ns() / 1000000;
+    if (!force && now - io->stats_last < ival)
+        return;
+    io->stats_last = now;
+    asyncproxy_getstats(ap, &st);
+#if defined(PYTHON_AWARE)
+    PyGILState_STATE gstate;
+    gstate = PyGILState_Ensure();
+#endif
+    stats_cb(&st);
+#if defined(PYTHON_AWARE)
+    PyGILState_Release(gstate);
+#endif
+}
 
-static void *
-asyncproxy_run(void *args)
+static void
+asyncproxy_connected(struct asyncproxy *ap, int aidx, int nattempts,
+  uint64_t elapsed)
+{
+
+    pthread_mutex_lock(&ap->mutex);
+    ap->conn.aidx = aidx;
+    ap->conn.nattempts = nattempts;
+    ap->conn.elapsed = elapsed;
+    ap->conn.done = 1;
+    pthread_mutex_unlock(&ap->mutex);
+}
+
+/*
+ * Whether connecting to the destination is more involved than a single
+ * non-blocking connect(2) that the relay loop can wait on: there is a
+ * deadline to enforce, more than one address to try or the socket created
+ * by the ctor is of the wrong family.
+ */
+static int
+asyncproxy_needs_he(struct asyncproxy *ap)
+{
+
+    /* Nothing to wait for with datagrams */
+    if (ap->af == AF_UNIX || ap->dgram)
+        return (0);
+    return (ap->connect_timeout > 0 || ap->dests->naddrs > 1 ||
+      ap->dests->addrs[0].ss.ss_family != ap->sinkaf);
+}
+
+static int
+asyncproxy_connect_isrunning(void *arg)
 {
-    int n, i, state, j, eidx, rval;
     struct asyncproxy *ap;
-    struct pollfd pfds[2];
-    struct asp_sock *asps[2];
-    struct io_buf bufs[2];
-    ssize_t rlen;
+    int rval;
+
+    ap = (struct asyncproxy *)arg;
+    pthread_mutex_lock(&ap->mutex);
+    rval = (ap->state == AP_STATE_RUN && !ap->conn.abort);
+    pthread_mutex_unlock(&ap->mutex);
+    return (rval);
+}
 
-    eidx = -1;
+static int
+asyncproxy_connect_he(struct asyncproxy *ap)
+{
+    struct asp_connect_res cres;
 
-    ap = (struct asyncproxy *)args;
+    if (asp_connect(ap->dests, ap->bound ? &ap->bindaddr : NULL, &ap->sockopts,
+      ap->connect_timeout, asyncproxy_connect_isrunning, ap, &cres) != 0) {
+        fprintf(stderr, "asyncproxy_run: connect() failed after %d attempt(s): %s\n",
+          cres.nattempts, strerror(cres.error));
+        fflush(stderr);
+        return (-1);
+    }
     if (ap->debug > 1) {
-        fprintf(stderr, "asyncproxy_run(%p)\n", (void *)ap);
+        fprintf(stderr, "asyncproxy_run(%p): connected to address %d after "
+          "%d attempt(s) in %llu ns\n", (void *)ap, cres.aidx, cres.nattempts,
+          (unsigned long long)cres.elapsed_ns);
+        fflush(stderr);
+    }
+    /*
+     * Replace the ctor-created socket, keeping the fd number intact since
+     * other threads may refer to it.
+     */
+    if (dup2(cres.fd, ap->sink.fd) < 0) {
+        fprintf(stderr, "asyncproxy_run: dup2() failed: %s\n", strerror(errno));
+        fflush(stderr);
+        close(cres.fd);
+        return (-1);
+    }
+    close(cres.fd);
+    asyncproxy_connected(ap, cres.aidx, cres.nattempts, cres.elapsed_ns);
+    return (0);
+}
+
+/*
+ * Checks the relay against its timeouts, returns the one that has run out
+ * or AP_EXPIRY_NONE with the time to check again at in io->deadline. The
+ * activity is only recorded in io->lastact, the deadline is not moved until
+ * it's been reached, so it's cheap to keep track of with a timer.
+ */
+static enum ap_expiry
+asyncproxy_io_expiry(struct asyncproxy *ap, struct asyncproxy_io *io,
+  uint64_t now)
+{
+    unsigned int tmo[AP_EXPIRY_MAX];
+    uint64_t due[AP_EXPIRY_MAX];
+    int r, first;
+
+    /* Only set before the start, no locking */
+    tmo[AP_EXPIRY_IDLE] = ap->idle;
+    due[AP_EXPIRY_IDLE] = (io->lastact[0] > io->lastact[1]) ?
+      io->lastact[0] : io->lastact[1];
+    tmo[AP_EXPIRY_IDLE_I2O] = ap->dir_idle[AP_DIR_I2O];
+    due[AP_EXPIRY_IDLE_I2O] = io->lastact[AP_DIR_I2O];
+    tmo[AP_EXPIRY_IDLE_O2I] = ap->dir_idle[AP_DIR_O2I];
+    due[AP_EXPIRY_IDLE_O2I] = io->lastact[AP_DIR_O2I];
+    tmo[AP_EXPIRY_LIFETIME] = ap->lifetime;
+    due[AP_EXPIRY_LIFETIME] = io->tstart;
+    first = AP_EXPIRY_NONE;
+    for (r = AP_EXPIRY_IDLE; r < AP_EXPIRY_MAX; r++) {
+        if (tmo[r] == 0)
+            continue;
+        due[r] += tmo[r];
+        if (first == AP_EXPIRY_NONE || due[r] < due[first])
+            first = r;
+    }
+    io->deadline = 0;
+    if (first == AP_EXPIRY_NONE)
+        return (AP_EXPIRY_NONE);
+    if (now >= due[first])
+        return ((enum ap_expiry)first);
+    io->deadline = due[first];
+    return (AP_EXPIRY_NONE);
+}
+
+/* Start the clock on the timeouts, if there are any */
+static void
+asyncproxy_io_timer_init(struct asyncproxy *ap, struct asyncproxy_io *io)
+{
+
+    io->tstart = io->lastact[0] = io->lastact[1] = getmonotime_ms();
+    asyncproxy_io_expiry(ap, io, io->tstart);
+}
+
+/* Data has been received in the direction */
+static void
+asyncproxy_io_active(struct asyncproxy_io *io, int i)
+{
+
+    if (io->quickack[i])
+        asp_sockopts_rearm(io->asps[i]->fd);
+    if (io->deadline != 0)
+        io->lastact[i] = getmonotime_ms();
+}
+
+/* Returns non-zero once the relay is to be ended on a timeout */
+static int
+asyncproxy_io_expired(struct asyncproxy *ap, struct asyncproxy_io *io)
+{
+    enum ap_expiry reason;
+    uint64_t now;
+
+    if (io->deadline == 0)
+        return (0);
+    now = getmonotime_ms();
+    if (now < io->deadline)
+        return (0);
+    reason = asyncproxy_io_expiry(ap, io, now);
+    if (reason == AP_EXPIRY_NONE)
+        return (0);
+    pthread_mutex_lock(&ap->mutex);
+    ap->expired = reason;
+    pthread_mutex_unlock(&ap->mutex);
+    __atomic_add_fetch(&expiry_global[reason], 1, __ATOMIC_RELAXED);
+    if (ap->debug > 1) {
+        fprintf(stderr, "asyncproxy_run(%p): %s, out\n", (void *)ap,
+          expiry_descs[reason]);
+        fflush(stderr);
+    }
+    return (1);
+}
+
+/*
+ * Allocates the buffer for the direction unless it's there already. In the
+ * compact mode that is only done once there is data to be read into it.
+ */
+static int
+asyncproxy_io_bufget(struct asyncproxy *ap, struct asyncproxy_io *io, int i)
+{
+
+    if (io->bufs[i].data != NULL)
+        return (0);
+    if (asp_buf_ctor(&io->bufs[i], ap->bufsize) != 0)
+        return (-1);
+    asp_mem_account(&ap->mstats, 0, io->bufs[i].size);
+    return (0);
+}
+
+/* In the compact mode, gives the buffer back to the pool once it's drained */
+static void
+asyncproxy_io_bufput(struct asyncproxy *ap, struct asyncproxy_io *io, int i)
+{
+
+    if (!ap->compact || io->bufs[i].data == NULL || io->bufs[i].len != 0)
+        return;
+    asp_mem_account(&ap->mstats, 0, -(int64_t)io->bufs[i].size);
+    asp_buf_dtor(&io->bufs[i]);
+}
+
+static int
+asyncproxy_io_init(struct asyncproxy *ap, struct asyncproxy_io *io)
+{
+    const struct sockaddr *dsa;
+    struct sockaddr_un un;
+    socklen_t alen;
+    int i, rval;
+
+    io->inited = 1;
+    io->eidx = -1;
+    io->pipes[0].fds[0] = io->pipes[1].fds[0] = -1;
+    rval = !ap->compact && (asyncproxy_io_bufget(ap, io, 0) != 0 ||
+      asyncproxy_io_bufget(ap, io, 1) != 0);
+    if (rval != 0) {
+        fprintf(stderr, "asyncproxy_run: asp_buf_ctor() failed: %s\n", strerror(errno));
         fflush(stderr);
+        return (-1);
     }
     pthread_mutex_lock(&ap->mutex);
     if (ap->state == AP_STATE_START)
         ap->state = AP_STATE_RUN;
     pthread_mutex_unlock(&ap->mutex);
+    asyncproxy_io_timer_init(ap, io);
+
+    /* Name resolution deferred from the ctor, see AP_FLAG_RESOLVE_ASYNC */
+    if (ap->resolve_pending && asyncproxy_resolve(ap, 0) != 0)
+        return (-1);
 
-    memset(pfds, '\0', sizeof(pfds));
-    memset(bufs, '\0', sizeof(bufs));
-    pfds[0].fd = ap->source.fd;
-    pfds[0].events = POLLIN;
-    asps[0] = &ap->source;
-    pfds[1].fd = ap->sink.fd;
-    pfds[1].events = POLLIN;
-    asps[1] = &ap->sink;
+    io->pfds[0].fd = ap->source.fd;
+    io->pfds[0].events = POLLIN;
+    io->asps[0] = &ap->source;
+    io->pfds[1].fd = ap->sink.fd;
+    io->pfds[1].events = POLLIN;
+    io->asps[1] = &ap->sink;
+    for (i = 0; i < 2; i++)
+        io->quickack[i] = asp_sockopts_needrearm(io->asps[i]->fd, &ap->sockopts);
+
+    /*
+     * Relay sockets and pipes through a kernel pipe with splice(2) and
+     * avoid copying the data into the userland, unless there is a
+     * transform to be applied to it.
+     */
+    if (ap->splice && asp_sock_cansplice(&ap->source) &&
+      asp_sock_cansplice(&ap->sink)) {
+        if (asp_pipe_ctor(&io->pipes[0]) == 0 &&
+          asp_pipe_ctor(&io->pipes[1]) != 0)
+            asp_pipe_dtor(&io->pipes[0]);
+    }
 
+    if (ap->dest_type == AP_DEST_HOST && asyncproxy_needs_he(ap))
+        return (asyncproxy_connect_he(ap));
     if (ap->dest_type == AP_DEST_HOST) {
-        rval = connect(ap->sink.fd, &ap->destaddr.sa, ap->destaddr.alen);
-        if (rval != 0) {
+        dsa = asyncproxy_destaddr(ap, &un, &alen);
+        ap->conn.stime = getmonotime_ns();
+        rval = connect(ap->sink.fd, dsa, alen);
+        if (rval == 0) {
+            asyncproxy_connected(ap, 0, 1, getmonotime_ns() - ap->conn.stime);
+        } else {
             if (ap->debug > 2) {
                 fprintf(stderr, "asyncproxy_run: connect(%d) = %d\n", ap->sink.fd, rval);
                 fflush(stderr);
@@ -227,383 +644,1604 @@ asyncproxy_run(void *args)
             if (errno != EINPROGRESS) {
                 fprintf(stderr, "asyncproxy_run: connect() failed: %s\n", strerror(errno));
                 fflush(stderr);
-                goto out;
+                return (-1);
             }
-            pfds[1].events |= POLLOUT;
+            io->pfds[1].events |= POLLOUT;
         }
     }
+    return (0);
+}
 
-    for (;;) {
-        pthread_mutex_lock(&ap->mutex);
-        state = ap->state;
-        pthread_mutex_unlock(&ap->mutex);
-        if (state != AP_STATE_RUN) {
-            if (ap->debug > 2) {
-                fprintf(stderr, "asyncproxy_run(%p): exit on state %d\n", (void *)ap, state);
-                fflush(stderr);
-            }
-            break;
-        }
-        n = poll(pfds, 2, INFTIM);
-        if (n < 0 && ap->debug > 0) {
-                fprintf(stderr, "asyncproxy_run: poll() failed: %s\n", strerror(errno));
-                fflush(stderr);
-        }
-        if (ap->debug > 3) {
-            fprintf(stderr, "asyncproxy_run(%p): poll() = %d\n", (void *)ap, n);
-            fflush(stderr);
-        }
-        if (n <= 0) {
-            continue;
-        }
+static int
+asyncproxy_io_isrunning(struct asyncproxy *ap)
+{
+    int state;
 
-        for (i = 0; i < 2; i++) {
-            if (ap->debug > 0) {
-                if (ap->debug > 3) {
-                    fprintf(stderr, "asyncproxy_run(%p): pfds[%d] = {.events = %d, .revents = %d}\n",
-                      (void *)ap, i, pfds[i].events, pfds[i].revents);
-                    fflush(stderr);
-                }
-                assert((pfds[i].revents & POLLNVAL) == 0);
-            }
-            if (pfds[i].revents & (POLLHUP | POLLERR)) {
-                if (ap->debug > 1) {
-                    fprintf(stderr, "asyncproxy_run(%p): fd %d is gone, out\n", (void *)ap, pfds[i].fd);
-                    fflush(stderr);
-                }
-                eidx = i;
-                goto out;
-            }
-            j = NEG(i);
-            if (pfds[i].revents & POLLIN && BUF_FREE(&bufs[i]) > 0) {
-                struct recv_res r;
-                r = asp_sock_recv(asps[i], BUF_P(&bufs[i]), BUF_FREE(&bufs[i]));
-                if (ap->debug > 2) {
-                    assert(pfds[i].fd == asps[i]->fd);
-                    fprintf(stderr, "asyncproxy_run(%p): received %ld bytes from %d\n", (void *)ap, r.len, pfds[i].fd);
-                    fflush(stderr);
-                }
-                if (r.len <= 0) {
-                    if (ap->debug > 1) {
-                        fprintf(stderr, "asyncproxy_run(%p): fd %d recv "
-                          "failed with error %d, out\n", (void *)ap, pfds[i].fd,
-                          r.errnom);
-                        fflush(stderr);
-                    }
-                    eidx = i;
-                    goto out;
-                }
-                pthread_mutex_lock(&ap->mutex);
-                __typeof(ap->transform[i]) transform = ap->transform[i];
-                pthread_mutex_unlock(&ap->mutex);
-                if (transform != NULL) {
-#if defined(PYTHON_AWARE)
-                    PyGILState_STATE gstate;
-                    gstate = PyGILState_Ensure();
-#endif
-                    struct transform_res tr = {BUF_P(&bufs[i]), r.len};
-                    transform(&tr);
-#if defined(PYTHON_AWARE)
-                    PyGILState_Release(gstate);
-#endif
-                    if ((ssize_t)tr.len != r.len) {
-                        assert(BUF_FREE(&bufs[i]) >= tr.len);
-                        r.len = tr.len;
-                    }
-                    if (tr.buf != BUF_P(&bufs[i])) {
-                        if (tr.len > 0) {
-                            assert(BUF_FREE(&bufs[i]) >= tr.len);
-                            memmove(BUF_P(&bufs[i]), tr.buf, tr.len);
-                        }
-                        r.len = tr.len;
-                    } else if ((ssize_t)tr.len != r.len) {
-                        assert((ssize_t)tr.len < r.len);
-                        r.len = tr.len;
-                    }
-                }
-                bufs[i].len += r.len;
-                if (BUF_FREE(&bufs[i]) == 0) {
-                    pfds[i].events &= ~POLLIN;
-                }
-                pfds[i].revents &= ~POLLIN;
-            }
-        }
-        for (i = 0; i < 2; i++) {
-            j = NEG(i);
-            if (bufs[i].len > 0) {
-                if (pfds[j].events & POLLOUT && (pfds[j].revents & POLLOUT) == 0)
-                    continue;
-                rlen = asp_sock_send(asps[j], bufs[i].data, bufs[i].len);
-                if (ap->debug > 2) {
-                    assert(pfds[j].fd == asps[j]->fd);
-                    fprintf(stderr, "asyncproxy_run(%p): sent %ld bytes to %d\n", (void *)ap, rlen, pfds[j].fd);
-                    fflush(stderr);
-                }
-                if (rlen < (ssize_t)bufs[i].len) {
-                    pfds[j].events |= POLLOUT;
-                }
-                if (rlen <= 0)
-                    continue;
-                if (rlen < (ssize_t)bufs[i].len) {
-                    memmove(bufs[i].data, bufs[i].data + rlen, bufs[i].len - rlen);
-                    bufs[i].len -= rlen;
-                } else {
-                    bufs[i].len = 0;
-                    pfds[j].events &= ~POLLOUT;
-                }
-                pfds[j].revents &= ~POLLOUT;
-                pfds[i].events |= POLLIN;
-            } else if (pfds[j].events & POLLOUT && pfds[j].revents & POLLOUT) {
-                pfds[j].revents &= ~POLLOUT;
-                pfds[j].events &= ~POLLOUT;
-                pfds[i].events |= POLLIN;
-            }
+    pthread_mutex_lock(&ap->mutex);
+    state = ap->state;
+    pthread_mutex_unlock(&ap->mutex);
+    if (state != AP_STATE_RUN) {
+        if (ap->debug > 2) {
+            fprintf(stderr, "asyncproxy_run(%p): exit on state %d\n", (void *)ap, state);
+            fflush(stderr);
         }
+        return (0);
     }
+    return (1);
+}
 
-out:
-    if (ap->debug > 0 && eidx != -1) {
-        j = NEG(eidx);
-        assert(pfds[j].events & POLLOUT || bufs[eidx].len == 0);
+static void
+asyncproxy_io_flushed(struct asyncproxy *ap, struct asyncproxy_io *io, int i,
+  size_t len)
+{
+
+    asp_lat_deq(&io->lat[i], len, getmonotime_ns(), &ap->hists->flush[i],
+      &hists_global.flush[i]);
+}
+
+/* Reading in the direction is welcome again, unless throttled or paused */
+static void
+asyncproxy_io_wantin(struct asyncproxy_io *io, int i)
+{
+
+    if (io->thr_start[i] == 0 && io->mpaused[i] == 0)
+        io->pfds[i].events |= POLLIN;
+}
+
+static void
+asyncproxy_io_resize(struct asyncproxy *ap, struct asp_buf *bp, size_t size)
+{
+    size_t osize;
+
+    osize = bp->size;
+    if (asp_buf_resize(bp, size) == 0)
+        asp_mem_account(&ap->mstats, 0, (int64_t)size - (int64_t)osize);
+}
+
+/*
+ * Pause reading in the given direction if it's holding as much as its high
+ * watermark allows already, or the process is over its memory budget.
+ * Returns non-zero if paused.
+ */
+static int
+asyncproxy_io_mempause(struct asyncproxy *ap, struct asyncproxy_io *io, int i,
+  uint64_t high)
+{
+    int why;
+
+    if (high != 0 && ASP_IO_BUFFERED(io, i) >= high)
+        why = ASP_MPAUSE_WM;
+    else if (asp_mem_overbudget())
+        why = ASP_MPAUSE_BUDGET;
+    else
+        return (0);
+    io->pfds[i].events &= ~POLLIN;
+    if ((io->mpaused[i] & why) == 0) {
+        io->mpaused[i] |= why;
+        asp_mem_paused(&ap->mstats, why == ASP_MPAUSE_BUDGET);
     }
+    return (1);
+}
+
+/* Resume paused directions that are back under the low watermark(s) */
+static void
+asyncproxy_io_memresume(struct asyncproxy *ap, struct asyncproxy_io *io)
+{
+    uint64_t low;
+    int i;
+
     pthread_mutex_lock(&ap->mutex);
-    if (ap->state == AP_STATE_RUN) {
-        ap->state = AP_STATE_QUIT;
-        shutdown(ap->source.fd, SHUT_RDWR);
-    }
+    low = ap->wm_low;
     pthread_mutex_unlock(&ap->mutex);
-
-    if (ap->debug > 0) {
-        fprintf(stderr, "cease asyncproxy_run(%p)\n", (void *)ap);
-        fflush(stderr);
+    for (i = 0; i < 2; i++) {
+        if (io->mpaused[i] == 0)
+            continue;
+        if ((io->mpaused[i] & ASP_MPAUSE_WM) && ASP_IO_BUFFERED(io, i) <= low)
+            io->mpaused[i] &= ~ASP_MPAUSE_WM;
+        if ((io->mpaused[i] & ASP_MPAUSE_BUDGET) && asp_mem_belowlow())
+            io->mpaused[i] &= ~ASP_MPAUSE_BUDGET;
+        asyncproxy_io_wantin(io, i);
     }
+}
 
-    return (NULL);
+/*
+ * How many bytes can be read in the given direction, SIZE_MAX if it's not
+ * shaped. Called with the mutex held.
+ */
+static size_t
+asyncproxy_shape_avail(struct asyncproxy *ap, int i, uint64_t *delay)
+{
+    struct asp_shaper *sps[2] = {ap->shaper[i], ap->group[i]};
+    size_t avail, rval;
+    uint64_t now, d;
+    int k;
+
+    if (sps[0] == NULL && sps[1] == NULL)
+        return (SIZE_MAX);
+    now = getmonotime_ns();
+    rval = SIZE_MAX;
+    *delay = 0;
+    for (k = 0; k < 2; k++) {
+        if (sps[k] == NULL)
+            continue;
+        d = 0;
+        avail = asp_shaper_avail(sps[k], now, &d);
+        if (avail < rval)
+            rval = avail;
+        if (d > *delay)
+            *delay = d;
+    }
+    return (rval);
 }
 
-void *
-asyncproxy_ctor(const struct asyncproxy_ctor_args *acap)
+static void
+asyncproxy_shape_consume(struct asyncproxy *ap, int i, size_t len)
 {
-    struct asyncproxy *ap;
-    char pnum[6];
-    int n, fd1;
 
-    if (dbg_level > 0) {
-        if (acap->dest_type == AP_DEST_HOST) {
-            fprintf(stderr, "asyncproxy_ctor(%d, %s, %d, %u, %s) = ",
-              acap->fd, acap->dest, acap->portn, acap->af, acap->bindto);
-        } else {
-            fprintf(stderr, "asyncproxy_ctor(%d, %d) = ", acap->fd,
-              acap->out_fd);
+    pthread_mutex_lock(&ap->mutex);
+    if (ap->shaper[i] != NULL)
+        asp_shaper_consume(ap->shaper[i], len);
+    if (ap->group[i] != NULL)
+        asp_shaper_consume(ap->group[i], len);
+    pthread_mutex_unlock(&ap->mutex);
+}
+
+/*
+ * Out of tokens: stop reading in that direction until io_timeout() decides
+ * it is time to resume. Data is left in the socket buffer, where it builds
+ * up and pushes back on the sender.
+ */
+static void
+asyncproxy_io_throttle(struct asyncproxy *ap, struct asyncproxy_io *io, int i,
+  uint64_t delay)
+{
+    uint64_t now;
+    int qlen;
+
+    io->pfds[i].events &= ~POLLIN;
+    now = getmonotime_ns();
+    io->thr_wake[i] = now + delay;
+    if (io->thr_start[i] != 0)
+        return;
+    io->thr_start[i] = now;
+    if (ioctl(io->pfds[i].fd, FIONREAD, &qlen) != 0)
+        qlen = 0;
+    pthread_mutex_lock(&ap->mutex);
+    ap->shstats[i].nthrottled++;
+    ap->shstats[i].deferred += qlen;
+    pthread_mutex_unlock(&ap->mutex);
+}
+
+static void
+asyncproxy_io_unthrottle(struct asyncproxy *ap, struct asyncproxy_io *io, int i,
+  uint64_t now)
+{
+
+    pthread_mutex_lock(&ap->mutex);
+    ap->shstats[i].throttled_ns += now - io->thr_start[i];
+    pthread_mutex_unlock(&ap->mutex);
+    io->thr_start[i] = 0;
+    asyncproxy_io_wantin(io, i);
+}
+
+/* Resume the throttled directions that are due, on the shared loops */
+static void
+asyncproxy_io_thrresume(struct asyncproxy *ap, struct asyncproxy_io *io)
+{
+    uint64_t now;
+    int i;
+
+    if (io->thr_start[0] == 0 && io->thr_start[1] == 0)
+        return;
+    now = getmonotime_ns();
+    for (i = 0; i < 2; i++) {
+        if (io->thr_start[i] != 0 && now >= io->thr_wake[i])
+            asyncproxy_io_unthrottle(ap, io, i, now);
+    }
+}
+
+/* Poll timeout, resumes throttled directions that are due */
+static int
+asyncproxy_io_timeout(struct asyncproxy *ap, struct asyncproxy_io *io)
+{
+    uint64_t now;
+    int i, timeout, ms;
+
+    timeout = INFTIM;
+    /* Nothing but other relays draining can lift the budget pause, recheck */
+    if ((io->mpaused[0] | io->mpaused[1]) & ASP_MPAUSE_BUDGET) {
+        asyncproxy_io_memresume(ap, io);
+        if ((io->mpaused[0] | io->mpaused[1]) & ASP_MPAUSE_BUDGET)
+            timeout = ASP_ELOOP_TICK;
+    }
+    /* Up in time for the next timeouts check */
+    if (io->deadline != 0) {
+        now = getmonotime_ms();
+        ms = (io->deadline <= now) ? 0 : (io->deadline - now > INT_MAX) ?
+          INT_MAX : (int)(io->deadline - now);
+        if (timeout == INFTIM || ms < timeout)
+            timeout = ms;
+    }
+    if (io->thr_start[0] == 0 && io->thr_start[1] == 0)
+        return (timeout);
+    now = getmonotime_ns();
+    for (i = 0; i < 2; i++) {
+        if (io->thr_start[i] == 0)
+            continue;
+        if (now >= io->thr_wake[i]) {
+            asyncproxy_io_unthrottle(ap, io, i, now);
+            continue;
         }
-        fflush(stderr);
+        ms = (int)((io->thr_wake[i] - now + 999999) / 1000000);
+        if (ms > ASP_SHAPE_MAXWAIT)
+            ms = ASP_SHAPE_MAXWAIT;
+        if (timeout == INFTIM || ms < timeout)
+            timeout = ms;
     }
+    return (timeout);
+}
 
-    ap = malloc(sizeof(struct asyncproxy));
-    if (ap == NULL) {
-        if (dbg_level > 0) {
-            fprintf(stderr, "NULL\n");
-            fflush(stderr);
+/*
+ * Copy a chunk relayed in the given direction to the tap, unless it's not
+ * sampled or the relay has used up its capture byte cap.
+ */
+static void
+asyncproxy_io_tap(struct asyncproxy *ap, int i, const struct iovec *iov,
+  int niov, size_t len)
+{
+
+    if (ap->tap == NULL || len == 0)
+        return;
+    if (ap->tap_maxbytes != 0 && ap->tap_bytes >= ap->tap_maxbytes)
+        return;
+    if (ap->tap_nchunks++ % ap->tap_sample != 0)
+        return;
+    ap->tap_bytes += asp_tap_write(ap->tap, ap->tap_id, i, iov, niov, len);
+}
+
+/*
+ * Run the native transform and then the hooks set for the direction over
+ * len bytes of data at buf, that has room for size. Returns the new length,
+ * the data is left at buf.
+ */
+static size_t
+asyncproxy_io_transform(struct asyncproxy *ap, int i,
+  void (*transform)(struct transform_res *),
+  ssize_t (*vtransform)(void *, void *, size_t, size_t), void *varg,
+  void *buf, size_t len, size_t size)
+{
+    /* Native transforms can only be set before the start, no locking */
+    const struct asp_transform_inst *xform = &ap->xform[i];
+    struct transform_res tr = {buf, len};
+    uint64_t tts;
+    ssize_t rlen;
+
+    tts = (ap->hists != NULL) ? getmonotime_ns() : 0;
+    if (xform->ops != NULL)
+        xform->ops->apply(xform->state, &tr);
+    if (transform != NULL || vtransform != NULL) {
+#if defined(PYTHON_AWARE)
+        PyGILState_STATE gstate;
+        gstate = PyGILState_Ensure();
+#endif
+        if (transform != NULL)
+            transform(&tr);
+        if (vtransform != NULL) {
+            /*
+             * View hooks get the data at the start of the buffer, the rest
+             * of it is the room the data can grow into. Negative return
+             * value leaves it as is.
+             */
+            if (tr.buf != buf) {
+                memmove(buf, tr.buf, tr.len);
+                tr.buf = buf;
+            }
+            rlen = vtransform(varg, buf, tr.len, size);
+            if (rlen >= 0) {
+                assert((size_t)rlen <= size);
+                tr.len = rlen;
+            }
         }
-        return (NULL);
+#if defined(PYTHON_AWARE)
+        PyGILState_Release(gstate);
+#endif
     }
-    if (dbg_level > 0) {
-        fprintf(stderr, "%p\n", (void *)ap);
-        fflush(stderr);
+    if (ap->hists != NULL) {
+        /* Includes time spent waiting for the GIL */
+        uint64_t tlat = getmonotime_ns() - tts;
+        asp_hist_record(&ap->hists->transform[i], tlat);
+        asp_hist_record(&hists_global.transform[i], tlat);
     }
-    memset(ap, '\0', sizeof(struct asyncproxy));
-    fd1 = dup(acap->fd);
-    if (fd1 == -1) {
-        goto e0;
+    assert(size >= tr.len);
+    if (tr.buf != buf && tr.len > 0)
+        memmove(buf, tr.buf, tr.len);
+    return (tr.len);
+}
+
+/*
+ * Process revents reported for the pair, returns non-zero once either side is
+ * gone and the relay should be terminated.
+ */
+static int
+asyncproxy_io_step(struct asyncproxy *ap, struct asyncproxy_io *io)
+{
+    int i, j, niov;
+    struct pollfd *pfds;
+    struct asp_sock **asps;
+    struct asp_buf *bufs;
+    struct recv_res r;
+    struct iovec iov[2];
+    void *tailp;
+    size_t rsize, limit, cap;
+    ssize_t rlen;
+    uint64_t rts, delay, high;
+
+    rts = 0;
+    niov = 0;
+    tailp = NULL;
+    pfds = io->pfds;
+    asps = io->asps;
+    bufs = io->bufs;
+    /* Failed connect is reported as POLLOUT too, along with POLLERR */
+    if (ap->dest_type == AP_DEST_HOST && (pfds[1].revents & POLLOUT) &&
+      (pfds[1].revents & (POLLHUP | POLLERR)) == 0 && !ap->conn.done)
+        asyncproxy_connected(ap, 0, 1, getmonotime_ns() - ap->conn.stime);
+    for (i = 0; i < 2; i++) {
+        if (ap->debug > 0) {
+            if (ap->debug > 3) {
+                fprintf(stderr, "asyncproxy_run(%p): pfds[%d] = {.events = %d, .revents = %d}\n",
+                  (void *)ap, i, pfds[i].events, pfds[i].revents);
+                fflush(stderr);
+            }
+            assert((pfds[i].revents & POLLNVAL) == 0);
+        }
+        if (pfds[i].revents & (POLLHUP | POLLERR)) {
+            if (ap->debug > 1) {
+                fprintf(stderr, "asyncproxy_run(%p): fd %d is gone, out\n", (void *)ap, pfds[i].fd);
+                fflush(stderr);
+            }
+            io->eidx = i;
+            return (-1);
+        }
+        if ((pfds[i].revents & POLLIN) == 0)
+            continue;
+        pthread_mutex_lock(&ap->mutex);
+        __typeof(ap->transform[i]) transform = ap->transform[i];
+        __typeof(ap->vtransform[i]) vtransform = ap->vtransform[i];
+        void *varg = ap->vtransform_arg[i];
+        limit = asyncproxy_shape_avail(ap, i, &delay);
+        high = ap->wm_high;
+        pthread_mutex_unlock(&ap->mutex);
+        if (limit == 0) {
+            asyncproxy_io_throttle(ap, io, i, delay);
+            pfds[i].revents &= ~POLLIN;
+            continue;
+        }
+        if (asyncproxy_io_mempause(ap, io, i, high)) {
+            pfds[i].revents &= ~POLLIN;
+            continue;
+        }
+        /* Native transforms can only be set before the start, no locking */
+        const struct asp_transform_inst *xform = &ap->xform[i];
+        int has_tf = (transform != NULL || vtransform != NULL ||
+          xform->ops != NULL);
+        /*
+         * Shaped directions are copied, so that the reads can be capped,
+         * and so are the tapped ones
+         */
+        if (!has_tf && limit == SIZE_MAX && ap->tap == NULL && io->pipes[i].fds[0] != -1 &&
+          bufs[i].len == 0) {
+            r = asp_sock_splice_in(asps[i], &io->pipes[i]);
+            if (ap->debug > 2) {
+                fprintf(stderr, "asyncproxy_run(%p): spliced %ld bytes from %d\n", (void *)ap, r.len, pfds[i].fd);
+                fflush(stderr);
+            }
+            if (r.len < 0 && r.errnom == EAGAIN) {
+                pfds[i].revents &= ~POLLIN;
+                continue;
+            }
+            if (r.len < 0 && r.errnom == EINVAL && io->pipes[i].len == 0) {
+                /* Not supported for this fd, fall back to copying */
+                asp_pipe_dtor(&io->pipes[i]);
+            } else {
+                if (r.len <= 0) {
+                    if (ap->debug > 1) {
+                        fprintf(stderr, "asyncproxy_run(%p): fd %d splice "
+                          "failed with error %d, out\n", (void *)ap, pfds[i].fd,
+                          r.errnom);
+                        fflush(stderr);
+                    }
+                    io->eidx = i;
+                    return (-1);
+                }
+                asp_mem_account(&ap->mstats, r.len, 0);
+                asyncproxy_io_active(io, i);
+                if (ap->hists != NULL)
+                    asp_lat_enq(&io->lat[i], r.len, getmonotime_ns());
+                if (ASP_PIPE_FREE(&io->pipes[i]) == 0) {
+                    pfds[i].events &= ~POLLIN;
+                }
+                pfds[i].revents &= ~POLLIN;
+                continue;
+            }
+        }
+        /*
+         * Either the buffer is full or the data spliced before a transform
+         * has been installed is still in the pipe, hold off until it's out.
+         */
+        if (io->pipes[i].len > 0 ||
+          (bufs[i].data != NULL && ASP_BUF_FREE(&bufs[i]) == 0)) {
+            pfds[i].events &= ~POLLIN;
+            continue;
+        }
+        if (asyncproxy_io_bufget(ap, io, i) != 0) {
+            fprintf(stderr, "asyncproxy_run: asp_buf_ctor() failed: %s\n", strerror(errno));
+            fflush(stderr);
+            io->eidx = i;
+            return (-1);
+        }
+        /* Don't read past the tokens available nor the high watermark */
+        cap = limit;
+        if (high != 0 && high - ASP_IO_BUFFERED(io, i) < cap)
+            cap = high - ASP_IO_BUFFERED(io, i);
+        if (!has_tf) {
+            rsize = ASP_BUF_FREE(&bufs[i]);
+            niov = asp_buf_iov_free(&bufs[i], iov);
+            if (cap < rsize) {
+                if (iov[0].iov_len >= cap) {
+                    iov[0].iov_len = cap;
+                    niov = 1;
+                } else {
+                    iov[1].iov_len = cap - iov[0].iov_len;
+                }
+            }
+            r = asp_sock_recvv(asps[i], iov, niov);
+        } else {
+            /* Transforms operate on a contiguous chunk of data */
+            tailp = asp_buf_tail(&bufs[i], &rsize);
+            r = asp_sock_recv(asps[i], tailp, (cap < rsize) ? cap : rsize);
+        }
+        if (ap->debug > 2) {
+            assert(pfds[i].fd == asps[i]->fd);
+            fprintf(stderr, "asyncproxy_run(%p): received %ld bytes from %d\n", (void *)ap, r.len, pfds[i].fd);
+            fflush(stderr);
+        }
+        if (r.len <= 0) {
+            if (ap->debug > 1) {
+                fprintf(stderr, "asyncproxy_run(%p): fd %d recv "
+                  "failed with error %d, out\n", (void *)ap, pfds[i].fd,
+                  r.errnom);
+                fflush(stderr);
+            }
+            io->eidx = i;
+            return (-1);
+        }
+        if (limit != SIZE_MAX)
+            asyncproxy_shape_consume(ap, i, r.len);
+        asyncproxy_io_active(io, i);
+        if (ap->hists != NULL)
+            rts = getmonotime_ns();
+        if (has_tf)
+            r.len = asyncproxy_io_transform(ap, i, transform, vtransform,
+              varg, tailp, r.len, rsize);
+        if (ap->tap != NULL) {
+            if (has_tf) {
+                iov[0].iov_base = tailp;
+                iov[0].iov_len = r.len;
+                niov = 1;
+            }
+            asyncproxy_io_tap(ap, i, iov, niov, r.len);
+        }
+        if (ap->hists != NULL)
+            asp_lat_enq(&io->lat[i], r.len, rts);
+        asp_buf_produce(&bufs[i], r.len);
+        asp_mem_account(&ap->mstats, r.len, 0);
+        /* Everything could have been dropped by the transform */
+        asyncproxy_io_bufput(ap, io, i);
+        /*
+         * In the adaptive mode, grow the buffer as long as each read
+         * takes all the space offered, i.e. there is a bulk transfer going,
+         * and there is memory to spare.
+         */
+        io->lastrlen[i] = r.len;
+        if (ap->buf_adaptive && cap == SIZE_MAX && (size_t)r.len == rsize &&
+          bufs[i].size < ASP_BUF_MAX && !asp_mem_overbudget())
+            asyncproxy_io_resize(ap, &bufs[i], bufs[i].size * 2);
+        if (ASP_BUF_FREE(&bufs[i]) == 0) {
+            pfds[i].events &= ~POLLIN;
+        }
+        pfds[i].revents &= ~POLLIN;
     }
-    if (asp_sock_ctor(&ap->source, fd1) != 0) {
-        close(fd1);
-        goto e0;
+    for (i = 0; i < 2; i++) {
+        j = NEG(i);
+        if (io->pipes[i].len > 0) {
+            if (pfds[j].events & POLLOUT && (pfds[j].revents & POLLOUT) == 0)
+                continue;
+            rlen = asp_sock_splice_out(asps[j], &io->pipes[i]);
+            if (ap->debug > 2) {
+                fprintf(stderr, "asyncproxy_run(%p): spliced %ld bytes to %d\n", (void *)ap, rlen, pfds[j].fd);
+                fflush(stderr);
+            }
+            if (rlen <= 0 || io->pipes[i].len > 0) {
+                pfds[j].events |= POLLOUT;
+            }
+            if (rlen <= 0)
+                continue;
+            asp_mem_account(&ap->mstats, -rlen, 0);
+            if (ap->hists != NULL)
+                asyncproxy_io_flushed(ap, io, i, rlen);
+            if (io->pipes[i].len == 0) {
+                pfds[j].events &= ~POLLOUT;
+            }
+            pfds[j].revents &= ~POLLOUT;
+            asyncproxy_io_wantin(io, i);
+        } else if (bufs[i].len > 0) {
+            if (pfds[j].events & POLLOUT && (pfds[j].revents & POLLOUT) == 0)
+                continue;
+            rlen = asp_sock_sendv(asps[j], iov, asp_buf_iov_data(&bufs[i], iov));
+            if (ap->debug > 2) {
+                assert(pfds[j].fd == asps[j]->fd);
+                fprintf(stderr, "asyncproxy_run(%p): sent %ld bytes to %d\n", (void *)ap, rlen, pfds[j].fd);
+                fflush(stderr);
+            }
+            if (rlen < (ssize_t)bufs[i].len) {
+                pfds[j].events |= POLLOUT;
+            }
+            if (rlen <= 0)
+                continue;
+            asp_mem_account(&ap->mstats, -rlen, 0);
+            if (ap->hists != NULL)
+                asyncproxy_io_flushed(ap, io, i, rlen);
+            asp_buf_consume(&bufs[i], rlen);
+            if (bufs[i].len == 0) {
+                pfds[j].events &= ~POLLOUT;
+                /* Bulk transfer is over, shrink the buffer back */
+                if (ap->compact)
+                    asyncproxy_io_bufput(ap, io, i);
+                else if (ap->buf_adaptive && bufs[i].size > ap->bufsize &&
+                  io->lastrlen[i] < ap->bufsize)
+                    asyncproxy_io_resize(ap, &bufs[i], ap->bufsize);
+            }
+            pfds[j].revents &= ~POLLOUT;
+            asyncproxy_io_wantin(io, i);
+        } else if (pfds[j].events & POLLOUT && pfds[j].revents & POLLOUT) {
+            pfds[j].revents &= ~POLLOUT;
+            pfds[j].events &= ~POLLOUT;
+            asyncproxy_io_wantin(io, i);
+        }
     }
-    ap->dest_type = acap->dest_type;
-    ap->debug = dbg_level;
-    ap->last_seen_alive = -1;
-    ap->dest = acap->dest;
-    if (acap->dest_type == AP_DEST_FD) {
-        fd1 = dup(acap->out_fd);
-    } else {
-        ap->portn = acap->portn;
-        ap->af = acap->af;
-        ap->bindto = acap->bindto;
+    if (io->mpaused[0] != 0 || io->mpaused[1] != 0)
+        asyncproxy_io_memresume(ap, io);
+    asyncproxy_io_report(ap, io, 0);
+    return (0);
+}
+
+static void
+asyncproxy_io_fini(struct asyncproxy *ap, struct asyncproxy_io *io)
+{
+    uint64_t now;
+    int i;
 
-        fd1 = socket(acap->af, SOCK_STREAM, 0);
+    if (ap->debug > 0 && io->eidx != -1) {
+        assert(io->pfds[NEG(io->eidx)].events & POLLOUT ||
+          (io->bufs[io->eidx].len == 0 && io->pipes[io->eidx].len == 0));
     }
-    if (fd1 < 0)
-        goto e1;
-    if (asp_sock_ctor(&ap->sink, fd1) != 0) {
-        close(fd1);
-        goto e1;
+    asp_mem_account(&ap->mstats,
+      -(int64_t)(ASP_IO_BUFFERED(io, 0) + ASP_IO_BUFFERED(io, 1)),
+      -(int64_t)(io->bufs[0].size + io->bufs[1].size));
+    asp_pipe_dtor(&io->pipes[0]);
+    asp_pipe_dtor(&io->pipes[1]);
+    asp_buf_dtor(&io->bufs[0]);
+    asp_buf_dtor(&io->bufs[1]);
+    now = getmonotime_ns();
+    for (i = 0; i < 2; i++) {
+        if (io->thr_start[i] != 0)
+            asyncproxy_io_unthrottle(ap, io, i, now);
+    }
+    asyncproxy_io_report(ap, io, 1);
+    if (ap->debug > 0) {
+        fprintf(stderr, "cease asyncproxy_run(%p)\n", (void *)ap);
+        fflush(stderr);
+    }
+    pthread_mutex_lock(&ap->mutex);
+    if (ap->state == AP_STATE_RUN) {
+        ap->state = AP_STATE_QUIT;
+        shutdown(ap->source.fd, SHUT_RDWR);
     }
+    ap->io = NULL;
+    ap->iodone = 1;
+    if (ap->done.fds[0] != -1)
+        asp_event_post(&ap->done);
+    pthread_cond_broadcast(&ap->cond);
+    pthread_mutex_unlock(&ap->mutex);
+    free(io);
+}
 
-    if (acap->dest_type == AP_DEST_FD)
-        goto finalize;
+static void *
+asyncproxy_run(void *args)
+{
+    int n;
+    struct asyncproxy *ap;
+    struct asyncproxy_io *io;
 
-    if (acap->bindto != NULL) {
-        assert (acap->af != AF_UNIX);
-        struct sockaddr_in bindaddr;
+    ap = (struct asyncproxy *)args;
+    io = ap->io;
+    if (ap->debug > 1) {
+        fprintf(stderr, "asyncproxy_run(%p)\n", (void *)ap);
+        fflush(stderr);
+    }
+    if (!io->inited && asyncproxy_io_init(ap, io) != 0)
+        goto out;
 
-        if (asp_pton(acap->bindto, &bindaddr) != 1) {
-            fprintf(stderr, "asyncproxy_ctor: inet_pton() failed\n");
-            goto e3;
-        }
-        if (bind(ap->sink.fd, tocsa(&bindaddr), sizeof(struct sockaddr_in)) != 0) {
-            fprintf(stderr, "asyncproxy_ctor: bind() failed: %s\n", strerror(errno));
-            goto e3;
+    while (asyncproxy_io_isrunning(ap)) {
+        n = poll(io->pfds, 2, asyncproxy_io_timeout(ap, io));
+        if (n < 0 && ap->debug > 0) {
+                fprintf(stderr, "asyncproxy_run: poll() failed: %s\n", strerror(errno));
+                fflush(stderr);
         }
-    }
-    if (acap->af != AF_UNIX) {
-        snprintf(pnum, sizeof(pnum), "%u", acap->portn);
-        n = resolve(&ap->destaddr.sa, acap->af, acap->dest, pnum, 0);
-        if (n != 0) {
-            fprintf(stderr, "asyncproxy_ctor: resolve() failed: %s\n", gai_strerror(n));
-            goto e3;
+        if (ap->debug > 3) {
+            fprintf(stderr, "asyncproxy_run(%p): poll() = %d\n", (void *)ap, n);
+            fflush(stderr);
         }
-        ap->destaddr.alen = (acap->af == AF_INET) ? sizeof(struct sockaddr_in) : sizeof(struct sockaddr_in6);
-    } else {
-        struct sockaddr_un *un = &ap->destaddr.un;
-        size_t len = strlen(acap->dest);
-        if (len >= sizeof(un->sun_path)) {
-            fprintf(stderr, "asyncproxy_ctor: path too long: %s\n", acap->dest);
-            goto e3;
+        if (asyncproxy_io_expired(ap, io))
+            break;
+        if (n <= 0) {
+            continue;
         }
-        un->sun_family = AF_UNIX;
-        memcpy(un->sun_path, acap->dest, len + 1);
-#if defined(HAVE_SOCKADDR_SUN_LEN)
-        un->sun_len = len;
-#endif
-        ap->destaddr.alen = sizeof(struct sockaddr_un);
-    }
-finalize:
-    if (asp_sock_setnonblock(ap->source.fd) == -1) {
-        fprintf(stderr, "asyncproxy_ctor: asp_sock_setnonblock(ap->source.fd) failed: %s\n", strerror(errno));
-        goto e3;
+        if (asyncproxy_io_step(ap, io) != 0)
+            break;
     }
-    if (asp_sock_setnonblock(ap->sink.fd) == -1) {
-        fprintf(stderr, "asyncproxy_ctor: asp_sock_setnonblock(ap->source.fd) failed: %s\n", strerror(errno));
-        goto e3;
+
+out:
+    asyncproxy_io_fini(ap, io);
+    return (NULL);
+}
+
+static int
+asyncproxy_dgram_isrunning(void *arg)
+{
+    struct asyncproxy *ap;
+
+    ap = (struct asyncproxy *)arg;
+    return (asyncproxy_io_isrunning(ap) && !asyncproxy_io_expired(ap, ap->io));
+}
+
+static size_t
+asyncproxy_dgram_transform(void *arg, int i, void *buf, size_t len,
+  size_t size)
+{
+    struct asyncproxy *ap;
+
+    ap = (struct asyncproxy *)arg;
+    asyncproxy_io_active(ap->io, i);
+    pthread_mutex_lock(&ap->mutex);
+    __typeof(ap->transform[i]) transform = ap->transform[i];
+    __typeof(ap->vtransform[i]) vtransform = ap->vtransform[i];
+    void *varg = ap->vtransform_arg[i];
+    pthread_mutex_unlock(&ap->mutex);
+    if (transform != NULL || vtransform != NULL || ap->xform[i].ops != NULL)
+        len = asyncproxy_io_transform(ap, i, transform, vtransform, varg, buf,
+          len, size);
+    if (ap->tap != NULL && len > 0) {
+        struct iovec iov = {buf, len};
+        asyncproxy_io_tap(ap, i, &iov, 1, len);
     }
+    return (len);
+}
 
-    if (pthread_mutex_init(&ap->mutex, NULL) != 0) {
-        fprintf(stderr, "asyncproxy_ctor: pthread_mutex_init() failed: %s\n", strerror(errno));
-        goto e3;
+static void
+asyncproxy_dgram_report(void *arg)
+{
+    struct asyncproxy *ap;
+
+    ap = (struct asyncproxy *)arg;
+    asyncproxy_io_report(ap, ap->io, 0);
+}
+
+/* Point the sink at the destination, recreating it if of the wrong family */
+static int
+asyncproxy_dgram_connect(struct asyncproxy *ap)
+{
+    const struct sockaddr *dsa;
+    struct sockaddr_un un;
+    socklen_t alen;
+    int fd;
+
+    if (ap->af != AF_UNIX && ap->destaddr.sa.sa_family != ap->sinkaf) {
+        fd = socket(ap->destaddr.sa.sa_family, SOCK_DGRAM, 0);
+        if (fd < 0)
+            goto e0;
+        if (asp_sock_setnonblock(fd) != 0 || dup2(fd, ap->sink.fd) < 0) {
+            close(fd);
+            goto e0;
+        }
+        close(fd);
+        ap->sinkaf = ap->destaddr.sa.sa_family;
+        asp_sockopts_apply(ap->sink.fd, &ap->sockopts);
     }
+    dsa = asyncproxy_destaddr(ap, &un, &alen);
+    ap->conn.stime = getmonotime_ns();
+    if (connect(ap->sink.fd, dsa, alen) != 0)
+        goto e0;
+    asyncproxy_connected(ap, 0, 1, getmonotime_ns() - ap->conn.stime);
+    return (0);
+e0:
+    fprintf(stderr, "asyncproxy_dgram_run: connect() failed: %s\n", strerror(errno));
+    fflush(stderr);
+    return (-1);
+}
 
-#if defined(PYTHON_AWARE) && PY_VERSION_HEX < 0x03070000
-    PyEval_InitThreads();
-#endif
+/*
+ * Datagram relays run on a thread of their own, see asp_dgram_run(). With
+ * sessions the sink is not connected anywhere and serves to wake the relay
+ * up once shut down by asyncproxy_join().
+ */
+static void *
+asyncproxy_dgram_run(void *args)
+{
+    struct asyncproxy *ap;
+    struct asyncproxy_io *io;
+    struct asp_dgram_args dga;
+    struct sockaddr_un un;
+    socklen_t alen;
+    int64_t alloc;
+    int i;
+
+    ap = (struct asyncproxy *)args;
+    io = ap->io;
+    io->inited = 1;
+    io->eidx = -1;
+    io->pipes[0].fds[0] = io->pipes[1].fds[0] = -1;
+    pthread_mutex_lock(&ap->mutex);
+    if (ap->state == AP_STATE_START)
+        ap->state = AP_STATE_RUN;
+    pthread_mutex_unlock(&ap->mutex);
+    asyncproxy_io_timer_init(ap, io);
+    if (ap->resolve_pending && asyncproxy_resolve(ap, 0) != 0)
+        goto out;
+
+    memset(&dga, '\0', sizeof(dga));
+    dga.source = &ap->source;
+    dga.sink = &ap->sink;
+    if (ap->dest_type == AP_DEST_HOST) {
+        dga.dest = asyncproxy_destaddr(ap, &un, &alen);
+        dga.destlen = alen;
+        dga.idle_ms = ap->dgram_idle;
+        if (ap->bound) {
+            dga.bindaddr = tocsa(&ap->bindaddr);
+            dga.bindlen = sizeof(struct sockaddr_in);
+        }
+        if (dga.idle_ms == 0 && asyncproxy_dgram_connect(ap) != 0)
+            goto out;
+    }
+    dga.msgsize = ap->bufsize;
+    /* Check the timeouts four times per the shortest one at least */
+    for (i = 0; i < 4; i++) {
+        unsigned int tmo = (i == 0) ? ap->idle : (i == 3) ? ap->lifetime :
+          ap->dir_idle[i - 1];
+        if (tmo != 0 && (dga.tick_ms == 0 || tmo / 4 < dga.tick_ms))
+            dga.tick_ms = (tmo / 4 > 0) ? tmo / 4 : 1;
+    }
+    dga.stats = &ap->dstats;
+    dga.isrunning = asyncproxy_dgram_isrunning;
+    dga.transform = asyncproxy_dgram_transform;
+    dga.report = asyncproxy_dgram_report;
+    dga.arg = ap;
+    alloc = (int64_t)(ASP_DGRAM_BATCH * dga.msgsize);
+    asp_mem_account(&ap->mstats, 0, alloc);
+    if (asp_dgram_run(&dga) != 0) {
+        fprintf(stderr, "asyncproxy_dgram_run: asp_dgram_run() failed: %s\n",
+          strerror(errno));
+        fflush(stderr);
+    }
+    asp_mem_account(&ap->mstats, 0, -alloc);
+out:
+    asyncproxy_io_fini(ap, io);
+    return (NULL);
+}
+
+static int
+asyncproxy_eng_step(void *arg)
+{
+    struct asyncproxy *ap;
+    struct asyncproxy_io *io;
+    int rval;
+
+    ap = (struct asyncproxy *)arg;
+    io = ap->io;
+    if (!asyncproxy_io_isrunning(ap) || asyncproxy_io_expired(ap, io))
+        return (-1);
+    asyncproxy_io_thrresume(ap, io);
+    rval = asyncproxy_io_step(ap, io);
+    /*
+     * Have the loop recheck the budget and the token buckets, see
+     * asyncproxy_io_timeout()
+     */
+    ap->ent.tick = ((io->mpaused[0] | io->mpaused[1]) & ASP_MPAUSE_BUDGET) != 0 ||
+      io->thr_start[0] != 0 || io->thr_start[1] != 0;
+    ap->ent.deadline = io->deadline;
+    return (rval);
+}
+
+static void
+asyncproxy_eng_fini(void *arg)
+{
+    struct asyncproxy *ap;
+
+    ap = (struct asyncproxy *)arg;
+    asyncproxy_io_fini(ap, ap->io);
+}
+
+/*
+ * Try to hand the relay over to one of the shared event loops, returns
+ * non-zero if that is not possible and a dedicated thread has to be used
+ * instead.
+ */
+static int
+asyncproxy_start_engine(struct asyncproxy *ap)
+{
+    struct asyncproxy_io *io;
+
+    if (!asp_engine_isrunning() || ap->dgram)
+        return (-1);
+    /* Don't stall the shared loops waiting on the resolver or connect */
+    if (ap->resolve_pending ||
+      (ap->dest_type == AP_DEST_HOST && asyncproxy_needs_he(ap)))
+        return (-1);
+    pthread_mutex_lock(&ap->mutex);
+    ap->engine = 1;
+    pthread_mutex_unlock(&ap->mutex);
+    io = ap->io;
+    if (asyncproxy_io_init(ap, io) != 0) {
+        asyncproxy_io_fini(ap, io);
+        return (0);
+    }
+    ap->ent.pfds = io->pfds;
+    ap->ent.step = asyncproxy_eng_step;
+    ap->ent.fini = asyncproxy_eng_fini;
+    ap->ent.arg = ap;
+    ap->ent.deadline = io->deadline;
+    if (asp_engine_attach(&ap->ent) != 0) {
+        pthread_mutex_lock(&ap->mutex);
+        ap->engine = 0;
+        pthread_mutex_unlock(&ap->mutex);
+        return (-1);
+    }
+    return (0);
+}
+
+void *
+asyncproxy_ctor(const struct asyncproxy_ctor_args *acap)
+{
+    struct asyncproxy *ap;
+    int fd1, i;
+
+    if (dbg_level > 0) {
+        if (acap->dest_type == AP_DEST_HOST) {
+            fprintf(stderr, "asyncproxy_ctor(%d, %s, %d, %u, %s) = ",
+              acap->fd, acap->dest, acap->portn, acap->af, acap->bindto);
+        } else {
+            fprintf(stderr, "asyncproxy_ctor(%d, %d) = ", acap->fd,
+              acap->out_fd);
+        }
+        fflush(stderr);
+    }
+
+    ap = malloc(sizeof(struct asyncproxy));
+    if (ap == NULL) {
+        if (dbg_level > 0) {
+            fprintf(stderr, "NULL\n");
+            fflush(stderr);
+        }
+        return (NULL);
+    }
+    if (dbg_level > 0) {
+        fprintf(stderr, "%p\n", (void *)ap);
+        fflush(stderr);
+    }
+    memset(ap, '\0', sizeof(struct asyncproxy));
+    fd1 = dup(acap->fd);
+    if (fd1 == -1) {
+        goto e0;
+    }
+    if (asp_sock_ctor(&ap->source, fd1) != 0) {
+        close(fd1);
+        goto e0;
+    }
+    ap->dest_type = acap->dest_type;
+    ap->debug = dbg_level;
+    ap->splice = use_splice;
+    ap->compact = use_compact;
+    ap->bufsize = (acap->bufsize > 0) ? acap->bufsize : ASP_BUF_DEFAULT;
+    ap->buf_adaptive = (acap->flags & AP_FLAG_BUF_ADAPTIVE) != 0;
+    ap->dgram = (acap->flags & AP_FLAG_DGRAM) != 0;
+    ap->sockopts = acap->sockopts;
+    if (use_instrument) {
+        ap->hists = malloc(sizeof(struct asyncproxy_hists));
+        if (ap->hists == NULL)
+            goto e1;
+        memset(ap->hists, '\0', sizeof(struct asyncproxy_hists));
+    }
+    ap->last_seen_alive = -1;
+    ap->done.fds[0] = ap->done.fds[1] = -1;
+    if (acap->dest_type == AP_DEST_FD) {
+        fd1 = dup(acap->out_fd);
+    } else {
+        ap->portn = acap->portn;
+        ap->af = acap->af;
+        ap->connect_timeout = acap->connect_timeout;
+        ap->dgram_idle = ap->dgram ? acap->dgram_idle : 0;
+        ap->dest = strdup(acap->dest);
+        if (ap->dest == NULL)
+            goto e1;
+        if (acap->af != AF_UNIX) {
+            ap->dests = malloc(sizeof(struct asp_resolve_res));
+            if (ap->dests == NULL)
+                goto e1;
+        }
+
+        /* Any family will do, to be replaced once connected if it's wrong */
+        ap->sinkaf = (acap->af != AF_UNSPEC) ? acap->af : AF_INET;
+        fd1 = socket(ap->sinkaf, ap->dgram ? SOCK_DGRAM : SOCK_STREAM, 0);
+    }
+    if (fd1 < 0)
+        goto e1;
+    if (asp_sock_ctor(&ap->sink, fd1) != 0) {
+        close(fd1);
+        goto e1;
+    }
+
+    if (acap->dest_type == AP_DEST_FD)
+        goto finalize;
+
+    if (acap->bindto != NULL) {
+        assert (acap->af != AF_UNIX);
+
+        if (asp_pton(acap->bindto, &ap->bindaddr) != 1) {
+            fprintf(stderr, "asyncproxy_ctor: inet_pton() failed\n");
+            errno = EINVAL;
+            goto e3;
+        }
+        if (bind(ap->sink.fd, tocsa(&ap->bindaddr), sizeof(struct sockaddr_in)) != 0) {
+            fprintf(stderr, "asyncproxy_ctor: bind() failed: %s\n", strerror(errno));
+            goto e3;
+        }
+        ap->bound = 1;
+    }
+    if (acap->af != AF_UNIX) {
+        if (asyncproxy_resolve(ap, (acap->flags & AP_FLAG_RESOLVE_ASYNC) != 0) != 0)
+            goto e3;
+    } else if (strlen(acap->dest) >= sizeof(((struct sockaddr_un *)0)->sun_path)) {
+        fprintf(stderr, "asyncproxy_ctor: path too long: %s\n", acap->dest);
+        errno = ENAMETOOLONG;
+        goto e3;
+    }
+finalize:
+    if (asp_sock_setnonblock(ap->source.fd) == -1) {
+        fprintf(stderr, "asyncproxy_ctor: asp_sock_setnonblock(ap->source.fd) failed: %s\n", strerror(errno));
+        goto e3;
+    }
+    if (asp_sock_setnonblock(ap->sink.fd) == -1) {
+        fprintf(stderr, "asyncproxy_ctor: asp_sock_setnonblock(ap->source.fd) failed: %s\n", strerror(errno));
+        goto e3;
+    }
+    /*
+     * Best effort, see asyncproxy_getsockopts() for what's in effect. The
+     * sink is yet to be created for the AP_DEST_HOST.
+     */
+    for (i = 0; i < 2; i++) {
+        fd1 = (i == 0) ? ap->source.fd : ap->sink.fd;
+        if (fd1 >= 0 && asp_sockopts_apply(fd1, &ap->sockopts) != 0 &&
+          ap->debug > 0) {
+            fprintf(stderr, "asyncproxy_ctor: asp_sockopts_apply() failed: %s\n",
+              strerror(errno));
+            fflush(stderr);
+        }
+    }
+
+    if (pthread_mutex_init(&ap->mutex, NULL) != 0) {
+        fprintf(stderr, "asyncproxy_ctor: pthread_mutex_init() failed: %s\n", strerror(errno));
+        goto e3;
+    }
+    if (pthread_cond_init(&ap->cond, NULL) != 0) {
+        fprintf(stderr, "asyncproxy_ctor: pthread_cond_init() failed: %s\n", strerror(errno));
+        goto e4;
+    }
+
+#if defined(PYTHON_AWARE) && PY_VERSION_HEX < 0x03070000
+    PyEval_InitThreads();
+#endif
+
+    return (ap);
+e4:
+    pthread_mutex_destroy(&ap->mutex);
+e3:
+    asp_sock_dtor(&ap->sink);
+e1:
+    free(ap->dests);
+    free(ap->dest);
+    free(ap->hists);
+    asp_sock_dtor(&ap->source);
+e0:
+    free(ap);
+    return (NULL);
+}
+
+int
+asyncproxy_start(void *_ap)
+{
+    struct asyncproxy *ap;
+    struct asyncproxy_io *io;
+    pthread_attr_t attr, *attrp;
+    int err;
+
+    ap = (struct asyncproxy *)_ap;
+    if (ap->debug > 0) {
+        fprintf(stderr, "asyncproxy_start(%p)\n", (void *)ap);
+        fflush(stderr);
+    }
+    io = malloc(sizeof(struct asyncproxy_io));
+    if (io == NULL) {
+        fprintf(stderr, "asyncproxy_start: malloc() failed: %s\n", strerror(errno));
+        return (-1);
+    }
+    memset(io, '\0', sizeof(struct asyncproxy_io));
+    pthread_mutex_lock(&ap->mutex);
+    if (ap->debug > 0)
+        assert(ap->state == AP_STATE_INIT);
+    ap->state = AP_STATE_START;
+    ap->io = io;
+    pthread_mutex_unlock(&ap->mutex);
+    if (asyncproxy_start_engine(ap) == 0) {
+        ap->needsjoin = 1;
+        return (0);
+    }
+    attrp = NULL;
+    if (ap->compact && pthread_attr_init(&attr) == 0) {
+        attrp = &attr;
+        if (pthread_attr_setstacksize(attrp, compact_stacksize) != 0 &&
+          ap->debug > 0) {
+            fprintf(stderr, "asyncproxy_start: pthread_attr_setstacksize() failed\n");
+            fflush(stderr);
+        }
+    }
+    err = pthread_create(&ap->thread, attrp,
+      ap->dgram ? asyncproxy_dgram_run : asyncproxy_run, ap);
+    if (attrp != NULL)
+        pthread_attr_destroy(attrp);
+    if (err != 0) {
+        errno = err;
+        fprintf(stderr, "asyncproxy_start: pthread_create() failed: %s\n", strerror(errno));
+        pthread_mutex_lock(&ap->mutex);
+        assert(ap->state == AP_STATE_START || ap->state == AP_STATE_RUN);
+        ap->state = AP_STATE_INIT;
+        ap->io = NULL;
+        pthread_mutex_unlock(&ap->mutex);
+        free(io);
+        return (-1);
+    }
+    ap->needsjoin = 1;
+    return (0);
+}
+
+
+void
+asyncproxy_dtor(void *_ap)
+{
+    struct asyncproxy *ap;
+    int i;
+
+    ap = (struct asyncproxy *)_ap;
+    if (ap->debug > 0) {
+        fprintf(stderr, "asyncproxy_dtor(%p)\n", (void *)ap);
+        fflush(stderr);
+    }
+
+    pthread_mutex_lock(&ap->mutex);
+    if (ap->state == AP_STATE_START || ap->state == AP_STATE_RUN)
+        ap->state = AP_STATE_CEASE;
+    pthread_mutex_unlock(&ap->mutex);
+    asyncproxy_join(_ap, 1);
+    pthread_cond_destroy(&ap->cond);
+    pthread_mutex_destroy(&ap->mutex);
+    asp_sock_dtor(&ap->sink);
+    asp_sock_dtor(&ap->source);
+    asp_transform_dtor(&ap->xform[0]);
+    asp_transform_dtor(&ap->xform[1]);
+    for (i = 0; i < 2; i++) {
+        if (ap->shaper[i] != NULL)
+            asp_shaper_unref(ap->shaper[i]);
+        if (ap->group[i] != NULL)
+            asp_shaper_unref(ap->group[i]);
+    }
+    if (ap->tap != NULL)
+        asp_tap_unref(ap->tap);
+    asp_event_dtor(&ap->done);
+    free(ap->dests);
+    free(ap->dest);
+    free(ap->hists);
+    free(ap->addrbuf);
+    free(ap);
+}
+
+int
+asyncproxy_isalive(void *_ap)
+{
+    struct asyncproxy *ap;
+    int rval;
+
+    ap = (struct asyncproxy *)_ap;
+
+    pthread_mutex_lock(&ap->mutex);
+    rval = (ap->state == AP_STATE_START) || (ap->state == AP_STATE_RUN);
+    pthread_mutex_unlock(&ap->mutex);
+
+    if (ap->debug > 1 && ap->last_seen_alive != rval) {
+        fprintf(stderr, "asyncproxy_isalive(%p) = %d->%d\n", (void *)ap, ap->last_seen_alive, rval);
+        fflush(stderr);
+        ap->last_seen_alive = rval;
+    }
+
+    return (rval);
+}
+
+/*
+ * Create n proxies from the array of ctor args, starting them as well if
+ * start is non-zero. Unless NULL, hooks has the in->out and out->in
+ * transforms installed into each of them before the start, either could be
+ * NULL. The handles go into aps, NULL for the ones that have failed, with
+ * errno of the failure in errs (0 for the rest). Returns the number of
+ * proxies created (and started).
+ */
+int
+asyncproxy_ctor_batch(const struct asyncproxy_ctor_args *acaps, int n,
+  void (* const *hooks)(struct transform_res *), int start, void **aps,
+  int *errs)
+{
+    int i, nok;
+
+    for (nok = i = 0; i < n; i++) {
+        errno = 0;
+        aps[i] = asyncproxy_ctor(&acaps[i]);
+        if (aps[i] != NULL && hooks != NULL) {
+            asyncproxy_set_i2o(aps[i], hooks[0]);
+            asyncproxy_set_o2i(aps[i], hooks[1]);
+        }
+        if (aps[i] != NULL && start && asyncproxy_start(aps[i]) != 0) {
+            errs[i] = errno;
+            asyncproxy_dtor(aps[i]);
+            aps[i] = NULL;
+            continue;
+        }
+        errs[i] = (aps[i] == NULL) ? errno : 0;
+        if (aps[i] != NULL)
+            nok++;
+    }
+    return (nok);
+}
+
+/*
+ * Start the proxies in aps, skipping NULL entries and the ones started
+ * already. errs is filled the same way as by asyncproxy_ctor_batch(), the
+ * ones that have failed to start are left in the INIT state. Returns the
+ * number of proxies started.
+ */
+int
+asyncproxy_start_batch(void **aps, int n, int *errs)
+{
+    struct asyncproxy *ap;
+    int i, nok, state;
+
+    for (nok = i = 0; i < n; i++) {
+        errs[i] = 0;
+        if (aps[i] == NULL)
+            continue;
+        ap = (struct asyncproxy *)aps[i];
+        pthread_mutex_lock(&ap->mutex);
+        state = ap->state;
+        pthread_mutex_unlock(&ap->mutex);
+        if (state != AP_STATE_INIT)
+            continue;
+        errno = 0;
+        if (asyncproxy_start(aps[i]) != 0) {
+            errs[i] = errno;
+            continue;
+        }
+        nok++;
+    }
+    return (nok);
+}
+
+/* Returns the number of proxies alive, res is set for each (0 if NULL) */
+int
+asyncproxy_isalive_batch(void **aps, int n, int *res)
+{
+    int i, nalive;
+
+    for (nalive = i = 0; i < n; i++) {
+        res[i] = (aps[i] != NULL) ? asyncproxy_isalive(aps[i]) : 0;
+        nalive += res[i];
+    }
+    return (nalive);
+}
+
+void
+asyncproxy_set_i2o(void *_ap, void (*i2ofp)(struct transform_res *))
+{
+    struct asyncproxy *ap;
+
+    ap = (struct asyncproxy *)_ap;
+
+    pthread_mutex_lock(&ap->mutex);
+    ap->transform[0] = i2ofp;
+    pthread_mutex_unlock(&ap->mutex);
+}
+
+void
+asyncproxy_set_o2i(void *_ap, void (*o2ifp)(struct transform_res *))
+{
+    struct asyncproxy *ap;
+
+    ap = (struct asyncproxy *)_ap;
+
+    pthread_mutex_lock(&ap->mutex);
+    ap->transform[1] = o2ifp;
+    pthread_mutex_unlock(&ap->mutex);
+}
+
+static ssize_t
+asyncproxy_view_cb(void *arg, void *buf, size_t len, size_t size)
+{
+    ssize_t (**vfpp)(void *, size_t, size_t);
+
+    vfpp = arg;
+    return ((*vfpp)(buf, len, size));
+}
+
+void
+asyncproxy_set_view_cb(void *_ap, enum ap_dir dir,
+  ssize_t (*vfp)(void *, size_t, size_t))
+{
+    struct asyncproxy *ap;
+
+    ap = (struct asyncproxy *)_ap;
+    assert(dir == AP_DIR_I2O || dir == AP_DIR_O2I);
+
+    pthread_mutex_lock(&ap->mutex);
+    ap->vcb[dir] = vfp;
+    ap->vtransform[dir] = (vfp != NULL) ? asyncproxy_view_cb : NULL;
+    ap->vtransform_arg[dir] = &ap->vcb[dir];
+    pthread_mutex_unlock(&ap->mutex);
+}
+
+/*
+ * Same as asyncproxy_set_view_cb(), with arg passed to the hook as the first
+ * argument.
+ */
+void
+asyncproxy_set_view_hook(void *_ap, enum ap_dir dir,
+  ssize_t (*vfp)(void *, void *, size_t, size_t), void *arg)
+{
+    struct asyncproxy *ap;
+
+    ap = (struct asyncproxy *)_ap;
+    assert(dir == AP_DIR_I2O || dir == AP_DIR_O2I);
+
+    pthread_mutex_lock(&ap->mutex);
+    ap->vcb[dir] = NULL;
+    ap->vtransform[dir] = vfp;
+    ap->vtransform_arg[dir] = arg;
+    pthread_mutex_unlock(&ap->mutex);
+}
+
+int
+asyncproxy_set_transform(void *_ap, enum ap_dir dir, const char *name,
+  const char *args)
+{
+    struct asyncproxy *ap;
+    struct asp_transform_inst xform;
+
+    ap = (struct asyncproxy *)_ap;
+    if (dir != AP_DIR_I2O && dir != AP_DIR_O2I) {
+        errno = EINVAL;
+        return (-1);
+    }
+
+    pthread_mutex_lock(&ap->mutex);
+    if (ap->state != AP_STATE_INIT) {
+        pthread_mutex_unlock(&ap->mutex);
+        fprintf(stderr, "asyncproxy_set_transform: proxy is already started\n");
+        fflush(stderr);
+        errno = EBUSY;
+        return (-1);
+    }
+    pthread_mutex_unlock(&ap->mutex);
+    if (name == NULL) {
+        asp_transform_dtor(&ap->xform[dir]);
+        return (0);
+    }
+    if (asp_transform_ctor(&xform, name, args) != 0)
+        return (-1);
+    asp_transform_dtor(&ap->xform[dir]);
+    ap->xform[dir] = xform;
+    return (0);
+}
+
+/* Rate limits can be changed at any time, picked up on the next read */
+static int
+asyncproxy_shape_check(enum ap_dir dir)
+{
+
+    if (dir != AP_DIR_I2O && dir != AP_DIR_O2I) {
+        errno = EINVAL;
+        return (-1);
+    }
+    return (0);
+}
+
+int
+asyncproxy_set_ratelimit(void *_ap, enum ap_dir dir, uint64_t rate,
+  uint64_t burst)
+{
+    struct asyncproxy *ap;
+    int rval;
+
+    ap = (struct asyncproxy *)_ap;
+    rval = 0;
+    pthread_mutex_lock(&ap->mutex);
+    if (asyncproxy_shape_check(dir) != 0) {
+        rval = -1;
+    } else if (ap->shaper[dir] != NULL) {
+        asp_shaper_set(ap->shaper[dir], rate, burst);
+    } else if (rate != 0) {
+        ap->shaper[dir] = asp_shaper_ctor(rate, burst);
+        if (ap->shaper[dir] == NULL)
+            rval = -1;
+    }
+    pthread_mutex_unlock(&ap->mutex);
+    return (rval);
+}
+
+int
+asyncproxy_set_shaper(void *_ap, enum ap_dir dir, void *group)
+{
+    struct asyncproxy *ap;
+    struct asp_shaper *ogroup;
+
+    ap = (struct asyncproxy *)_ap;
+    pthread_mutex_lock(&ap->mutex);
+    if (asyncproxy_shape_check(dir) != 0) {
+        pthread_mutex_unlock(&ap->mutex);
+        return (-1);
+    }
+    ogroup = ap->group[dir];
+    ap->group[dir] = (group != NULL) ? asp_shaper_ref(group) : NULL;
+    pthread_mutex_unlock(&ap->mutex);
+    if (ogroup != NULL)
+        asp_shaper_unref(ogroup);
+    return (0);
+}
+
+void
+asyncproxy_getshapestats(void *_ap, struct asp_shaper_stats *res)
+{
+    struct asyncproxy *ap;
+
+    ap = (struct asyncproxy *)_ap;
+    pthread_mutex_lock(&ap->mutex);
+    res[0] = ap->shstats[0];
+    res[1] = ap->shstats[1];
+    pthread_mutex_unlock(&ap->mutex);
+}
+
+/*
+ * Pause reading in a direction once it's holding high bytes, until it's
+ * down to low (half of high if 0). Can be changed at any time, high 0 turns
+ * it off.
+ */
+int
+asyncproxy_set_watermarks(void *_ap, uint64_t high, uint64_t low)
+{
+    struct asyncproxy *ap;
+
+    ap = (struct asyncproxy *)_ap;
+    if (low == 0)
+        low = high / 2;
+    if (low > high) {
+        errno = EINVAL;
+        return (-1);
+    }
+    pthread_mutex_lock(&ap->mutex);
+    ap->wm_high = high;
+    ap->wm_low = low;
+    pthread_mutex_unlock(&ap->mutex);
+    return (0);
+}
+
+void
+asyncproxy_getmemstats(void *_ap, struct asp_mem_stats *res)
+{
+    struct asyncproxy *ap;
+
+    ap = (struct asyncproxy *)_ap;
+    asp_mem_getstats(&ap->mstats, res);
+}
+
+void
+asyncproxy_getdgramstats(void *_ap, struct asp_dgram_stats *res)
+{
+    struct asyncproxy *ap;
 
-    return (ap);
-#if 0
-e5:
-    pthread_mutex_destroy(&ap->mutex);
-#endif
-e3:
-    asp_sock_dtor(&ap->sink);
-e1:
-    asp_sock_dtor(&ap->source);
-e0:
-    free(ap);
-    return (NULL);
+    ap = (struct asyncproxy *)_ap;
+    asp_dgram_getstats(&ap->dstats, res);
 }
 
+/*
+ * Copy the relayed data, before the start only: every sample-th chunk (1 if
+ * 0) in either direction, up to maxbytes in total (0 - no cap), recorded
+ * under the given id. NULL tap detaches it.
+ */
 int
-asyncproxy_start(void *_ap)
+asyncproxy_set_tap(void *_ap, void *tap, uint64_t id, unsigned int sample,
+  uint64_t maxbytes)
 {
     struct asyncproxy *ap;
 
     ap = (struct asyncproxy *)_ap;
-    if (ap->debug > 0) {
-        fprintf(stderr, "asyncproxy_start(%p)\n", (void *)ap);
-        fflush(stderr);
-    }
     pthread_mutex_lock(&ap->mutex);
-    if (ap->debug > 0)
-        assert(ap->state == AP_STATE_INIT);
-    ap->state = AP_STATE_START;
-    pthread_mutex_unlock(&ap->mutex);
-    if (pthread_create(&ap->thread, NULL, asyncproxy_run, ap) != 0) {
-        fprintf(stderr, "asyncproxy_start: pthread_create() failed: %s\n", strerror(errno));
-        pthread_mutex_lock(&ap->mutex);
-        assert(ap->state == AP_STATE_START);
-        ap->state = AP_STATE_INIT;
+    if (ap->state != AP_STATE_INIT) {
         pthread_mutex_unlock(&ap->mutex);
+        fprintf(stderr, "asyncproxy_set_tap: proxy is already started\n");
+        fflush(stderr);
+        errno = EBUSY;
         return (-1);
     }
-    ap->needsjoin = 1;
+    pthread_mutex_unlock(&ap->mutex);
+    if (ap->tap != NULL)
+        asp_tap_unref(ap->tap);
+    ap->tap = (tap != NULL) ? asp_tap_ref(tap) : NULL;
+    ap->tap_id = id;
+    ap->tap_sample = (sample > 0) ? sample : 1;
+    ap->tap_maxbytes = maxbytes;
     return (0);
 }
 
+/* Capture ring file any number of proxies can be tapped into */
+void *
+asyncproxy_tap_ctor(const char *path, unsigned int nslots, unsigned int snaplen)
+{
+
+    return (asp_tap_ctor(path, nslots, snaplen));
+}
+
+uint64_t
+asyncproxy_tap_count(void *tp)
+{
+
+    return (asp_tap_count(tp));
+}
 
 void
-asyncproxy_dtor(void *_ap)
+asyncproxy_tap_dtor(void *tp)
 {
-    struct asyncproxy *ap;
 
-    ap = (struct asyncproxy *)_ap;
-    if (ap->debug > 0) {
-        fprintf(stderr, "asyncproxy_dtor(%p)\n", (void *)ap);
-        fflush(stderr);
-    }
+    asp_tap_unref(tp);
+}
 
-    pthread_mutex_lock(&ap->mutex);
-    if (ap->state == AP_STATE_START || ap->state == AP_STATE_RUN)
-        ap->state = AP_STATE_CEASE;
-    pthread_mutex_unlock(&ap->mutex);
-    asyncproxy_join(_ap, 1);
-    pthread_mutex_destroy(&ap->mutex);
-    asp_sock_dtor(&ap->sink);
-    asp_sock_dtor(&ap->source);
-    free(ap);
+/* Token bucket that can be shared by any number of proxies */
+void *
+asyncproxy_shaper_ctor(uint64_t rate, uint64_t burst)
+{
+
+    return (asp_shaper_ctor(rate, burst));
+}
+
+void
+asyncproxy_shaper_set(void *sp, uint64_t rate, uint64_t burst)
+{
+
+    asp_shaper_set(sp, rate, burst);
+}
+
+void
+asyncproxy_shaper_dtor(void *sp)
+{
+
+    asp_shaper_unref(sp);
 }
 
 int
-asyncproxy_isalive(void *_ap)
+asyncproxy_describe_transform(void *_ap, enum ap_dir dir, char *buf, size_t len)
 {
     struct asyncproxy *ap;
-    int rval;
+    const struct asp_transform_inst *xform;
 
     ap = (struct asyncproxy *)_ap;
+    if (dir != AP_DIR_I2O && dir != AP_DIR_O2I)
+        return (-1);
+    xform = &ap->xform[dir];
 
-    pthread_mutex_lock(&ap->mutex);
-    rval = (ap->state == AP_STATE_START) || (ap->state == AP_STATE_RUN);
-    pthread_mutex_unlock(&ap->mutex);
+    if (xform->ops == NULL || xform->ops->describe == NULL || len == 0)
+        return (-1);
+    buf[0] = '\0';
+    return (xform->ops->describe(xform->state, buf, len));
+}
 
-    if (ap->debug > 1 && ap->last_seen_alive != rval) {
-        fprintf(stderr, "asyncproxy_isalive(%p) = %d->%d\n", (void *)ap, ap->last_seen_alive, rval);
-        fflush(stderr);
-        ap->last_seen_alive = rval;
-    }
+int
+asyncproxy_transform_load(const char *path)
+{
 
-    return (rval);
+    return (asp_transform_load(path));
 }
 
 void
-asyncproxy_set_i2o(void *_ap, void (*i2ofp)(struct transform_res *))
+asyncproxy_set_stats_cb(void *_ap, void (*stats_cb)(const struct asyncproxy_stats *),
+  unsigned int ival_ms)
 {
     struct asyncproxy *ap;
 
     ap = (struct asyncproxy *)_ap;
 
     pthread_mutex_lock(&ap->mutex);
-    ap->transform[0] = i2ofp;
+    ap->stats_cb = stats_cb;
+    ap->stats_ival = ival_ms;
     pthread_mutex_unlock(&ap->mutex);
 }
 
 void
-asyncproxy_set_o2i(void *_ap, void (*o2ifp)(struct transform_res *))
+asyncproxy_getstats(void *_ap, struct asyncproxy_stats *res)
 {
     struct asyncproxy *ap;
 
     ap = (struct asyncproxy *)_ap;
 
-    pthread_mutex_lock(&ap->mutex);
-    ap->transform[1] = o2ifp;
-    pthread_mutex_unlock(&ap->mutex);
+    asp_sock_getstats(&ap->source, &res->source, 1);
+    asp_sock_getstats(&ap->sink, &res->sink, 1);
+}
+
+/* Stats for each proxy in aps into res, all zeroes for NULL entries */
+void
+asyncproxy_getstats_batch(void **aps, int n, struct asyncproxy_stats *res)
+{
+    int i;
+
+    for (i = 0; i < n; i++) {
+        if (aps[i] != NULL)
+            asyncproxy_getstats(aps[i], &res[i]);
+        else
+            memset(&res[i], '\0', sizeof(res[i]));
+    }
+}
+
+static void
+asyncproxy_hists_read(const struct asyncproxy_hists *hp, struct asyncproxy_hists *res)
+{
+    int i;
+
+    for (i = 0; i < 2; i++) {
+        asp_hist_read(&hp->flush[i], &res->flush[i]);
+        asp_hist_read(&hp->transform[i], &res->transform[i]);
+    }
+}
+
+int
+asyncproxy_gethists(void *_ap, struct asyncproxy_hists *res)
+{
+    struct asyncproxy *ap;
+
+    ap = (struct asyncproxy *)_ap;
+
+    if (ap->hists == NULL)
+        return (-1);
+    asyncproxy_hists_read(ap->hists, res);
+    return (0);
+}
+
+void
+asyncproxy_gethists_global(struct asyncproxy_hists *res)
+{
+
+    asyncproxy_hists_read(&hists_global, res);
 }
 
 void
@@ -615,45 +2253,212 @@ asyncproxy_join(void *_ap, int force)
     if (!ap->needsjoin) {
         return;
     }
-    if (force != 0)
+    if (force != 0) {
+        pthread_mutex_lock(&ap->mutex);
+        ap->conn.abort = 1;
+        pthread_mutex_unlock(&ap->mutex);
         shutdown(ap->sink.fd, SHUT_RDWR);
-    pthread_join(ap->thread, NULL);
+    }
+    if (ap->engine) {
+        pthread_mutex_lock(&ap->mutex);
+        while (!ap->iodone)
+            pthread_cond_wait(&ap->cond, &ap->mutex);
+        pthread_mutex_unlock(&ap->mutex);
+    } else {
+        pthread_join(ap->thread, NULL);
+    }
     ap->needsjoin = 0;
 }
 
+/*
+ * Returns an fd that becomes readable once the relay is over (and
+ * asyncproxy_join() won't block), so that it can be waited upon with
+ * poll(2) and friends. The fd belongs to the proxy and is valid until
+ * asyncproxy_dtor().
+ */
+int
+asyncproxy_getdonefd(void *_ap)
+{
+    struct asyncproxy *ap;
+    int fd;
+
+    ap = (struct asyncproxy *)_ap;
+    pthread_mutex_lock(&ap->mutex);
+    if (ap->done.fds[0] == -1) {
+        if (asp_event_ctor(&ap->done) != 0) {
+            pthread_mutex_unlock(&ap->mutex);
+            return (-1);
+        }
+        if (ap->iodone)
+            asp_event_post(&ap->done);
+    }
+    fd = ap->done.fds[0];
+    pthread_mutex_unlock(&ap->mutex);
+    return (fd);
+}
+
 const char *
 asyncproxy_describe(void *_ap)
 {
     struct asyncproxy *ap;
+    enum ap_expiry expired;
     int state;
 
     ap = (struct asyncproxy *)_ap;
     pthread_mutex_lock(&ap->mutex);
     state = ap->state;
+    expired = ap->expired;
     pthread_mutex_unlock(&ap->mutex);
+    if (state == AP_STATE_QUIT && expired != AP_EXPIRY_NONE)
+        return (expiry_descs[expired]);
     return (states[state].sname);
 }
 
+static const char *
+asp_ntop(const struct sockaddr_storage *ssp, char *buf, size_t len,
+  unsigned short *portn)
+{
+    const void *ap;
+    unsigned short port;
+
+    if (ssp->ss_family == AF_INET6) {
+        ap = &((const struct sockaddr_in6 *)ssp)->sin6_addr;
+        port = ((const struct sockaddr_in6 *)ssp)->sin6_port;
+    } else {
+        ap = &((const struct sockaddr_in *)ssp)->sin_addr;
+        port = ((const struct sockaddr_in *)ssp)->sin_port;
+    }
+    if (inet_ntop(ssp->ss_family, ap, buf, len) == NULL)
+        return (NULL);
+    if (portn != NULL)
+        *portn = ntohs(port);
+    return (buf);
+}
+
 const char *
 asyncproxy_getsockname(void *_ap, unsigned short *portn)
 {
     struct asyncproxy *ap;
-    struct sockaddr_in sn;
+    struct sockaddr_storage sn;
     socklen_t snlen;
 
     ap = (struct asyncproxy *)_ap;
     if (ap->af == AF_UNIX)
         return ("AF_UNIX");
-    snlen = sizeof(struct sockaddr_in);
+    snlen = sizeof(sn);
     if (getsockname(ap->sink.fd, tov(&sn), &snlen) < 0)
         return (NULL);
-    if (inet_ntop(ap->af, &sn.sin_addr, ap->addrbuf, sizeof(ap->addrbuf)) == NULL)
-        return (NULL);
+    if (ap->addrbuf == NULL) {
+        ap->addrbuf = malloc(INET6_ADDRSTRLEN);
+        if (ap->addrbuf == NULL)
+            return (NULL);
+    }
+    return (asp_ntop(&sn, ap->addrbuf, INET6_ADDRSTRLEN, portn));
+}
+
+int
+asyncproxy_getconninfo(void *_ap, struct asyncproxy_conninfo *res)
+{
+    struct asyncproxy *ap;
+    int aidx;
+
+    ap = (struct asyncproxy *)_ap;
+    if (ap->dest_type != AP_DEST_HOST)
+        return (-1);
+    memset(res, '\0', sizeof(struct asyncproxy_conninfo));
+    pthread_mutex_lock(&ap->mutex);
+    if (!ap->conn.done) {
+        pthread_mutex_unlock(&ap->mutex);
+        return (-1);
+    }
+    aidx = ap->conn.aidx;
+    res->nattempts = ap->conn.nattempts;
+    res->connect_ns = ap->conn.elapsed;
+    pthread_mutex_unlock(&ap->mutex);
+    if (ap->af == AF_UNIX) {
+        /* Socket path, truncated if it doesn't fit */
+        res->af = AF_UNIX;
+        strncpy(res->addr, ap->dest, sizeof(res->addr) - 1);
+        return (0);
+    }
+    res->af = ap->dests->addrs[aidx].ss.ss_family;
+    if (asp_ntop(&ap->dests->addrs[aidx].ss, res->addr, sizeof(res->addr),
+      &res->port) == NULL)
+        return (-1);
+    return (0);
+}
+
+/*
+ * Socket options in effect for the source (leg 0) or the sink (leg 1), with
+ * the ones that could be read in the mask.
+ */
+int
+asyncproxy_getsockopts(void *_ap, int leg, struct asp_sockopts *res)
+{
+    struct asyncproxy *ap;
+
+    ap = (struct asyncproxy *)_ap;
+    if (leg != 0 && leg != 1) {
+        errno = EINVAL;
+        return (-1);
+    }
+    asp_sockopts_get((leg == 0) ? ap->source.fd : ap->sink.fd, res);
+    return (0);
+}
+
+/*
+ * Timeouts in ms, 0 - none: idle is for no data received either way,
+ * idle_i2o/idle_o2i for none in the direction and lifetime is counted from
+ * the start. The relay is ended once any of them runs out, see
+ * asyncproxy_getexpiry(). Only before the start.
+ */
+int
+asyncproxy_set_timeouts(void *_ap, unsigned int idle, unsigned int idle_i2o,
+  unsigned int idle_o2i, unsigned int lifetime)
+{
+    struct asyncproxy *ap;
 
-    if (portn != NULL) {
-        *portn = ntohs(sn.sin_port);
+    ap = (struct asyncproxy *)_ap;
+    pthread_mutex_lock(&ap->mutex);
+    if (ap->state != AP_STATE_INIT) {
+        pthread_mutex_unlock(&ap->mutex);
+        fprintf(stderr, "asyncproxy_set_timeouts: proxy is already started\n");
+        fflush(stderr);
+        errno = EBUSY;
+        return (-1);
     }
-    return (ap->addrbuf);
+    ap->idle = idle;
+    ap->dir_idle[AP_DIR_I2O] = idle_i2o;
+    ap->dir_idle[AP_DIR_O2I] = idle_o2i;
+    ap->lifetime = lifetime;
+    pthread_mutex_unlock(&ap->mutex);
+    return (0);
+}
+
+enum ap_expiry
+asyncproxy_getexpiry(void *_ap)
+{
+    struct asyncproxy *ap;
+    enum ap_expiry rval;
+
+    ap = (struct asyncproxy *)_ap;
+    pthread_mutex_lock(&ap->mutex);
+    rval = ap->expired;
+    pthread_mutex_unlock(&ap->mutex);
+    return (rval);
+}
+
+void
+asyncproxy_getexpirystats_global(struct asyncproxy_expiry_stats *res)
+{
+
+    res->idle = __atomic_load_n(&expiry_global[AP_EXPIRY_IDLE], __ATOMIC_RELAXED);
+    res->idle_i2o = __atomic_load_n(&expiry_global[AP_EXPIRY_IDLE_I2O],
+      __ATOMIC_RELAXED);
+    res->idle_o2i = __atomic_load_n(&expiry_global[AP_EXPIRY_IDLE_O2I],
+      __ATOMIC_RELAXED);
+    res->lifetime = __atomic_load_n(&expiry_global[AP_EXPIRY_LIFETIME],
+      __ATOMIC_RELAXED);
 }
 
 void
@@ -662,3 +2467,94 @@ asyncproxy_setdebug(int new_level)
 
     dbg_level = new_level;
 }
+
+void
+asyncproxy_setinstrument(int enable)
+{
+
+    use_instrument = enable;
+}
+
+void
+asyncproxy_setdnscache(unsigned int ttl_ms, unsigned int size)
+{
+
+    asp_resolve_setcache(ttl_ms, size);
+}
+
+void
+asyncproxy_getdnsstats(struct asp_resolve_stats *res)
+{
+
+    asp_resolve_getstats(res);
+}
+
+/*
+ * Process-wide cap on the data held by all relays, readers are paused once
+ * it's exceeded and resumed once the total is down to low (3/4 of the
+ * budget if 0).
+ */
+void
+asyncproxy_setmembudget(uint64_t budget, uint64_t low)
+{
+
+    asp_mem_setbudget(budget, low);
+}
+
+void
+asyncproxy_getmemstats_global(struct asp_mem_stats *res)
+{
+
+    asp_mem_getstats_global(res);
+}
+
+void
+asyncproxy_setsplice(int enable)
+{
+
+    use_splice = enable;
+}
+
+/*
+ * Proxies created from now on hold their relay buffers only while there is
+ * data in them, taking them from the shared pool, and are started on threads
+ * with a stack of stacksize bytes. The pool keeps up to maxcached bytes of
+ * the buffers given back for reuse. Zeroes pick the defaults.
+ */
+void
+asyncproxy_setcompact(int enable, size_t stacksize, uint64_t maxcached)
+{
+
+    if (stacksize == 0)
+        stacksize = ASP_STACK_COMPACT;
+#if defined(PTHREAD_STACK_MIN)
+    if (stacksize < (size_t)PTHREAD_STACK_MIN)
+        stacksize = (size_t)PTHREAD_STACK_MIN;
+#endif
+    if (maxcached == 0)
+        maxcached = ASP_SLAB_CACHE_DEFAULT;
+    compact_stacksize = stacksize;
+    asp_slab_setcache(enable ? maxcached : 0);
+    use_compact = enable;
+}
+
+void
+asyncproxy_getpoolstats(struct asp_slab_stats *res)
+{
+
+    asp_slab_getstats(res);
+}
+
+int
+asyncproxy_engine_start(int nloops)
+{
+
+    return (asp_engine_start(nloops));
+}
+
+int
+asyncproxy_engine_stop(void)
+{
+
+    return (asp_engine_stop());
+}
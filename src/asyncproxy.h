@@ -23,7 +23,33 @@
  * SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
  */
 
+#include <sys/types.h>
+
+#include "asp_iostats.h"
+#include "asp_dgram.h"
+#include "asp_hist.h"
+#include "asp_mem.h"
+#include "asp_resolve.h"
+#include "asp_shaper.h"
+#include "asp_slab.h"
+#include "asp_sockopt.h"
+#include "asyncproxy_transform.h"
+
 enum ap_dest {AP_DEST_HOST = 0, AP_DEST_FD};
+enum ap_dir {AP_DIR_I2O = 0, AP_DIR_O2I};
+
+/* Grow relay buffers for bulk transfers and shrink them back when done */
+#define AP_FLAG_BUF_ADAPTIVE 0x1
+/*
+ * Don't block in the ctor resolving the destination unless it's cached,
+ * do it in the relay thread instead
+ */
+#define AP_FLAG_RESOLVE_ASYNC 0x2
+/*
+ * Relay datagrams keeping their boundaries: the sink is a SOCK_DGRAM socket
+ * and bufsize is the largest datagram relayed
+ */
+#define AP_FLAG_DGRAM 0x4
 
 struct asyncproxy_ctor_args {
     int fd;
@@ -37,20 +63,103 @@ struct asyncproxy_ctor_args {
         };
         int out_fd;
     };
+    size_t bufsize;
+    unsigned int flags;
+    /* Connect deadline in ms, 0 - none */
+    unsigned int connect_timeout;
+    /*
+     * AP_FLAG_DGRAM: give each client its own session with the destination,
+     * closed after that many ms of inactivity, 0 - no sessions
+     */
+    unsigned int dgram_idle;
+    /* Applied to both the source and the sink */
+    struct asp_sockopts sockopts;
+};
+
+/* Address the relay has connected to and how long it took */
+struct asyncproxy_conninfo {
+    char addr[46];
+    unsigned short port;
+    int af;
+    int nattempts;
+    uint64_t connect_ns;
+};
+
+struct asyncproxy_stats {
+    struct asp_iostats_bi source;
+    struct asp_iostats_bi sink;
+};
+
+/* Why a relay was ended by its timeouts, see asyncproxy_set_timeouts() */
+enum ap_expiry {AP_EXPIRY_NONE = 0, AP_EXPIRY_IDLE, AP_EXPIRY_IDLE_I2O,
+  AP_EXPIRY_IDLE_O2I, AP_EXPIRY_LIFETIME, AP_EXPIRY_MAX};
+
+/* Number of relays ended for each of the reasons */
+struct asyncproxy_expiry_stats {
+    uint64_t idle;
+    uint64_t idle_i2o;
+    uint64_t idle_o2i;
+    uint64_t lifetime;
 };
 
-struct transform_res {
-    void *buf;
-    size_t len;
+/* Indexed by direction: 0 is in->out (source->sink), 1 is out->in */
+struct asyncproxy_hists {
+    struct asp_hist flush[2];
+    struct asp_hist transform[2];
 };
 
 void * asyncproxy_ctor(const struct asyncproxy_ctor_args *);
 int asyncproxy_start(void *);
 int asyncproxy_isalive(void *);
+int asyncproxy_ctor_batch(const struct asyncproxy_ctor_args *, int,
+  void (* const *)(struct transform_res *), int, void **, int *);
+int asyncproxy_start_batch(void **, int, int *);
+int asyncproxy_isalive_batch(void **, int, int *);
+void asyncproxy_getstats_batch(void **, int, struct asyncproxy_stats *);
 void asyncproxy_set_i2o(void *, void (*)(struct transform_res *));
 void asyncproxy_set_o2i(void *, void (*)(struct transform_res *));
+void asyncproxy_set_view_cb(void *, enum ap_dir, ssize_t (*)(void *, size_t, size_t));
+void asyncproxy_set_view_hook(void *, enum ap_dir,
+  ssize_t (*)(void *, void *, size_t, size_t), void *);
+int asyncproxy_set_transform(void *, enum ap_dir, const char *, const char *);
+int asyncproxy_describe_transform(void *, enum ap_dir, char *, size_t);
+int asyncproxy_transform_load(const char *);
+int asyncproxy_set_ratelimit(void *, enum ap_dir, uint64_t, uint64_t);
+int asyncproxy_set_shaper(void *, enum ap_dir, void *);
+void asyncproxy_getshapestats(void *, struct asp_shaper_stats *);
+void * asyncproxy_shaper_ctor(uint64_t, uint64_t);
+void asyncproxy_shaper_set(void *, uint64_t, uint64_t);
+void asyncproxy_shaper_dtor(void *);
+int asyncproxy_set_watermarks(void *, uint64_t, uint64_t);
+void asyncproxy_getmemstats(void *, struct asp_mem_stats *);
+void asyncproxy_getdgramstats(void *, struct asp_dgram_stats *);
+int asyncproxy_set_tap(void *, void *, uint64_t, unsigned int, uint64_t);
+void * asyncproxy_tap_ctor(const char *, unsigned int, unsigned int);
+uint64_t asyncproxy_tap_count(void *);
+void asyncproxy_tap_dtor(void *);
+void asyncproxy_set_stats_cb(void *, void (*)(const struct asyncproxy_stats *), unsigned int);
+void asyncproxy_getstats(void *, struct asyncproxy_stats *);
+int asyncproxy_gethists(void *, struct asyncproxy_hists *);
+void asyncproxy_gethists_global(struct asyncproxy_hists *);
 void asyncproxy_join(void *, int);
+int asyncproxy_getdonefd(void *);
 void asyncproxy_dtor(void *);
 const char * asyncproxy_describe(void *);
 const char * asyncproxy_getsockname(void *, unsigned short *);
+int asyncproxy_getconninfo(void *, struct asyncproxy_conninfo *);
+int asyncproxy_getsockopts(void *, int, struct asp_sockopts *);
+int asyncproxy_set_timeouts(void *, unsigned int, unsigned int, unsigned int,
+  unsigned int);
+enum ap_expiry asyncproxy_getexpiry(void *);
+void asyncproxy_getexpirystats_global(struct asyncproxy_expiry_stats *);
 void asyncproxy_setdebug(int);
+void asyncproxy_setsplice(int);
+void asyncproxy_setcompact(int, size_t, uint64_t);
+void asyncproxy_getpoolstats(struct asp_slab_stats *);
+void asyncproxy_setdnscache(unsigned int, unsigned int);
+void asyncproxy_getdnsstats(struct asp_resolve_stats *);
+void asyncproxy_setmembudget(uint64_t, uint64_t);
+void asyncproxy_getmemstats_global(struct asp_mem_stats *);
+void asyncproxy_setinstrument(int);
+int asyncproxy_engine_start(int);
+int asyncproxy_engine_stop(void);
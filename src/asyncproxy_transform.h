@@ -0,0 +1,74 @@
+/*
+ * Copyright (c) 2026 Sippy Software, Inc. All rights reserved.
+ *
+ * Redistribution and use in source and binary forms, with or without modification,
+ * are permitted provided that the following conditions are met:
+ *
+ * 1. Redistributions of source code must retain the above copyright notice, this
+ * list of conditions and the following disclaimer.
+ *
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ * this list of conditions and the following disclaimer in the documentation and/or
+ * other materials provided with the distribution.
+ *
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ * ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+ * WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+ * DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+ * ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+ * (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+ * LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ * ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+ * (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+ * SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+ */
+
+#pragma once
+
+#include <stddef.h>
+
+/*
+ * Native transform plugin ABI.
+ *
+ * A plugin is a shared object exporting a NULL-terminated array of
+ * transform descriptors under the ASYNCPROXY_TRANSFORM_SYM name:
+ *
+ *   const struct asyncproxy_transform *const asyncproxy_transforms[] = {
+ *       &my_transform,
+ *       NULL
+ *   };
+ *
+ * Once loaded with asyncproxy_transform_load() the transforms can be attached
+ * to a proxy by name with asyncproxy_set_transform(). Each attachment gets
+ * its own state, created by the init() hook with the (optional) argument
+ * string passed by the caller and released by the free() hook when the proxy
+ * is destroyed.
+ *
+ * The apply() hook is called by the relay for each chunk of data received,
+ * without holding the Python GIL or any of the proxy locks. It can modify
+ * the data in place, make it shorter (or empty, to drop it) by adjusting
+ * len, or point buf to some other memory owned by the transform state. The
+ * resulting chunk must never be longer than the original one.
+ *
+ * The optional describe() hook formats the current state into a
+ * NUL-terminated string, it may be called from any thread at any time while
+ * the relay is running, so it should only read data that is safe to access
+ * concurrently.
+ */
+#define ASYNCPROXY_TRANSFORM_ABI 1
+#define ASYNCPROXY_TRANSFORM_SYM "asyncproxy_transforms"
+
+struct transform_res {
+    void *buf;
+    size_t len;
+};
+
+struct asyncproxy_transform {
+    unsigned int abi;
+    const char *name;
+    /* Returns 0 on success and stores per-attachment state into *statep */
+    int (*init)(void **statep, const char *args);
+    void (*apply)(void *state, struct transform_res *);
+    void (*free)(void *state);
+    int (*describe)(void *state, char *buf, size_t len);
+};
@@ -0,0 +1,92 @@
+import asyncio
+import select
+import socket
+import unittest
+from threading import Thread
+from asyncproxy.AsyncProxy import AsyncProxy2FD
+from asyncproxy.AsyncTCPProxy import AsyncTCPProxy
+
+def echo_server():
+    srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    srv.bind(('127.0.0.1', 0))
+    srv.listen(16)
+    def serve(conn):
+        with conn:
+            while (data := conn.recv(4096)):
+                conn.sendall(data)
+    def run():
+        while True:
+            try:
+                conn, _ = srv.accept()
+            except OSError:
+                return
+            Thread(target = serve, args = (conn,), daemon = True).start()
+    Thread(target = run, daemon = True).start()
+    return srv
+
+class AsyncProxyAsyncioTest(unittest.TestCase):
+    def test_wait_closed(self):
+        client, proxy_in = socket.socketpair()
+        proxy_out, server = socket.socketpair()
+        proxy = AsyncProxy2FD(proxy_in.fileno(), proxy_out.fileno())
+        proxy.start()
+        donefd = proxy.getdonefd()
+        self.assertEqual(select.select([donefd], [], [], 0.1)[0], [])
+        async def run():
+            loop = asyncio.get_running_loop()
+            await loop.sock_sendall(client, b'hello')
+            self.assertEqual(await loop.sock_recv(server, 1024), b'hello')
+            client.close()
+            await asyncio.wait_for(proxy.wait_closed(), 5)
+        client.setblocking(False)
+        server.setblocking(False)
+        asyncio.run(run())
+        self.assertFalse(proxy.isAlive())
+        # Stays readable once signalled
+        self.assertEqual(select.select([donefd], [], [], 0)[0], [donefd])
+        for s in (proxy_in, proxy_out, server): s.close()
+
+    def test_getdonefd_after_join(self):
+        a, b = socket.socketpair()
+        proxy = AsyncProxy2FD(a.fileno(), b.fileno())
+        proxy.start()
+        proxy.join(shutdown=True)
+        fd = proxy.getdonefd()
+        self.assertEqual(select.select([fd], [], [], 0)[0], [fd])
+        a.close(); b.close()
+
+    def test_AsyncTCPProxy(self):
+        srv = echo_server()
+        async def client(port, i):
+            r, w = await asyncio.open_connection('127.0.0.1', port)
+            w.write(b'z' * i)
+            self.assertEqual(await r.readexactly(i), b'z' * i)
+            w.close()
+            await w.wait_closed()
+        async def run():
+            async with AsyncTCPProxy(0, '127.0.0.1', srv.getsockname()[1]) as proxy:
+                await asyncio.gather(*(client(proxy.port, i) for i in range(1, 11)))
+                # Let the forwarders get reaped as they are done
+                for i in range(100):
+                    if len(proxy.forwarders) == 0:
+                        break
+                    await asyncio.sleep(0.01)
+                self.assertEqual(len(proxy.forwarders), 0)
+                # Connection still open at the shutdown time
+                r, w = await asyncio.open_connection('127.0.0.1', proxy.port)
+                w.write(b'x')
+                self.assertEqual(await r.readexactly(1), b'x')
+            self.assertEqual(len(proxy.forwarders), 0)
+            w.close()
+            return proxy.stats()
+        st = asyncio.run(run())
+        self.assertEqual(st.source_in.btotal, 56)
+        self.assertEqual(st.sink_out.btotal, 56)
+        self.assertEqual(st.source_out.btotal, 56)
+        srv.close()
+
+def runme():
+    unittest.main(module = __name__)
+
+if __name__ == '__main__':
+    runme()
@@ -0,0 +1,75 @@
+import socket
+import unittest
+from time import monotonic
+from asyncproxy.AsyncProxy import AsyncProxy
+
+def listener(af, host):
+    srv = socket.socket(af, socket.SOCK_STREAM)
+    srv.bind((host, 0))
+    srv.listen(0)
+    return srv
+
+class AsyncProxyConnectTest(unittest.TestCase):
+    def relay(self, host, port, af, **kwa):
+        client, proxy_in = socket.socketpair()
+        proxy = AsyncProxy(proxy_in.fileno(), host, port, af, None, **kwa)
+        proxy.start()
+        return proxy, (client, proxy_in)
+
+    def connect(self, srv, host, af, **kwa):
+        proxy, socks = self.relay(host, srv.getsockname()[1], af, **kwa)
+        conn, _ = srv.accept()
+        socks[0].sendall(b'hello')
+        self.assertEqual(conn.recv(1024), b'hello')
+        ci = proxy.getconninfo()
+        proxy.join(shutdown=True)
+        for s in (conn, *socks): s.close()
+        return ci
+
+    def test_connect(self):
+        srv = listener(socket.AF_INET, '127.0.0.1')
+        port = srv.getsockname()[1]
+        for kwa in ({}, {'connect_timeout': 5.0}):
+            ci = self.connect(srv, '127.0.0.1', socket.AF_INET, **kwa)
+            self.assertEqual(ci[:4], ('127.0.0.1', port, socket.AF_INET, 1))
+            self.assertGreater(ci.time, 0)
+        srv.close()
+
+    @unittest.skipIf(not socket.has_ipv6, "requires IPv6")
+    def test_unspec(self):
+        # The relay starts off with an IPv4 socket, which has to be replaced
+        try:
+            srv = listener(socket.AF_INET6, '::1')
+        except OSError:
+            self.skipTest("no IPv6 loopback")
+        port = srv.getsockname()[1]
+        ci = self.connect(srv, '::1', socket.AF_UNSPEC)
+        self.assertEqual(ci[:4], ('::1', port, socket.AF_INET6, 1))
+        srv.close()
+
+    def test_timeout(self):
+        # Fill the accept queue up, so that any further SYNs are dropped
+        srv = listener(socket.AF_INET, '127.0.0.1')
+        filler = socket.create_connection(srv.getsockname())
+        stime = monotonic()
+        proxy, socks = self.relay('127.0.0.1', srv.getsockname()[1],
+                                  socket.AF_INET, connect_timeout = 0.3)
+        proxy.join(shutdown=False)
+        self.assertLess(monotonic() - stime, 3.0)
+        self.assertGreaterEqual(monotonic() - stime, 0.3)
+        self.assertEqual(proxy.describe(), b'QUIT')
+        self.assertIsNone(proxy.getconninfo())
+        self.assertEqual(socks[0].recv(1024), b'')
+        # Forced join interrupts the connect in progress
+        proxy, socks2 = self.relay('127.0.0.1', srv.getsockname()[1],
+                                   socket.AF_INET, connect_timeout = 30.0)
+        stime = monotonic()
+        proxy.join(shutdown=True)
+        self.assertLess(monotonic() - stime, 3.0)
+        for s in (filler, srv, *socks, *socks2): s.close()
+
+def runme():
+    unittest.main(module = __name__)
+
+if __name__ == '__main__':
+    runme()
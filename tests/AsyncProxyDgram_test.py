@@ -0,0 +1,107 @@
+import socket
+import unittest
+from threading import Thread
+from ctypes import string_at, memmove
+from asyncproxy.AsyncProxy import AsyncDgramProxy, AsyncDgramProxy2FD
+from asyncproxy.UDPProxy import UDPProxy
+from asyncproxy.IOStats import IOStats
+
+from testutil import wait_for
+
+class UpperDgramProxy(AsyncDgramProxy2FD):
+    def in2out(self, res_p):
+        tr = res_p.contents
+        memmove(tr.buf, string_at(tr.buf, tr.len).upper(), tr.len)
+
+    @staticmethod
+    def out2in_view(view, length):
+        # Drops datagrams starting with "x"
+        return 0 if view[:1] == b'x' else None
+
+def udp_echo_server():
+    srv = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    srv.bind(('127.0.0.1', 0))
+    def run():
+        while True:
+            try:
+                data, addr = srv.recvfrom(65536)
+            except OSError:
+                return
+            srv.sendto(data, addr)
+    Thread(target = run, daemon = True).start()
+    return srv
+
+class AsyncProxyDgramTest(unittest.TestCase):
+    def test_boundaries(self):
+        client, proxy_in = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        proxy_out, server = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        proxy = UpperDgramProxy(proxy_in.fileno(), proxy_out.fileno(), bufsize = 1000)
+        proxy.start()
+        msgs = [b'a' * n for n in (1, 10, 999, 1000, 7)]
+        for m in msgs:
+            client.send(m)
+        for m in msgs:
+            self.assertEqual(server.recv(2048), m.upper())
+        # Too big to relay
+        client.send(b'b' * 1001)
+        client.send(b'c')
+        self.assertEqual(server.recv(2048), b'C')
+        for m in (b'xyz', b'pong'):
+            server.send(m)
+        self.assertEqual(client.recv(2048), b'pong')
+        proxy.join(shutdown=True)
+        st = proxy.getstats()
+        self.assertEqual(st.source_in, IOStats(7, 3018))
+        self.assertEqual(st.sink_out, IOStats(6, 2018))
+        self.assertEqual(st.sink_in, IOStats(2, 7))
+        self.assertEqual(st.source_out, IOStats(1, 4))
+        self.assertEqual(proxy.getdgramstats().dropped, 2)
+        for s in (client, proxy_in, proxy_out, server): s.close()
+
+    def test_connected(self):
+        srv = udp_echo_server()
+        client, proxy_in = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        proxy = AsyncDgramProxy(proxy_in.fileno(), '127.0.0.1', srv.getsockname()[1],
+                                socket.AF_INET, None)
+        proxy.start()
+        for i in range(10):
+            client.send(b'%d' % i)
+            self.assertEqual(client.recv(1024), b'%d' % i)
+        self.assertEqual(proxy.getconninfo().port, srv.getsockname()[1])
+        proxy.join(shutdown=True)
+        self.assertFalse(proxy.isAlive())
+        self.assertEqual(proxy.getdgramstats().sessions_total, 0)
+        for s in (client, proxy_in, srv): s.close()
+
+    def test_UDPProxy(self):
+        srv = udp_echo_server()
+        proxy = UDPProxy(0, '127.0.0.1', srv.getsockname()[1], session_idle = 0.2)
+        proxy.start()
+        clients = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for i in range(5)]
+        for c in clients:
+            c.settimeout(5)
+            c.connect(('127.0.0.1', proxy.port))
+        for n in range(3):
+            for i, c in enumerate(clients):
+                c.send(b'client %d/%d' % (i, n))
+            for i, c in enumerate(clients):
+                self.assertEqual(c.recv(1024), b'client %d/%d' % (i, n))
+        st = proxy.dgram_stats()
+        self.assertEqual((st.sessions, st.sessions_total), (5, 5))
+        self.assertTrue(wait_for(lambda: proxy.dgram_stats().sessions == 0))
+        self.assertEqual(proxy.dgram_stats().expired, 5)
+        # Sessions come back on new traffic
+        clients[0].send(b'again')
+        self.assertEqual(clients[0].recv(1024), b'again')
+        self.assertEqual(proxy.dgram_stats().sessions_total, 6)
+        self.assertEqual(proxy.stats().source_in.nops, 16)
+        proxy.shutdown()
+        self.assertFalse(proxy.isAlive())
+        self.assertEqual(proxy.dgram_stats().sessions, 0)
+        for s in clients + [srv]: s.close()
+
+def runme():
+    unittest.main(module = __name__)
+
+if __name__ == '__main__':
+    runme()
@@ -0,0 +1,68 @@
+import socket
+import sys
+import unittest
+from ctypes import string_at, memmove
+from asyncproxy.AsyncProxy import AsyncProxy2FD, engine_start, engine_stop
+
+class UpperProxy(AsyncProxy2FD):
+    def in2out(self, res_p):
+        tr = res_p.contents
+        memmove(tr.buf, string_at(tr.buf, tr.len).upper(), tr.len)
+
+@unittest.skipIf(not sys.platform.startswith('linux'), "engine requires epoll")
+class AsyncProxyEngineTest(unittest.TestCase):
+    nproxies = 64
+
+    def setUp(self):
+        engine_start(4)
+
+    def tearDown(self):
+        engine_stop()
+
+    def test_AsyncProxyEngine(self):
+        relays = []
+        for i in range(self.nproxies):
+            client, proxy_in = socket.socketpair()
+            proxy_out, server = socket.socketpair()
+            pclass = UpperProxy if (i % 2) else AsyncProxy2FD
+            proxy = pclass(proxy_in.fileno(), proxy_out.fileno())
+            proxy.start()
+            self.assertTrue(proxy.isAlive())
+            relays.append((proxy, (client, proxy_in, proxy_out, server)))
+
+        for i, (proxy, (client, _, _, server)) in enumerate(relays):
+            msg = b'hello %d' % i
+            client.sendall(msg)
+            expect = msg.upper() if (i % 2) else msg
+            self.assertEqual(expect, server.recv(1024))
+            server.sendall(msg)
+            self.assertEqual(msg, client.recv(1024))
+
+        # Peer going away terminates the relay on its own
+        proxy, socks = relays.pop()
+        socks[0].close()
+        proxy.join(shutdown=False)
+        self.assertFalse(proxy.isAlive())
+        self.assertEqual(proxy.describe(), b'QUIT')
+
+        for s in socks: s.close()
+        for proxy, socks in relays:
+            proxy.join(shutdown=True)
+            self.assertFalse(proxy.isAlive())
+            for s in socks: s.close()
+        del proxy
+        relays = None
+
+        # Not pollable, falls back to a dedicated thread
+        args = (open('/dev/null', 'r+'), open('/dev/null', 'r+'))
+        a = AsyncProxy2FD(*(x.fileno() for x in args))
+        a.start()
+        a.join(shutdown=False)
+        del a
+        for s in args: s.close()
+
+def runme():
+    unittest.main(module = __name__)
+
+if __name__ == '__main__':
+    runme()
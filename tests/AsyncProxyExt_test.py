@@ -0,0 +1,104 @@
+import errno
+import os
+import socket
+import sys
+import unittest
+from os.path import abspath, dirname
+from subprocess import run
+from asyncproxy import AsyncProxy
+from asyncproxy.AsyncProxy import AsyncProxy2FD, AsyncProxyError, AP_DIR_I2O, \
+  transform_load
+
+class AsyncProxyExtTest(unittest.TestCase):
+    def test_binding(self):
+        if os.environ.get('LAP_NO_EXT'):
+            self.assertIsNone(AsyncProxy._ext)
+        else:
+            self.assertIsNotNone(AsyncProxy._ext)
+            self.assertIs(AsyncProxyError, AsyncProxy._ext.Error)
+
+    def test_errno(self):
+        with self.assertRaises(AsyncProxyError) as cm:
+            AsyncProxy2FD(-1, -1)
+        self.assertIsInstance(cm.exception, OSError)
+        self.assertEqual(cm.exception.errno, errno.EBADF)
+        client, proxy_in = socket.socketpair()
+        proxy_out, server = socket.socketpair()
+        proxy = AsyncProxy2FD(proxy_in.fileno(), proxy_out.fileno())
+        with self.assertRaises(AsyncProxyError) as cm:
+            proxy.set_transform(AP_DIR_I2O, 'nonexistent')
+        self.assertEqual(cm.exception.errno, errno.ENOENT)
+        proxy.start()
+        with self.assertRaises(AsyncProxyError) as cm:
+            proxy.set_transform(AP_DIR_I2O, 'count')
+        self.assertEqual(cm.exception.errno, errno.EBUSY)
+        client.sendall(b'ping')
+        self.assertEqual(server.recv(1024), b'ping')
+        proxy.join(shutdown=True)
+        self.assertFalse(proxy.isAlive())
+        self.assertEqual(proxy.describe(), b'QUIT')
+        self.assertEqual(proxy.getstats().sink_out.btotal, 4)
+        for s in (client, proxy_in, proxy_out, server): s.close()
+        with self.assertRaises(AsyncProxyError) as cm:
+            transform_load('/nonexistent.so')
+        self.assertEqual(cm.exception.errno, errno.ENOENT)
+
+    @unittest.skipIf(not sys.platform.startswith('linux'), "engine requires epoll")
+    def test_engine_hooks(self):
+        # Starts wait on the loop thread, which is busy running the Python
+        # hook of another proxy. Run apart, so that a deadlock can't hang
+        # the suite.
+        script = """if True:
+            import socket
+            from threading import Thread, Event
+            from asyncproxy.AsyncProxy import AsyncProxy2FD, engine_start, engine_stop
+            class Hooked(AsyncProxy2FD):
+                def in2out(self, res_p):
+                    pass
+            engine_start(1)
+            client, proxy_in = socket.socketpair()
+            proxy_out, server = socket.socketpair()
+            hooked = Hooked(proxy_in.fileno(), proxy_out.fileno())
+            hooked.start()
+            done = Event()
+            def traffic():
+                while not done.is_set():
+                    client.sendall(b'x' * 1024)
+                    server.recv(65536)
+            t = Thread(target = traffic)
+            t.start()
+            socks, proxies = [], []
+            for i in range(200):
+                s = socket.socketpair() + socket.socketpair()
+                p = AsyncProxy2FD(s[1].fileno(), s[2].fileno())
+                p.start()
+                socks.append(s)
+                proxies.append(p)
+            done.set()
+            t.join()
+            for p in proxies + [hooked]:
+                p.join(shutdown=True)
+            engine_stop()
+        """
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(p for p in sys.path if p)
+        r = run([sys.executable, '-c', script], env = env, capture_output = True,
+                text = True, timeout = 60)
+        self.assertEqual(r.returncode, 0, r.stderr)
+
+    @unittest.skipIf(os.environ.get('LAP_NO_EXT'), "already on ctypes")
+    def test_fallback(self):
+        # Same tests over the ctypes binding
+        env = dict(os.environ, LAP_NO_EXT = '1')
+        env['PYTHONPATH'] = os.pathsep.join([dirname(abspath(__file__))] +
+                                            [p for p in sys.path if p])
+        r = run([sys.executable, '-m', 'unittest', 'AsyncProxyExt_test',
+                 'AsyncProxy2FD_test', 'AsyncProxyTransform_test'], env = env,
+                capture_output = True, text = True, timeout = 60)
+        self.assertEqual(r.returncode, 0, r.stderr)
+
+def runme():
+    unittest.main(module = __name__)
+
+if __name__ == '__main__':
+    runme()
@@ -0,0 +1,91 @@
+import errno
+import socket
+import unittest
+from ctypes import string_at, memmove
+from unittest.mock import patch
+from asyncproxy import AsyncProxy
+from asyncproxy.AsyncProxy import ProxyGroup, AsyncProxyError
+
+class UpperGroup(ProxyGroup):
+    def in2out(self, res_p):
+        tr = res_p.contents
+        memmove(tr.buf, string_at(tr.buf, tr.len).upper(), tr.len)
+
+class AsyncProxyGroupTest(unittest.TestCase):
+    def mksocks(self, n):
+        socks = [socket.socketpair() + socket.socketpair() for i in range(n)]
+        pairs = [(s[1].fileno(), s[2].fileno()) for s in socks]
+        return socks, pairs
+
+    def relay(self, socks, alive):
+        for i, (client, _, _, server) in enumerate(socks):
+            if not alive[i]:
+                continue
+            client.sendall(b'hello %d' % i)
+            self.assertEqual(server.recv(1024).lower(), b'hello %d' % i)
+            server.sendall(b'bye %d' % i)
+            self.assertEqual(client.recv(1024), b'bye %d' % i)
+
+    def test_group(self):
+        socks, pairs = self.mksocks(50)
+        pairs[7] = (-1, pairs[7][1])
+        group = ProxyGroup(pairs)
+        self.assertEqual(len(group), 50)
+        alive = [i != 7 for i in range(50)]
+        self.assertIsInstance(group.errors[7], AsyncProxyError)
+        self.assertEqual(group.errors[7].errno, errno.EBADF)
+        self.assertEqual(group.errors.count(None), 49)
+        self.assertEqual(group.isalive(), alive)
+        self.relay(socks, alive)
+        stats = group.getstats()
+        self.assertIsNone(stats[7])
+        self.assertEqual(stats[3].source_in.btotal, 7)
+        self.assertEqual(stats[12].sink_in.btotal, 6)
+        group.join(shutdown=True)
+        self.assertEqual(group.isalive(), [False] * 50)
+        del group
+        for s in socks:
+            for x in s: x.close()
+
+    def test_hooks(self):
+        socks, pairs = self.mksocks(10)
+        group = UpperGroup(pairs, start = False)
+        self.assertEqual(group.isalive(), [False] * 10)
+        group.start()
+        self.assertEqual(group.errors, [None] * 10)
+        self.assertEqual(group.isalive(), [True] * 10)
+        # Running ones are left alone
+        group.start()
+        self.assertEqual(group.errors, [None] * 10)
+        self.relay(socks, [True] * 10)
+        client, _, _, server = socks[0]
+        client.sendall(b'abc')
+        self.assertEqual(server.recv(1024), b'ABC')
+        group.join(shutdown=True)
+        for s in socks:
+            for x in s: x.close()
+
+    def test_hooks_batch(self):
+        # Created, hooked and started by the one call into the library
+        socks, pairs = self.mksocks(10)
+        fail = AssertionError('per-relay call made')
+        with patch.object(AsyncProxy._asp, 'asyncproxy_set_i2o', side_effect = fail), \
+          patch.object(AsyncProxy._asp, 'asyncproxy_set_o2i', side_effect = fail), \
+          patch.object(AsyncProxy._asp, 'asyncproxy_start_batch', side_effect = fail):
+            group = UpperGroup(pairs)
+        self.assertEqual(group.errors, [None] * 10)
+        self.assertEqual(group.isalive(), [True] * 10)
+        for client, _, _, server in socks:
+            client.sendall(b'abc')
+            self.assertEqual(server.recv(1024), b'ABC')
+            server.sendall(b'xyz')
+            self.assertEqual(client.recv(1024), b'xyz')
+        group.join(shutdown=True)
+        for s in socks:
+            for x in s: x.close()
+
+def runme():
+    unittest.main(module = __name__)
+
+if __name__ == '__main__':
+    runme()
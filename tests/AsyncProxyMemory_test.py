@@ -0,0 +1,163 @@
+import os
+import socket
+import sys
+import unittest
+from tempfile import TemporaryDirectory
+from threading import Thread
+from asyncproxy.AsyncProxy import AsyncProxy, AsyncProxy2FD, setsplice, \
+  setmembudget, getmemstats_global, engine_start, engine_stop, setcompact, \
+  getpoolstats
+
+from testutil import recvall, wait_for
+
+class Relay(object):
+    # Server side is not read from until drain(), so that the data piles up
+    def __init__(self, size, **kwa):
+        self.client, self.proxy_in = socket.socketpair()
+        self.proxy_out, self.server = socket.socketpair()
+        self.proxy = AsyncProxy2FD(self.proxy_in.fileno(), self.proxy_out.fileno(), **kwa)
+        self.payload = os.urandom(size)
+        self.proxy.start()
+        self.sender = Thread(target = self.client.sendall, args = (self.payload,))
+        self.sender.start()
+
+    def drain(self):
+        received = recvall(self.server, len(self.payload))
+        self.sender.join()
+        return received == self.payload
+
+    def close(self):
+        self.proxy.join(shutdown=True)
+        for s in (self.client, self.proxy_in, self.proxy_out, self.server): s.close()
+
+class AsyncProxyMemoryTest(unittest.TestCase):
+    size = 4 * 1024 * 1024
+
+    def setUp(self):
+        setsplice(False)
+
+    def tearDown(self):
+        setmembudget(0)
+        setsplice(True)
+
+    def test_watermarks(self):
+        r = Relay(self.size, bufsize = 1024 * 1024)
+        r.proxy.set_watermarks(64 * 1024, 16 * 1024)
+        self.assertTrue(wait_for(lambda: r.proxy.getmemstats().wm_pauses > 0))
+        st = r.proxy.getmemstats()
+        self.assertGreater(st.buffered, 0)
+        self.assertLessEqual(st.buffered, 64 * 1024)
+        self.assertEqual(st.allocated, 2 * 1024 * 1024)
+        self.assertEqual(st.budget_pauses, 0)
+        self.assertTrue(r.drain())
+        self.assertGreater(r.proxy.getmemstats().wm_pauses, 1)
+        with self.assertRaises(Exception):
+            r.proxy.set_watermarks(1024, 2048)
+        r.close()
+        st = r.proxy.getmemstats()
+        self.assertEqual((st.buffered, st.allocated), (0, 0))
+
+    def budget(self):
+        budget, bufsize, nrelays = 256 * 1024, 128 * 1024, 4
+        before = getmemstats_global()
+        setmembudget(budget)
+        relays = [Relay(self.size // nrelays, bufsize = bufsize) for i in range(nrelays)]
+        self.assertTrue(wait_for(lambda: getmemstats_global().budget_pauses > before.budget_pauses))
+        # Each relay may have had a read in flight when the budget ran out
+        self.assertLessEqual(getmemstats_global().buffered - before.buffered,
+                             budget + nrelays * bufsize)
+        # Drained all at once, stalled ones hold the others over the budget
+        res = []
+        readers = [Thread(target = lambda r: res.append(r.drain()), args = (r,)) for r in relays]
+        for t in readers: t.start()
+        for t in readers: t.join()
+        self.assertEqual(res, [True] * nrelays)
+        for r in relays: r.close()
+        after = getmemstats_global()
+        self.assertEqual(after.buffered, before.buffered)
+        self.assertEqual(after.allocated, before.allocated)
+
+    def test_budget(self):
+        self.budget()
+
+    @unittest.skipIf(not sys.platform.startswith('linux'), "engine requires epoll")
+    def test_budget_engine(self):
+        engine_start(2)
+        try:
+            self.budget()
+        finally:
+            engine_stop()
+
+class AsyncProxyCompactTest(unittest.TestCase):
+    def setUp(self):
+        setsplice(False)
+        setcompact(True)
+
+    def tearDown(self):
+        setcompact(False)
+        setsplice(True)
+
+    def compact(self):
+        r = Relay(4 * 1024 * 1024, bufsize = 16 * 1024)
+        self.assertTrue(r.drain())
+        # Nothing held once it's all through
+        self.assertTrue(wait_for(lambda: r.proxy.getmemstats().allocated == 0))
+        before = getpoolstats()
+        r.client.sendall(b'ping')
+        self.assertEqual(r.server.recv(1024), b'ping')
+        self.assertTrue(wait_for(lambda: r.proxy.getmemstats().allocated == 0))
+        self.assertGreater(getpoolstats().hits, before.hits)
+        r.close()
+
+    def test_compact(self):
+        self.compact()
+
+    @unittest.skipIf(not sys.platform.startswith('linux'), "engine requires epoll")
+    def test_compact_engine(self):
+        engine_start(2)
+        try:
+            self.compact()
+        finally:
+            engine_stop()
+
+    def test_idle(self):
+        relays = [Relay(0) for i in range(16)]
+        for r in relays:
+            self.assertEqual(r.proxy.getmemstats().allocated, 0)
+        for r in relays: r.close()
+        setcompact(False)
+        r = Relay(0, bufsize = 16 * 1024)
+        self.assertTrue(wait_for(lambda: r.proxy.getmemstats().allocated == 32 * 1024))
+        r.close()
+
+    def test_dest(self):
+        # Addresses are not kept around, make sure they still work
+        with TemporaryDirectory() as tdir:
+            path = os.path.join(tdir, 'sock')
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(path)
+            server.listen(1)
+            client, proxy_in = socket.socketpair()
+            proxy = AsyncProxy(proxy_in.fileno(), path, 0, socket.AF_UNIX, None)
+            proxy.start()
+            conn, _ = server.accept()
+            client.sendall(b'ping')
+            self.assertEqual(conn.recv(1024), b'ping')
+            self.assertEqual(proxy.getsockname()[0], 'AF_UNIX')
+            proxy.join(shutdown=True)
+            for s in (client, proxy_in, server, conn): s.close()
+        server = socket.create_server(('127.0.0.1', 0))
+        client, proxy_in = socket.socketpair()
+        proxy = AsyncProxy(proxy_in.fileno(), '127.0.0.1', server.getsockname()[1],
+                           socket.AF_INET, None)
+        proxy.start()
+        conn, peer = server.accept()
+        self.assertEqual(proxy.getsockname(), peer)
+        proxy.join(shutdown=True)
+        for s in (client, proxy_in, server, conn): s.close()
+
+def runme():
+    unittest.main(module = __name__)
+
+if __name__ == '__main__':
+    runme()
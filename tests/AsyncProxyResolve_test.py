@@ -0,0 +1,92 @@
+import socket
+import unittest
+from threading import Thread
+from time import sleep
+from asyncproxy.AsyncProxy import AsyncProxy, setdnscache, getdnsstats
+
+def echo_server():
+    srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    srv.bind(('127.0.0.1', 0))
+    srv.listen(16)
+    def run():
+        while True:
+            try:
+                conn, _ = srv.accept()
+            except OSError:
+                return
+            with conn:
+                while (data := conn.recv(4096)):
+                    conn.sendall(data)
+    Thread(target = run, daemon = True).start()
+    return srv
+
+class AsyncProxyResolveTest(unittest.TestCase):
+    def setUp(self):
+        self.srv = echo_server()
+        self.port = self.srv.getsockname()[1]
+
+    def tearDown(self):
+        self.srv.close()
+        setdnscache(30, 128)
+
+    def delta(self, before):
+        return tuple(a - b for a, b in zip(getdnsstats(), before))
+
+    def relay(self, host, **kwa):
+        client, proxy_in = socket.socketpair()
+        proxy = AsyncProxy(proxy_in.fileno(), host, self.port, socket.AF_INET, None, **kwa)
+        proxy.start()
+        client.sendall(b'ping')
+        self.assertEqual(client.recv(1024), b'ping')
+        proxy.join(shutdown=True)
+        client.close(); proxy_in.close()
+
+    def test_cache(self):
+        setdnscache(30, 16)
+        before = getdnsstats()
+        self.relay('localhost')
+        self.relay('localhost')
+        self.assertEqual(self.delta(before), (1, 1, 0))
+        # Bounded size, LRU entry is evicted
+        setdnscache(30, 0)
+        setdnscache(30, 1)
+        before = getdnsstats()
+        for host in ('localhost', '127.0.0.1', 'localhost'):
+            self.relay(host)
+        self.assertEqual(self.delta(before), (0, 3, 0))
+        # TTL
+        setdnscache(0.05, 0)
+        setdnscache(0.05, 16)
+        before = getdnsstats()
+        self.relay('localhost')
+        sleep(0.1)
+        self.relay('localhost')
+        self.assertEqual(self.delta(before), (0, 2, 0))
+
+    def test_async(self):
+        setdnscache(30, 16)
+        before = getdnsstats()
+        self.relay('localhost', resolve_async = True)
+        self.relay('localhost', resolve_async = True)
+        self.assertEqual(self.delta(before), (1, 1, 0))
+
+        # Failure is reported by the ctor in the sync mode and terminates
+        # the relay in the async one
+        before = getdnsstats()
+        self.assertRaises(Exception, AsyncProxy, 0, 'nonexistent.invalid',
+                          self.port, socket.AF_INET, None)
+        client, proxy_in = socket.socketpair()
+        proxy = AsyncProxy(proxy_in.fileno(), 'nonexistent.invalid', self.port,
+                           socket.AF_INET, None, resolve_async = True)
+        proxy.start()
+        proxy.join(shutdown=False)
+        self.assertEqual(proxy.describe(), b'QUIT')
+        self.assertEqual(client.recv(1024), b'')
+        self.assertEqual(self.delta(before), (0, 2, 2))
+        client.close(); proxy_in.close()
+
+def runme():
+    unittest.main(module = __name__)
+
+if __name__ == '__main__':
+    runme()
@@ -0,0 +1,123 @@
+import os
+import socket
+import sys
+import unittest
+from threading import Thread
+from time import monotonic
+from asyncproxy.AsyncProxy import AsyncProxy2FD, Shaper, AP_DIR_I2O, AP_DIR_O2I, \
+  engine_start, engine_stop
+
+from testutil import recvall
+
+class LimitedProxy(AsyncProxy2FD):
+    in2out_rate = (1024 * 1024, 64 * 1024)
+
+class Relay(object):
+    def __init__(self, pclass = AsyncProxy2FD, **kwa):
+        self.client, self.proxy_in = socket.socketpair()
+        self.proxy_out, self.server = socket.socketpair()
+        self.proxy = pclass(self.proxy_in.fileno(), self.proxy_out.fileno(), **kwa)
+
+    def transfer(self, size):
+        payload = os.urandom(size)
+        sender = Thread(target = self.client.sendall, args = (payload,))
+        sender.start()
+        received = recvall(self.server, size)
+        sender.join()
+        return payload == received
+
+    def close(self):
+        self.proxy.join(shutdown=True)
+        for s in (self.client, self.proxy_in, self.proxy_out, self.server): s.close()
+
+class AsyncProxyShapingTest(unittest.TestCase):
+    size = 320 * 1024
+
+    def test_ratelimit(self):
+        r = Relay(LimitedProxy)
+        r.proxy.start()
+        stime = monotonic()
+        self.assertTrue(r.transfer(self.size))
+        # 64KB burst, the rest at 1MB/s
+        self.assertGreater(monotonic() - stime, 0.2)
+        r.server.sendall(b'pong')
+        self.assertEqual(b'pong', recvall(r.client, 4))
+        i2o, o2i = r.proxy.getshapestats()
+        self.assertGreater(i2o.nthrottled, 0)
+        self.assertGreater(i2o.throttled, 0.1)
+        self.assertEqual(o2i.nthrottled, 0)
+        r.close()
+
+    def test_group(self):
+        shaper = Shaper(1024 * 1024, 64 * 1024)
+        relays = [Relay() for i in range(2)]
+        for r in relays:
+            r.proxy.set_shaper(AP_DIR_I2O, shaper)
+            r.proxy.start()
+        del shaper
+        stime = monotonic()
+        senders = [Thread(target = r.transfer, args = (self.size // 2,)) for r in relays]
+        for t in senders: t.start()
+        for t in senders: t.join()
+        # Both draw from the same bucket
+        self.assertGreater(monotonic() - stime, 0.2)
+        for r in relays:
+            self.assertGreater(r.proxy.getshapestats()[0].nthrottled, 0)
+            r.close()
+
+    def test_runtime_change(self):
+        r = Relay()
+        r.proxy.set_ratelimit(AP_DIR_I2O, 16 * 1024, 16 * 1024)
+        r.proxy.start()
+        res = []
+        sender = Thread(target = lambda: res.append(r.transfer(self.size)))
+        sender.start()
+        sender.join(0.3)
+        self.assertTrue(sender.is_alive())
+        stime = monotonic()
+        r.proxy.set_ratelimit(AP_DIR_I2O, 0)
+        sender.join()
+        self.assertEqual(res, [True])
+        self.assertLess(monotonic() - stime, 1.0)
+        r.close()
+
+    @unittest.skipIf(not sys.platform.startswith('linux'), "engine requires epoll")
+    def test_engine(self):
+        nthreads = lambda: len(os.listdir('/proc/self/task'))
+        engine_start(2)
+        try:
+            # Shaped relays run on the shared loops too, resumed on their tick
+            r = Relay(LimitedProxy)
+            n = nthreads()
+            r.proxy.start()
+            self.assertEqual(nthreads(), n)
+            stime = monotonic()
+            self.assertTrue(r.transfer(self.size))
+            self.assertGreater(monotonic() - stime, 0.2)
+            self.assertGreater(r.proxy.getshapestats()[0].nthrottled, 0)
+            r.proxy.set_ratelimit(AP_DIR_I2O, 0)
+            r.close()
+            # And the limits can be changed while there
+            r = Relay()
+            r.proxy.start()
+            self.assertTrue(r.transfer(1024))
+            r.proxy.set_ratelimit(AP_DIR_I2O, 16 * 1024, 16 * 1024)
+            res = []
+            sender = Thread(target = lambda: res.append(r.transfer(self.size)))
+            sender.start()
+            sender.join(0.3)
+            self.assertTrue(sender.is_alive())
+            r.proxy.set_ratelimit(AP_DIR_I2O, 0)
+            sender.join()
+            self.assertEqual(res, [True])
+            with self.assertRaises(Exception):
+                r.proxy.set_ratelimit(2, 1024 * 1024)
+            r.close()
+        finally:
+            engine_stop()
+
+def runme():
+    unittest.main(module = __name__)
+
+if __name__ == '__main__':
+    runme()
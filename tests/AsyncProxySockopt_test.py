@@ -0,0 +1,102 @@
+import socket
+import unittest
+from asyncproxy.AsyncProxy import AsyncProxy, AsyncProxy2FD, ProxyGroup, \
+  SockOpts, SOCKOPT_PROFILES
+from asyncproxy.Forwarder import Forwarder
+
+def tcppair():
+    lsock = socket.create_server(('127.0.0.1', 0))
+    a = socket.create_connection(lsock.getsockname())
+    b, _ = lsock.accept()
+    lsock.close()
+    return a, b
+
+class AsyncProxySockoptTest(unittest.TestCase):
+    def tcp_relay(self, sockopts):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        client, proxy_in = tcppair()
+        proxy = AsyncProxy(proxy_in.fileno(), '127.0.0.1', server.getsockname()[1],
+                           socket.AF_INET, None, sockopts = sockopts)
+        proxy.start()
+        conn, _ = server.accept()
+        client.sendall(b'ping')
+        self.assertEqual(conn.recv(1024), b'ping')
+        return proxy, (client, proxy_in, server, conn)
+
+    def test_profiles(self):
+        proxy, socks = self.tcp_relay('low-latency')
+        for so in proxy.getsockopts():
+            self.assertTrue(so.nodelay)
+            self.assertTrue(so.keepalive)
+        # Not touched on the far ends
+        self.assertEqual(socks[0].getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY), 0)
+        proxy.join(shutdown=True)
+        for s in socks: s.close()
+        proxy, socks = self.tcp_relay('bulk')
+        # Whatever the kernel caps it to
+        ref = socket.socket()
+        ref.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKOPT_PROFILES['bulk'].sndbuf)
+        want = ref.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+        ref.close()
+        for so in proxy.getsockopts():
+            self.assertFalse(so.nodelay)
+            self.assertEqual(so.sndbuf, want)
+        proxy.join(shutdown=True)
+        for s in socks: s.close()
+        proxy, socks = self.tcp_relay({'tos': 0x10, 'sndbuf': 65536})
+        so_in, so_out = proxy.getsockopts()
+        self.assertEqual((so_in.tos, so_out.tos), (0x10, 0x10))
+        proxy.join(shutdown=True)
+        for s in socks: s.close()
+
+    def test_non_tcp(self):
+        client, proxy_in = socket.socketpair()
+        proxy_out, server = socket.socketpair()
+        proxy = AsyncProxy2FD(proxy_in.fileno(), proxy_out.fileno(),
+                              sockopts = SockOpts(nodelay = True, sndbuf = 65536))
+        for so in proxy.getsockopts():
+            self.assertIsNone(so.nodelay)
+            self.assertIsNone(so.tos)
+            self.assertGreaterEqual(so.sndbuf, 65536)
+        del proxy
+        with self.assertRaises(ValueError):
+            AsyncProxy2FD(proxy_in.fileno(), proxy_out.fileno(), sockopts = 'fastest')
+        group = ProxyGroup([(proxy_in.fileno(), proxy_out.fileno())], start = False,
+                           sockopts = {'rcvbuf': 65536})
+        self.assertEqual(group.errors, [None])
+        self.assertGreaterEqual(proxy_in.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF), 65536)
+        del group
+        for s in (client, proxy_in, proxy_out, server): s.close()
+
+    def test_forwarder(self):
+        # Pure Python forwarder applies the same options
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        client, proxy_in = tcppair()
+        fwd = Forwarder(proxy_in, (server.getsockname(), socket.AF_INET),
+                        sockopts = 'low-latency')
+        fwd.start()
+        conn, _ = server.accept()
+        client.sendall(b'ping')
+        self.assertEqual(conn.recv(1024), b'ping')
+        for s in (fwd.source, fwd.sink):
+            self.assertNotEqual(s.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY), 0)
+        # Set again after the reads, on the TCP legs only
+        self.assertEqual(fwd.quickack, [True, True])
+        a, b = socket.socketpair()
+        self.assertFalse(SOCKOPT_PROFILES['low-latency'].rearm(a))
+        a.close()
+        b.close()
+        client.close()
+        conn.close()
+        fwd.join()
+        server.close()
+
+def runme():
+    unittest.main(module = __name__)
+
+if __name__ == '__main__':
+    runme()
@@ -0,0 +1,75 @@
+import os
+import socket
+import unittest
+from threading import Thread
+from ctypes import string_at, memmove
+from asyncproxy.AsyncProxy import AsyncProxy2FD, setsplice
+
+from testutil import recvall
+
+class SwapCaseProxy(AsyncProxy2FD):
+    def in2out(self, res_p):
+        tr = res_p.contents
+        memmove(tr.buf, string_at(tr.buf, tr.len).swapcase(), tr.len)
+
+class AsyncProxySpliceTest(unittest.TestCase):
+    size = 4 * 1024 * 1024
+
+    def relay(self, pclass, expect, **kwa):
+        client, proxy_in = socket.socketpair()
+        proxy_out, server = socket.socketpair()
+        proxy = pclass(proxy_in.fileno(), proxy_out.fileno(), **kwa)
+        proxy.start()
+        payload = os.urandom(self.size)
+        sender = Thread(target = client.sendall, args = (payload,))
+        sender.start()
+        received = recvall(server, self.size)
+        sender.join()
+        self.assertEqual(expect(payload), received)
+        server.sendall(b'pong')
+        self.assertEqual(b'pong', recvall(client, 4))
+        proxy.join(shutdown=True)
+        for s in (client, proxy_in, proxy_out, server): s.close()
+
+    def test_splice(self):
+        for enable in (True, False):
+            setsplice(enable)
+            self.relay(AsyncProxy2FD, lambda x: x)
+        setsplice(True)
+
+    def test_transform_fallback(self):
+        self.relay(SwapCaseProxy, lambda x: x.swapcase())
+
+    def test_bufsize(self):
+        setsplice(False)
+        # Odd sizes to make sure the ring buffer wraps around
+        for bufsize in (1000, 4099, 100000):
+            for buf_adaptive in (False, True):
+                self.relay(AsyncProxy2FD, lambda x: x, bufsize = bufsize,
+                           buf_adaptive = buf_adaptive)
+                self.relay(SwapCaseProxy, lambda x: x.swapcase(),
+                           bufsize = bufsize, buf_adaptive = buf_adaptive)
+        setsplice(True)
+
+    def test_pipes(self):
+        rin, win = os.pipe()
+        rout, wout = os.pipe()
+        proxy = AsyncProxy2FD(rin, wout)
+        proxy.start()
+        payload = os.urandom(256 * 1024)
+        sender = Thread(target = os.write, args = (win, payload))
+        sender.start()
+        received = b''
+        while len(received) < len(payload):
+            received += os.read(rout, len(payload) - len(received))
+        sender.join()
+        self.assertEqual(payload, received)
+        os.close(win)
+        proxy.join(shutdown=False)
+        for fd in (rin, rout, wout): os.close(fd)
+
+def runme():
+    unittest.main(module = __name__)
+
+if __name__ == '__main__':
+    runme()
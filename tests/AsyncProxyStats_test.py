@@ -0,0 +1,107 @@
+import socket
+import unittest
+from threading import Thread
+from ctypes import string_at, memmove
+from asyncproxy.AsyncProxy import AsyncProxy2FD, setsplice, setinstrument, \
+  gethists_global
+from asyncproxy.TCPProxy import TCPProxy
+from asyncproxy.IOStats import IOStats, ProxyStats
+
+class StatsProxy(AsyncProxy2FD):
+    stats_interval = 0.0
+
+    def on_stats(self, st):
+        self.last_stats = st
+
+class UpperProxy(AsyncProxy2FD):
+    def in2out(self, res_p):
+        tr = res_p.contents
+        memmove(tr.buf, string_at(tr.buf, tr.len).upper(), tr.len)
+
+def echo_server():
+    srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    srv.bind(('127.0.0.1', 0))
+    srv.listen(16)
+    def run():
+        while True:
+            try:
+                conn, _ = srv.accept()
+            except OSError:
+                return
+            with conn:
+                while (data := conn.recv(4096)):
+                    conn.sendall(data)
+    Thread(target = run, daemon = True).start()
+    return srv
+
+class AsyncProxyStatsTest(unittest.TestCase):
+    def test_getstats(self):
+        for enable in (True, False):
+            setsplice(enable)
+            client, proxy_in = socket.socketpair()
+            proxy_out, server = socket.socketpair()
+            proxy = StatsProxy(proxy_in.fileno(), proxy_out.fileno())
+            proxy.start()
+            client.sendall(b'x' * 100)
+            self.assertEqual(server.recv(1024), b'x' * 100)
+            server.sendall(b'y' * 10)
+            self.assertEqual(client.recv(1024), b'y' * 10)
+            proxy.join(shutdown=True)
+            st = proxy.getstats()
+            self.assertEqual(st, ProxyStats(IOStats(1, 100), IOStats(1, 10),
+                                            IOStats(1, 10), IOStats(1, 100)))
+            self.assertEqual(st, proxy.last_stats)
+            for s in (client, proxy_in, proxy_out, server): s.close()
+        setsplice(True)
+
+    def test_hists(self):
+        setinstrument(True)
+        before = gethists_global()
+        for pclass in (UpperProxy, AsyncProxy2FD):
+            client, proxy_in = socket.socketpair()
+            proxy_out, server = socket.socketpair()
+            proxy = pclass(proxy_in.fileno(), proxy_out.fileno())
+            proxy.start()
+            for i in range(5):
+                client.sendall(b'x' * 10)
+                self.assertEqual(server.recv(1024), b'X' * 10 if pclass is UpperProxy else b'x' * 10)
+            server.sendall(b'y')
+            self.assertEqual(client.recv(1024), b'y')
+            proxy.join(shutdown=True)
+            h = proxy.gethists()
+            self.assertEqual(h.in2out_flush.count, 5)
+            self.assertEqual(h.out2in_flush.count, 1)
+            self.assertEqual(h.in2out_transform.count, 5 if pclass is UpperProxy else 0)
+            self.assertEqual(h.out2in_transform.count, 0)
+            self.assertEqual(sum(h.in2out_flush.buckets), 5)
+            self.assertGreater(h.in2out_flush.percentile(99), 0)
+            for s in (client, proxy_in, proxy_out, server): s.close()
+        after = gethists_global()
+        self.assertEqual(after.in2out_flush.count - before.in2out_flush.count, 10)
+        self.assertEqual(after.in2out_transform.count - before.in2out_transform.count, 5)
+        setinstrument(False)
+        a, b = socket.socketpair()
+        self.assertIsNone(AsyncProxy2FD(a.fileno(), b.fileno()).gethists())
+        a.close(); b.close()
+
+    def test_TCPProxy_stats(self):
+        srv = echo_server()
+        proxy = TCPProxy(0, '127.0.0.1', srv.getsockname()[1])
+        proxy.start()
+        for i in range(1, 4):
+            with socket.create_connection(('127.0.0.1', proxy.port)) as s:
+                s.sendall(b'z' * i)
+                self.assertEqual(s.recv(1024), b'z' * i)
+        st = proxy.stats()
+        self.assertEqual(st.source_in.btotal, 6)
+        self.assertEqual(st.sink_out.btotal, 6)
+        self.assertEqual(st.sink_in.btotal, 6)
+        proxy.shutdown()
+        self.assertEqual(proxy.stats().source_out.btotal, 6)
+        srv.close()
+
+def runme():
+    unittest.main(module = __name__)
+
+if __name__ == '__main__':
+    runme()
@@ -0,0 +1,107 @@
+import io
+import os
+import socket
+import struct
+import tempfile
+import unittest
+from ctypes import string_at, memmove
+from asyncproxy.AsyncProxy import AsyncProxy2FD, AsyncDgramProxy2FD, Tap, \
+  AP_DIR_I2O, AP_DIR_O2I
+from asyncproxy.TapReader import TapReader
+
+class UpperProxy(AsyncProxy2FD):
+    def in2out(self, res_p):
+        tr = res_p.contents
+        memmove(tr.buf, string_at(tr.buf, tr.len).upper(), tr.len)
+
+class AsyncProxyTapTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix = '.tap')
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def relay(self, proxy, a, b, msgs):
+        proxy.start()
+        for m in msgs:
+            a.send(m)
+            self.assertEqual(b.recv(4096).lower(), m.lower())
+            b.send(m[::-1])
+            self.assertEqual(a.recv(4096), m[::-1])
+        proxy.join(shutdown=True)
+
+    def test_tap(self):
+        tap = Tap(self.path, nslots = 64, snaplen = 8)
+        msgs = [b'hello', b'0123456789abcdef', b'x']
+        ids = []
+        for pclass, stype in ((AsyncProxy2FD, socket.SOCK_STREAM),
+                              (UpperProxy, socket.SOCK_STREAM),
+                              (AsyncDgramProxy2FD, socket.SOCK_DGRAM)):
+            client, proxy_in = socket.socketpair(socket.AF_UNIX, stype)
+            proxy_out, server = socket.socketpair(socket.AF_UNIX, stype)
+            proxy = pclass(proxy_in.fileno(), proxy_out.fileno())
+            proxy.set_tap(tap)
+            ids.append(proxy.tap_id)
+            self.relay(proxy, client, server, msgs)
+            for s in (client, proxy_in, proxy_out, server): s.close()
+        self.assertEqual(len(set(ids)), 3)
+        self.assertEqual(tap.count(), 18)
+        rd = TapReader(self.path)
+        self.assertEqual(rd.lost(), 0)
+        recs = rd.records()
+        self.assertEqual([r.seq for r in recs], list(range(18)))
+        for n, pid in enumerate(ids):
+            mine = recs[n * 6:(n + 1) * 6]
+            self.assertTrue(all(r.id == pid for r in mine))
+            for m, (r1, r2) in zip(msgs, zip(mine[::2], mine[1::2])):
+                self.assertEqual(r1.dir, AP_DIR_I2O)
+                self.assertEqual(r1.data, (m.upper() if n == 1 else m)[:8])
+                self.assertEqual(r1.origlen, len(m))
+                self.assertEqual(r2.dir, AP_DIR_O2I)
+                self.assertEqual(r2.data, m[::-1][:8])
+        self.assertTrue(all(a.time <= b.time for a, b in zip(recs, recs[1:])))
+
+        f = io.BytesIO()
+        self.assertEqual(rd.write_pcapng(f), 18)
+        buf, off, types = f.getvalue(), 0, []
+        while off < len(buf):
+            btype, blen = struct.unpack_from('=II', buf, off)
+            types.append(btype)
+            off += blen
+        self.assertEqual(off, len(buf))
+        self.assertEqual(types, [0x0A0D0D0A] + [1] * 3 + [6] * 18)
+
+    def test_limits(self):
+        tap = Tap(self.path, nslots = 4, snaplen = 64)
+        client, proxy_in = socket.socketpair()
+        proxy_out, server = socket.socketpair()
+        proxy = AsyncProxy2FD(proxy_in.fileno(), proxy_out.fileno())
+        proxy.set_tap(tap, tap_id = 42, sample = 2)
+        self.relay(proxy, client, server, [b'%02d' % i for i in range(10)])
+        # Every other chunk, the ring only holds the last 4 of them
+        self.assertEqual(tap.count(), 10)
+        rd = TapReader(self.path)
+        self.assertEqual(rd.lost(), 6)
+        recs = rd.records()
+        self.assertEqual([r.seq for r in recs], [6, 7, 8, 9])
+        self.assertEqual([r.data for r in recs], [b'06', b'07', b'08', b'09'])
+        self.assertTrue(all(r.id == 42 and r.dir == AP_DIR_I2O for r in recs))
+        for s in (client, proxy_in, proxy_out, server): s.close()
+
+        client, proxy_in = socket.socketpair()
+        proxy_out, server = socket.socketpair()
+        proxy = AsyncProxy2FD(proxy_in.fileno(), proxy_out.fileno())
+        proxy.set_tap(tap, maxbytes = 5)
+        self.relay(proxy, client, server, [b'abc'] * 4)
+        self.assertEqual(tap.count(), 12)
+        # Too late once started
+        with self.assertRaises(Exception):
+            proxy.set_tap(None)
+        for s in (client, proxy_in, proxy_out, server): s.close()
+
+def runme():
+    unittest.main(module = __name__)
+
+if __name__ == '__main__':
+    runme()
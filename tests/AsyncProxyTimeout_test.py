@@ -0,0 +1,112 @@
+import socket
+import sys
+import unittest
+from time import monotonic, sleep
+from asyncproxy.AsyncProxy import AsyncProxy2FD, AsyncDgramProxy2FD, Timeouts, \
+  engine_start, engine_stop, getexpirystats_global
+from asyncproxy.TCPProxy import TCPProxy
+from asyncproxy.ForwarderFast import ForwarderFast
+from asyncproxy.Forwarder import Forwarder
+
+from TCPProxy_test import echo_server
+from testutil import wait_for
+
+def mkrelay(pclass = AsyncProxy2FD, stype = socket.SOCK_STREAM, **kwa):
+    client, proxy_in = socket.socketpair(type = stype)
+    proxy_out, server = socket.socketpair(type = stype)
+    proxy = pclass(proxy_in.fileno(), proxy_out.fileno(), **kwa)
+    proxy.start()
+    return proxy, (client, proxy_in, proxy_out, server)
+
+class AsyncProxyTimeoutTest(unittest.TestCase):
+    def check_idle(self, n):
+        before = getexpirystats_global()
+        relays = [mkrelay(timeouts = 0.2) for i in range(n)]
+        stime = monotonic()
+        # Traffic keeps it going
+        for i in range(5):
+            for proxy, (client, _, _, server) in relays:
+                client.sendall(b'ping')
+                self.assertEqual(server.recv(1024), b'ping')
+            sleep(0.1)
+        self.assertTrue(all(p.isAlive() for p, _ in relays))
+        for proxy, socks in relays:
+            proxy.join(shutdown=False)
+            self.assertEqual(proxy.getexpiry(), 'idle')
+            self.assertEqual(proxy.describe(), b'QUIT (idle timeout)')
+            for s in socks: s.close()
+        self.assertLess(monotonic() - stime, 2.0)
+        after = getexpirystats_global()
+        self.assertEqual(after.idle - before.idle, n)
+
+    def test_idle(self):
+        self.check_idle(4)
+
+    @unittest.skipIf(not sys.platform.startswith('linux'), "engine requires epoll")
+    def test_idle_engine(self):
+        engine_start(2)
+        try:
+            self.check_idle(64)
+        finally:
+            engine_stop()
+
+    def test_direction(self):
+        # Only the replies keep coming
+        proxy, socks = mkrelay(timeouts = {'in2out_idle': 0.3})
+        server = socks[3]
+        for i in range(20):
+            server.sendall(b'pong')
+            if not proxy.isAlive():
+                break
+            sleep(0.05)
+        proxy.join(shutdown=False)
+        self.assertEqual(proxy.getexpiry(), 'in2out_idle')
+        self.assertEqual(proxy.describe(), b'QUIT (in2out idle timeout)')
+        for s in socks: s.close()
+        # None of them run out
+        proxy, socks = mkrelay(timeouts = Timeouts(idle = 5, lifetime = 10))
+        proxy.join(shutdown=True)
+        self.assertIsNone(proxy.getexpiry())
+        self.assertEqual(proxy.describe(), b'QUIT')
+        for s in socks: s.close()
+
+    def test_lifetime(self):
+        proxy, socks = mkrelay(timeouts = {'lifetime': 0.3, 'idle': 10})
+        for i in range(20):
+            if not proxy.isAlive():
+                break
+            socks[0].sendall(b'ping')
+            sleep(0.05)
+        proxy.join(shutdown=False)
+        self.assertEqual(proxy.getexpiry(), 'lifetime')
+        for s in socks: s.close()
+        # Datagram relays too
+        proxy, socks = mkrelay(AsyncDgramProxy2FD, socket.SOCK_DGRAM, timeouts = 0.2)
+        socks[0].send(b'ping')
+        self.assertEqual(socks[3].recv(1024), b'ping')
+        proxy.join(shutdown=False)
+        self.assertEqual(proxy.getexpiry(), 'idle')
+        for s in socks: s.close()
+
+    def test_tcpproxy(self):
+        srv = echo_server()
+        for fclass in (ForwarderFast, Forwarder):
+            proxy = TCPProxy(0, '127.0.0.1', srv.getsockname()[1])
+            proxy.forwarder_class = fclass
+            proxy.timeouts = 0.2
+            proxy.start()
+            s = socket.create_connection(('127.0.0.1', proxy.port))
+            s.sendall(b'x')
+            self.assertEqual(s.recv(1), b'x')
+            # Ended by the proxy, not the client
+            self.assertEqual(s.recv(1), b'')
+            self.assertTrue(wait_for(lambda: proxy.expiry_stats().idle == 1))
+            proxy.shutdown()
+            s.close()
+        srv.close()
+
+def runme():
+    unittest.main(module = __name__)
+
+if __name__ == '__main__':
+    runme()
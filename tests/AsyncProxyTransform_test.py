@@ -0,0 +1,158 @@
+import contextlib
+import io
+import os
+import socket
+import unittest
+from shutil import which
+from subprocess import check_call
+from tempfile import TemporaryDirectory
+from time import sleep
+from ctypes import string_at, memmove
+from asyncproxy.AsyncProxy import AsyncProxy2FD, AP_DIR_I2O, AP_DIR_O2I, \
+  transform_load
+
+SRCDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+PLUGIN_SRC = r'''
+#include <ctype.h>
+#include "asyncproxy_transform.h"
+
+static void
+upper_apply(void *state, struct transform_res *trp)
+{
+    unsigned char *cp = trp->buf;
+
+    for (size_t i = 0; i < trp->len; i++)
+        cp[i] = toupper(cp[i]);
+}
+
+static const struct asyncproxy_transform upper = {
+    .abi = ASYNCPROXY_TRANSFORM_ABI,
+    .name = "test_upper",
+    .apply = upper_apply,
+};
+
+const struct asyncproxy_transform *const asyncproxy_transforms[] = {
+    &upper,
+    NULL
+};
+'''
+
+def xor(data, key):
+    return bytes(b ^ key[i % len(key)] for i, b in enumerate(data))
+
+class XorProxy(AsyncProxy2FD):
+    in2out_native = ('xor', 'deadbeef')
+    out2in_native = ('xor', '5a')
+
+class CountProxy(AsyncProxy2FD):
+    in2out_native = 'count'
+
+    def in2out(self, res_p):
+        tr = res_p.contents
+        memmove(tr.buf, string_at(tr.buf, tr.len).swapcase(), tr.len)
+
+class ViewProxy(AsyncProxy2FD):
+    def in2out_view(self, view, length):
+        # Grow in place
+        view[length:length * 2] = view[:length]
+        return length * 2
+
+    def out2in_view(self, view, length):
+        if bytes(view[:length]) == b'drop':
+            return 0
+        if bytes(view[:length]) == b'keep':
+            return None
+        if bytes(view[:length]) == b'fail':
+            return length + len(view)
+        return b'<' + bytes(view[:length]) + b'>'
+
+class AsyncProxyTransformTest(unittest.TestCase):
+    def relay(self, proxy, socks, msgs):
+        client, _, _, server = socks
+        proxy.start()
+        for m in msgs:
+            client.sendall(m)
+            yield server.recv(1024)
+            server.sendall(m)
+            yield client.recv(1024)
+        proxy.join(shutdown=True)
+        for s in socks: s.close()
+
+    def mkproxy(self, pclass):
+        client, proxy_in = socket.socketpair()
+        proxy_out, server = socket.socketpair()
+        proxy = pclass(proxy_in.fileno(), proxy_out.fileno())
+        return proxy, (client, proxy_in, proxy_out, server)
+
+    def test_xor(self):
+        proxy, socks = self.mkproxy(XorProxy)
+        msgs = (b'hello', b'world!', b'x' * 7)
+        res = list(self.relay(proxy, socks, msgs))
+        # Key position carries over between the chunks
+        self.assertEqual(b''.join(res[0::2]), xor(b''.join(msgs), b'\xde\xad\xbe\xef'))
+        self.assertEqual(b''.join(res[1::2]), xor(b''.join(msgs), b'\x5a'))
+
+    def test_count(self):
+        proxy, socks = self.mkproxy(CountProxy)
+        self.assertEqual(proxy.describe_transform(AP_DIR_I2O), '0 0')
+        self.assertIsNone(proxy.describe_transform(AP_DIR_O2I))
+        res = list(self.relay(proxy, socks, (b'abc', b'Hello')))
+        # Python hook runs after the native one
+        self.assertEqual(res, [b'ABC', b'abc', b'hELLO', b'Hello'])
+        self.assertEqual(proxy.describe_transform(AP_DIR_I2O), '2 8')
+
+    def test_view(self):
+        proxy, socks = self.mkproxy(ViewProxy)
+        client, _, _, server = socks
+        proxy.start()
+        client.sendall(b'abc')
+        self.assertEqual(server.recv(1024), b'abcabc')
+        server.sendall(b'drop')
+        while proxy.getstats().sink_in.btotal < 4:
+            sleep(0.01)
+        server.sendall(b'keep')
+        self.assertEqual(client.recv(1024), b'keep')
+        with contextlib.redirect_stderr(io.StringIO()) as err:
+            server.sendall(b'fail')
+            self.assertEqual(client.recv(1024), b'fail')
+        self.assertIn('ValueError', err.getvalue())
+        server.sendall(b'xyz')
+        self.assertEqual(client.recv(1024), b'<xyz>')
+        proxy.join(shutdown=True)
+        for s in socks: s.close()
+
+    def test_errors(self):
+        proxy, socks = self.mkproxy(AsyncProxy2FD)
+        self.assertRaises(Exception, proxy.set_transform, AP_DIR_I2O, 'nonexistent')
+        self.assertRaises(Exception, proxy.set_transform, AP_DIR_I2O, 'xor')
+        self.assertRaises(Exception, proxy.set_transform, AP_DIR_I2O, 'xor', 'xyz')
+        proxy.set_transform(AP_DIR_O2I, 'count')
+        proxy.set_transform(AP_DIR_O2I, None)
+        self.assertIsNone(proxy.describe_transform(AP_DIR_O2I))
+        proxy.start()
+        self.assertRaises(Exception, proxy.set_transform, AP_DIR_I2O, 'count')
+        proxy.join(shutdown=True)
+        for s in socks: s.close()
+        self.assertRaises(Exception, transform_load, '/nonexistent.so')
+
+    @unittest.skipIf(which('cc') is None, "requires a C compiler")
+    def test_plugin(self):
+        with TemporaryDirectory() as tdir:
+            src = os.path.join(tdir, 'upper.c')
+            lib = os.path.join(tdir, 'upper.so')
+            with open(src, 'w') as f:
+                f.write(PLUGIN_SRC)
+            check_call(['cc', '-shared', '-fpic', '-I', SRCDIR, '-o', lib, src])
+            self.assertEqual(transform_load(lib), 1)
+            self.assertRaises(Exception, transform_load, lib)
+        proxy, socks = self.mkproxy(AsyncProxy2FD)
+        proxy.set_transform(AP_DIR_I2O, 'test_upper')
+        res = list(self.relay(proxy, socks, (b'abc',)))
+        self.assertEqual(res, [b'ABC', b'abc'])
+
+def runme():
+    unittest.main(module = __name__)
+
+if __name__ == '__main__':
+    runme()
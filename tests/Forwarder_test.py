@@ -0,0 +1,97 @@
+import os
+import socket
+import unittest
+from time import monotonic
+from threading import Thread
+from asyncproxy.Forwarder import Forwarder, ForwarderLoop
+
+from testutil import recvall
+
+class ForwarderTest(unittest.TestCase):
+    size = 4 * 1024 * 1024
+
+    def setUp(self):
+        self.srv, self.front = (socket.create_server(('127.0.0.1', 0)) for i in range(2))
+
+    def tearDown(self):
+        self.srv.close()
+        self.front.close()
+
+    def client(self):
+        client = socket.create_connection(self.front.getsockname())
+        return client, self.front.accept()[0]
+
+    def connect(self, **kwa):
+        client, source = self.client()
+        fwd = Forwarder(source, (self.srv.getsockname(), socket.AF_INET), **kwa)
+        fwd.start()
+        server, _ = self.srv.accept()
+        return fwd, client, server
+
+    def relay(self, **kwa):
+        fwd, client, server = self.connect(**kwa)
+        payload = os.urandom(self.size)
+        sender = Thread(target = client.sendall, args = (payload,))
+        sender.start()
+        self.assertEqual(recvall(server, self.size), payload)
+        sender.join()
+        server.sendall(b'pong')
+        self.assertEqual(recvall(client, 4), b'pong')
+        # Pending data is flushed before the relay goes down
+        server.sendall(b'bye')
+        server.close()
+        self.assertEqual(recvall(client, 4), b'bye')
+        fwd.join()
+        self.assertFalse(fwd.isAlive())
+        st = fwd.getstats()
+        self.assertEqual((st.source_in.btotal, st.sink_out.btotal), (self.size, self.size))
+        self.assertEqual((st.sink_in.btotal, st.source_out.btotal), (7, 7))
+        client.close()
+
+    def test_thread(self):
+        for bufsize in (1000, 64 * 1024):
+            self.relay(bufsize = bufsize)
+
+    def test_loop(self):
+        loop = ForwarderLoop()
+        relays = [self.connect(loop = loop) for i in range(32)]
+        for i, (fwd, client, server) in enumerate(relays):
+            client.sendall(b'hello %d' % i)
+            self.assertEqual(server.recv(1024), b'hello %d' % i)
+        self.relay(loop = loop)
+        for fwd, client, server in relays:
+            fwd.shutdown()
+            fwd.join()
+            self.assertEqual(client.recv(1), b'')
+            client.close(); server.close()
+        loop.stop()
+        self.assertFalse(loop.is_alive())
+
+    def test_connect_timeout(self):
+        # Fill the accept queue up, so that any further SYNs are dropped
+        srv = socket.create_server(('127.0.0.1', 0), backlog = 0)
+        filler = socket.create_connection(srv.getsockname())
+        self.msgs = []
+        for loop in (None, ForwarderLoop()):
+            client, source = self.client()
+            stime = monotonic()
+            fwd = Forwarder(source, (srv.getsockname(), socket.AF_INET), logger = self,
+                            connect_timeout = 0.3, loop = loop)
+            fwd.start()
+            fwd.join()
+            self.assertGreaterEqual(monotonic() - stime, 0.3)
+            self.assertLess(monotonic() - stime, 3.0)
+            self.assertEqual(client.recv(1), b'')
+            self.assertIn('timed out', self.msgs.pop())
+            client.close()
+        loop.stop()
+        for s in (filler, srv): s.close()
+
+    def log(self, msg, flush):
+        self.msgs.append(msg)
+
+def runme():
+    unittest.main(module = __name__)
+
+if __name__ == '__main__':
+    runme()
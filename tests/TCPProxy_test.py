@@ -0,0 +1,203 @@
+import os
+import signal
+import sys
+import socket
+import unittest
+from tempfile import mkdtemp
+from threading import Thread
+from asyncproxy.TCPProxy import TCPProxy
+from asyncproxy.TCPProxyMP import TCPProxyMP
+from asyncproxy.TCPProxyLB import TCPProxyLB, Upstream
+from asyncproxy.ForwarderFast import ForwarderFast
+from asyncproxy.Forwarder import Forwarder
+
+from testutil import recvall, wait_for
+
+def echo_server(path = None):
+    srv = socket.socket(socket.AF_INET if path is None else socket.AF_UNIX, socket.SOCK_STREAM)
+    srv.bind(('127.0.0.1', 0) if path is None else path)
+    srv.listen(128)
+    def serve(conn):
+        with conn:
+            while (data := conn.recv(4096)):
+                conn.sendall(data)
+    def run():
+        while True:
+            try:
+                conn, _ = srv.accept()
+            except OSError:
+                return
+            Thread(target = serve, args = (conn,), daemon = True).start()
+    Thread(target = run, daemon = True).start()
+    return srv
+
+class TCPProxyTest(unittest.TestCase):
+    nconns = 20
+
+    def test_reaping(self):
+        srv = echo_server()
+        for fclass in (ForwarderFast, Forwarder):
+            proxy = TCPProxy(0, '127.0.0.1', srv.getsockname()[1])
+            proxy.forwarder_class = fclass
+            proxy.start()
+            conns = []
+            for i in range(self.nconns):
+                s = socket.create_connection(('127.0.0.1', proxy.port))
+                s.sendall(b'x')
+                self.assertEqual(s.recv(1), b'x')
+                conns.append(s)
+            self.assertEqual(len(proxy.forwarders), self.nconns)
+            # Reaped as they go away, with no new connections coming in
+            for s in conns[1:]: s.close()
+            self.assertTrue(wait_for(lambda: len(proxy.forwarders) == 1))
+            self.assertEqual(proxy.reaped_stats.source_in.btotal, self.nconns - 1)
+            # The remaining one is torn down by the shutdown()
+            proxy.shutdown()
+            self.assertEqual(len(proxy.forwarders), 0)
+            self.assertFalse(proxy.reaper.is_alive())
+            self.assertEqual(proxy.stats().source_in.btotal, self.nconns)
+            conns[0].close()
+        srv.close()
+
+    def test_accept_burst(self):
+        srv = echo_server()
+        proxy = TCPProxy(0, '127.0.0.1', srv.getsockname()[1], backlog = 64)
+        # Burst queued up in the kernel before the accept loop is running
+        conns = [socket.create_connection(('127.0.0.1', proxy.port))
+                 for i in range(self.nconns)]
+        st = proxy.accept_stats()
+        self.assertEqual(st.accepted, 0)
+        if sys.platform.startswith('linux'):
+            self.assertEqual((st.queued, st.backlog), (self.nconns, 64))
+        proxy.start()
+        for s in conns:
+            s.sendall(b'y')
+            self.assertEqual(s.recv(1), b'y')
+        st = proxy.accept_stats()
+        self.assertEqual((st.accepted, st.rejected, st.pending), (self.nconns, 0, 0))
+        if sys.platform.startswith('linux'):
+            self.assertEqual(st.queued, 0)
+        for s in conns: s.close()
+        proxy.shutdown()
+        srv.close()
+
+    def test_access_check(self):
+        srv = echo_server()
+        proxy = TCPProxy(0, '127.0.0.1', srv.getsockname()[1])
+        proxy.allowed_ips = ('192.0.2.1',)
+        proxy.start()
+        with socket.create_connection(('127.0.0.1', proxy.port)) as s:
+            self.assertEqual(s.recv(1), b'')
+        self.assertEqual(proxy.accept_stats().rejected, 1)
+        proxy.shutdown()
+        srv.close()
+
+    def test_TCPProxyMP(self):
+        srv = echo_server()
+        proxy = TCPProxyMP(0, '127.0.0.1', srv.getsockname()[1], nworkers = 2)
+        proxy.stats_interval = 0.05
+        proxy.start()
+        conns = []
+        for i in range(1, self.nconns + 1):
+            s = socket.create_connection(('127.0.0.1', proxy.port))
+            s.sendall(b'm' * i)
+            self.assertEqual(recvall(s, i), b'm' * i)
+            conns.append(s)
+        # Least-connections balancing
+        self.assertEqual(proxy.worker_load(), (self.nconns // 2,) * 2)
+        for s in conns[:-2]: s.close()
+        self.assertTrue(wait_for(lambda: sum(proxy.worker_load()) == 2))
+        total = self.nconns * (self.nconns + 1) // 2
+        self.assertTrue(wait_for(lambda: proxy.stats().sink_in.btotal == total))
+        proxy.shutdown()
+        st = proxy.stats()
+        self.assertEqual((st.source_in.btotal, st.source_out.btotal), (total, total))
+        for s in conns[-2:]:
+            self.assertEqual(s.recv(1), b'')
+            s.close()
+        srv.close()
+
+    def test_TCPProxyMP_respawn(self):
+        srv = echo_server()
+        proxy = TCPProxyMP(0, '127.0.0.1', srv.getsockname()[1], nworkers = 2)
+        proxy.start()
+        pids = [w[1].pid for w in proxy.workers]
+        os.kill(pids[0], signal.SIGKILL)
+        self.assertTrue(wait_for(lambda: proxy.workers[0][1].pid != pids[0]))
+        for i in range(4):
+            with socket.create_connection(('127.0.0.1', proxy.port)) as s:
+                s.sendall(b'ping')
+                self.assertEqual(recvall(s, 4), b'ping')
+        self.assertTrue(wait_for(lambda: sum(proxy.worker_load()) == 0))
+        proxy.shutdown()
+        srv.close()
+
+class TCPProxyLBTest(unittest.TestCase):
+    def echo(self, proxy):
+        with socket.create_connection(('127.0.0.1', proxy.port)) as s:
+            s.sendall(b'x')
+            try:
+                return s.recv(1) == b'x'
+            except ConnectionResetError:
+                return False
+
+    def test_policies(self):
+        srvs = [echo_server() for i in range(3)]
+        addrs = [s.getsockname() for s in srvs]
+        for policy, weights, expect in (('round_robin', (1, 1, 1), (2, 2, 2)),
+                                        ('weighted', (3, 2, 1), (3, 2, 1))):
+            ups = [Upstream(a, w) for a, w in zip(addrs, weights)]
+            proxy = TCPProxyLB(0, ups, policy = policy)
+            proxy.start()
+            for i in range(6):
+                self.assertTrue(self.echo(proxy))
+            self.assertEqual(tuple(u.conns for u in proxy.upstream_stats()), expect)
+            proxy.shutdown()
+        proxy = TCPProxyLB(0, addrs, policy = 'least_conn')
+        proxy.start()
+        conns = [socket.create_connection(('127.0.0.1', proxy.port)) for i in range(3)]
+        for s in conns:
+            s.sendall(b'y')
+            self.assertEqual(s.recv(1), b'y')
+        self.assertEqual(tuple(u.active for u in proxy.upstream_stats()), (1, 1, 1))
+        conns.pop(1).close()
+        self.assertTrue(wait_for(lambda: proxy.upstream_stats()[1].active == 0))
+        self.assertTrue(self.echo(proxy))
+        self.assertEqual(tuple(u.conns for u in proxy.upstream_stats()), (1, 2, 1))
+        for s in conns: s.close()
+        proxy.shutdown()
+        for s in srvs: s.close()
+
+    def test_health(self):
+        tdir = mkdtemp()
+        path = os.path.join(tdir, 'echo.sock')
+        srv = echo_server(path)
+        dead = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        dead.bind(('127.0.0.1', 0))
+        daddr = dead.getsockname()
+        dead.close()
+        for fclass in (ForwarderFast, Forwarder):
+            proxy = TCPProxyLB(0, (path, daddr))
+            proxy.forwarder_class = fclass
+            proxy.max_failures = 1
+            proxy.eject_time = 60.0
+            proxy.start()
+            # Round-robin starts off with the second one
+            self.assertFalse(self.echo(proxy))
+            self.assertTrue(wait_for(lambda: proxy.upstream_stats()[1].ejected))
+            for i in range(4):
+                self.assertTrue(self.echo(proxy))
+            good, bad = proxy.upstream_stats()
+            self.assertEqual((good.conns, good.failures, good.ejected), (4, 0, False))
+            self.assertEqual((bad.conns, bad.failures), (1, 1))
+            self.assertTrue(wait_for(lambda: proxy.upstream_stats()[0].latency is not None))
+            proxy.shutdown()
+        srv.close()
+        os.unlink(path)
+        os.rmdir(tdir)
+
+def runme():
+    unittest.main(module = __name__)
+
+if __name__ == '__main__':
+    runme()
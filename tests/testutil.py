@@ -0,0 +1,20 @@
+from time import monotonic, sleep
+
+def recvall(sock, size):
+    # Reads up to size bytes, less only if the peer is gone
+    res = bytearray()
+    while len(res) < size:
+        data = sock.recv(size - len(res))
+        if not data:
+            break
+        res += data
+    return bytes(res)
+
+def wait_for(cond, timeout = 5.0):
+    # Polls cond() until it holds, False if it has not within the timeout
+    etime = monotonic() + timeout
+    while not cond():
+        if monotonic() > etime:
+            return False
+        sleep(0.01)
+    return True